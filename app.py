@@ -23,7 +23,7 @@ import math
 from flask import (
     Flask, render_template, request, redirect, url_for,
     flash, jsonify, session, send_file, Response,
-    make_response, abort, Blueprint, g
+    make_response, abort, Blueprint, g, has_request_context, stream_with_context
 )
 from flask_login import (
     LoginManager, login_user, logout_user,
@@ -35,7 +35,6 @@ from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from markupsafe import escape, Markup
 from sqlalchemy import event, and_, or_, not_, text
-from apscheduler.schedulers.background import BackgroundScheduler
 
 # ========================
 # NE PAS IMPORTER FLASK-MAIL ICI
@@ -61,7 +60,7 @@ try:
     # Import des modèles spécifiques après db
     from models import (
         User, Direction, Service, Cartographie, Risque, EvaluationRisque,
-        KRI, MesureKRI, Processus, EtapeProcessus, SousEtapeProcessus, LienProcessus,
+        KRI, MesureKRI, EtatKRI, Processus, EtapeProcessus, SousEtapeProcessus, LienProcessus,
         ZoneRisqueProcessus, ControleProcessus, VeilleReglementaire, ActionConformite,
         Audit, Constatation, Recommandation, PlanAction, EtapePlanAction, HistoriqueModification,
         Alerte, ZoneRisqueOrganigramme, PointDecision, LigneOrganisation, TitreOrganisation,
@@ -74,7 +73,8 @@ try:
         Questionnaire, QuestionnaireCategorie, Question, OptionQuestion, ConditionQuestion,
         ReponseQuestionnaire, ReponseQuestion, ReponseOption, CampagneEvaluation,
         AnalyseIA, FichierMetadata, RecommandationGlobale, JournalActiviteClient, EnvironnementClient, Client,
-        FormuleAbonnement, AbonnementClient, FichierRapport
+        FormuleAbonnement, AbonnementClient, FichierRapport, RisqueEvaluationCourante,
+        VerrouTache, ExecutionTache, RapportGenere
     )
     
     MODELS_IMPORTED = True
@@ -105,7 +105,7 @@ from email.header import Header
 from email.utils import formataddr
 
 class EmailService:
-    """Service d'email utilisant SMTP direct sans Flask-Mail"""
+    """Service d'email : les messages passent par la boîte d'envoi (services/emails_sortants.py)"""
     
     def __init__(self):
         self.smtp_server = 'smtp.gmail.com'
@@ -123,68 +123,17 @@ class EmailService:
             print(f"✅ Service email SMTP configuré ({self.sender_email})")
     
     def send_email(self, to_email, subject, body, html_body=None, cc=None, bcc=None):
-        """Envoyer un email via SMTP direct"""
-        
-        # Mode simulation si pas de mot de passe
-        if self.simulation_mode:
-            print(f"📧 [SIMULATION] Email à: {to_email}")
-            print(f"   Sujet: {subject}")
-            print(f"   Contenu: {body[:100]}...")
-            return True
-        
+        """Mettre un email en file (envoi SMTP par services/emails_sortants.py)"""
+        from services.emails_sortants import mettre_en_file
+
         try:
-            # Créer le message
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            msg['From'] = formataddr((str(Header(self.sender_name, 'utf-8')), self.sender_email))
-            
-            # Gérer les destinataires
-            if isinstance(to_email, list):
-                msg['To'] = ', '.join(to_email)
-                recipients = to_email
-            else:
-                msg['To'] = to_email
-                recipients = [to_email]
-            
-            # Ajouter CC si spécifié
-            if cc:
-                if isinstance(cc, list):
-                    msg['Cc'] = ', '.join(cc)
-                    recipients.extend(cc)
-                else:
-                    msg['Cc'] = cc
-                    recipients.append(cc)
-            
-            # Ajouter BCC si spécifié
-            if bcc:
-                if isinstance(bcc, list):
-                    recipients.extend(bcc)
-                else:
-                    recipients.append(bcc)
-            
-            # Partie texte
-            text_part = MIMEText(body, 'plain', 'utf-8')
-            msg.attach(text_part)
-            
-            # Partie HTML si fournie
-            if html_body:
-                html_part = MIMEText(html_body, 'html', 'utf-8')
-                msg.attach(html_part)
-            
-            # Envoyer via SMTP
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.sender_email, self.password)
-                server.send_message(msg, from_addr=self.sender_email, to_addrs=recipients)
-            
-            print(f"✅ Email envoyé à {to_email}")
+            mettre_en_file(to_email, subject, corps_texte=body, corps_html=html_body, cc=cc, bcc=bcc,
+                           categorie='contact')
+            print(f"📧 Email mis en file pour {to_email}")
             return True
-            
         except Exception as e:
-            print(f"❌ Erreur envoi email à {to_email}: {e}")
-            # Fallback en mode simulation
-            print(f"📧 [FALLBACK SIMULATION] Email à: {to_email}")
-            print(f"   Sujet: {subject}")
+            db.session.rollback()
+            print(f"❌ Erreur mise en file email à {to_email}: {e}")
             return False
     
     def send_contact_confirmation(self, nom_complet, email, societe, telephone, sujet, message, reference):
@@ -681,7 +630,6 @@ try:
         declencher_mise_a_jour_risque,
         synchroniser_cartographie_apres_action,
         recalculer_indicateurs_cartographie,
-        generer_matrice_risque_specifique,
         generer_alerte_creation_risque,
         generer_alerte_evaluation_risque,
         notifier_archivage_risque,
@@ -710,7 +658,6 @@ except ImportError as e:
     def declencher_mise_a_jour_risque(*args, **kwargs): print("🔔 Fonction indisponible")
     def synchroniser_cartographie_apres_action(*args, **kwargs): print("🔄 Fonction indisponible")
     def recalculer_indicateurs_cartographie(*args, **kwargs): print("📊 Fonction indisponible")
-    generer_matrice_risque_specifique = None
     def generer_alerte_creation_risque(*args, **kwargs): print("📢 Fonction indisponible")
     def generer_alerte_evaluation_risque(*args, **kwargs): print("📢 Fonction indisponible")
     def notifier_archivage_risque(*args, **kwargs): print("📢 Fonction indisponible")
@@ -1115,6 +1062,12 @@ app.config.update({
     'MAX_CONTENT_LENGTH': 16 * 1024 * 1024  # 16MB
 })
 
+# Journalisation structurée (JSON, file non bloquante, durée par requête)
+import logging
+from services.journalisation import init_journalisation
+init_journalisation(app)
+logger = logging.getLogger(__name__)
+
 # ========================
 # CRÉATION DES DOSSIERS D'UPLOAD
 # ========================
@@ -1172,10 +1125,10 @@ if MODELS_IMPORTED:
         try:
             return db.session.get(User, int(user_id))
         except (ValueError, TypeError) as e:
-            print(f"⚠️ Erreur de conversion user_id: {e}")
+            logger.warning("Erreur de conversion user_id: %s", e)
             return None
         except Exception as e:
-            print(f"⚠️ Erreur lors du chargement utilisateur {user_id}: {e}")
+            logger.warning("Erreur lors du chargement utilisateur %s: %s", user_id, e)
             return None
     
     print("✅ User loader configuré")
@@ -1334,26 +1287,8 @@ try:
         print(f"Mode simulation: {getattr(service_ia, 'mode_simulation', 'N/A')}")
         print(f"Client OpenAI initialisé: {getattr(service_ia, 'client', None) is not None}")
         print(f"Clé API disponible: {'Oui' if os.environ.get('OPENAI_API_KEY') else 'Non'}")
-        
-        # Test du service IA
-        try:
-            test_result = service_ia.analyser_audit(1, 'test', 1)
-            print(f"\n📊 Test analyse audit:")
-            print(f"  Type résultat: {type(test_result)}")
-            
-            if hasattr(test_result, 'to_dict'):
-                result_dict = test_result.to_dict()
-            elif hasattr(test_result, 'resultat'):
-                result_dict = test_result.resultat
-            else:
-                result_dict = test_result
-            
-            print(f"  Recommandations: {len(result_dict.get('recommandations_ia', []))}")
-            print(f"  Causes racines: {len(result_dict.get('causes_racines', []))}")
-            print(f"  Score confiance: {result_dict.get('metadata', {}).get('score_confiance', 'N/A')}")
-            
-        except Exception as e:
-            print(f"❌ Erreur test service IA: {e}")
+        # Plus d'analyse de test au démarrage : les analyses passent par la file
+        # d'attente (services/file_analyse_ia.py), jamais par le processus web
     else:
         print("⚠️ Service IA non disponible")
         service_ia = None
@@ -1737,20 +1672,130 @@ with app.app_context():
     verify_and_fix_database()
     
 # ========================
-# MIDDLEWARE DE FILTRAGE (doit être après les décorateurs)
+# CONTEXTE DE REQUÊTE (middleware unique)
 # ========================
+# Un seul before_request et un seul context_processor : le tenant, la vue du
+# super admin, la formule et les permissions vérifiées sont résolus une fois
+# par requête et conservés sur g.contexte_requete (services/contexte_requete.py).
+
+from services.contexte_requete import obtenir_contexte, paresseux, LIMITES_ENDPOINTS
+from services.permissions_effectives import permissions_effectives_utilisateurs
+
 
 @app.before_request
-def auto_filter_data():
-    """Filtre automatiquement les données par client"""
-    # Ne pas filtrer pour super admin
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        g.client_id = None  # Super admin voit tout
+def preparer_contexte_requete():
+    """Middleware unique : sous-domaine, tenant, permissions et limites de formule"""
+    if request.endpoint == 'static':
         return
     
-    # Pour les autres utilisateurs
-    if current_user.is_authenticated:
-        g.client_id = current_user.client_id
+    # 1. Sous-domaine client (aussi pour les visiteurs non connectés)
+    reponse = detect_client_subdomain()
+    if reponse is not None:
+        return reponse
+    
+    if not current_user.is_authenticated:
+        g.client_id = None
+        g.filter_by_client = False
+        return
+    
+    contexte = obtenir_contexte()
+    
+    # 2. Tenant : super admin sans filtre, autres utilisateurs filtrés par client
+    g.client_id = contexte.client_id
+    g.filter_by_client = contexte.filter_by_client
+    
+    # 3. Maintenance périodique des permissions (compteurs en session)
+    auto_sync_user_permissions()
+    auto_verify_permissions()
+    auto_correct_permissions()
+    ensure_admin_client_permissions()
+    
+    # 4. Client consulté par le super admin (restauré par restore_original_client)
+    if contexte.est_super_admin and contexte.viewing_client_id:
+        g.original_client_id = current_user.client_id
+        current_user.client_id = contexte.viewing_client_id
+    
+    # 5. Permissions requises par l'endpoint (table compilée au démarrage)
+    message = contexte.permission_refusee(request.endpoint)
+    if message:
+        flash(message, 'error')
+        return redirect(url_for('dashboard'))
+    
+    # 6. Limites de la formule sur les créations
+    return check_formule_limits_middleware()
+
+
+@app.context_processor
+def inject_contexte_requete():
+    """Injecte dans tous les templates les utilitaires et le contexte de requête (paresseux)"""
+    valeurs = {
+        'tenant_manager': TenantManager,
+        'has_tenant_access': TenantManager.ensure_client_access,
+        'tenant_filtered_query': tenant_filtered_query,
+        'should_display_module': should_display_module,
+        'get_visible_modules': get_visible_modules,
+        'can_access_route': can_view_filter,
+        'url_exists': url_exists,
+        'get_file_size': get_file_size,
+        'now': datetime.utcnow
+    }
+    if not has_request_context():
+        return valeurs
+    
+    contexte = obtenir_contexte()
+    
+    def formule_limits():
+        formule = contexte.formule
+        if not formule:
+            return {}
+        return {
+            'utilisateurs': formule.max_utilisateurs,
+            'risques': formule.max_risques,
+            'audits': formule.max_audits
+        }
+    
+    def is_module_restricted(module_code):
+        formule = contexte.formule
+        return formule.can_access_module(module_code) if formule else False
+    
+    def has_permission(perm):
+        if not contexte.authentifie:
+            return False
+        return (current_user.permissions or {}).get(perm, False)
+    
+    def notifications_count():
+        if not contexte.authentifie:
+            return 0
+        try:
+            return compteur_non_lues(current_user.id)
+        except Exception:
+            return 0
+    
+    valeurs.update({
+        # Clients et vue du super admin
+        'available_clients': paresseux(lambda: contexte.clients_disponibles),
+        'viewing_client': paresseux(lambda: contexte.viewing_client),
+        'is_viewing_other_client': paresseux(lambda: contexte.viewing_client is not None),
+        'view_mode': contexte.view_mode,
+        'view_text': paresseux(lambda: contexte.affichage_vue[0]),
+        'view_icon': paresseux(lambda: contexte.affichage_vue[1]),
+        'view_class': paresseux(lambda: contexte.affichage_vue[2]),
+        
+        # Formule
+        'current_formule': paresseux(lambda: contexte.formule),
+        'has_formule': paresseux(lambda: contexte.formule is not None),
+        'formule_limits': paresseux(formule_limits),
+        'can_upgrade': paresseux(lambda: contexte.can_upgrade),
+        'is_module_restricted': is_module_restricted,
+        
+        # Permissions et notifications
+        'has_permission': has_permission,
+        'notifications_count': notifications_count,
+        'has_notifications_permission': paresseux(
+            lambda: contexte.has_permission('can_view_notifications')
+        )
+    })
+    return valeurs
 
 @app.route('/admin/parametrage/fichiers/configurer', methods=['POST'])
 @login_required
@@ -1854,69 +1899,6 @@ def fix_database_columns():
     
     return redirect(url_for('dashboard'))
 
-@app.before_request
-def check_permissions_middleware():
-    """Middleware pour vérifier les permissions sur chaque requête"""
-    if current_user.is_authenticated:
-        # Si c'est le super admin, BYPASS toutes les vérifications de permissions
-        if current_user.role == 'super_admin':
-            return  # Super admin passe partout sans vérification
-        
-        # Liste des endpoints protégés et leurs permissions requises
-        protected_endpoints = {
-            'liste_cartographies': 'can_manage_risks',
-            'nouvelle_cartographie': 'can_manage_risks',
-            'liste_kri': 'can_manage_kri',
-            'nouveau_kri': 'can_manage_kri',
-            'liste_audits': 'can_manage_audit',
-            'nouvel_audit': 'can_manage_audit',
-            'veille_reglementaire': 'can_manage_regulatory',
-            'liste_logigrammes': 'can_manage_logigram',
-            'admin_dashboard': 'can_manage_users',
-            'admin_utilisateurs': 'can_view_users_list',  # CHANGÉ: nouvelle permission
-            'rapports': 'can_view_reports',
-            'export_risques': 'can_export_data',
-            'admin_directions': 'can_view_departments',  # AJOUTÉ
-            'nouvelle_direction': 'can_manage_departments',  # AJOUTÉ
-            'modifier_direction': 'can_manage_departments',  # AJOUTÉ
-            'nouveau_service': 'can_manage_departments',  # AJOUTÉ
-            'rapports': 'can_view_reports'  # AJOUTÉ pour rapports
-        }
-        
-        endpoint = request.endpoint
-        
-        # Vérifier si l'endpoint nécessite une permission spécifique
-        if endpoint in protected_endpoints:
-            required_permission = protected_endpoints[endpoint]
-            
-            # Vérifier si l'utilisateur a la permission
-            if hasattr(current_user, 'has_permission'):
-                if not current_user.has_permission(required_permission):
-                    flash('Accès refusé : permissions insuffisantes', 'error')
-                    return redirect(url_for('dashboard'))
-            else:
-                # Vérification basée sur le rôle (fallback)
-                role_permissions = {
-                    'admin': ['can_manage_risks', 'can_manage_kri', 'can_manage_audit', 
-                             'can_manage_regulatory', 'can_manage_logigram', 'can_manage_users',
-                             'can_view_users_list', 'can_view_reports', 'can_export_data',
-                             'can_view_departments', 'can_manage_departments'],
-                    'manager': ['can_manage_risks', 'can_manage_kri', 'can_manage_audit',
-                               'can_view_reports', 'can_export_data', 'can_view_departments'],
-                    'auditeur': ['can_manage_audit', 'can_view_reports', 'can_view_departments'],
-                    'utilisateur': ['can_view_reports', 'can_view_departments'],
-                    'consultant': ['can_view_reports', 'can_view_departments']
-                }
-                
-                if current_user.role in role_permissions:
-                    if required_permission not in role_permissions[current_user.role]:
-                        flash('Accès refusé : permissions insuffisantes', 'error')
-                        return redirect(url_for('dashboard'))
-                else:
-                    flash('Accès refusé : rôle non reconnu', 'error')
-                    return redirect(url_for('dashboard'))
-
-print("✅ Middleware de permissions configuré")
 # ========================
 # FONCTIONS DE JOURNALISATION
 # ========================
@@ -2111,43 +2093,25 @@ print("✅ Headers de sécurité configurés")
 @app.errorhandler(404)
 def page_not_found(e):
     """Gestionnaire d'erreur 404."""
-    print(f"⚠️ Page non trouvée: {request.path}")
+    logger.info("Page non trouvée: %s", request.path)
     return render_template('errors/404.html'), 404
 
 @app.errorhandler(403)
 def forbidden(e):
     """Gestionnaire d'erreur 403."""
-    print(f"⚠️ Accès interdit: {request.path}")
+    logger.warning("Accès interdit: %s", request.path)
     return render_template('errors/403.html'), 403
 
 @app.errorhandler(500)
 def internal_server_error(e):
     """Gestionnaire d'erreur 500."""
-    print(f"❌ Erreur serveur: {e}")
+    logger.error("Erreur serveur: %s", e, exc_info=getattr(e, 'original_exception', None) or e)
     return render_template('errors/500.html'), 500
 
 print("✅ Gestionnaires d'erreurs configurés")
 
-# ========================
-# MIDDLEWARE DE JOURNALISATION
-# ========================
-
-@app.before_request
-def before_request_logging():
-    """Journalise les requêtes entrantes."""
-    if request.endpoint and not request.endpoint.startswith('static'):
-        g.start_time = datetime.now()
-        print(f"🌐 Requête: {request.method} {request.path}")
-
-@app.after_request
-def after_request_logging(response):
-    """Journalise les réponses."""
-    if hasattr(g, 'start_time'):
-        duration = (datetime.now() - g.start_time).total_seconds()
-        print(f"✅ Réponse: {request.method} {request.path} - {response.status_code} ({duration:.3f}s)")
-    return response
-
-print("✅ Middleware de journalisation configuré")
+# La journalisation des requêtes (request_id, durée, statut) est assurée par
+# services/journalisation.py (init_journalisation, en tête de ce fichier).
 
 # ========================
 # VÉRIFICATION FINALE
@@ -2324,32 +2288,18 @@ def config_initiales():
             pass
 
 
-@app.context_processor
-def inject_clients():
-    """Injecte la liste des clients disponibles dans tous les templates"""
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        # Pour super admin: tous les clients actifs
-        available_clients = Client.query.filter_by(is_active=True)\
-            .order_by(Client.nom).all()
-    else:
-        # Pour autres utilisateurs: seulement leur client
-        if hasattr(current_user, 'client_id') and current_user.client_id:
-            available_clients = Client.query.filter_by(
-                id=current_user.client_id, 
-                is_active=True
-            ).all()
-        else:
-            available_clients = []
-    
-    # Client actuellement visualisé
-    viewing_client_id = session.get('viewing_client_id')
-    viewing_client = Client.query.get(viewing_client_id) if viewing_client_id else None
-    
-    return {
-        'available_clients': available_clients,
-        'viewing_client': viewing_client,
-        'is_viewing_other_client': viewing_client_id and viewing_client_id != getattr(current_user, 'client_id', None)
-    }
+
+# ========================
+# NOTIFICATIONS EN TEMPS RÉEL (SSE, COMPTEUR DE NON LUES)
+# ========================
+from services.notifications_temps_reel import (
+    init_notifications_temps_reel, compteur_non_lues, etag_notifications, avec_etag, reponse_non_modifiee
+)
+
+# Avant la première requête sur User : ajoute les colonnes du compteur
+if MODELS_IMPORTED:
+    init_notifications_temps_reel(app)
+
 
 # ========================
 # INITIALISATION DE LA BASE DE DONNÉES
@@ -2393,6 +2343,105 @@ with app.app_context():
         except Exception as e:
             print(f"❌ Erreur initialisation base de données: {e}")
 
+# ========================
+# PROJECTION DES ÉVALUATIONS COURANTES
+# ========================
+try:
+    from services.evaluation_courante import (
+        init_evaluation_courante, requete_evaluations_courantes,
+        repartition_niveaux, evaluations_courantes_par_risque, evaluations_validees_par_risque
+    )
+    if MODELS_IMPORTED:
+        init_evaluation_courante(app)
+    EVALUATION_COURANTE_AVAILABLE = True
+except ImportError as e:
+    print(f"⚠️ Projection des évaluations courantes non disponible: {e}")
+    EVALUATION_COURANTE_AVAILABLE = False
+
+try:
+    from services.automatisation_audits import init_automatisation_audits
+    if MODELS_IMPORTED:
+        init_automatisation_audits(app)
+except ImportError as e:
+    print(f"⚠️ Automatisation des audits non disponible: {e}")
+
+try:
+    from services.file_analyse_ia import init_file_analyse_ia
+    if MODELS_IMPORTED:
+        init_file_analyse_ia(app)
+except ImportError as e:
+    print(f"⚠️ File d'attente des analyses IA non disponible: {e}")
+
+try:
+    from services.emails_sortants import init_emails_sortants
+    if MODELS_IMPORTED:
+        init_emails_sortants(app)
+except ImportError as e:
+    print(f"⚠️ Boîte d'envoi des emails non disponible: {e}")
+
+try:
+    from services.recherche import init_recherche
+    if MODELS_IMPORTED:
+        init_recherche(app)
+except ImportError as e:
+    print(f"⚠️ Recherche plein texte non disponible: {e}")
+
+try:
+    from services.series_kri import init_series_kri
+    if MODELS_IMPORTED:
+        init_series_kri(app)
+except ImportError as e:
+    print(f"⚠️ Agrégats des séries KRI non disponibles: {e}")
+
+try:
+    from services.analyse_kri import init_analyse_kri
+    if MODELS_IMPORTED:
+        init_analyse_kri(app)
+except ImportError as e:
+    print(f"⚠️ Analyse par lots des KRI non disponible: {e}")
+
+try:
+    from services.prevision_kri import init_prevision_kri
+    if MODELS_IMPORTED:
+        init_prevision_kri(app)
+except ImportError as e:
+    print(f"⚠️ Prévisions KRI non disponibles: {e}")
+
+try:
+    from services.consommation_ia import init_consommation_ia
+    if MODELS_IMPORTED:
+        init_consommation_ia(app)
+except ImportError as e:
+    print(f"⚠️ Suivi de consommation IA non disponible: {e}")
+
+try:
+    from services.repartiteur_ia import init_repartiteur_ia
+    init_repartiteur_ia(app)
+except ImportError as e:
+    print(f"⚠️ Répartiteur IA non disponible: {e}")
+
+try:
+    from services.echeances import init_echeances
+    if MODELS_IMPORTED:
+        init_echeances(app)
+except ImportError as e:
+    print(f"⚠️ Moteur des échéances non disponible: {e}")
+
+from services.pagination import paginer, paginer_curseur, parametres_pagination, CurseurInvalide
+
+# ========================
+# CACHE DES AGRÉGATS DE TABLEAUX DE BORD
+# ========================
+from services.cache_tableau_bord import cache_tableau_bord, init_cache_tableau_bord
+
+if MODELS_IMPORTED:
+    init_cache_tableau_bord(app)
+
+# ========================
+# MATRICES DE RISQUES (SVG/JSON EN CACHE)
+# ========================
+from services.matrice_risques import obtenir_matrice, matrice_svg, svg_data_uri, TYPES_MATRICE
+
 
 def get_niveau_from_score(score):
     """Convertit un score en niveau de risque"""
@@ -2555,122 +2604,6 @@ def creer_notification(type_notification, titre, message, destinataire_id, entit
         except:
             pass
 
-# ========================
-# FONCTIONS D'AUTOMATISATION
-# ========================
-
-def automatiser_statuts_audits():
-    """Automatise les mises à jour de statut des audits"""
-    if not MODELS_IMPORTED:
-        return
-    
-    print("🤖 Démarrage de l'automatisation des statuts d'audit...")
-    with app.app_context():
-        try:
-            audits = Audit.query.filter_by(is_archived=False).all()
-            
-            for audit in audits:
-                try:
-                    # Logique d'automatisation
-                    constatations_non_closes = Constatation.query.filter_by(
-                        audit_id=audit.id,
-                        is_archived=False
-                    ).filter(Constatation.statut != 'clos').count()
-                    
-                    total_constatations = Constatation.query.filter_by(
-                        audit_id=audit.id,
-                        is_archived=False
-                    ).count()
-                    
-                    if total_constatations > 0 and constatations_non_closes == 0:
-                        if audit.statut != 'clos':
-                            audit.statut = 'clos'
-                            audit.sous_statut = 'cloture'
-                            print(f"✅ Audit {audit.reference} automatiquement clos")
-                    
-                    db.session.commit()
-                    
-                except Exception as e:
-                    print(f"❌ Erreur sur audit {audit.reference}: {e}")
-                    db.session.rollback()
-                    
-        except Exception as e:
-            print(f"❌ Erreur automatisation: {e}")
-
-def verifier_echeances_et_alertes():
-    """Vérifie les échéances et génère des alertes"""
-    if not MODELS_IMPORTED:
-        return
-    
-    print("🔔 Vérification des échéances et alertes...")
-    with app.app_context():
-        try:
-            aujourdhui = datetime.utcnow().date()
-            recommandations = Recommandation.query.filter_by(is_archived=False).all()
-            
-            for recommandation in recommandations:
-                try:
-                    if recommandation.date_echeance:
-                        jours_restants = (recommandation.date_echeance - aujourdhui).days
-                        
-                        if 0 < jours_restants <= 7 and recommandation.statut != 'termine':
-                            # Créer une alerte
-                            creer_notification(
-                                type_notification='echeance_proche',
-                                titre=f"Échéance proche pour recommandation",
-                                message=f"La recommandation arrive à échéance dans {jours_restants} jours",
-                                destinataire_id=recommandation.responsable_id or recommandation.audit.responsable_id,
-                                entite_type='recommandation',
-                                entite_id=recommandation.id
-                            )
-                    
-                    db.session.commit()
-                    
-                except Exception as e:
-                    print(f"❌ Erreur sur recommandation {recommandation.id}: {e}")
-                    db.session.rollback()
-                    
-        except Exception as e:
-            print(f"❌ Erreur vérification échéances: {e}")
-
-def demarrer_scheduler():
-    """Démarre le scheduler pour les tâches automatiques"""
-    try:
-        scheduler = BackgroundScheduler()
-        
-        scheduler.add_job(
-            func=automatiser_statuts_audits,
-            trigger="interval",
-            hours=1,
-            id="verif_statuts",
-            name="Vérification automatique des statuts d'audit",
-            replace_existing=True
-        )
-        
-        scheduler.add_job(
-            func=verifier_echeances_et_alertes,
-            trigger="cron",
-            hour=8,
-            minute=0,
-            id="verif_echeances",
-            name="Vérification des échéances et alertes",
-            replace_existing=True
-        )
-        
-        scheduler.start()
-        print("✅ Scheduler démarré avec succès")
-        
-    except Exception as e:
-        print(f"❌ Erreur lors du démarrage du scheduler: {e}")
-
-# Démarrer le scheduler
-with app.app_context():
-    try:
-        demarrer_scheduler()
-    except:
-        print("⚠️ Scheduler non démarré (peut être normal en développement)")
-
-
 @app.route('/logigramme/<int:activite_id>/export-pdf')
 @login_required
 def export_logigramme_pdf(activite_id):
@@ -2834,224 +2767,23 @@ def export_logigramme_pdf(activite_id):
 # FONCTIONS D'AUTOMATISATION
 # ========================
 
-def automatiser_statuts_audits():
-    """Automatise les mises à jour de statut des audits"""
+def automatiser_statuts_audits(dry_run=False):
+    """Automatise les mises à jour de statut des audits (traitement ensembliste par lots)"""
     print("🤖 Démarrage de l'automatisation des statuts d'audit...")
     with app.app_context():
-        audits = Audit.query.filter_by(is_archived=False).all()
-        
-        for audit in audits:
-            try:
-                # Vérifier si toutes les constatations sont clôturées
-                constatations_non_closes = Constatation.query.filter_by(
-                    audit_id=audit.id,
-                    is_archived=False
-                ).filter(Constatation.statut != 'clos').count()
-                
-                total_constatations = Constatation.query.filter_by(
-                    audit_id=audit.id,
-                    is_archived=False
-                ).count()
-                
-                # Si toutes les constatations sont clôturées, clore l'audit
-                if total_constatations > 0 and constatations_non_closes == 0:
-                    if audit.statut != 'clos':
-                        audit.statut = 'clos'
-                        audit.sous_statut = 'cloture'
-                        print(f"✅ Audit {audit.reference} automatiquement clos")
-                        
-                        # Notifier le responsable
-                        if audit.responsable_id:
-                            creer_notification(
-                                type_notification='audit_clos',
-                                titre=f"Audit {audit.reference} clos",
-                                message=f"L'audit {audit.reference} a été automatiquement clos car toutes les constatations sont traitées.",
-                                destinataire_id=audit.responsable_id,
-                                entite_type='audit',
-                                entite_id=audit.id
-                            )
-                
-                # Mettre à jour le sous-statut en fonction de l'avancement
-                if audit.statut != 'clos' and audit.statut != 'archive':
-                    if audit.progression_globale < 25:
-                        audit.sous_statut = 'planification'
-                    elif audit.progression_globale < 50:
-                        audit.sous_statut = 'collecte'
-                    elif audit.progression_globale < 75:
-                        audit.sous_statut = 'analyse'
-                    elif audit.progression_globale < 90:
-                        audit.sous_statut = 'redaction'
-                    elif audit.progression_globale < 100:
-                        audit.sous_statut = 'validation'
-                
-                # Mettre à jour la date de modification
-                audit.updated_at = datetime.utcnow()
-                db.session.commit()
-                
-            except Exception as e:
-                print(f"❌ Erreur sur audit {audit.reference}: {e}")
-                db.session.rollback()
+        from services.automatisation_audits import automatiser_statuts_audits_lot
+        return automatiser_statuts_audits_lot(dry_run=dry_run)
 
-def verifier_echeances_et_alertes():
-    """Vérifie les échéances et génère des alertes"""
+def verifier_echeances_et_alertes(dry_run=False):
+    """Vérifie les échéances et génère des alertes (traitement ensembliste, idempotent sur la journée)"""
     print("🔔 Vérification des échéances et alertes...")
     with app.app_context():
-        aujourdhui = datetime.utcnow().date()
-        
-        # Vérifier les recommandations
-        recommandations = Recommandation.query.filter_by(is_archived=False).all()
-        
-        for recommandation in recommandations:
-            try:
-                # Alerte échéance proche (7 jours)
-                if recommandation.date_echeance:
-                    jours_restants = (recommandation.date_echeance - aujourdhui).days
-                    
-                    if 0 < jours_restants <= 7 and recommandation.statut != 'termine':
-                        # Vérifier si une alerte existe déjà
-                        existing_alert = Notification.query.filter_by(
-                            type_notification='echeance_proche',
-                            entite_id=recommandation.id,
-                            est_lue=False
-                        ).first()
-                        
-                        if not existing_alert:
-                            creer_notification(
-                                type_notification='echeance_proche',
-                                titre=f"Échéance proche pour recommandation",
-                                message=f"La recommandation arrive à échéance dans {jours_restants} jours",
-                                destinataire_id=recommandation.responsable_id or recommandation.audit.responsable_id,
-                                entite_type='recommandation',
-                                entite_id=recommandation.id
-                            )
-                    
-                    # Alerte retard
-                    elif jours_restants < 0 and recommandation.statut != 'termine':
-                        recommandation.statut = 'retarde'
-                        
-                        existing_alert = Notification.query.filter_by(
-                            type_notification='retard',
-                            entite_id=recommandation.id,
-                            est_lue=False
-                        ).first()
-                        
-                        if not existing_alert:
-                            creer_notification(
-                                type_notification='retard',
-                                titre=f"Retard sur recommandation",
-                                message=f"La recommandation est en retard de {abs(jours_restants)} jours",
-                                destinataire_id=recommandation.responsable_id or recommandation.audit.responsable_id,
-                                entite_type='recommandation',
-                                entite_id=recommandation.id
-                            )
-                
-                db.session.commit()
-                
-            except Exception as e:
-                print(f"❌ Erreur sur recommandation {recommandation.id}: {e}")
-                db.session.rollback()
-        
-        # Vérifier les plans d'action
-        plans = PlanAction.query.filter_by(is_archived=False).all()
-        
-        for plan in plans:
-            try:
-                if plan.date_fin_prevue:
-                    jours_restants = (plan.date_fin_prevue - aujourdhui).days
-                    
-                    # Alerte 7 jours avant échéance
-                    if 0 < jours_restants <= 7 and plan.statut not in ['termine', 'suspendu']:
-                        existing_alert = Notification.query.filter_by(
-                            type_notification='echeance_proche',
-                            entite_id=plan.id,
-                            est_lue=False
-                        ).first()
-                        
-                        if not existing_alert:
-                            creer_notification(
-                                type_notification='echeance_proche',
-                                titre=f"Échéance proche pour le plan {plan.nom}",
-                                message=f"Le plan {plan.nom} arrive à échéance dans {jours_restants} jours",
-                                destinataire_id=plan.responsable_id or plan.audit.responsable_id,
-                                entite_type='plan_action',
-                                entite_id=plan.id
-                            )
-                    
-                    # Alerte retard
-                    elif jours_restants < 0 and plan.statut not in ['termine', 'suspendu']:
-                        plan.statut = 'retarde'
-                        
-                        existing_alert = Notification.query.filter_by(
-                            type_notification='retard',
-                            entite_id=plan.id,
-                            est_lue=False
-                        ).first()
-                        
-                        if not existing_alert:
-                            creer_notification(
-                                type_notification='retard',
-                                titre=f"Retard sur le plan {plan.nom}",
-                                message=f"Le plan {plan.nom} est en retard de {abs(jours_restants)} jours",
-                                destinataire_id=plan.responsable_id or plan.audit.responsable_id,
-                                entite_type='plan_action',
-                                entite_id=plan.id
-                            )
-                
-                # Si toutes les sous-actions sont terminées, terminer le plan
-                if plan.sous_actions:
-                    toutes_terminees = all(s.pourcentage_realisation == 100 for s in plan.sous_actions)
-                    if toutes_terminees and plan.statut != 'termine':
-                        plan.statut = 'termine'
-                        plan.date_fin_reelle = datetime.utcnow().date()
-                        plan.pourcentage_realisation = 100
-                        
-                        # Notifier
-                        creer_notification(
-                            type_notification='plan_termine',
-                            titre=f"Plan d'action terminé: {plan.nom}",
-                            message=f"Le plan d'action '{plan.nom}' a été automatiquement marqué comme terminé car toutes les sous-actions sont complètes.",
-                            destinataire_id=plan.responsable_id or plan.audit.responsable_id,
-                            entite_type='plan_action',
-                            entite_id=plan.id
-                        )
-                
-                db.session.commit()
-                
-            except Exception as e:
-                print(f"❌ Erreur sur plan {plan.id}: {e}")
-                db.session.rollback()
+        from services.echeances import verifier_echeances
+        return verifier_echeances(dry_run=dry_run)
 
-def demarrer_scheduler():
-    """Démarre le scheduler pour les tâches automatiques"""
-    try:
-        scheduler = BackgroundScheduler()
-        
-        # Vérifier les statuts toutes les heures
-        scheduler.add_job(
-            func=automatiser_statuts_audits,
-            trigger="interval",
-            hours=1,
-            id="verif_statuts",
-            name="Vérification automatique des statuts d'audit",
-            replace_existing=True
-        )
-        
-        # Vérifier les échéances tous les jours à 8h
-        scheduler.add_job(
-            func=verifier_echeances_et_alertes,
-            trigger="cron",
-            hour=8,
-            minute=0,
-            id="verif_echeances",
-            name="Vérification des échéances et alertes",
-            replace_existing=True
-        )
-        
-        scheduler.start()
-        print("✅ Scheduler démarré avec succès")
-        
-    except Exception as e:
-        print(f"❌ Erreur lors du démarrage du scheduler: {e}")
+# Les tâches planifiées (automatiser_statuts_audits, verifier_echeances_et_alertes)
+# sont exécutées par worker.py, jamais par les workers web :
+# voir services/taches_planifiees.py
 
 
 # ========================
@@ -3088,59 +2820,10 @@ def synchroniser_etape_organigramme(etape_id, action_type, user_id):
         print(f"❌ Erreur synchronisation étape {etape_id}: {e}")
         return False
 
-from apscheduler.schedulers.background import BackgroundScheduler
-
-def demarrer_scheduler():
-    """Démarre le scheduler pour les tâches automatiques"""
-    scheduler = BackgroundScheduler()
-    
-    # Vérifier les statuts toutes les heures
-    scheduler.add_job(
-        func=automatiser_statuts_audits,
-        trigger="interval",
-        hours=1,
-        id="verif_statuts",
-        name="Vérification automatique des statuts d'audit",
-        replace_existing=True
-    )
-    
-    # Vérifier les échéances tous les jours à 8h
-    scheduler.add_job(
-        func=verifier_echeances_et_alertes,
-        trigger="cron",
-        hour=8,
-        minute=0,
-        id="verif_echeances",
-        name="Vérification des échéances et alertes",
-        replace_existing=True
-    )
-    
-    scheduler.start()
-    print("✅ Scheduler démarré")
-
-# Appeler dans le contexte de l'application
-with app.app_context():
-    demarrer_scheduler()
-
 # ========================
 # MIDDLEWARE MULTI-TENANT SIMPLE
 # ========================
 
-@app.before_request
-def setup_multi_tenant():
-    """Configure le multi-tenant pour chaque requête"""
-    if current_user.is_authenticated:
-        # Super admin : pas de filtre
-        if current_user.role == 'super_admin':
-            g.client_id = None
-            g.filter_by_client = False
-        else:
-            # Clients normaux : filtrer par client_id
-            g.client_id = current_user.client_id
-            g.filter_by_client = True
-    else:
-        g.client_id = None
-        g.filter_by_client = False
 
 def get_client_filter(model_class, **filters):
     """
@@ -3407,14 +3090,6 @@ class TenantManager:
         
         return model_instance
 
-# Injecter dans les templates
-@app.context_processor
-def inject_tenant_utils():
-    return {
-        'tenant_manager': TenantManager,
-        'has_tenant_access': TenantManager.ensure_client_access
-    }
-
 def declencher_mise_a_jour_risque(risque_id, action, utilisateur_id, donnees_supplementaires=None):
     """Déclencher une mise à jour automatique pour un risque"""
     risque = Risque.query.get(risque_id)
@@ -3902,38 +3577,6 @@ def check_super_admin_access():
     """Vérifie si l'utilisateur courant est super admin"""
     return current_user.is_authenticated and current_user.role == 'super_admin'
 
-@app.before_request
-def check_permissions_middleware():
-    """Middleware pour vérifier les permissions sur chaque requête"""
-    if current_user.is_authenticated:
-        # Si c'est le super admin, BYPASS toutes les vérifications de permissions
-        if current_user.role == 'super_admin':
-            return  # Super admin passe partout sans vérification
-        
-        # Liste des endpoints protégés et leurs permissions requises
-        protected_endpoints = {
-            'liste_cartographies': 'can_manage_risks',
-            'nouvelle_cartographie': 'can_manage_risks',
-            'liste_kri': 'can_manage_kri',
-            'nouveau_kri': 'can_manage_kri',
-            'liste_audits': 'can_manage_audit',
-            'nouvel_audit': 'can_manage_audit',
-            'veille_reglementaire': 'can_manage_regulatory',
-            'liste_logigrammes': 'can_manage_logigram',
-            'admin_dashboard': 'can_manage_users',
-            'admin_utilisateurs': 'can_manage_users',
-            'rapports': 'can_view_reports',
-            'export_risques': 'can_export_data'
-        }
-        
-        endpoint = request.endpoint
-        
-        # Vérifier si l'endpoint nécessite une permission spécifique
-        if endpoint in protected_endpoints:
-            required_permission = protected_endpoints[endpoint]
-            if not current_user.has_permission(required_permission):
-                flash('Accès refusé : permissions insuffisantes', 'error')
-                return redirect(url_for('dashboard'))
 
 # ========================
 # FONCTION DE FILTRAGE DES DONNÉES
@@ -4233,28 +3876,6 @@ def tenant_filtered_query(model_class, **filters):
     # PAR DÉFAUT : retourner une requête vide
     return query.filter(False)
 
-@app.context_processor
-def inject_tenant_filter():
-    """Injecte la fonction de filtrage dans tous les templates"""
-    return dict(tenant_filtered_query=tenant_filtered_query)
-
-# ========================
-# MIDDLEWARE DE FILTRAGE
-# ========================
-
-@app.before_request
-def auto_filter_data():
-    """Filtre automatiquement les données par client"""
-    # Ne pas filtrer pour super admin
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        g.client_id = None  # Super admin voit tout
-        return
-    
-    # Pour les autres utilisateurs
-    if current_user.is_authenticated:
-        g.client_id = current_user.client_id
-
-
 
 # ========================
 # PATCH TEMPORAIRE POUR MULTI-TENANT
@@ -4700,52 +4321,8 @@ def super_admin_control_panel():
                          view_mode=view_mode,
                          current_user=current_user)
 
-@app.context_processor
-def inject_view_info():
-    """Injecte les informations de vue dans tous les templates"""
-    viewing_client = None
-    view_mode = session.get('view_mode', 'my_client')
-    
-    if 'viewing_client_id' in session:
-        viewing_client = Client.query.get(session['viewing_client_id'])
-    
-    # Déterminer le texte à afficher
-    view_text = "Mon client"
-    view_icon = "fas fa-building"
-    view_class = "is-info"
-    
-    if viewing_client:
-        view_text = f"Vue: {viewing_client.reference}"
-        view_icon = "fas fa-eye"
-        view_class = "is-success"
-    elif view_mode == 'my_data_only':
-        view_text = "Mes données"
-        view_icon = "fas fa-user"
-        view_class = "is-warning"
-    
-    return {
-        'viewing_client': viewing_client,
-        'view_mode': view_mode,
-        'view_text': view_text,
-        'view_icon': view_icon,
-        'view_class': view_class,
-        'is_viewing_other_client': viewing_client is not None
-    }
-
-# Middleware pour appliquer le client de la session
-@app.before_request
-def apply_session_client():
-    """Si super admin a sélectionné un client, l'appliquer"""
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        if 'viewing_client_id' in session:
-            # Temporairement changer le client_id de l'utilisateur
-            g.original_client_id = current_user.client_id
-            current_user.client_id = session['viewing_client_id']
-        else:
-            # Réinitialiser
-            if hasattr(g, 'original_client_id'):
-                current_user.client_id = g.original_client_id
 
+# Client consulté par le super admin : restauré après la requête (voir preparer_contexte_requete)
 @app.after_request
 def restore_original_client(response):
     """Restaurer le client_id original après la requête"""
@@ -5053,7 +4630,7 @@ def api_maintenance_environment(env_id):
 
 # ==================== MIDDLEWARE SOUS-DOMAIN ====================
 
-@app.before_request
+# Appelé par preparer_contexte_requete
 def detect_client_subdomain():
     """Détecte le sous-domaine et route vers le client correspondant"""
     host = request.host
@@ -5522,17 +5099,6 @@ def url_exists(endpoint):
     except:
         return False
 
-# Injecter la fonction dans le contexte Jinja2
-@app.context_processor
-def utility_processor():
-    """Injecte des fonctions utilitaires dans tous les templates"""
-    return {
-        'url_exists': url_exists,
-        'now': datetime.utcnow
-    }
-
-
-
 @app.route('/fix-all-manager-permissions')
 @login_required
 @super_admin_required
@@ -6136,30 +5702,6 @@ def force_my_data_view():
     return redirect(url_for('liste_logigrammes'))
 
 
-@app.before_request
-def auto_check_view_mode():
-    """Vérifier et corriger automatiquement le mode de vue pour super admin"""
-    
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        
-        endpoint = request.endpoint
-        
-        # Si on accède à une liste de données (logigrammes, risques, etc.)
-        list_endpoints = ['liste_logigrammes', 'liste_risques', 'liste_audits', 
-                         'super_admin_clients', 'super_admin_formules']
-        
-        if endpoint in list_endpoints:
-            # Vérifier si on est en mode "vue personnelle"
-            current_mode = session.get('view_mode')
-            
-            print(f"🔍 AUTO CHECK: {endpoint}")
-            print(f"   Mode actuel: {current_mode}")
-            print(f"   Viewing client: {session.get('viewing_client_id')}")
-            
-            # Si pas de mode défini, suggérer d'activer "mes données"
-            if not current_mode and not session.get('viewing_client_id'):
-                print("   ⚠️  Pas de mode défini, suggestion d'activer 'mes données'")
-                # Ne pas forcer automatiquement, juste logger
 
                 
 # ========================
@@ -7487,7 +7029,7 @@ def api_check_module_access(module_code):
 # MIDDLEWARE POUR VÉRIFIER LES LIMITES
 # ========================
 
-@app.before_request
+# Appelé par preparer_contexte_requete
 def check_formule_limits_middleware():
     """Middleware pour vérifier les limites de formule avant certaines actions"""
     if not current_user.is_authenticated:
@@ -7497,21 +7039,13 @@ def check_formule_limits_middleware():
     if request.method not in ['POST', 'PUT']:
         return
     
-    # Liste des endpoints à vérifier
-    limit_check_endpoints = {
-        'admin_nouvel_utilisateur': 'utilisateurs',
-        'nouveau_risque': 'risques',
-        'nouvel_audit': 'audits',
-        'nouveau_processus': 'processus',
-        'nouveau_logigramme': 'logigrammes'
-    }
-    
+    # Endpoints à vérifier (table LIMITES_ENDPOINTS de services/contexte_requete.py)
     endpoint = request.endpoint
-    if endpoint in limit_check_endpoints:
-        limit_type = limit_check_endpoints[endpoint]
+    if endpoint in LIMITES_ENDPOINTS:
+        limit_type = LIMITES_ENDPOINTS[endpoint]
+        formule = obtenir_contexte().formule
         
-        if current_user.client and current_user.client.formule:
-            formule = current_user.client.formule
+        if formule:
             
             # Obtenir le compteur actuel
             if limit_type == 'utilisateurs':
@@ -7683,46 +7217,6 @@ def api_formule_comparison(formule_id):
     return jsonify(comparison)
 
 
-# ========================
-# UTILITAIRES POUR LES TEMPLATES
-# ========================
-
-@app.context_processor
-def inject_formule_info():
-    """Injecter les informations de formule dans tous les templates"""
-    formule_info = {
-        'current_formule': None,
-        'has_formule': False,
-        'formule_limits': {},
-        'can_upgrade': False,
-        'is_module_restricted': lambda module: False
-    }
-    
-    if current_user.is_authenticated and current_user.client and current_user.client.formule:
-        formule = current_user.client.formule
-        formule_info['current_formule'] = formule
-        formule_info['has_formule'] = True
-        formule_info['formule_limits'] = {
-            'utilisateurs': formule.max_utilisateurs,
-            'risques': formule.max_risques,
-            'audits': formule.max_audits
-        }
-        
-        # Vérifier s'il y a des options d'upgrade
-        formule_info['can_upgrade'] = FormuleAbonnement.query.filter(
-            FormuleAbonnement.is_active == True,
-            FormuleAbonnement.max_utilisateurs > formule.max_utilisateurs
-        ).count() > 0
-        
-        # Fonction pour vérifier l'accès aux modules
-        def check_module_access(module_code):
-            return formule.can_access_module(module_code)
-        
-        formule_info['is_module_restricted'] = check_module_access
-    
-    return formule_info
-
-
 @app.route('/super-admin/formules')
 @login_required
 @super_admin_required
@@ -9100,17 +8594,37 @@ def admin_dashboard():
     
     # Récupérer les statistiques AVEC ISOLATION
     if is_super_admin:
-        # SUPER ADMIN : voit tout
-        stats = {
-            'users_active': User.query.filter_by(is_active=True).count(),
-            'users_total': User.query.count(),
-            'clients_total': Client.query.filter_by(is_active=True).count(),
-            'risques_actifs': Risque.query.filter_by(is_archived=False).count(),
-            'audits_en_cours': Audit.query.filter_by(statut='en_cours').count(),
-            'kri_actifs': KRI.query.filter_by(est_actif=True).count(),
-            'veilles_actives': VeilleReglementaire.query.filter_by(statut='en_vigueur').count(),
-            'formules_actives': FormuleAbonnement.query.filter_by(is_active=True).count()
-        }
+        # SUPER ADMIN : voit tout (agrégats en cache, portée globale)
+        def calculer_stats_globales():
+            from sqlalchemy import func
+            
+            stats = {
+                'users_active': User.query.filter_by(is_active=True).count(),
+                'users_total': User.query.count(),
+                'clients_total': Client.query.filter_by(is_active=True).count(),
+                'risques_actifs': Risque.query.filter_by(is_archived=False).count(),
+                'audits_en_cours': Audit.query.filter_by(statut='en_cours').count(),
+                'kri_actifs': KRI.query.filter_by(est_actif=True).count(),
+                'veilles_actives': VeilleReglementaire.query.filter_by(statut='en_vigueur').count(),
+                'formules_actives': FormuleAbonnement.query.filter_by(is_active=True).count()
+            }
+            
+            # Statistiques par formule (un seul GROUP BY)
+            clients_par_formule = dict(db.session.query(
+                Client.formule_id, func.count(Client.id)
+            ).filter(Client.is_active == True).group_by(Client.formule_id).all())
+            
+            formules_stats = [{
+                'nom': formule.nom,
+                'clients': clients_par_formule.get(formule.id, 0),
+                'prix_mensuel': formule.prix_mensuel
+            } for formule in FormuleAbonnement.query.filter_by(is_active=True).all()]
+            
+            return {'stats': stats, 'formules_stats': formules_stats}
+        
+        agregats = cache_tableau_bord.obtenir('admin_dashboard', None, calculer_stats_globales)
+        stats = dict(agregats['stats'])
+        formules_stats = agregats['formules_stats']
         
         # Utilisateurs récents
         users = User.query.order_by(User.created_at.desc()).limit(50).all()
@@ -9118,16 +8632,6 @@ def admin_dashboard():
         # Clients récents
         recent_clients = Client.query.order_by(Client.created_at.desc()).limit(10).all()
         
-        # Statistiques par formule
-        formules_stats = []
-        for formule in FormuleAbonnement.query.filter_by(is_active=True).all():
-            clients_count = Client.query.filter_by(formule_id=formule.id, is_active=True).count()
-            formules_stats.append({
-                'nom': formule.nom,
-                'clients': clients_count,
-                'prix_mensuel': formule.prix_mensuel
-            })
-        
     else:
         # ADMIN CLIENT : voit seulement son client
         client_id = current_user.client_id
@@ -9142,17 +8646,22 @@ def admin_dashboard():
             .order_by(User.created_at.desc())\
             .limit(20).all()
         
-        # Statistiques DU CLIENT
-        stats = {
+        # Statistiques DU CLIENT (agrégats en cache par client)
+        def calculer_stats_client():
+            return {
+                'users_total': get_client_filter(User).count(),
+                'risques_actifs': get_client_filter(Risque).filter_by(is_archived=False).count(),
+                'audits_en_cours': get_client_filter(Audit).filter_by(statut='en_cours').count(),
+                'kri_actifs': get_client_filter(KRI).filter_by(est_actif=True).count(),
+                'veilles_actives': get_client_filter(VeilleReglementaire).filter_by(statut='en_vigueur').count()
+            }
+        
+        stats = dict(cache_tableau_bord.obtenir('admin_dashboard', client_id, calculer_stats_client))
+        stats.update({
             'users_active': len(users),
-            'users_total': get_client_filter(User).count(),
-            'risques_actifs': get_client_filter(Risque).filter_by(is_archived=False).count(),
-            'audits_en_cours': get_client_filter(Audit).filter_by(statut='en_cours').count(),
-            'kri_actifs': get_client_filter(KRI).filter_by(est_actif=True).count(),
-            'veilles_actives': get_client_filter(VeilleReglementaire).filter_by(statut='en_vigueur').count(),
             'clients_total': 1,  # Uniquement son propre client
             'formule': current_user.client.formule.nom if current_user.client.formule else 'Aucune'
-        }
+        })
         
         # Client info
         client = current_user.client
@@ -9532,15 +9041,35 @@ def admin_utilisateurs():
         flash('Accès refusé : permission requise', 'error')
         return redirect(url_for('dashboard'))
     
+    from sqlalchemy import func
+    
+    def statistiques_utilisateurs(users_query):
+        """Compteurs sur l'ensemble de la liste (pas seulement la page affichée)"""
+        par_role = dict(users_query.with_entities(
+            User.role, func.count(User.id)
+        ).order_by(None).group_by(User.role).all())
+        return {
+            'total': sum(par_role.values()),
+            'actifs': users_query.filter(User.is_active == True).order_by(None).count(),
+            'par_role': par_role
+        }
+    
     # SUPER ADMIN : voir tous les utilisateurs (sauf autres super admin)
     if current_user.role == 'super_admin':
-        users = User.query.filter(
+        users_query = User.query.filter(
             User.role != 'super_admin'  # Ne montre pas les autres super admin
-        ).order_by(User.client_id, User.username).all()
+        ).order_by(User.client_id, User.username, User.id)
+        pagination = paginer(users_query, defaut=50)
+        stats_users = statistiques_utilisateurs(users_query)
         
         return render_template(
             'admin/utilisateurs_super_admin.html',
-            users=users,
+            users=pagination.items,
+            pagination=pagination,
+            stats_users=stats_users,
+            permissions_utilisateurs=permissions_effectives_utilisateurs(pagination.items),
+            total_users=stats_users['total'],
+            active_users=stats_users['actifs'],
             role_display="SUPER ADMIN - Vue globale",
             total_clients=Client.query.count(),
             clients_actifs=Client.query.filter_by(is_active=True).count()
@@ -9548,37 +9077,42 @@ def admin_utilisateurs():
     
     # ADMIN CLIENT : voir les utilisateurs de son client
     elif current_user.role == 'admin' and current_user.is_client_admin:
-        users = User.query.filter_by(
+        # Ne pas montrer d'autres admin client (sauf lui-même)
+        users_query = User.query.filter_by(
             client_id=current_user.client_id
         ).filter(
-            User.role != 'super_admin'  # Ne montre pas les super admin
-        ).order_by(User.username).all()
-        
-        # Filtrer pour ne pas montrer d'autres admin client (sauf lui-même)
-        filtered_users = []
-        for user in users:
-            if not user.is_client_admin or user.id == current_user.id:
-                filtered_users.append(user)
+            User.role != 'super_admin',  # Ne montre pas les super admin
+            or_(User.is_client_admin == False, User.is_client_admin.is_(None),
+                User.id == current_user.id)
+        ).order_by(User.username, User.id)
+        pagination = paginer(users_query, defaut=50)
         
         return render_template(
             'admin/utilisateurs.html',  # Template normal
-            users=filtered_users,
+            users=pagination.items,
+            pagination=pagination,
+            stats_users=statistiques_utilisateurs(users_query),
+            permissions_utilisateurs=permissions_effectives_utilisateurs(pagination.items),
             role_display=f"Admin Client: {current_user.client.reference if current_user.client else 'Mon client'}"
         )
     
     # UTILISATEURS NORMAUX : voir la liste (lecture seule)
     elif current_user.has_permission('can_view_users_list'):
-        users = User.query.filter_by(
+        users_query = User.query.filter_by(
             client_id=current_user.client_id
         ).filter(
             User.role != 'super_admin',  # Pas de super admin
             User.is_client_admin == False  # Pas d'admin client
-        ).order_by(User.username).all()
+        ).order_by(User.username, User.id)
+        pagination = paginer(users_query, defaut=50)
         
         # Utiliser le template normal mais ajouter un indicateur
         return render_template(
             'admin/utilisateurs.html',  # Même template
-            users=users,
+            users=pagination.items,
+            pagination=pagination,
+            stats_users=statistiques_utilisateurs(users_query),
+            permissions_utilisateurs=permissions_effectives_utilisateurs(pagination.items),
             role_display="Liste des utilisateurs"
         )
     
@@ -10440,7 +9974,7 @@ def sync_client_permissions(client_id):
         flash(f'❌ Erreur: {str(e)}', 'error')
         return redirect(url_for('super_admin_client_detail', id=client_id))
 
-@app.before_request
+# Appelé par preparer_contexte_requete
 def auto_sync_user_permissions():
     """Synchronise automatiquement les permissions manquantes"""
     if current_user.is_authenticated:
@@ -10471,7 +10005,7 @@ def auto_sync_user_permissions():
                 if updated:
                     try:
                         db.session.commit()
-                        print(f"🔄 Permissions auto-synchronisées pour {current_user.username}")
+                        logger.info("Permissions auto-synchronisées pour %s", current_user.username)
                     except:
                         db.session.rollback()
 
@@ -11162,7 +10696,7 @@ def verify_user_permissions_on_update(user_id):
                 # Désactiver la permission
                 user.permissions[perm_key] = False
 
-@app.before_request
+# Appelé par preparer_contexte_requete
 def auto_verify_permissions():
     """Vérifie automatiquement les permissions pour les requêtes POST"""
     if request.method == 'POST' and current_user.is_authenticated:
@@ -11189,7 +10723,7 @@ def webhook_formule_updated(formule_id):
     return jsonify({'success': True, 'message': f'Permissions synchronisées pour la formule {formule.nom}'})
 
 
-@app.before_request
+# Appelé par preparer_contexte_requete
 def auto_correct_permissions():
     """Corrige automatiquement les permissions à chaque requête pour les admin client"""
     
@@ -12245,110 +11779,6 @@ def can_view_filter(endpoint):
     # Si pas dans la map, autoriser par défaut (sécurité)
     return True
 
-# Injecter dans tous les templates
-@app.context_processor
-def inject_permission_helpers():
-    """Injecte les helpers de permissions dans tous les templates"""
-    return {
-        'should_display_module': should_display_module,
-        'get_visible_modules': get_visible_modules,
-        'has_permission': lambda perm: current_user.permissions.get(perm, False) if current_user.is_authenticated else False,
-        'can_access_route': lambda endpoint: can_view_filter(endpoint)
-    }
-
-@app.before_request
-def check_module_access_middleware():
-    """
-    Middleware pour vérifier l'accès aux routes en fonction des permissions
-    - VERSION CORRIGÉE pour gestionnaire aussi
-    """
-    if not current_user.is_authenticated:
-        return
-    
-    # Ne pas vérifier pour certaines routes
-    exempt_routes = ['static', 'login', 'logout', 'public_home']
-    if request.endpoint in exempt_routes:
-        return
-    
-    # Liste des endpoints qui nécessitent une permission spécifique
-    protected_endpoints = {
-        # Risques
-        'liste_cartographies': 'can_manage_risks',
-        'nouvelle_cartographie': 'can_manage_risks',
-        'modifier_cartographie': 'can_manage_risks',
-        'detail_cartographie': 'can_manage_risks',
-        
-        # KRI
-        'liste_kri': 'can_manage_kri',
-        'nouveau_kri': 'can_manage_kri',
-        'modifier_kri': 'can_manage_kri',
-        
-        # Audit
-        'liste_audits': 'can_manage_audit',
-        'nouvel_audit': 'can_manage_audit',
-        'detail_audit': 'can_manage_audit',
-        
-        # Veille
-        'veille_reglementaire': 'can_manage_regulatory',
-        'nouvelle_veille': 'can_manage_regulatory',
-        
-        # Logigrammes
-        'liste_logigrammes': 'can_manage_logigram',
-        'nouveau_logigramme': 'can_manage_logigram',
-        'editer_logigramme': 'can_manage_logigram',
-        
-        # Plans d'action
-        'liste_plans_action': 'can_view_action_plans',
-        
-        # Utilisateurs - CORRECTION ICI
-        'admin_utilisateurs': 'can_view_users_list',
-        'admin_nouvel_utilisateur': 'can_create_users',  # CHANGÉ de 'can_edit_users' à 'can_create_users'
-        'admin_editer_utilisateur': 'can_edit_users',
-        
-        # Routes GESTIONNAIRE spécifiques
-        'gestionnaire_utilisateurs': 'can_view_users_list',
-        'gestionnaire_creer_utilisateur': 'can_create_users',  # AJOUTÉ
-        'gestionnaire_editer_utilisateur': 'can_edit_users',   # AJOUTÉ
-        'gestionnaire_gerer_permissions': 'can_manage_permissions',  # AJOUTÉ
-        
-        # Directions
-        'admin_directions': 'can_view_departments',
-        'nouvelle_direction': 'can_manage_departments',
-        
-        # Paramétrage
-        'parametrage_risque': 'can_manage_settings',
-        'parametrage_champs': 'can_manage_settings',
-        'parametrage_fichiers': 'can_manage_settings'
-    }
-    
-    endpoint = request.endpoint
-    
-    if endpoint in protected_endpoints:
-        required_permission = protected_endpoints[endpoint]
-        
-        # DEBUG
-        print(f"🔍 [MIDDLEWARE] Vérification endpoint: {endpoint}")
-        print(f"   Permission requise: {required_permission}")
-        print(f"   Utilisateur: {current_user.username} (rôle: {current_user.role})")
-        
-        # Vérifier la permission
-        has_perm = current_user.has_permission(required_permission)
-        print(f"   Résultat permission: {has_perm}")
-        
-        if not has_perm:
-            print(f"   ❌ Permission refusée par middleware")
-            
-            # Si c'est une route gestionnaire, proposer une solution
-            if endpoint.startswith('gestionnaire_'):
-                flash(f'Permission "{required_permission}" manquante. Les gestionnaires doivent avoir "can_manage_users = True" pour accéder à cette fonctionnalité.', 'error')
-            else:
-                flash(f'Accès non autorisé au module {endpoint}. Permission "{required_permission}" requise.', 'error')
-            
-            return redirect(url_for('dashboard'))
-        else:
-            print(f"   ✅ Permission accordée par middleware")
-
-
 @app.route('/activate-gestionnaire-permissions')
 @login_required
 def activate_gestionnaire_permissions():
@@ -13235,7 +12665,7 @@ def fix_all_admin_permissions():
         return jsonify({'error': str(e)}), 500
 
 
-@app.before_request
+# Appelé par preparer_contexte_requete
 def ensure_admin_client_permissions():
     """Garantit que les admin clients ont toujours les permissions de base"""
     
@@ -13265,15 +12695,15 @@ def ensure_admin_client_permissions():
                 if not current_user.permissions.get(perm, False):
                     current_user.permissions[perm] = True
                     needs_update = True
-                    print(f"🔄 Permission ajoutée pour {current_user.username}: {perm}")
+                    logger.info("Permission ajoutée pour %s: %s", current_user.username, perm)
             
             if needs_update:
                 try:
                     db.session.commit()
-                    print(f"✅ Permissions garanties pour admin client: {current_user.username}")
+                    logger.info("Permissions garanties pour admin client: %s", current_user.username)
                 except Exception as e:
                     db.session.rollback()
-                    print(f"⚠️ Erreur garantie permissions: {e}")
+                    logger.warning("Erreur garantie permissions: %s", e)
 
 
 @app.route('/debug/admin-permissions')
@@ -13348,32 +12778,6 @@ def format_permissions_filter(permissions_dict):
     
     return result
 
-@app.before_request
-def check_permissions():
-    """Vérifie les permissions pour chaque requête"""
-    if current_user.is_authenticated:
-        # Liste des endpoints protégés et leurs permissions requises
-        protected_endpoints = {
-            'liste_cartographies': 'can_manage_risks',
-            'nouvelle_cartographie': 'can_manage_risks',
-            'liste_kri': 'can_manage_kri',
-            'nouveau_kri': 'can_manage_kri',
-            'liste_audits': 'can_manage_audit',
-            'nouvel_audit': 'can_manage_audit',
-            'veille_reglementaire': 'can_manage_regulatory',
-            'liste_logigrammes': 'can_manage_logigram',
-            'admin_dashboard': 'can_manage_users',
-            'admin_utilisateurs': 'can_manage_users',
-            'rapports': 'can_view_reports',
-            'export_risques': 'can_export_data'
-        }
-        
-        endpoint = request.endpoint
-        if endpoint in protected_endpoints:
-            required_permission = protected_endpoints[endpoint]
-            if not current_user.has_permission(required_permission):
-                flash('Accès refusé : permissions insuffisantes', 'error')
-                return redirect(url_for('dashboard'))
 
             
 
@@ -15859,14 +15263,17 @@ def client_admin_dashboard():
 @super_admin_required
 def super_admin_dashboard():
     """Tableau de bord super admin"""
-    # Récupérer les statistiques
-    total_clients = Client.query.count()
-    clients_actifs = Client.query.filter_by(is_active=True).count()
+    # Récupérer les statistiques (agrégats en cache, portée globale)
+    def calculer_totaux():
+        return {
+            'total_clients': Client.query.count(),
+            'clients_actifs': Client.query.filter_by(is_active=True).count(),
+            'total_utilisateurs': User.query.count(),
+            'total_risques': Risque.query.filter_by(is_archived=False).count(),
+            'total_audits': Audit.query.filter_by(is_archived=False).count()
+        }
     
-    # Calculer les totaux globaux
-    total_utilisateurs = User.query.count()
-    total_risques = Risque.query.filter_by(is_archived=False).count()
-    total_audits = Audit.query.filter_by(is_archived=False).count()
+    totaux = cache_tableau_bord.obtenir('super_admin_dashboard', None, calculer_totaux)
     
     # Clients récents
     clients_recents = Client.query.order_by(Client.created_at.desc()).limit(5).all()
@@ -15877,13 +15284,9 @@ def super_admin_dashboard():
     ).limit(10).all()
     
     return render_template('super_admin/dashboard.html',
-                         total_clients=total_clients,
-                         clients_actifs=clients_actifs,
-                         total_utilisateurs=total_utilisateurs,
-                         total_risques=total_risques,
-                         total_audits=total_audits,
                          clients_recents=clients_recents,
-                         activites=activites)
+                         activites=activites,
+                         **totaux)
 
 
 # ========================
@@ -15899,20 +15302,6 @@ def debug_form_errors(form):
 
 
 
-# ========================
-# MIDDLEWARE DE FILTRAGE CLIENT
-# ========================
-
-@app.before_request
-def filter_client_data():
-    """Filtre automatiquement les données par client"""
-    if current_user.is_authenticated and not current_user.role == 'super_admin':
-        # Ne pas filtrer les routes publiques ou d'administration
-        if request.endpoint and not request.endpoint.startswith(('login', 'logout', 'static', 
-                                                                'super_admin', 'client_admin')):
-            # Ajouter le filtre client_id aux requêtes
-            g.client_id = current_user.client_id
-
 # Dans chaque route qui manipule des données, ajoutez ce filtre :
 def check_client_access(entite):
     """Vérifie que l'utilisateur a accès à l'entité"""
@@ -16005,115 +15394,127 @@ def dashboard():
     """Tableau de bord principal avec isolation multi-tenant complète"""
     from sqlalchemy import func, and_
     
-    # ========================
-    # 1. FILTRES DE BASE PAR CLIENT
-    # ========================
-    
-    # Risques avec filtre client
-    total_risques = get_client_filter(Risque).filter_by(is_archived=False).count()
-    
-    # KRI avec filtre client
-    total_kri = get_client_filter(KRI).filter_by(est_actif=True).count()
-    
-    # ========================
-    # 2. LOGIGRAMMES & PROCESSUS
-    # ========================
-    
-    # Logigrammes - seulement ceux de l'utilisateur
-    total_logigrammes = get_client_filter(ProcessusActivite).count()
-    logigrammes_actifs = get_client_filter(ProcessusActivite).filter_by(is_archived=False).count()
-    
-    # Processus pour compatibilité
-    total_processus = get_client_filter(Processus).count()
-    processus_actifs = get_client_filter(Processus).filter_by(statut='actif').count()
-    
-    # ========================
-    # 3. VEILLE RÉGLEMENTAIRE
-    # ========================
-    
-    # Veilles actives et non archivées
-    veilles_actives = get_client_filter(VeilleReglementaire).filter_by(
-        is_active=True, 
-        is_archived=False
-    ).count()
-    
-    # Actions retardées
-    actions_retardees = get_client_filter(ActionConformite).filter(
-        ActionConformite.date_echeance < datetime.now().date(),
-        ActionConformite.statut.in_(['a_faire', 'en_cours']),
-        ActionConformite.is_archived == False
-    ).count()
-    
-    # ========================
-    # 4. ANALYSE DES RISQUES
-    # ========================
-    
-    # Sous-requête pour les dernières évaluations
-    derniere_eval_subq = db.session.query(
-        EvaluationRisque.risque_id,
-        func.max(EvaluationRisque.created_at).label('max_date')
-    ).join(Risque, EvaluationRisque.risque_id == Risque.id)
-    
-    # Ajouter le filtre client pour les super admin uniquement
-    if current_user.role != 'super_admin':
-        derniere_eval_subq = derniere_eval_subq.filter(Risque.client_id == current_user.client_id)
+    # Les agrégats sont mis en cache par client (services/cache_tableau_bord.py)
+    # et invalidés à chaque écriture validée sur les modèles concernés.
+    client_dashboard_id = current_user.client_id if current_user.role != 'super_admin' else None
+    
+    def calculer_compteurs():
+        # ========================
+        # 1. FILTRES DE BASE PAR CLIENT
+        # ========================
+        compteurs = {
+            # Risques et KRI avec filtre client
+            'total_risques': get_client_filter(Risque).filter_by(is_archived=False).count(),
+            'total_kri': get_client_filter(KRI).filter_by(est_actif=True).count(),
+            
+            # ========================
+            # 2. LOGIGRAMMES & PROCESSUS
+            # ========================
+            'total_logigrammes': get_client_filter(ProcessusActivite).count(),
+            'logigrammes_actifs': get_client_filter(ProcessusActivite).filter_by(is_archived=False).count(),
+            'total_processus': get_client_filter(Processus).count(),
+            'processus_actifs': get_client_filter(Processus).filter_by(statut='actif').count(),
+            
+            # ========================
+            # 3. VEILLE RÉGLEMENTAIRE
+            # ========================
+            'veilles_actives': get_client_filter(VeilleReglementaire).filter_by(
+                is_active=True,
+                is_archived=False
+            ).count(),
+            'actions_retardees': get_client_filter(ActionConformite).filter(
+                ActionConformite.date_echeance < datetime.now().date(),
+                ActionConformite.statut.in_(['a_faire', 'en_cours']),
+                ActionConformite.is_archived == False
+            ).count()
+        }
+        return compteurs
     
-    derniere_eval_subq = derniere_eval_subq.group_by(EvaluationRisque.risque_id).subquery()
+    def calculer_indicateurs_risques():
+        # ========================
+        # 4. ANALYSE DES RISQUES (projection des évaluations courantes)
+        # ========================
+        indicateurs = {'repartition': repartition_niveaux(client_id=client_dashboard_id)}
+        
+        # ========================
+        # 7. ALERTES KRI
+        # ========================
+        derniere_mesure_subq = db.session.query(
+            MesureKRI.kri_id, func.max(MesureKRI.date_mesure).label('max_date')
+        ).join(KRI, MesureKRI.kri_id == KRI.id)
+        
+        if client_dashboard_id is not None:
+            derniere_mesure_subq = derniere_mesure_subq.filter(KRI.client_id == client_dashboard_id)
+        
+        derniere_mesure_subq = derniere_mesure_subq.group_by(MesureKRI.kri_id).subquery()
+        
+        kri_alertes_query = db.session.query(KRI).join(
+            derniere_mesure_subq, KRI.id == derniere_mesure_subq.c.kri_id
+        ).join(MesureKRI, and_(
+            MesureKRI.kri_id == KRI.id, 
+            MesureKRI.date_mesure == derniere_mesure_subq.c.max_date
+        )).join(Risque, KRI.risque_id == Risque.id)
+        
+        if client_dashboard_id is not None:
+            kri_alertes_query = kri_alertes_query.filter(
+                KRI.client_id == client_dashboard_id,
+                Risque.client_id == client_dashboard_id
+            )
+        
+        indicateurs['kri_alertes'] = kri_alertes_query.filter(
+            Risque.is_archived == False, 
+            KRI.est_actif == True,
+            KRI.seuil_alerte.isnot(None), 
+            MesureKRI.valeur >= KRI.seuil_alerte
+        ).count()
+        
+        # ========================
+        # 8. TENDANCE GLOBALE
+        # ========================
+        score_moyen = requete_evaluations_courantes(
+            func.avg(RisqueEvaluationCourante.score_risque), client_id=client_dashboard_id
+        ).scalar()
+        indicateurs['score_risque_moyen'] = round(score_moyen, 2) if score_moyen else 0
+        return indicateurs
     
-    # Niveaux de risques
-    niveaux_query = db.session.query(
-        EvaluationRisque.niveau_risque, func.count(EvaluationRisque.id)
-    ).select_from(EvaluationRisque).join(
-        derniere_eval_subq,
-        and_(
-            EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-            EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-        )
-    ).join(Risque, EvaluationRisque.risque_id == Risque.id)
+    # Même portée que dashboard_risques : get_client_filter ne filtre pas le super admin,
+    # même quand il visualise un client (ses compteurs sont ceux de la vue globale)
+    compteurs = cache_tableau_bord.obtenir(
+        'dashboard_compteurs', client_dashboard_id, calculer_compteurs
+    )
+    indicateurs = cache_tableau_bord.obtenir(
+        'dashboard_risques', client_dashboard_id, calculer_indicateurs_risques
+    )
     
-    # Filtrer par client
-    if current_user.role != 'super_admin':
-        niveaux_query = niveaux_query.filter(Risque.client_id == current_user.client_id)
-    
-    niveaux_risques = niveaux_query.filter(
-        Risque.is_archived == False, 
-        EvaluationRisque.niveau_risque.isnot(None)
-    ).group_by(EvaluationRisque.niveau_risque).all()
-    
-    # Compter les risques par niveau
-    risques_faibles = risques_moyens = risques_eleves = risques_critiques_count = 0
-    for niveau, count in niveaux_risques:
-        if niveau == 'Faible': 
-            risques_faibles = count
-        elif niveau == 'Moyen': 
-            risques_moyens = count
-        elif niveau == 'Élevé': 
-            risques_eleves = count
-        elif niveau == 'Critique': 
-            risques_critiques_count = count
+    total_risques = compteurs['total_risques']
+    total_kri = compteurs['total_kri']
+    total_logigrammes = compteurs['total_logigrammes']
+    logigrammes_actifs = compteurs['logigrammes_actifs']
+    total_processus = compteurs['total_processus']
+    processus_actifs = compteurs['processus_actifs']
+    veilles_actives = compteurs['veilles_actives']
+    actions_retardees = compteurs['actions_retardees']
+    
+    repartition = indicateurs['repartition']
+    risques_faibles = repartition.get('Faible', 0)
+    risques_moyens = repartition.get('Moyen', 0)
+    risques_eleves = repartition.get('Élevé', 0)
+    risques_critiques_count = repartition.get('Critique', 0)
+    kri_alertes = indicateurs['kri_alertes']
+    score_risque_moyen = indicateurs['score_risque_moyen']
     
     # ========================
     # 5. RISQUES CRITIQUES
     # ========================
     
     # Risques critiques avec évaluations
-    risques_critiques_query = db.session.query(Risque, EvaluationRisque
-    ).select_from(EvaluationRisque).join(
-        derniere_eval_subq,
-        and_(
-            EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-            EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-        )
-    ).join(Risque, EvaluationRisque.risque_id == Risque.id)
-    
-    # Filtrer par client
-    if current_user.role != 'super_admin':
-        risques_critiques_query = risques_critiques_query.filter(Risque.client_id == current_user.client_id)
-    
-    risques_critiques_list = risques_critiques_query.filter(
-        Risque.is_archived == False, 
-        EvaluationRisque.niveau_risque == 'Critique'
-    ).order_by(EvaluationRisque.score_risque.desc()
+    risques_critiques_list = requete_evaluations_courantes(
+        Risque, EvaluationRisque, client_id=client_dashboard_id
+    ).join(
+        EvaluationRisque, EvaluationRisque.id == RisqueEvaluationCourante.evaluation_id
+    ).filter(
+        RisqueEvaluationCourante.niveau_risque == 'Critique'
+    ).order_by(RisqueEvaluationCourante.score_risque.desc()
     ).limit(10).all()
     
     risques_critiques_formatted = [{'risque': r, 'evaluation': e} for r, e in risques_critiques_list]
@@ -16134,65 +15535,6 @@ def dashboard():
     
     cartographies = cartographies_query.all()
     
-    # ========================
-    # 7. ALERTES KRI
-    # ========================
-    
-    # Dernières mesures KRI
-    derniere_mesure_subq = db.session.query(
-        MesureKRI.kri_id, func.max(MesureKRI.date_mesure).label('max_date')
-    ).join(KRI, MesureKRI.kri_id == KRI.id)
-    
-    # Filtrer par client
-    if current_user.role != 'super_admin':
-        derniere_mesure_subq = derniere_mesure_subq.filter(KRI.client_id == current_user.client_id)
-    
-    derniere_mesure_subq = derniere_mesure_subq.group_by(MesureKRI.kri_id).subquery()
-    
-    # Alertes KRI
-    kri_alertes_query = db.session.query(KRI).join(
-        derniere_mesure_subq, KRI.id == derniere_mesure_subq.c.kri_id
-    ).join(MesureKRI, and_(
-        MesureKRI.kri_id == KRI.id, 
-        MesureKRI.date_mesure == derniere_mesure_subq.c.max_date
-    )).join(Risque, KRI.risque_id == Risque.id)
-    
-    # Filtrer par client
-    if current_user.role != 'super_admin':
-        kri_alertes_query = kri_alertes_query.filter(
-            KRI.client_id == current_user.client_id,
-            Risque.client_id == current_user.client_id
-        )
-    
-    kri_alertes = kri_alertes_query.filter(
-        Risque.is_archived == False, 
-        KRI.est_actif == True,
-        KRI.seuil_alerte.isnot(None), 
-        MesureKRI.valeur >= KRI.seuil_alerte
-    ).count()
-    
-    # ========================
-    # 8. TENDANCE GLOBALE
-    # ========================
-    
-    # Score de risque moyen
-    score_query = db.session.query(func.avg(EvaluationRisque.score_risque)
-    ).select_from(EvaluationRisque).join(
-        derniere_eval_subq,
-        and_(
-            EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-            EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-        )
-    ).join(Risque, EvaluationRisque.risque_id == Risque.id
-    ).filter(Risque.is_archived == False)
-    
-    # Filtrer par client
-    if current_user.role != 'super_admin':
-        score_query = score_query.filter(Risque.client_id == current_user.client_id)
-    
-    score_risque_moyen = score_query.scalar()
-    score_risque_moyen = round(score_risque_moyen, 2) if score_risque_moyen else 0
-    
     # Déterminer la tendance
     if score_risque_moyen < 8:
         tendance_globale, couleur_tendance = 'positive', 'success'
@@ -16217,10 +15559,7 @@ def dashboard():
     # Récupérer les notifications non lues
     notifications_non_lues = 0
     try:
-        notifications_non_lues = get_client_filter(Notification).filter_by(
-            destinataire_id=current_user.id,
-            est_lue=False
-        ).count()
+        notifications_non_lues = compteur_non_lues(current_user.id)
     except:
         pass  # Si le modèle Notification n'existe pas encore
     
@@ -16277,6 +15616,23 @@ def dashboard():
         }
     )
 
+def filtre_export_dashboard():
+    """
+    Conditions restreignant l'export du tableau de bord à un client.
+
+    Utilisateur : son client. Super admin : le client passé en paramètre
+    (client_id, transmis par le rendu en arrière-plan du rapport
+    'dashboard_pdf'), à défaut tous les clients.
+    Retourne une fonction modèle -> liste de conditions pour .filter(*...).
+    """
+    if current_user.role == 'super_admin':
+        client_id = request.args.get('client_id', type=int) or None
+        if client_id is None:
+            return lambda modele: []
+    else:
+        client_id = current_user.client_id
+    return lambda modele: [modele.client_id == client_id]
+
 @app.route('/export/dashboard')
 @login_required
 def export_dashboard():
@@ -16290,29 +15646,31 @@ def export_dashboard():
         from dateutil.relativedelta import relativedelta
         
         # --- RÉCUPÉRATION DES DONNÉES COMPLÈTES ---
+        du_client = filtre_export_dashboard()
         
         # 1. Statistiques principales
-        total_risques = Risque.query.filter_by(is_archived=False).count()
+        total_risques = Risque.query.filter(Risque.is_archived == False, *du_client(Risque)).count()
         
         # KRI actifs
         total_kri = db.session.query(KRI).join(
             Risque, KRI.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             KRI.est_actif == True
         ).count()
         
         # Processus et logigrammes
-        total_processus = Processus.query.count()
-        total_logigrammes = ProcessusActivite.query.count()
-        logigrammes_actifs = ProcessusActivite.query.filter_by(
-            is_archived=False
+        total_processus = Processus.query.filter(*du_client(Processus)).count()
+        total_logigrammes = ProcessusActivite.query.filter(*du_client(ProcessusActivite)).count()
+        logigrammes_actifs = ProcessusActivite.query.filter(
+            ProcessusActivite.is_archived == False, *du_client(ProcessusActivite)
         ).count()
         
         # Veilles actives
-        veilles_actives = VeilleReglementaire.query.filter_by(
-            is_active=True, 
-            is_archived=False
+        veilles_actives = VeilleReglementaire.query.filter(
+            VeilleReglementaire.is_active == True,
+            VeilleReglementaire.is_archived == False,
+            *du_client(VeilleReglementaire)
         ).count()
         
         # 2. Calcul des risques par niveau
@@ -16332,7 +15690,7 @@ def export_dashboard():
             )
         ).join(Risque, EvaluationRisque.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False, 
+            Risque.is_archived == False, *du_client(Risque),
             EvaluationRisque.niveau_risque.isnot(None)
         ).group_by(EvaluationRisque.niveau_risque).all()
         
@@ -16358,7 +15716,7 @@ def export_dashboard():
             func.count().label('count')
         ).join(Risque, EvaluationRisque.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             EvaluationRisque.created_at >= six_mois
         ).group_by(
             func.strftime('%Y-%m', EvaluationRisque.created_at),
@@ -16378,7 +15736,7 @@ def export_dashboard():
                 EvaluationRisque.created_at == derniere_eval_subq.c.max_date
             )
         ).filter(
-            Risque.is_archived == False
+            Risque.is_archived == False, *du_client(Risque)
         ).group_by(Cartographie.id
         ).order_by(func.avg(EvaluationRisque.score_risque).desc()
         ).limit(5).all()
@@ -16396,7 +15754,7 @@ def export_dashboard():
             MesureKRI.date_mesure == derniere_mesure_subq.c.max_date
         )).join(Risque, KRI.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             KRI.est_actif == True,
             KRI.seuil_alerte.isnot(None),
             MesureKRI.valeur >= KRI.seuil_alerte
@@ -16406,7 +15764,8 @@ def export_dashboard():
         actions_retardees = ActionConformite.query.filter(
             ActionConformite.date_echeance < datetime.now().date(),
             ActionConformite.statut.in_(['a_faire', 'en_cours']),
-            ActionConformite.is_archived == False
+            ActionConformite.is_archived == False,
+            *du_client(ActionConformite)
         ).join(VeilleReglementaire).filter(
             VeilleReglementaire.is_active == True,
             VeilleReglementaire.is_archived == False
@@ -16422,14 +15781,14 @@ def export_dashboard():
                 EvaluationRisque.created_at == derniere_eval_subq.c.max_date
             )
         ).join(Risque
-        ).filter(Risque.is_archived == False
+        ).filter(Risque.is_archived == False, *du_client(Risque)
         ).scalar()
         
         score_risque_moyen = round(score_risque_moyen, 2) if score_risque_moyen else 0
         
         # 8. Taux de couverture des risques (risques avec KRI)
         risques_avec_kri = db.session.query(Risque).join(KRI).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             KRI.est_actif == True
         ).distinct().count()
         
@@ -16455,20 +15814,20 @@ def export_dashboard():
                     EvaluationRisque.created_at == derniere_eval_subq.c.max_date
                 )
             ).join(Risque).filter(
-                Risque.is_archived == False,
+                Risque.is_archived == False, *du_client(Risque),
                 EvaluationRisque.niveau_risque == niveau
             ).scalar()
             scores_par_niveau[niveau] = round(score, 2) if score else 0
         
         # 11. Nouvelles données pour l'évolution
         nouveaux_risques_6_mois = Risque.query.filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             Risque.created_at >= six_mois
         ).count()
         
         # Risques avec faible score (considérés comme "clôturés")
         risques_clotures_6_mois = db.session.query(Risque).join(EvaluationRisque).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             EvaluationRisque.created_at >= six_mois,
             EvaluationRisque.score_risque <= 5
         ).distinct().count()
@@ -17023,24 +16382,28 @@ def generate_cartographie_rows(cartographies_risque):
 def export_dashboard_csv():
     """Export de secours en CSV enrichi (compatible SQLite)"""
     try:
-        import csv
-        from io import StringIO
-        from flask import Response
+        from services.export_tableur import reponse_csv
         from sqlalchemy import func, and_
         from datetime import datetime, timedelta
         
         # --- RÉCUPÉRATION DES DONNÉES (compatible SQLite) ---
-        total_risques = Risque.query.filter_by(is_archived=False).count()
+        du_client = filtre_export_dashboard()
+        total_risques = Risque.query.filter(Risque.is_archived == False, *du_client(Risque)).count()
         total_kri = db.session.query(KRI).join(
             Risque, KRI.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             KRI.est_actif == True
         ).count()
-        total_processus = Processus.query.count()
-        total_logigrammes = ProcessusActivite.query.count()
-        logigrammes_actifs = ProcessusActivite.query.filter_by(is_archived=False).count()
-        veilles_actives = VeilleReglementaire.query.filter_by(is_active=True, is_archived=False).count()
+        total_processus = Processus.query.filter(*du_client(Processus)).count()
+        total_logigrammes = ProcessusActivite.query.filter(*du_client(ProcessusActivite)).count()
+        logigrammes_actifs = ProcessusActivite.query.filter(
+            ProcessusActivite.is_archived == False, *du_client(ProcessusActivite)
+        ).count()
+        veilles_actives = VeilleReglementaire.query.filter(
+            VeilleReglementaire.is_active == True, VeilleReglementaire.is_archived == False,
+            *du_client(VeilleReglementaire)
+        ).count()
         
         # Données risques avec sous-requête
         derniere_eval_subq = db.session.query(
@@ -17059,7 +16422,7 @@ def export_dashboard_csv():
             )
         ).join(Risque, EvaluationRisque.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False, 
+            Risque.is_archived == False, *du_client(Risque),
             EvaluationRisque.niveau_risque.isnot(None)
         ).group_by(EvaluationRisque.niveau_risque).all()
         
@@ -17083,7 +16446,7 @@ def export_dashboard_csv():
             MesureKRI.date_mesure == derniere_mesure_subq.c.max_date
         )).join(Risque, KRI.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             KRI.est_actif == True,
             KRI.seuil_alerte.isnot(None),
             MesureKRI.valeur >= KRI.seuil_alerte
@@ -17093,7 +16456,8 @@ def export_dashboard_csv():
         actions_retardees = ActionConformite.query.filter(
             ActionConformite.date_echeance < datetime.now().date(),
             ActionConformite.statut.in_(['a_faire', 'en_cours']),
-            ActionConformite.is_archived == False
+            ActionConformite.is_archived == False,
+            *du_client(ActionConformite)
         ).join(VeilleReglementaire).filter(
             VeilleReglementaire.is_active == True,
             VeilleReglementaire.is_archived == False
@@ -17108,12 +16472,12 @@ def export_dashboard_csv():
                 EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
                 EvaluationRisque.created_at == derniere_eval_subq.c.max_date
             )
-        ).join(Risque).filter(Risque.is_archived == False).scalar()
+        ).join(Risque).filter(Risque.is_archived == False, *du_client(Risque)).scalar()
         score_risque_moyen = round(score_risque_moyen, 2) if score_risque_moyen else 0
         
         # Taux couverture
         risques_avec_kri = db.session.query(Risque).join(KRI).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             KRI.est_actif == True
         ).distinct().count()
         taux_couverture = round((risques_avec_kri / max(total_risques, 1)) * 100, 1) if total_risques > 0 else 0
@@ -17121,12 +16485,12 @@ def export_dashboard_csv():
         # Données évolutives
         six_mois = datetime.now() - timedelta(days=180)
         nouveaux_risques_6_mois = Risque.query.filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             Risque.created_at >= six_mois
         ).count()
         
         risques_clotures_6_mois = db.session.query(Risque).join(EvaluationRisque).filter(
-            Risque.is_archived == False,
+            Risque.is_archived == False, *du_client(Risque),
             EvaluationRisque.created_at >= six_mois,
             EvaluationRisque.score_risque <= 5
         ).distinct().count()
@@ -17139,104 +16503,93 @@ def export_dashboard_csv():
         pourcentage_critiques = round((risques_critiques_count / max(total_risques, 1)) * 100, 1) if total_risques > 0 else 0
         
         # --- CRÉATION DU CSV ENRICHIE ---
-        output = StringIO()
-        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
+        # Lignes envoyées en flux par services/export_tableur.py (BOM UTF-8, « ; »)
+        lignes = []
         
         # En-tête complète
-        writer.writerow(['TABLEAU DE BORD ANALYTIQUE - SYSTÈME DE MANAGEMENT DES RISQUES'])
-        writer.writerow(['Export généré le', datetime.now().strftime('%d/%m/%Y à %H:%M')])
-        writer.writerow(['Utilisateur', current_user.username])
-        writer.writerow(['Base de données', 'SQLite'])
-        writer.writerow([])
+        lignes.append(['TABLEAU DE BORD ANALYTIQUE - SYSTÈME DE MANAGEMENT DES RISQUES'])
+        lignes.append(['Export généré le', datetime.now().strftime('%d/%m/%Y à %H:%M')])
+        lignes.append(['Utilisateur', current_user.username])
+        lignes.append(['Base de données', 'SQLite'])
+        lignes.append([])
         
         # Section 1: Statistiques principales
-        writer.writerow(['SECTION 1: STATISTIQUES PRINCIPALES'])
-        writer.writerow(['Indicateur', 'Valeur', 'Détail', 'Pourcentage'])
-        writer.writerow(['Risques Actifs', total_risques, f'{risques_critiques_count} critiques', 
+        lignes.append(['SECTION 1: STATISTIQUES PRINCIPALES'])
+        lignes.append(['Indicateur', 'Valeur', 'Détail', 'Pourcentage'])
+        lignes.append(['Risques Actifs', total_risques, f'{risques_critiques_count} critiques', 
                         f'{pourcentage_critiques}%'])
-        writer.writerow(['KRI Surveillés', total_kri, f'{kri_alertes} en alerte', 
+        lignes.append(['KRI Surveillés', total_kri, f'{kri_alertes} en alerte', 
                         f'{round(kri_alertes/max(total_kri,1)*100,1)}%' if total_kri > 0 else '0%'])
-        writer.writerow(['Taux Couverture', f'{taux_couverture}%', f'{risques_avec_kri} risques couverts', '-'])
-        writer.writerow(['Score Moyen', f'{score_risque_moyen}/25', get_niveau_from_score(score_risque_moyen), '-'])
-        writer.writerow(['Veilles Actives', veilles_actives, f'{actions_retardees} retards', 
+        lignes.append(['Taux Couverture', f'{taux_couverture}%', f'{risques_avec_kri} risques couverts', '-'])
+        lignes.append(['Score Moyen', f'{score_risque_moyen}/25', get_niveau_from_score(score_risque_moyen), '-'])
+        lignes.append(['Veilles Actives', veilles_actives, f'{actions_retardees} retards', 
                         f'{round(actions_retardees/max(veilles_actives,1)*100,1)}%' if veilles_actives > 0 else '0%'])
-        writer.writerow(['Processus/Logigrammes', f'{total_processus}/{total_logigrammes}', 
+        lignes.append(['Processus/Logigrammes', f'{total_processus}/{total_logigrammes}', 
                         f'{logigrammes_actifs} actifs', 
                         f'{round(logigrammes_actifs/max(total_logigrammes,1)*100,1)}%' if total_logigrammes > 0 else '0%'])
-        writer.writerow([])
+        lignes.append([])
         
         # Section 2: Répartition des risques
-        writer.writerow(['SECTION 2: RÉPARTITION DES RISQUES'])
-        writer.writerow(['Niveau', 'Nombre', 'Pourcentage'])
+        lignes.append(['SECTION 2: RÉPARTITION DES RISQUES'])
+        lignes.append(['Niveau', 'Nombre', 'Pourcentage'])
         
         total_risques_niveles = max(risques_faibles + risques_moyens + risques_eleves + risques_critiques_count, 1)
         
-        writer.writerow(['Faible', risques_faibles, f'{risques_faibles/total_risques_niveles*100:.1f}%'])
-        writer.writerow(['Moyen', risques_moyens, f'{risques_moyens/total_risques_niveles*100:.1f}%'])
-        writer.writerow(['Élevé', risques_eleves, f'{risques_eleves/total_risques_niveles*100:.1f}%'])
-        writer.writerow(['Critique', risques_critiques_count, f'{risques_critiques_count/total_risques_niveles*100:.1f}%'])
-        writer.writerow(['TOTAL', total_risques_niveles, '100%'])
-        writer.writerow([])
+        lignes.append(['Faible', risques_faibles, f'{risques_faibles/total_risques_niveles*100:.1f}%'])
+        lignes.append(['Moyen', risques_moyens, f'{risques_moyens/total_risques_niveles*100:.1f}%'])
+        lignes.append(['Élevé', risques_eleves, f'{risques_eleves/total_risques_niveles*100:.1f}%'])
+        lignes.append(['Critique', risques_critiques_count, f'{risques_critiques_count/total_risques_niveles*100:.1f}%'])
+        lignes.append(['TOTAL', total_risques_niveles, '100%'])
+        lignes.append([])
         
         # Section 3: Alertes et recommandations
-        writer.writerow(['SECTION 3: ALERTES ET RECOMMANDATIONS'])
-        writer.writerow(['Type Alerte', 'Nombre', 'Priorité', 'Recommandation'])
-        writer.writerow(['Risques Critiques', risques_critiques_count, 'Haute', 
+        lignes.append(['SECTION 3: ALERTES ET RECOMMANDATIONS'])
+        lignes.append(['Type Alerte', 'Nombre', 'Priorité', 'Recommandation'])
+        lignes.append(['Risques Critiques', risques_critiques_count, 'Haute', 
                         'Réviser et mettre en place des actions correctives immédiates'])
-        writer.writerow(['KRI en Alerte', kri_alertes, 'Moyenne', 
+        lignes.append(['KRI en Alerte', kri_alertes, 'Moyenne', 
                         'Analyser les causes et ajuster les seuils si nécessaire'])
-        writer.writerow(['Actions en Retard', actions_retardees, 'Haute', 
+        lignes.append(['Actions en Retard', actions_retardees, 'Haute', 
                         'Mettre à jour les échéances et statuts'])
-        writer.writerow(['Risques non Couverts', total_risques - risques_avec_kri, 'Moyenne', 
+        lignes.append(['Risques non Couverts', total_risques - risques_avec_kri, 'Moyenne', 
                         'Définir des KRI pour les risques sans surveillance'])
-        writer.writerow([])
+        lignes.append([])
         
         # Section 4: Évolution
-        writer.writerow(['SECTION 4: ÉVOLUTION SUR 6 MOIS'])
-        writer.writerow(['Métrique', 'Valeur', 'Période'])
-        writer.writerow(['Nouveaux Risques', nouveaux_risques_6_mois, '6 derniers mois'])
-        writer.writerow(['Risques Clôturés', risques_clotures_6_mois, '6 derniers mois'])
-        writer.writerow(['Taux de Rotation', f'{taux_rotation}%', '6 derniers mois'])
-        writer.writerow(['Moyenne Mensuelle', f'{round(total_risques/6, 1)}', 'risques évalués/mois'])
-        writer.writerow([])
+        lignes.append(['SECTION 4: ÉVOLUTION SUR 6 MOIS'])
+        lignes.append(['Métrique', 'Valeur', 'Période'])
+        lignes.append(['Nouveaux Risques', nouveaux_risques_6_mois, '6 derniers mois'])
+        lignes.append(['Risques Clôturés', risques_clotures_6_mois, '6 derniers mois'])
+        lignes.append(['Taux de Rotation', f'{taux_rotation}%', '6 derniers mois'])
+        lignes.append(['Moyenne Mensuelle', f'{round(total_risques/6, 1)}', 'risques évalués/mois'])
+        lignes.append([])
         
         # Section 5: Synthèse
-        writer.writerow(['SECTION 5: SYNTHÈSE'])
-        writer.writerow(['Aspect', 'Évaluation', 'Commentaire'])
-        writer.writerow(['Maturité du Système', 
+        lignes.append(['SECTION 5: SYNTHÈSE'])
+        lignes.append(['Aspect', 'Évaluation', 'Commentaire'])
+        lignes.append(['Maturité du Système', 
                         'Élevée' if taux_couverture > 70 else 'Moyenne' if taux_couverture > 40 else 'Faible',
                         f'Couverture KRI: {taux_couverture}%'])
-        writer.writerow(['Niveau de Risque Global', 
+        lignes.append(['Niveau de Risque Global', 
                         get_niveau_from_score(score_risque_moyen),
                         f'Score moyen: {score_risque_moyen}/25'])
-        writer.writerow(['Vigilance Requise', 
+        lignes.append(['Vigilance Requise', 
                         'Élevée' if risques_critiques_count > 0 or actions_retardees > 5 else 'Moyenne',
                         f'{risques_critiques_count} critiques, {actions_retardees} retards'])
-        writer.writerow(['Tendance', 
+        lignes.append(['Tendance', 
                         get_tendance_text(score_risque_moyen),
                         get_tendance_text(score_risque_moyen).upper()])
-        writer.writerow([])
+        lignes.append([])
         
         # Notes
-        writer.writerow(['NOTES IMPORTANTES:'])
-        writer.writerow(['1. Les données excluent les éléments archivés'])
-        writer.writerow(['2. Les scores de risque sont sur une échelle de 0 à 25'])
-        writer.writerow(['3. La criticité est déterminée par le score: Faible(0-5), Moyen(6-10), Élevé(11-15), Critique(16-25)'])
-        writer.writerow(['4. Document généré automatiquement - Système de Management Intégré'])
-        writer.writerow(['5. Compatible SQLite - Utilisation de strftime pour les dates'])
-        
-        # Préparer la réponse
-        output.seek(0)
-        response = Response(
-            output.getvalue(),
-            mimetype='text/csv; charset=utf-8',
-            headers={
-                'Content-Disposition': f'attachment; filename=dashboard_analytique_{datetime.now().strftime("%Y%m%d_%H%M")}.csv',
-                'Content-Type': 'application/csv'
-            }
-        )
+        lignes.append(['NOTES IMPORTANTES:'])
+        lignes.append(['1. Les données excluent les éléments archivés'])
+        lignes.append(['2. Les scores de risque sont sur une échelle de 0 à 25'])
+        lignes.append(['3. La criticité est déterminée par le score: Faible(0-5), Moyen(6-10), Élevé(11-15), Critique(16-25)'])
+        lignes.append(['4. Document généré automatiquement - Système de Management Intégré'])
+        lignes.append(['5. Compatible SQLite - Utilisation de strftime pour les dates'])
         
-        return response
+        return reponse_csv(lignes, f'dashboard_analytique_{datetime.now().strftime("%Y%m%d_%H%M")}.csv')
         
     except Exception as e:
         flash(f'Erreur lors de l\'export CSV: {str(e)}', 'error')
@@ -17402,24 +16755,6 @@ def init_parametres_par_defaut():
         print(f"❌ Erreur initialisation paramètres: {e}")
         return False
 
-@app.context_processor
-def utility_processor():
-    def get_file_size(filepath):
-        # La même fonction que ci-dessus
-        try:
-            if os.path.exists(filepath):
-                size = os.path.getsize(filepath)
-                if size < 1024:
-                    return f"{size} B"
-                elif size < 1024 * 1024:
-                    return f"{size/1024:.1f} KB"
-                else:
-                    return f"{size/(1024*1024):.1f} MB"
-            return "N/A"
-        except:
-            return "N/A"
-    
-    return dict(get_file_size=get_file_size)
 
 # ------------------------------------------------------------
 # ROUTES D'ADMINISTRATION
@@ -18008,573 +17343,15 @@ def archiver_risque(id):
 @app.route('/export/risques-excel/<int:cartographie_id>')
 @login_required
 def export_risques_excel(cartographie_id):
-    """Export Excel complet des risques d'une cartographie - Version sans pandas"""
+    """Export Excel complet des risques d'une cartographie (écriture seule, requête pré-jointe)"""
     try:
-        from openpyxl import Workbook
-        from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
-        import io
-        from datetime import datetime
+        from services.export_cartographie import export_cartographie_excel
         
-        # Récupérer la cartographie
         cartographie = Cartographie.query.get_or_404(cartographie_id)
-        
-        # Récupérer tous les risques NON ARCHIVÉS
-        risques = Risque.query.filter_by(
-            cartographie_id=cartographie_id,
-            is_archived=False
-        ).all()
-        
-        # Créer un workbook
-        wb = Workbook()
-        
-        # Supprimer la feuille par défaut
-        wb.remove(wb.active)
-        
-        # ============================================================================
-        # FEUILLE 1 : DÉTAIL COMPLET DES RISQUES
-        # ============================================================================
-        ws_detail = wb.create_sheet("Détail Risques")
-        
-        # Titre principal
-        ws_detail.merge_cells('A1:X1')
-        ws_detail['A1'] = f"CARTOGRAPHIE DES RISQUES - {cartographie.nom.upper()}"
-        ws_detail['A1'].font = Font(size=14, bold=True, color="FFFFFF")
-        ws_detail['A1'].fill = PatternFill(start_color="2C3E50", end_color="2C3E50", fill_type="solid")
-        ws_detail['A1'].alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Informations de la cartographie
-        ws_detail['A2'] = f"Direction : {cartographie.direction.nom if cartographie.direction else 'Non spécifiée'}"
-        ws_detail['A3'] = f"Service : {cartographie.service.nom if cartographie.service else 'Non spécifié'}"
-        ws_detail['A4'] = f"Date d'export : {datetime.now().strftime('%d/%m/%Y à %H:%M')}"
-        ws_detail['A5'] = f"Nombre de risques : {len(risques)}"
-        
-        # En-têtes détaillés (commencer à la ligne 7)
-        headers = [
-            'Référence', 'Intitulé', 'Description', 'Catégorie', 'Type de risque',
-            'Processus concerné', 'Cause racine', 'Conséquences',
-            'Date création', 'Créé par',
-            # Évaluation
-            'Impact', 'Probabilité', 'Niveau de maîtrise', 'Score', 'Niveau de risque',
-            'Date dernière évaluation', 'Évaluateur', 'Commentaire évaluation',
-            # Informations complémentaires
-            'KRI associé', 'Dernière mesure KRI', 'Statut KRI',
-            'Priorité', 'Coût estimé', 'Date échéance'
-        ]
-        
-        # Ajouter les en-têtes
-        for col, header in enumerate(headers, 1):
-            cell = ws_detail.cell(row=7, column=col)
-            cell.value = header
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="34495E", end_color="34495E", fill_type="solid")
-            cell.alignment = Alignment(horizontal='center')
-            cell.border = Border(bottom=Side(style='thin'))
-        
-        # Couleurs pour les niveaux de risque
-        couleur_faible = PatternFill(start_color="27AE60", end_color="27AE60", fill_type="solid")  # Vert
-        couleur_moyen = PatternFill(start_color="F39C12", end_color="F39C12", fill_type="solid")   # Orange
-        couleur_eleve = PatternFill(start_color="E74C3C", end_color="E74C3C", fill_type="solid")   # Rouge
-        couleur_critique = PatternFill(start_color="8B0000", end_color="8B0000", fill_type="solid") # Rouge foncé
-        couleur_non_evalue = PatternFill(start_color="95A5A6", end_color="95A5A6", fill_type="solid") # Gris
-        
-        # Remplir les données (commencer à la ligne 8)
-        for row_idx, risque in enumerate(risques, 8):
-            # ========== INFORMATIONS DE BASE ==========
-            data_row = [
-                risque.reference,
-                risque.intitule,
-                risque.description or '',
-                risque.categorie or '',
-                risque.type_risque or '',
-                risque.processus_concerne or '',
-                risque.cause_racine or '',
-                risque.consequences or '',
-                risque.created_at.strftime('%d/%m/%Y') if risque.created_at else '',
-                risque.createur.username if risque.createur else ''
-            ]
-            
-            # ========== ÉVALUATION ==========
-            # Récupérer la dernière évaluation
-            derniere_eval = EvaluationRisque.query.filter_by(
-                risque_id=risque.id
-            ).order_by(EvaluationRisque.created_at.desc()).first()
-            
-            if derniere_eval:
-                # Calcul des valeurs finales selon la hiérarchie triphasée
-                impact_final = (
-                    derniere_eval.impact_conf 
-                    if derniere_eval.impact_conf and derniere_eval.impact_conf > 0 
-                    else derniere_eval.impact_val 
-                    if derniere_eval.impact_val and derniere_eval.impact_val > 0 
-                    else derniere_eval.impact_pre
-                )
-                
-                probabilite_final = (
-                    derniere_eval.probabilite_conf 
-                    if derniere_eval.probabilite_conf and derniere_eval.probabilite_conf > 0 
-                    else derniere_eval.probabilite_val 
-                    if derniere_eval.probabilite_val and derniere_eval.probabilite_val > 0 
-                    else derniere_eval.probabilite_pre
-                )
-                
-                niveau_maitrise_final = (
-                    derniere_eval.niveau_maitrise_conf 
-                    if derniere_eval.niveau_maitrise_conf and derniere_eval.niveau_maitrise_conf > 0 
-                    else derniere_eval.niveau_maitrise_val 
-                    if derniere_eval.niveau_maitrise_val and derniere_eval.niveau_maitrise_val > 0 
-                    else derniere_eval.niveau_maitrise_pre
-                )
-                
-                # Calculer le score et niveau de risque
-                if impact_final and probabilite_final:
-                    score_final = impact_final * probabilite_final
-                    niveau_final = calculer_niveau_risque(impact_final, probabilite_final)[0]
-                else:
-                    score_final = None
-                    niveau_final = "À évaluer"
-                
-                # Compléter les données d'évaluation
-                data_row.extend([
-                    impact_final or "À évaluer",
-                    probabilite_final or "À évaluer",
-                    niveau_maitrise_final or "À évaluer",
-                    score_final or "À évaluer",
-                    niveau_final,
-                    derniere_eval.created_at.strftime('%d/%m/%Y') if derniere_eval.created_at else '',
-                    derniere_eval.evaluateur_final.username if derniere_eval.evaluateur_final else 
-                        (derniere_eval.validateur.username if derniere_eval.validateur else 
-                        (derniere_eval.referent_pre_evaluation.username if derniere_eval.referent_pre_evaluation else '')),
-                    derniere_eval.commentaire_confirmation or 
-                        derniere_eval.commentaire_validation or 
-                        derniere_eval.commentaire_pre_evaluation or ''
-                ])
-            else:
-                # Pas d'évaluation
-                data_row.extend([
-                    "À évaluer", "À évaluer", "À évaluer", "À évaluer", "À évaluer",
-                    "", "", ""
-                ])
-            
-            # ========== KRI ASSOCIÉ ==========
-            kri = KRI.query.filter_by(risque_id=risque.id, est_actif=True).first()
-            if kri:
-                derniere_mesure = MesureKRI.query.filter_by(
-                    kri_id=kri.id
-                ).order_by(MesureKRI.date_mesure.desc()).first()
-                
-                data_row.extend([
-                    kri.nom,
-                    f"{derniere_mesure.valeur} {kri.unite_mesure}" if derniere_mesure else "Pas de mesure",
-                    "Actif"
-                ])
-            else:
-                data_row.extend(["", "", ""])
-            
-            # ========== CHAMPS PERSONNALISÉS ==========
-            # Récupérer les champs personnalisés
-            champs_personnalises = {}
-            for champ in risque.champs_personnalises:
-                champs_personnalises[champ.nom_technique] = champ.get_valeur()
-            
-            # Ajouter les champs personnalisés spécifiques
-            data_row.extend([
-                champs_personnalises.get('priorite', ''),
-                champs_personnalises.get('cout_estime', ''),
-                champs_personnalises.get('date_echeance', '') 
-                if champs_personnalises.get('date_echeance') 
-                else ''
-            ])
-            
-            # ========== AJOUTER LA LIGNE AU WORKSHEET ==========
-            for col, value in enumerate(data_row, 1):
-                cell = ws_detail.cell(row=row_idx, column=col)
-                cell.value = value
-                
-                # Mise en forme conditionnelle pour le niveau de risque (colonne O)
-                if col == 15:  # Colonne "Niveau de risque"
-                    if value == 'Faible':
-                        cell.fill = couleur_faible
-                        cell.font = Font(color="FFFFFF", bold=True)
-                    elif value == 'Moyen':
-                        cell.fill = couleur_moyen
-                        cell.font = Font(color="FFFFFF", bold=True)
-                    elif value == 'Élevé':
-                        cell.fill = couleur_eleve
-                        cell.font = Font(color="FFFFFF", bold=True)
-                    elif value == 'Critique':
-                        cell.fill = couleur_critique
-                        cell.font = Font(color="FFFFFF", bold=True)
-                    elif value == 'À évaluer' or value == 'Non évalué':
-                        cell.fill = couleur_non_evalue
-                        cell.font = Font(color="FFFFFF", bold=True)
-                        cell.value = "À ÉVALUER"
-                    cell.alignment = Alignment(horizontal='center')
-                
-                # Centrer les scores et valeurs numériques
-                if col in [11, 12, 13, 14]:  # Impact, Probabilité, Maîtrise, Score
-                    if isinstance(value, (int, float)):
-                        cell.alignment = Alignment(horizontal='center')
-                    elif value == "À évaluer":
-                        cell.font = Font(color="FF0000", italic=True)
-                        cell.alignment = Alignment(horizontal='center')
-                
-                # Mise en forme pour les champs manquants
-                if value == "À évaluer":
-                    cell.fill = PatternFill(start_color="FFEAA7", end_color="FFEAA7", fill_type="solid")
-        
-        # Ajuster les largeurs de colonnes
-        column_widths = [15, 40, 50, 15, 15, 20, 30, 30, 12, 15, 
-                        10, 12, 12, 10, 15, 12, 15, 30, 20, 15, 12, 12, 15, 12]
-        for col, width in enumerate(column_widths, 1):
-            ws_detail.column_dimensions[chr(64 + col)].width = width
-        
-        # ============================================================================
-        # FEUILLE 2 : RISQUES À ÉVALUER
-        # ============================================================================
-        ws_a_evaluer = wb.create_sheet("Risques à évaluer")
-        
-        ws_a_evaluer.merge_cells('A1:F1')
-        ws_a_evaluer['A1'] = "RISQUES À ÉVALUER"
-        ws_a_evaluer['A1'].font = Font(size=14, bold=True, color="FFFFFF")
-        ws_a_evaluer['A1'].fill = PatternFill(start_color="FF6B6B", end_color="FF6B6B", fill_type="solid")
-        ws_a_evaluer['A1'].alignment = Alignment(horizontal='center')
-        
-        # Informations de la cartographie
-        ws_a_evaluer['A2'] = f"Cartographie : {cartographie.nom}"
-        ws_a_evaluer['A3'] = f"Nombre total de risques : {len(risques)}"
-        
-        # En-têtes (ligne 5)
-        headers_a_evaluer = ['Référence', 'Intitulé', 'Catégorie', 'Date création', 'Créé par', 'Dernière évaluation']
-        for col, header in enumerate(headers_a_evaluer, 1):
-            cell = ws_a_evaluer.cell(row=5, column=col)
-            cell.value = header
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="E74C3C", end_color="E74C3C", fill_type="solid")
-            cell.alignment = Alignment(horizontal='center')
-        
-        # Récupérer les risques sans évaluation ou avec évaluation incomplète
-        risques_a_evaluer = []
-        for risque in risques:
-            derniere_eval = EvaluationRisque.query.filter_by(
-                risque_id=risque.id
-            ).order_by(EvaluationRisque.created_at.desc()).first()
-            
-            doit_etre_evalue = False
-            
-            if not derniere_eval:
-                doit_etre_evalue = True
-            else:
-                # Vérifier si l'évaluation est incomplète
-                impact_final = (
-                    derniere_eval.impact_conf or 
-                    derniere_eval.impact_val or 
-                    derniere_eval.impact_pre
-                )
-                probabilite_final = (
-                    derniere_eval.probabilite_conf or 
-                    derniere_eval.probabilite_val or 
-                    derniere_eval.probabilite_pre
-                )
-                
-                if not impact_final or not probabilite_final:
-                    doit_etre_evalue = True
-            
-            if doit_etre_evalue:
-                risques_a_evaluer.append({
-                    'risque': risque,
-                    'derniere_eval': derniere_eval,
-                    'motif': "Pas d'évaluation" if not derniere_eval else "Évaluation incomplète"
-                })
-        
-        # Ajouter les risques à évaluer (ligne 6)
-        for row_idx, item in enumerate(risques_a_evaluer, 6):
-            data = [
-                item['risque'].reference,
-                item['risque'].intitule,
-                item['risque'].categorie or '',
-                item['risque'].created_at.strftime('%d/%m/%Y') if item['risque'].created_at else '',
-                item['risque'].createur.username if item['risque'].createur else '',
-                item['derniere_eval'].created_at.strftime('%d/%m/%Y') if item['derniere_eval'] else 'Jamais'
-            ]
-            
-            for col, value in enumerate(data, 1):
-                cell = ws_a_evaluer.cell(row=row_idx, column=col)
-                cell.value = value
-                
-                # Mettre en évidence
-                cell.fill = PatternFill(start_color="FFEAA7", end_color="FFEAA7", fill_type="solid")
-                if col == 6 and value == 'Jamais':
-                    cell.font = Font(color="E74C3C", bold=True)
-        
-        if not risques_a_evaluer:
-            cell = ws_a_evaluer.cell(row=6, column=1)
-            cell.value = "✅ Tous les risques sont à jour !"
-            cell.font = Font(color="27AE60", bold=True)
-            ws_a_evaluer.merge_cells('A6:F6')
-            cell.alignment = Alignment(horizontal='center')
-        
-        # Ajuster les largeurs
-        for col in range(1, 7):
-            ws_a_evaluer.column_dimensions[chr(64 + col)].width = 20
-        
-        # ============================================================================
-        # FEUILLE 3 : TABLEAU DE BORDEAUX
-        # ============================================================================
-        ws_bordeaux = wb.create_sheet("Tableau de Bordeaux")
-        
-        ws_bordeaux.merge_cells('A1:D1')
-        ws_bordeaux['A1'] = "TABLEAU DE BORDEAUX - CLASSEMENT DES RISQUES"
-        ws_bordeaux['A1'].font = Font(size=14, bold=True, color="FFFFFF")
-        ws_bordeaux['A1'].fill = PatternFill(start_color="2C3E50", end_color="2C3E50", fill_type="solid")
-        ws_bordeaux['A1'].alignment = Alignment(horizontal='center')
-        
-        # Informations de la cartographie
-        ws_bordeaux['A2'] = f"Cartographie : {cartographie.nom}"
-        
-        # Catégories du tableau de Bordeaux (ligne 4)
-        categories = [
-            ('ACTIONS PRIORITAIRES (Critiques)', couleur_critique),
-            ('SURVEILLANCE RENFORCÉE (Élevés)', couleur_eleve),
-            ('SURVEILLANCE COURANTE (Moyens)', couleur_moyen),
-            ('ACTIONS LIMITÉES (Faibles)', couleur_faible)
-        ]
-        
-        row_start = 4
-        for cat_index, (categorie, couleur) in enumerate(categories):
-            # En-tête de catégorie
-            ws_bordeaux.merge_cells(f'A{row_start}:D{row_start}')
-            cell = ws_bordeaux.cell(row=row_start, column=1)
-            cell.value = categorie
-            cell.fill = couleur
-            cell.font = Font(color="FFFFFF", bold=True)
-            cell.alignment = Alignment(horizontal='center')
-            
-            # Sous-en-têtes (ligne suivante)
-            headers_bordeaux = ['Référence', 'Intitulé', 'Score', 'Niveau']
-            for col, header in enumerate(headers_bordeaux, 1):
-                cell = ws_bordeaux.cell(row=row_start + 1, column=col)
-                cell.value = header
-                cell.font = Font(bold=True)
-                cell.fill = PatternFill(start_color="ECF0F1", end_color="ECF0F1", fill_type="solid")
-            
-            # Récupérer les risques par niveau
-            niveau = categorie.split('(')[1].replace(')', '').strip()
-            risques_niveau = []
-            
-            for risque in risques:
-                derniere_eval = EvaluationRisque.query.filter_by(
-                    risque_id=risque.id
-                ).order_by(EvaluationRisque.created_at.desc()).first()
-                
-                if derniere_eval and derniere_eval.niveau_risque == niveau:
-                    risques_niveau.append({
-                        'risque': risque,
-                        'evaluation': derniere_eval
-                    })
-            
-            # Trier par score décroissant
-            risques_niveau.sort(key=lambda x: x['evaluation'].score_risque or 0, reverse=True)
-            
-            # Ajouter les risques (ligne suivante)
-            for risk_idx, item in enumerate(risques_niveau, row_start + 2):
-                data_risk = [
-                    item['risque'].reference,
-                    item['risque'].intitule[:50] + "..." if len(item['risque'].intitule) > 50 else item['risque'].intitule,
-                    item['evaluation'].score_risque or 0,
-                    item['evaluation'].niveau_risque or 'Non évalué'
-                ]
-                
-                for col, value in enumerate(data_risk, 1):
-                    cell = ws_bordeaux.cell(row=risk_idx, column=col)
-                    cell.value = value
-                    
-                    # Appliquer la couleur pour la colonne niveau
-                    if col == 4:
-                        if value == 'Faible':
-                            cell.fill = couleur_faible
-                            cell.font = Font(color="FFFFFF", bold=True)
-                        elif value == 'Moyen':
-                            cell.fill = couleur_moyen
-                            cell.font = Font(color="FFFFFF", bold=True)
-                        elif value == 'Élevé':
-                            cell.fill = couleur_eleve
-                            cell.font = Font(color="FFFFFF", bold=True)
-                        elif value == 'Critique':
-                            cell.fill = couleur_critique
-                            cell.font = Font(color="FFFFFF", bold=True)
-            
-            if not risques_niveau:
-                # Aucun risque dans cette catégorie
-                cell = ws_bordeaux.cell(row=row_start + 2, column=1)
-                cell.value = "Aucun risque"
-                cell.font = Font(italic=True, color="95A5A6")
-                risk_idx = row_start + 2
-            
-            row_start = risk_idx + 3
-        
-        # Ajuster les largeurs
-        ws_bordeaux.column_dimensions['A'].width = 15
-        ws_bordeaux.column_dimensions['B'].width = 40
-        ws_bordeaux.column_dimensions['C'].width = 10
-        ws_bordeaux.column_dimensions['D'].width = 12
-        
-        # ============================================================================
-        # FEUILLE 4 : STATISTIQUES
-        # ============================================================================
-        ws_stats = wb.create_sheet("Statistiques")
-        
-        ws_stats.merge_cells('A1:C1')
-        ws_stats['A1'] = "STATISTIQUES DE LA CARTOGRAPHIE"
-        ws_stats['A1'].font = Font(size=14, bold=True, color="FFFFFF")
-        ws_stats['A1'].fill = PatternFill(start_color="2C3E50", end_color="2C3E50", fill_type="solid")
-        ws_stats['A1'].alignment = Alignment(horizontal='center')
-        
-        # Informations de base (ligne 3)
-        ws_stats['A3'] = f"Cartographie : {cartographie.nom}"
-        ws_stats['A4'] = f"Direction : {cartographie.direction.nom if cartographie.direction else 'Non spécifiée'}"
-        ws_stats['A5'] = f"Service : {cartographie.service.nom if cartographie.service else 'Non spécifié'}"
-        ws_stats['A6'] = f"Nombre total de risques : {len(risques)}"
-        ws_stats['A7'] = f"Date d'export : {datetime.now().strftime('%d/%m/%Y %H:%M')}"
-        
-        # Calcul des statistiques (ligne 9)
-        row_start = 9
-        
-        # Distribution par niveau de risque
-        ws_stats.cell(row=row_start, column=1, value="NIVEAU DE RISQUE")
-        ws_stats.cell(row=row_start, column=2, value="NOMBRE")
-        ws_stats.cell(row=row_start, column=3, value="POURCENTAGE")
-        
-        # Mise en forme de l'en-tête
-        for col in [1, 2, 3]:
-            cell = ws_stats.cell(row=row_start, column=col)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="34495E", end_color="34495E", fill_type="solid")
-        
-        niveaux = {'Critique': 0, 'Élevé': 0, 'Moyen': 0, 'Faible': 0, 'À évaluer': 0}
-        for risque in risques:
-            derniere_eval = EvaluationRisque.query.filter_by(
-                risque_id=risque.id
-            ).order_by(EvaluationRisque.created_at.desc()).first()
-            
-            if derniere_eval and derniere_eval.niveau_risque:
-                niveau = derniere_eval.niveau_risque
-                if niveau in niveaux:
-                    niveaux[niveau] += 1
-            else:
-                niveaux['À évaluer'] += 1
-        
-        # Ajouter les statistiques de niveau (ligne 10+)
-        for idx, (niveau, count) in enumerate(niveaux.items(), row_start + 1):
-            ws_stats.cell(row=idx, column=1, value=niveau)
-            ws_stats.cell(row=idx, column=2, value=count)
-            
-            # Calculer le pourcentage
-            total = len(risques)
-            pourcentage = (count / total * 100) if total > 0 else 0
-            ws_stats.cell(row=idx, column=3, value=f"{pourcentage:.1f}%")
-            
-            # Mise en forme conditionnelle
-            cell_niveau = ws_stats.cell(row=idx, column=1)
-            if niveau == 'Critique':
-                cell_niveau.fill = couleur_critique
-                cell_niveau.font = Font(color="FFFFFF", bold=True)
-            elif niveau == 'Élevé':
-                cell_niveau.fill = couleur_eleve
-                cell_niveau.font = Font(color="FFFFFF", bold=True)
-            elif niveau == 'Moyen':
-                cell_niveau.fill = couleur_moyen
-                cell_niveau.font = Font(color="FFFFFF", bold=True)
-            elif niveau == 'Faible':
-                cell_niveau.fill = couleur_faible
-                cell_niveau.font = Font(color="FFFFFF", bold=True)
-            elif niveau == 'À évaluer':
-                cell_niveau.fill = couleur_non_evalue
-                cell_niveau.font = Font(color="FFFFFF", bold=True)
-        
-        # État des évaluations (après un saut de ligne)
-        row_start = idx + 3
-        ws_stats.cell(row=row_start, column=1, value="ÉTAT ÉVALUATION")
-        ws_stats.cell(row=row_start, column=2, value="NOMBRE")
-        ws_stats.cell(row=row_start, column=3, value="POURCENTAGE")
-        
-        # Mise en forme de l'en-tête
-        for col in [1, 2, 3]:
-            cell = ws_stats.cell(row=row_start, column=col)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="34495E", end_color="34495E", fill_type="solid")
-        
-        # Calculer les états d'évaluation
-        eval_completes = 0
-        eval_incompletes = 0
-        sans_eval = 0
-        
-        for risque in risques:
-            derniere_eval = EvaluationRisque.query.filter_by(
-                risque_id=risque.id
-            ).order_by(EvaluationRisque.created_at.desc()).first()
-            
-            if not derniere_eval:
-                sans_eval += 1
-            else:
-                impact_final = (
-                    derniere_eval.impact_conf or 
-                    derniere_eval.impact_val or 
-                    derniere_eval.impact_pre
-                )
-                probabilite_final = (
-                    derniere_eval.probabilite_conf or 
-                    derniere_eval.probabilite_val or 
-                    derniere_eval.probabilite_pre
-                )
-                
-                if impact_final and probabilite_final:
-                    eval_completes += 1
-                else:
-                    eval_incompletes += 1
-        
-        # Ajouter les états d'évaluation
-        stats_eval = [
-            ('Évaluations complètes', eval_completes),
-            ('Évaluations incomplètes', eval_incompletes),
-            ('Sans évaluation', sans_eval)
-        ]
-        
-        for idx, (label, count) in enumerate(stats_eval, row_start + 1):
-            ws_stats.cell(row=idx, column=1, value=label)
-            ws_stats.cell(row=idx, column=2, value=count)
-            
-            # Calculer le pourcentage
-            total = len(risques)
-            pourcentage = (count / total * 100) if total > 0 else 0
-            ws_stats.cell(row=idx, column=3, value=f"{pourcentage:.1f}%")
-        
-        # Ajuster les largeurs
-        ws_stats.column_dimensions['A'].width = 25
-        ws_stats.column_dimensions['B'].width = 15
-        ws_stats.column_dimensions['C'].width = 15
-        
-        # ============================================================================
-        # SAUVEGARDE ET RETOUR DU FICHIER
-        # ============================================================================
-        # Sauvegarder dans un buffer
-        buffer = io.BytesIO()
-        wb.save(buffer)
-        buffer.seek(0)
-        
-        # Retourner le fichier Excel
-        from flask import Response
-        return Response(
-            buffer.getvalue(),
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={
-                "Content-Disposition": f"attachment; filename=risques_{cartographie.nom.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-            }
-        )
+        return export_cartographie_excel(cartographie)
         
     except Exception as e:
-        print(f"Erreur détaillée export Excel: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Erreur export Excel cartographie %s", cartographie_id)
         flash(f'Erreur lors de l\'export Excel: {str(e)}', 'error')
         return redirect(url_for('detail_cartographie', id=cartographie_id))
 # Route restauration risque
@@ -21961,22 +20738,21 @@ def detail_cartographie(id):
     evaluations_campagne = []
     risques_avec_evaluation = []
     
-    for risque in cartographie.risques:
-        # Ignorer les risques archivés
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-        
-        # Vérifier l'accès au risque
-        if not check_client_access(risque):
-            print(f"⚠️ Risque {risque.reference} inaccessible, ignoré")
-            continue
-        
-        # CORRECTION : Filtrer l'évaluation par client
-        evaluation = get_client_filter(EvaluationRisque)\
-            .filter_by(
-                risque_id=risque.id,
-                campagne_id=campagne_active.id
-            ).order_by(EvaluationRisque.created_at.desc()).first()
+    risques_actifs = [r for r in cartographie.risques
+                      if not getattr(r, 'is_archived', False) and check_client_access(r)]
+    
+    # Dernière évaluation de chaque risque dans la campagne, en une seule requête
+    evaluations_par_risque = {}
+    if risques_actifs:
+        evaluations_requete = get_client_filter(EvaluationRisque)\
+            .filter(EvaluationRisque.campagne_id == campagne_active.id,
+                    EvaluationRisque.risque_id.in_([r.id for r in risques_actifs]))\
+            .order_by(EvaluationRisque.created_at.desc())
+        for evaluation in evaluations_requete:
+            evaluations_par_risque.setdefault(evaluation.risque_id, evaluation)
+    
+    for risque in risques_actifs:
+        evaluation = evaluations_par_risque.get(risque.id)
         
         if evaluation:
             # Vérifier que l'évaluation a des valeurs valides
@@ -21988,85 +20764,46 @@ def detail_cartographie(id):
                           evaluation.probabilite_pre)
             
             if impact and probabilite and impact > 0 and probabilite > 0:
-                print(f"📊 Évaluation valide pour {risque.reference} dans campagne {campagne_active.nom}")
                 evaluations_campagne.append(evaluation)
-            
-            risques_avec_evaluation.append({
-                'risque': risque,
-                'evaluation': evaluation,
-                'est_evalue': True
-            })
-        else:
-            # Pas d'évaluation dans cette campagne
-            risques_avec_evaluation.append({
-                'risque': risque,
-                'evaluation': None,
-                'est_evalue': False
-            })
+        
+        risques_avec_evaluation.append({
+            'risque': risque,
+            'evaluation': evaluation,
+            'est_evalue': evaluation is not None
+        })
     
     print(f"📊 Cartographie {cartographie.nom}: {len(evaluations_campagne)} évaluations valides dans la campagne '{campagne_active.nom}'")
     
-    # ========== GÉNÉRATION DES MATRICES ==========
+    # ========== GÉNÉRATION DES MATRICES (SVG en cache) ==========
+    matrice_classique = None
+    matrice_criticite = None
+    matrice_priorisation = None
+    matrice_surbrillance = None
+    
     if evaluations_campagne:
+        portee_matrice = {'cartographie_id': id, 'campagne_id': campagne_active.id}
         try:
-            from utils import generer_matrice_risques, generer_matrice_risque_specifique
-            
-            print(f"🔄 Génération matrice classique pour campagne {campagne_active.nom}...")
-            matrice_classique = generer_matrice_risques(evaluations_campagne, 'classique')
-            
-            print(f"🔄 Génération matrice criticité pour campagne {campagne_active.nom}...")
-            matrice_criticite = generer_matrice_risques(evaluations_campagne, 'criticite')
-            
-            print(f"🔄 Génération matrice priorisation pour campagne {campagne_active.nom}...")
-            matrice_priorisation = generer_matrice_risques(evaluations_campagne, 'priorisation')
-            
-            # Générer une matrice par défaut avec le premier risque en surbrillance
-            risque_surbrillance = None
-            risques_actifs = [r for r in cartographie.risques 
-                            if not getattr(r, 'is_archived', False) 
-                            and check_client_access(r)]
-            
-            if risques_actifs:
-                risque_surbrillance = risques_actifs[0]
-                # Chercher son évaluation dans la campagne active
-                evaluation_surbrillance = None
-                for eval_item in evaluations_campagne:
-                    if eval_item.risque_id == risque_surbrillance.id:
-                        evaluation_surbrillance = eval_item
-                        break
-                
-                if evaluation_surbrillance:
-                    print(f"🎯 Génération matrice surbrillance pour: {risque_surbrillance.reference}")
-                    matrice_surbrillance = generer_matrice_risque_specifique(evaluations_campagne, risque_surbrillance)
-                else:
-                    matrice_surbrillance = None
-            else:
-                matrice_surbrillance = None
-                
+            matrice_classique = matrice_svg(evaluations_campagne, 'classique', **portee_matrice)
+            matrice_criticite = matrice_svg(evaluations_campagne, 'criticite', **portee_matrice)
+            matrice_priorisation = matrice_svg(evaluations_campagne, 'priorisation', **portee_matrice)
+            
+            # Matrice par défaut avec le premier risque en surbrillance (s'il est évalué)
+            if risques_actifs and any(e.risque_id == risques_actifs[0].id for e in evaluations_campagne):
+                matrice_surbrillance = matrice_svg(evaluations_campagne, 'classique',
+                                                   risque_cible_id=risques_actifs[0].id, **portee_matrice)
         except Exception as e:
             print(f"❌ Erreur génération matrices: {e}")
             import traceback
             traceback.print_exc()
-            # Matrices vides en cas d'erreur
-            matrice_classique = None
-            matrice_criticite = None
-            matrice_priorisation = None
-            matrice_surbrillance = None
     else:
         # Pas d'évaluations dans cette campagne, matrices vides
         print(f"⚠️ Aucune évaluation valide trouvée dans la campagne '{campagne_active.nom}'")
-        matrice_classique = None
-        matrice_criticite = None
-        matrice_priorisation = None
-        matrice_surbrillance = None
     
     # ========== TABLEAU DE BORDEAUX (basé sur la campagne active) ==========
     tableau_bordeaux = generer_tableau_bordeaux_campagne(cartographie.risques, campagne_active.id)
     
     # ========== STATISTIQUES ==========
-    nb_risques_total = len([r for r in cartographie.risques 
-                           if not getattr(r, 'is_archived', False) 
-                           and check_client_access(r)])
+    nb_risques_total = len(risques_actifs)
     nb_risques_evalues = len([r for r in risques_avec_evaluation if r['est_evalue']])
     progression_campagne = int((nb_risques_evalues / nb_risques_total * 100) if nb_risques_total > 0 else 0)
     
@@ -22617,12 +21354,11 @@ def supprimer_toutes_lues():
 @login_required
 def api_notifications_count():
     """API pour obtenir le nombre de notifications non lues"""
-    count = Notification.query.filter_by(
-        destinataire_id=current_user.id,
-        est_lue=False
-    ).count()
+    count, etag = etag_notifications(current_user.id)
+    if request.if_none_match.contains(etag):
+        return reponse_non_modifiee(etag)
     
-    return jsonify({'count': count})
+    return avec_etag(jsonify({'count': count}), etag)
 
 @app.route('/api/notifications/recent')
 @login_required
@@ -22630,6 +21366,10 @@ def api_notifications_recent():
     """API pour les notifications récentes (pour dropdown)"""
     limit = request.args.get('limit', 5, type=int)
     
+    count, etag = etag_notifications(current_user.id, limit)
+    if request.if_none_match.contains(etag):
+        return reponse_non_modifiee(etag)
+    
     notifications = Notification.query.filter_by(
         destinataire_id=current_user.id
     ).order_by(
@@ -22660,13 +21400,10 @@ def api_notifications_recent():
             'color': 'primary'
         })
     
-    return jsonify({
+    return avec_etag(jsonify({
         'notifications': notifications_data,
-        'count': Notification.query.filter_by(
-            destinataire_id=current_user.id,
-            est_lue=False
-        ).count()
-    })
+        'count': count
+    }), etag)
 
 # ==================== ROUTE PREFERENCES (simplifiée) ====================
 
@@ -22929,9 +21666,11 @@ def matrice_risque_specifique(cartographie_id, risque_id):
     # CORRECTION : Récupérer TOUTES les évaluations VALIDES avec isolation
     evaluations = []
     
-    # Récupérer les risques de la cartographie avec isolation
+    # Récupérer les risques de la cartographie avec isolation (évaluations préchargées)
+    from sqlalchemy.orm import selectinload
     risques_cartographie = get_client_filter(Risque)\
         .filter_by(cartographie_id=cartographie_id, is_archived=False)\
+        .options(selectinload(Risque.evaluations))\
         .all()
     
     print(f"🎯 Matrice spécifique - Cartographie: {cartographie.nom} (ID: {cartographie_id})")
@@ -22941,12 +21680,6 @@ def matrice_risque_specifique(cartographie_id, risque_id):
     for risque in risques_cartographie:
         # Vérifier l'accès au risque
         if not check_client_access(risque):
-            print(f"⚠️ Risque {risque.reference} inaccessible pour l'utilisateur")
-            continue
-            
-        # Ignorer les risques archivés (double vérification)
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            print(f"❌ Risque {risque.reference} archivé - ignoré")
             continue
             
         # Prendre TOUTES les évaluations pour avoir une vue complète
@@ -22965,29 +21698,14 @@ def matrice_risque_specifique(cartographie_id, risque_id):
             
             if impact and probabilite and impact > 0 and probabilite > 0:
                 evaluations.append(evaluation)
-                print(f"   ✅ Évaluation ajoutée: Risque {risque.reference}, Impact: {impact}, Probabilité: {probabilite}")
     
     print(f"📊 Total évaluations valides et accessibles: {len(evaluations)}")
     
-    # Générer la matrice avec le risque en surbrillance
+    # Générer la matrice (SVG en cache) avec le risque en surbrillance
     try:
-        if 'generer_matrice_risque_specifique' in globals():
-            matrice_surbrillance = generer_matrice_risque_specifique(evaluations, risque_cible)
-        else:
-            # Fallback si la fonction n'est pas disponible
-            print("⚠️ Fonction generer_matrice_risque_specifique non disponible")
-            matrice_surbrillance = {
-                'evaluations': evaluations,
-                'risque_cible': {
-                    'id': risque_cible.id,
-                    'reference': risque_cible.reference,
-                    'intitule': risque_cible.intitule
-                },
-                'message': 'Matrice générée en mode de secours'
-            }
-            
-        print(f"✅ Matrice générée avec {len(evaluations)} évaluations")
-        
+        matrice_surbrillance = matrice_svg(evaluations, 'classique',
+                                           cartographie_id=cartographie_id,
+                                           risque_cible_id=risque_cible.id)
     except Exception as e:
         print(f"❌ Erreur génération matrice spécifique: {e}")
         import traceback
@@ -23410,16 +22128,8 @@ def invalider_cache_matrices(cartographie_id):
         print(f"⚠️ Accès non autorisé pour invalider cache de cartographie {cartographie_id}")
         return
     
-    cache_keys = [
-        f'matrice_classique_{cartographie_id}',
-        f'matrice_criticite_{cartographie_id}', 
-        f'matrice_priorisation_{cartographie_id}',
-        f'matrice_surbrillance_{cartographie_id}'
-    ]
-    
-    for key in cache_keys:
-        # Implémentation de l'invalidation du cache
-        print(f"🗑️ Cache matrice invalidé: {key}")
+    cache_tableau_bord.invalider_cartographie(cartographie_id, client_id=cartographie.client_id)
+    print(f"🗑️ Cache matrices invalidé pour cartographie {cartographie_id}")
 
 @app.route('/kri', methods=['GET', 'POST'])
 @login_required
@@ -23466,69 +22176,56 @@ def liste_kri():
     if request.method == 'POST':
         return creer_kri_depuis_liste()
     
-    # CORRECTION : Utiliser get_client_filter
-    kris = get_client_filter(KRI)\
-        .filter_by(est_actif=True)\
-        .order_by(
-            KRI.type_indicateur.desc(),  # KRI d'abord, puis KPI
-            KRI.nom
-        ).all()
+    from sqlalchemy import func
     
-    # CORRECTION : Filtrer les KRI accessibles
-    accessible_kris = []
-    for kri in kris:
-        # Vérifier l'accès au KRI
-        if check_client_access(kri):
-            # Vérifier aussi l'accès au risque associé si présent
-            if kri.risque_id:
-                risque = Risque.query.get(kri.risque_id)
-                if risque and not check_client_access(risque):
-                    print(f"⚠️ KRI {kri.id} ignoré (risque inaccessible)")
-                    continue
-            
-            accessible_kris.append(kri)
+    # CORRECTION : Utiliser get_client_filter (isolation client) puis paginer
+    kris_query = get_client_filter(KRI).filter_by(est_actif=True)
+    pagination = paginer(kris_query.order_by(
+        KRI.type_indicateur.desc(),  # KRI d'abord, puis KPI
+        KRI.nom,
+        KRI.id
+    ))
+    accessible_kris = pagination.items
+    
+    # Statistiques sur l'ensemble des indicateurs du client (agrégats SQL)
+    par_type = dict(kris_query.with_entities(
+        KRI.type_indicateur, func.count(KRI.id)
+    ).group_by(KRI.type_indicateur).all())
+    sans_risque = kris_query.filter(KRI.risque_id.is_(None)).count()
+    total = sum(par_type.values())
+    
+    # États calculés par lots pour tous les indicateurs actifs du client (services/analyse_kri.py)
+    from services.analyse_kri import etats as etats_kri, rafraichir as rafraichir_etats_kri
+    ids_actifs = [kri_id for (kri_id,) in kris_query.with_entities(KRI.id)]
+    rafraichir_etats_kri(ids_actifs)
+    db.session.commit()
+    par_etat = dict(db.session.query(EtatKRI.etat, func.count(EtatKRI.kri_id)).filter(
+        EtatKRI.kri_id.in_(ids_actifs)
+    ).group_by(EtatKRI.etat).all())
+    etats = {
+        'alerte': par_etat.get('alerte', 0) + par_etat.get('sous_performance', 0),
+        'critique': par_etat.get('critique', 0) + par_etat.get('hors_cible', 0),
+    }
     
-    # Calculer les statistiques uniquement sur les KRI accessibles
     stats = {
-        'total': len(accessible_kris),
-        'kris': len([k for k in accessible_kris if k.type_indicateur == 'kri']),
-        'kpis': len([k for k in accessible_kris if k.type_indicateur == 'kpi']),
-        'actifs': len([k for k in accessible_kris if k.est_actif]),
-        'alertes': len([k for k in accessible_kris if getattr(k, 'est_en_alerte', False)]),
-        'avec_risque': len([k for k in accessible_kris if k.risque_id]),
-        'sans_risque': len([k for k in accessible_kris if not k.risque_id])
+        'total': total,
+        'kris': par_type.get('kri', 0),
+        'kpis': par_type.get('kpi', 0),
+        'actifs': total,
+        'alertes': etats['alerte'],
+        'critiques': etats['critique'],
+        'avec_risque': total - sans_risque,
+        'sans_risque': sans_risque
     }
     
-    # CORRECTION : Récupérer les utilisateurs du même client
-    if current_user.role == 'super_admin':
-        utilisateurs = User.query.filter_by(is_active=True).all()
-    else:
-        utilisateurs = get_client_filter(User).filter_by(is_active=True).all()
-    
-    # CORRECTION : Récupérer les risques accessibles du même client
-    risques_query = get_client_filter(Risque).filter_by(is_archived=False)
-    risques_disponibles = []
-    for risque in risques_query.all():
-        if check_client_access(risque):
-            risques_disponibles.append(risque)
-    
-    # Calculer la tendance pour chaque indicateur accessible
+    # Valeur, tendance et état de chaque indicateur de la page, depuis kri_etats
+    analyses = etats_kri([kri.id for kri in accessible_kris])
     for kri in accessible_kris:
-        # Récupérer seulement les mesures accessibles
-        mesures_accessibles = []
-        if hasattr(kri, 'mesures'):
-            for mesure in kri.mesures:
-                if check_client_access(mesure):
-                    mesures_accessibles.append(mesure)
-        
-        kri.tendance = calculer_tendance_kri(mesures_accessibles) if mesures_accessibles else 'stable'
-        
-        # Ajouter d'autres informations utiles
-        kri.nb_mesures = len(mesures_accessibles)
-        if hasattr(kri, 'derniere_valeur') and kri.derniere_valeur:
-            kri.valeur_formatee = f"{kri.derniere_valeur:.2f}"
-        else:
-            kri.valeur_formatee = "N/A"
+        kri.analyse = analyses.get(kri.id) or EtatKRI(kri_id=kri.id, nb_mesures=0, tendance='stable', etat='inconnu')
+        kri.tendance = kri.analyse.tendance
+        kri.nb_mesures = kri.analyse.nb_mesures
+        kri.derniere_valeur = kri.analyse.derniere_valeur
+        kri.valeur_formatee = f"{kri.derniere_valeur:.2f}" if kri.derniere_valeur is not None else "N/A"
         
         # Déterminer la couleur selon la tendance
         if kri.tendance == 'positive':
@@ -23539,16 +22236,12 @@ def liste_kri():
             kri.couleur_tendance = 'warning'
     
     # Debug info
-    print(f"🔍 Liste KRI - Utilisateur: {current_user.username}, Rôle: {current_user.role}")
-    print(f"🔍 KRI trouvés: {len(kris)}, Accessibles: {len(accessible_kris)}")
-    print(f"🔍 Utilisateurs disponibles: {len(utilisateurs)}")
-    print(f"🔍 Risques disponibles: {len(risques_disponibles)}")
+    logger.debug("Liste KRI: %s KRI, page %s/%s", pagination.total, pagination.page, pagination.pages)
     
     return render_template('kri/liste.html', 
                          kris=accessible_kris,
+                         pagination=pagination,
                          stats=stats,
-                         utilisateurs=utilisateurs,
-                         risques_disponibles=risques_disponibles,
                          datetime=datetime)
 
 # ========================
@@ -23566,9 +22259,7 @@ def nouveau_kri_form():
     # CORRECTION IMPORTANTE : Filtrer les risques du client
     risques_disponibles = get_client_filter(Risque).filter_by(is_archived=False).all()
     
-    print(f"🔍 DEBUG: {len(risques_disponibles)} risques disponibles pour l'utilisateur {current_user.username}")
-    for risque in risques_disponibles:
-        print(f"   - {risque.reference}: {risque.intitule} (client_id: {risque.client_id})")
+    logger.debug("%d risques disponibles pour l'utilisateur %s", len(risques_disponibles), current_user.username)
     
     return render_template('kri/form.html',
                          action='creer',
@@ -23609,7 +22300,7 @@ def nouveau_kri(risque_id):
         # CORRECTION : Filtrer les risques du client
         risques_disponibles = get_client_filter(Risque).filter_by(is_archived=False).all()
         
-        print(f"🔍 DEBUG création KRI pour risque {risque_id}: {len(risques_disponibles)} risques disponibles")
+        logger.debug("Création KRI pour risque %s: %d risques disponibles", risque_id, len(risques_disponibles))
         
         return render_template('kri/form.html',
                              action='creer',
@@ -24083,13 +22774,13 @@ def detail_kri(kri_id):
     # CORRECTION : Utiliser get_client_filter
     kri = get_client_filter(KRI).filter_by(id=kri_id).first_or_404()
     
-    # CORRECTION : Filtrer les mesures par client
-    mesures = get_client_filter(MesureKRI)\
-        .filter_by(kri_id=kri_id)\
-        .order_by(MesureKRI.date_mesure.desc())\
-        .all()
+    # CORRECTION : Filtrer les mesures par client (historique paginé : seule la page affichée est chargée)
+    mesures_pagination = paginer(get_client_filter(MesureKRI)
+                                 .filter_by(kri_id=kri_id)
+                                 .order_by(MesureKRI.date_mesure.desc(), MesureKRI.id.desc()), defaut=50)
+    mesures = mesures_pagination.items
     
-    # Regrouper les mesures par période/campagne (ex: mensuel)
+    # Regrouper les mesures de la page par période/campagne (ex: mensuel)
     mesures_par_periode = {}
     for mesure in mesures:
         # Format de période (ex: "Janvier 2024")
@@ -24098,23 +22789,31 @@ def detail_kri(kri_id):
             mesures_par_periode[periode] = []
         mesures_par_periode[periode].append(mesure)
     
-    # Calculer les statistiques
+    # Statistiques depuis les agrégats (services/series_kri.py)
+    from services.series_kri import statistiques as statistiques_kri, tendance
     statistiques = {}
-    if mesures:
-        valeurs = [m.valeur for m in mesures]
+    stats = statistiques_kri(kri_id)
+    if stats:
         statistiques = {
-            'moyenne': sum(valeurs) / len(valeurs),
-            'minimum': min(valeurs),
-            'maximum': max(valeurs),
-            'tendance': calculer_tendance_kri(mesures),
-            'nb_mesures': len(valeurs)
+            'moyenne': stats['moyenne'],
+            'minimum': stats['min'],
+            'maximum': stats['max'],
+            'tendance': tendance(kri_id),
+            'nb_mesures': stats['nb_mesures']
         }
     
+    # Prévision en cache (recalculée seulement après une nouvelle mesure)
+    from services.prevision_kri import previsions
+    prevision = previsions([kri_id]).get(kri_id)
+    db.session.commit()
+    
     return render_template('kri/detail.html',
                          kri=kri,
                          mesures=mesures,
+                         mesures_pagination=mesures_pagination,
                          mesures_par_periode=mesures_par_periode,
                          statistiques=statistiques,
+                         prevision=prevision,
                          datetime=datetime)
 
 def get_risques_pour_kri():
@@ -25148,34 +23847,6 @@ def api_notifications_stats():
             'error': str(e)
         })
 
-# ========================
-# AJOUTER UN CONTEXT PROCESSOR POUR LES NOTIFICATIONS
-# ========================
-
-@app.context_processor
-def inject_notifications():
-    """Injecter les données de notifications dans tous les templates"""
-    def get_notifications_count():
-        if current_user.is_authenticated:
-            try:
-                if NOTIFICATION_SERVICE_AVAILABLE:
-                    return NotificationService.get_count_notifications_non_lues(current_user.id)
-                else:
-                    # Fallback à l'ancien système
-                    return Notification.query.filter_by(
-                        destinataire_id=current_user.id,
-                        est_lue=False
-                    ).count()
-            except:
-                return 0
-        return 0
-    
-    return dict(
-        notifications_count=get_notifications_count,
-        has_notifications_permission=current_user.is_authenticated and 
-            current_user.has_permission('can_view_notifications')
-    )
-
 # ========================
 # AJOUTER UNE TÂCHE DE NETTOYAGE AUTOMATIQUE
 # ========================
@@ -25405,6 +24076,34 @@ def synchroniser_kri_manuel():
             'error': str(e)
         }), 500
     
+@app.route('/api/kri/mesures/import', methods=['POST'])
+@login_required
+def api_import_mesures_kri():
+    """Import groupé de mesures : fichier « fichier » (CSV, XLSX, JSON) ou corps JSON/CSV, rapport par ligne"""
+    from services.import_mesures_kri import ErreurImport, importer, lire_fichier
+    
+    if not current_user.has_permission('can_manage_kri'):
+        return jsonify({'success': False, 'error': 'Permission de gérer les KRI requise'}), 403
+    
+    fichier = request.files.get('fichier')
+    try:
+        if fichier:
+            lignes = lire_fichier(fichier.stream, fichier.filename, type_contenu=fichier.mimetype)
+        else:
+            lignes = lire_fichier(io.BytesIO(request.get_data()), type_contenu=request.mimetype)
+        rapport = importer(lignes, client_id=current_user.client_id,
+                           tous_clients=current_user.role == 'super_admin',
+                           utilisateur_id=current_user.id)
+    except ErreurImport as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # Une seule entrée de journal pour le lot
+    log_activity(current_user.id, 'import_mesures_kri',
+                 f"Import de mesures KRI : {rapport['inserees']} ajoutée(s), {rapport['mises_a_jour']} modifiée(s), "
+                 f"{rapport['nb_erreurs']} erreur(s)", 'kri', None)
+    
+    return jsonify({'success': True, 'rapport': rapport})
+
 @app.route('/api/risque/<int:risque_id>/kri')
 @login_required
 def api_kri_risque(risque_id):
@@ -25414,6 +24113,10 @@ def api_kri_risque(risque_id):
         kri = KRI.query.filter_by(risque_id=risque_id).first()
         
         if kri:
+            from services.analyse_kri import etats as etats_kri
+            analyse = etats_kri([kri.id]).get(kri.id)
+            db.session.commit()
+            
             # Récupérer les dernières mesures
             derniere_mesure = MesureKRI.query.filter_by(kri_id=kri.id).order_by(MesureKRI.date_mesure.desc()).first()
             
@@ -25433,7 +24136,7 @@ def api_kri_risque(risque_id):
                     'date_mesure': derniere_mesure.date_mesure.isoformat() if derniere_mesure else None,
                     'commentaire': derniere_mesure.commentaire if derniere_mesure else None
                 } if derniere_mesure else None,
-                'tendance': calculer_tendance_kri(kri.mesures) if kri.mesures else 'stable'
+                'tendance': analyse.tendance if analyse else 'stable'
             }
         else:
             kri_data = {
@@ -25840,16 +24543,13 @@ def veille_reglementaire():
         flash('Accès refusé : permission de gérer la veille règlementaire requise', 'error')
         return redirect(url_for('dashboard'))
     
-    # Utiliser get_client_filter pour le multi-tenant
-    veilles = get_client_filter(VeilleReglementaire)\
+    # Utiliser get_client_filter pour le multi-tenant (filtrage fait en SQL)
+    veilles_query = get_client_filter(VeilleReglementaire)\
         .filter_by(is_active=True, is_archived=False)\
-        .all()
-    
-    # Vérifier l'accès pour chaque veille
-    accessible_veilles = []
-    for veille in veilles:
-        if check_client_access(veille):
-            accessible_veilles.append(veille)
+        .order_by(VeilleReglementaire.date_application.is_(None),
+                  VeilleReglementaire.date_application, VeilleReglementaire.id)
+    pagination = paginer(veilles_query)
+    accessible_veilles = pagination.items
     
     # Calculer le nombre de jours restants avant application
     for veille in accessible_veilles:
@@ -25887,6 +24587,8 @@ def veille_reglementaire():
     
     return render_template('veille/liste.html', 
                          veilles=accessible_veilles, 
+                         veilles_total=pagination.total,
+                         pagination=pagination,
                          rapport=rapport,
                          users=users,
                          datetime=datetime,
@@ -26749,15 +25451,19 @@ def api_risques_critiques():
 def api_kri_evolution(kri_id):
     """API pour récupérer les données d'évolution d'un KRI"""
     try:
-        kri = KRI.query.get_or_404(kri_id)
-        
-        # Récupérer les mesures triées par date
-        mesures = MesureKRI.query.filter_by(kri_id=kri_id)\
-            .order_by(MesureKRI.date_mesure.asc())\
-            .all()
+        from services.series_kri import serie, serie_json
+        kri = get_client_filter(KRI).filter_by(id=kri_id).first_or_404()
         
-        dates = [mesure.date_mesure.strftime('%Y-%m-%d') for mesure in mesures]
-        valeurs = [float(mesure.valeur) for mesure in mesures]
+        # Série sous-échantillonnée : mesures brutes, ou moyennes par jour/semaine/mois
+        # (?depuis=AAAA-MM-JJ&jusqu=AAAA-MM-JJ&points=200)
+        depuis = request.args.get('depuis', type=lambda v: datetime.strptime(v, '%Y-%m-%d'))
+        jusqu = request.args.get('jusqu', type=lambda v: datetime.strptime(v, '%Y-%m-%d'))
+        if jusqu is not None:
+            jusqu = jusqu.replace(hour=23, minute=59, second=59)
+        points_max = min(max(request.args.get('points', 200, type=int), 10), 2000)
+        points = serie_json(serie(kri_id, depuis, jusqu, points_max=points_max))
+        if points['granularite'] == 'brut':
+            points['dates'] = [d[:10] for d in points['dates']]
         
         return jsonify({
             'success': True,
@@ -26766,8 +25472,7 @@ def api_kri_evolution(kri_id):
                 'nom': kri.nom,
                 'unite_mesure': kri.unite_mesure
             },
-            'dates': dates,
-            'valeurs': valeurs
+            **points
         })
         
     except Exception as e:
@@ -26776,6 +25481,37 @@ def api_kri_evolution(kri_id):
             'error': str(e)
         }), 500
 
+@app.route('/api/kri/<int:kri_id>/prevision')
+@login_required
+def api_kri_prevision(kri_id):
+    """Prévision en cache d'un KRI : modèle retenu, dates de franchissement des seuils, points jusqu'à l'horizon"""
+    from services.prevision_kri import points_prevus, previsions
+    kri = get_client_filter(KRI).filter_by(id=kri_id).first_or_404()
+    
+    prevision = previsions([kri.id]).get(kri.id)
+    db.session.commit()
+    if prevision is None or prevision.modele is None:
+        return jsonify({'success': True, 'prevision': None,
+                        'message': 'Pas assez de mesures pour une prévision'})
+    
+    return jsonify({
+        'success': True,
+        'prevision': {
+            'modele': prevision.modele,
+            'nb_points': prevision.nb_points,
+            'erreur': prevision.erreur,
+            'niveau': prevision.niveau,
+            'pente_jour': prevision.pente_jour,
+            'derniere_date': prevision.derniere_date.isoformat(),
+            'horizon_jours': prevision.horizon_jours,
+            'valeur_horizon': prevision.valeur_horizon,
+            'date_seuil_alerte': prevision.date_seuil_alerte.isoformat() if prevision.date_seuil_alerte else None,
+            'date_seuil_critique': prevision.date_seuil_critique.isoformat() if prevision.date_seuil_critique else None,
+            'calcule_le': prevision.calcule_le.isoformat() if prevision.calcule_le else None,
+            'points': points_prevus(prevision),
+        }
+    })
+
 # Routes pour l'administration
 @app.route('/risques')
 @login_required
@@ -27782,7 +26518,7 @@ def rapports():
     
     # Générer matrice consolidée
     toutes_evaluations = EvaluationRisque.query.filter_by(statut='valide').all()
-    matrice_consolidee = generer_matrice_risques(toutes_evaluations)
+    matrice_consolidee = matrice_svg(toutes_evaluations, 'classique')
     
     return render_template('rapports/index.html',
                          total_risques=total_risques,
@@ -28995,44 +27731,20 @@ def upload_multiple_preuves_constatation(audit_id, constatation_id):
 @app.route('/audit/<int:audit_id>/download-all-preuves')
 @login_required
 def download_all_preuves(audit_id):
-    """Télécharger toutes les preuves d'un audit sous forme d'archive ZIP"""
+    """Télécharger toutes les preuves d'un audit sous forme d'archive ZIP (envoyée en flux)"""
     audit = Audit.query.get_or_404(audit_id)
     
     try:
-        import zipfile
-        import io
-        import tempfile
-        
-        # Créer un fichier ZIP en mémoire
-        zip_buffer = io.BytesIO()
+        from services.archive_zip import entrees_existantes, entrees_preuves_audit, reponse_zip
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Récupérer toutes les constatations de l'audit
-            constatations = Constatation.query.filter_by(audit_id=audit_id).all()
-            
-            fichiers_ajoutes = 0
-            
-            for constatation in constatations:
-                if constatation.preuves:
-                    preuves_list = constatation.get_preuves_list
-                    
-                    for preuve_filename in preuves_list:
-                        # Chemin complet du fichier
-                        file_path = os.path.join('static/uploads/preuves', preuve_filename)
-                        
-                        # Vérifier si le fichier existe
-                        if os.path.exists(file_path):
-                            # Ajouter au ZIP avec un chemin organisé
-                            zip_path = f"preuves/{constatation.reference}/{preuve_filename}"
-                            zip_file.write(file_path, zip_path)
-                            fichiers_ajoutes += 1
+        # Seuls les chemins sont listés ici ; les fichiers sont lus pendant l'envoi
+        entrees = entrees_existantes(entrees_preuves_audit(audit))
+        fichiers_ajoutes = len(entrees)
         
         if fichiers_ajoutes == 0:
             flash('Aucune preuve à télécharger', 'warning')
             return redirect(url_for('detail_audit', id=audit_id))
         
-        zip_buffer.seek(0)
-        
         # Journaliser l'action
         journaliser_action_audit(
             audit_id=audit_id,
@@ -29041,18 +27753,71 @@ def download_all_preuves(audit_id):
             details={'fichiers_ajoutes': fichiers_ajoutes}
         )
         
-        # Retourner le fichier ZIP
-        return send_file(
-            zip_buffer,
-            as_attachment=True,
-            download_name=f"preuves_audit_{audit.reference}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
-            mimetype='application/zip'
+        return reponse_zip(
+            entrees,
+            f"preuves_audit_{audit.reference}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
         )
         
     except Exception as e:
         flash(f'Erreur lors de la création de l\'archive: {str(e)}', 'error')
         return redirect(url_for('detail_audit', id=audit_id))
 
+@app.route('/audit/<int:audit_id>/fichiers-rapport/telecharger-tout')
+@login_required
+def telecharger_tous_fichiers_rapport(audit_id):
+    """Télécharger les pièces jointes du rapport d'un audit (ZIP en flux)"""
+    audit = Audit.query.get_or_404(audit_id)
+    
+    if not check_client_access(audit):
+        flash('Accès non autorisé', 'error')
+        return redirect(url_for('liste_audits'))
+    
+    from services.archive_zip import entrees_existantes, entrees_fichiers_rapport, reponse_zip
+    
+    entrees = entrees_existantes(entrees_fichiers_rapport(audit))
+    if not entrees:
+        flash('Aucun fichier à télécharger', 'warning')
+        return redirect(url_for('rapport_audit_complet', audit_id=audit_id))
+    
+    log_activity(current_user.id, 'download_fichiers_rapport',
+                f"{len(entrees)} fichier(s) téléchargé(s) pour l'audit {audit.reference}",
+                'audit', audit_id)
+    
+    return reponse_zip(
+        entrees,
+        f"fichiers_rapport_{audit.reference}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    )
+
+@app.route('/audit/export-preuves')
+@login_required
+def exporter_toutes_preuves():
+    """Export complet des preuves et pièces jointes d'audit du client (ZIP en flux)"""
+    if current_user.role not in ('admin', 'super_admin'):
+        flash('Accès réservé aux administrateurs', 'error')
+        return redirect(url_for('liste_audits'))
+    
+    from services.archive_zip import entrees_client, entrees_existantes, reponse_zip
+    
+    # Le super admin exporte tous les clients, ou un seul avec ?client_id=
+    # (les autres : leur client uniquement, jamais « tous » même sans client_id)
+    if current_user.role == 'super_admin':
+        client_id = request.args.get('client_id', type=int)
+        tous_clients = client_id is None
+    else:
+        client_id = current_user.client_id
+        tous_clients = False
+    
+    entrees = entrees_existantes(entrees_client(client_id, tous_clients=tous_clients))
+    if not entrees:
+        flash('Aucune preuve à exporter', 'warning')
+        return redirect(url_for('liste_audits'))
+    
+    log_activity(current_user.id, 'export_preuves_client',
+                f"Export de {len(entrees)} fichier(s) de preuves (client {'tous' if tous_clients else client_id})",
+                'audit', None)
+    
+    return reponse_zip(entrees, f"preuves_audits_{'tous' if tous_clients else client_id or 'sans_client'}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
+
 @app.route('/download/preuve/<filename>')
 @login_required
 def download_preuve(filename):
@@ -29223,9 +27988,13 @@ def api_statut_risque(id):
 @app.route('/cartographie/<int:id>/export/matrice')
 @login_required
 def export_matrice_cartographie(id):
-    """Exporter la matrice de risques d'une cartographie"""
+    """Exporter la matrice de risques d'une cartographie (svg par défaut, png ou xlsx)"""
     cartographie = Cartographie.query.get_or_404(id)
     
+    if request.args.get('format') == 'xlsx':
+        from services.export_cartographie import export_matrice_excel
+        return export_matrice_excel(cartographie)
+    
     # Récupérer toutes les évaluations des risques de cette cartographie
     evaluations = []
     for risque in cartographie.risques:
@@ -29235,18 +28004,58 @@ def export_matrice_cartographie(id):
             derniere_evaluation = max(risque.evaluations, key=lambda x: x.created_at)
             evaluations.append(derniere_evaluation)
     
-    # Générer la matrice
-    matrice_image = generer_matrice_risques(evaluations, 'classique')
-    
-    # Retourner l'image en réponse directe
     from flask import Response
-    image_data = base64.b64decode(matrice_image)
     
-    response = Response(image_data, mimetype='image/png')
-    response.headers['Content-Disposition'] = f'attachment; filename=matrice_{cartographie.nom}_{datetime.now().strftime("%Y%m%d")}.png'
+    # PNG (matplotlib) seulement sur demande explicite : le SVG est servi depuis le cache
+    if request.args.get('format') == 'png':
+        image_data = base64.b64decode(generer_matrice_risques(evaluations, 'classique'))
+        mimetype, extension = 'image/png', 'png'
+    else:
+        image_data = obtenir_matrice(evaluations, 'classique', cartographie_id=id)['svg'].encode('utf-8')
+        mimetype, extension = 'image/svg+xml', 'svg'
+    
+    response = Response(image_data, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=matrice_{cartographie.nom}_{datetime.now().strftime("%Y%m%d")}.{extension}'
     
     return response
 
+
+@app.route('/api/cartographie/<int:id>/matrice')
+@login_required
+def api_matrice_cartographie(id):
+    """Matrice de risques en JSON (grille d'occupation, points, statistiques)"""
+    cartographie = get_client_filter(Cartographie).filter_by(id=id).first_or_404()
+    if not check_client_access(cartographie):
+        return jsonify({'error': 'Accès non autorisé'}), 403
+    
+    matrice_type = request.args.get('type', 'classique')
+    if matrice_type not in TYPES_MATRICE:
+        return jsonify({'error': f'Type de matrice inconnu: {matrice_type}'}), 400
+    
+    campagne_id = request.args.get('campagne_id', type=int)
+    risque_cible_id = request.args.get('risque_id', type=int)
+    
+    # Dernière évaluation de chaque risque actif (de la campagne si précisée)
+    requete = get_client_filter(EvaluationRisque)\
+        .join(Risque, EvaluationRisque.risque_id == Risque.id)\
+        .filter(Risque.cartographie_id == id, Risque.is_archived == False)\
+        .order_by(EvaluationRisque.created_at.desc())
+    if campagne_id:
+        requete = requete.filter(EvaluationRisque.campagne_id == campagne_id)
+    
+    evaluations_par_risque = {}
+    for evaluation in requete:
+        evaluations_par_risque.setdefault(evaluation.risque_id, evaluation)
+    
+    matrice = obtenir_matrice(list(evaluations_par_risque.values()), matrice_type,
+                              cartographie_id=id, campagne_id=campagne_id,
+                              risque_cible_id=risque_cible_id)
+    
+    if request.args.get('format') == 'svg':
+        return app.response_class(matrice['svg'], mimetype='image/svg+xml')
+    
+    return jsonify({k: v for k, v in matrice.items() if k != 'svg'})
+
 @app.route('/cartographie/<int:id>/risques/non-evalues')
 @login_required
 def risques_non_evalues(id):
@@ -29323,7 +28132,7 @@ def rapport_comparaison_matrices():
                 evaluations.append(derniere_eval)
         
         if evaluations:
-            matrice_classique = generer_matrice_risques(evaluations, 'classique')
+            matrice_classique = matrice_svg(evaluations, 'classique', cartographie_id=cartographie.id)
             matrices_data.append({
                 'cartographie': cartographie,
                 'matrice': matrice_classique,
@@ -29337,6 +28146,8 @@ def rapport_comparaison_matrices():
 @login_required
 def api_stats_cartographie(id):
     """API pour les statistiques d'une cartographie"""
+    from sqlalchemy import func
+    
     cartographie = Cartographie.query.get_or_404(id)
     
     stats = {
@@ -29352,24 +28163,26 @@ def api_stats_cartographie(id):
         'moyenne_scores': 0
     }
     
-    scores = []
-    for risque in cartographie.risques:
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-            
-        stats['total_risques'] += 1
-        
-        if risque.evaluations:
-            stats['risques_evalues'] += 1
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-            niveau = derniere_eval.niveau_risque
-            stats['repartition_niveaux'][niveau] += 1
-            scores.append(derniere_eval.score_risque)
-        else:
-            stats['risques_non_evalues'] += 1
+    stats['total_risques'] = Risque.query.filter_by(
+        cartographie_id=cartographie.id, is_archived=False
+    ).count()
+    
+    risques_evalues, moyenne_scores = requete_evaluations_courantes(
+        func.count(RisqueEvaluationCourante.risque_id),
+        func.avg(RisqueEvaluationCourante.score_risque)
+    ).filter(Risque.cartographie_id == cartographie.id).one()
     
-    if scores:
-        stats['moyenne_scores'] = round(sum(scores) / len(scores), 2)
+    stats['risques_evalues'] = risques_evalues
+    stats['risques_non_evalues'] = stats['total_risques'] - risques_evalues
+    stats['repartition_niveaux'].update(repartition_niveaux(
+        requete_evaluations_courantes(
+            RisqueEvaluationCourante.niveau_risque,
+            func.count(RisqueEvaluationCourante.risque_id)
+        ).filter(Risque.cartographie_id == cartographie.id)
+    ))
+    
+    if moyenne_scores is not None:
+        stats['moyenne_scores'] = round(moyenne_scores, 2)
     
     return jsonify(stats)
 
@@ -29383,22 +28196,19 @@ def dashboard_risques():
     
     # Statistiques globales - EXCLURE LES RISQUES ARCHIVÉS
     total_risques = Risque.query.filter_by(is_archived=False).count()
-    total_risques_evalues = db.session.query(Risque).join(EvaluationRisque).filter(
-        Risque.is_archived == False  # ← EXCLURE LES RISQUES ARCHIVÉS
-    ).distinct().count()
+    total_risques_evalues = requete_evaluations_courantes().count()
     
     # Risques critiques récents (moins de 30 jours) - EXCLURE LES RISQUES ARCHIVÉS
     date_limite = datetime.now() - timedelta(days=30)
-    risques_critiques_recents = []
-    
-    for risque in Risque.query.filter_by(is_archived=False).all():  # ← FILTRER LES RISQUES NON ARCHIVÉS
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-            if derniere_eval.niveau_risque in ['Critique', 'Élevé'] and derniere_eval.created_at >= date_limite:
-                risques_critiques_recents.append({
-                    'risque': risque,
-                    'evaluation': derniere_eval
-                })
+    risques_critiques_recents = [
+        {'risque': risque, 'evaluation': evaluation}
+        for risque, evaluation in requete_evaluations_courantes(Risque, EvaluationRisque).join(
+            EvaluationRisque, EvaluationRisque.id == RisqueEvaluationCourante.evaluation_id
+        ).filter(
+            RisqueEvaluationCourante.niveau_risque.in_(['Critique', 'Élevé']),
+            RisqueEvaluationCourante.date_evaluation >= date_limite
+        ).all()
+    ]
     
     # Répartition par catégorie - EXCLURE LES RISQUES ARCHIVÉS
     repartition_categories = db.session.query(
@@ -29437,18 +28247,21 @@ def recherche_risques():
     niveau_risque = request.args.get('niveau_risque', '')
     cartographie_id = request.args.get('cartographie_id', '')
     
-    # Construction de la requête de base
-    risques_query = Risque.query.filter_by(is_archived=False)
+    # Construction de la requête de base (isolation client)
+    risques_query = get_client_filter(Risque).filter_by(is_archived=False)
     
-    # Filtres
+    # Filtres (index plein texte, sinon recherche par motif)
     if query:
-        risques_query = risques_query.filter(
-            db.or_(
+        from services.recherche import filtre_ids
+        condition = filtre_ids('risque', query, client_id=current_user.client_id,
+                               tous_clients=current_user.role == 'super_admin')
+        if condition is None:
+            condition = db.or_(
                 Risque.reference.ilike(f'%{query}%'),
                 Risque.intitule.ilike(f'%{query}%'),
                 Risque.description.ilike(f'%{query}%')
             )
-        )
+        risques_query = risques_query.filter(condition)
     
     if categorie:
         risques_query = risques_query.filter_by(categorie=categorie)
@@ -29456,24 +28269,24 @@ def recherche_risques():
     if cartographie_id:
         risques_query = risques_query.filter_by(cartographie_id=cartographie_id)
     
-    risques = risques_query.all()
-    
-    # Filtre par niveau de risque si spécifié
+    # Filtre par niveau de risque sur l'évaluation courante
     if niveau_risque:
-        risques_filtres = []
-        for risque in risques:
-            if risque.evaluations:
-                derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-                if derniere_eval.niveau_risque == niveau_risque:
-                    risques_filtres.append(risque)
-        risques = risques_filtres
+        risques_query = risques_query.join(
+            RisqueEvaluationCourante, RisqueEvaluationCourante.risque_id == Risque.id
+        ).filter(RisqueEvaluationCourante.niveau_risque == niveau_risque)
+    
+    pagination = paginer(risques_query.order_by(Risque.reference, Risque.id))
+    risques = pagination.items
     
     # Options pour les filtres
-    categories = db.session.query(Risque.categorie).filter_by(is_archived=False).distinct().all()
-    cartographies = Cartographie.query.all()
+    categories = get_client_filter(Risque).filter_by(is_archived=False).with_entities(
+        Risque.categorie
+    ).distinct().all()
+    cartographies = get_client_filter(Cartographie).all()
     
     return render_template('recherche_risques.html',
                          risques=risques,
+                         pagination=pagination,
                          query=query,
                          categories=categories,
                          cartographies=cartographies,
@@ -29481,30 +28294,97 @@ def recherche_risques():
                          selected_niveau=niveau_risque,
                          selected_cartographie=cartographie_id)
 
+@app.route('/api/search')
+@login_required
+def api_search():
+    """Recherche plein texte classée (?q=&types=risque,constatation,...&page=&per_page=)"""
+    from services.recherche import ENTITES, RechercheIndisponible, rechercher
+    
+    types = [t for t in request.args.get('types', '').split(',') if t]
+    inconnus = [t for t in types if t not in ENTITES]
+    if inconnus:
+        return jsonify({'success': False, 'error': f"Type(s) inconnu(s): {', '.join(inconnus)}",
+                        'types': sorted(ENTITES)}), 400
+    
+    page, per_page = parametres_pagination(defaut=10, maximum=50)
+    try:
+        resultat = rechercher(request.args.get('q', ''), client_id=current_user.client_id,
+                              tous_clients=current_user.role == 'super_admin',
+                              entites=types or None, page=page, per_page=per_page)
+    except RechercheIndisponible as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    
+    return jsonify({
+        'success': True,
+        'resultats': resultat['resultats'],
+        'pagination': {k: resultat[k] for k in ('page', 'per_page', 'total', 'pages')},
+    })
+
 # Export des données
+def _ligne_export_risque(risque, evaluation):
+    valeurs = evaluation.get_valeurs_finales() if evaluation else {}
+    return {
+        'reference': risque.reference,
+        'intitule': risque.intitule,
+        'categorie': risque.categorie,
+        'impact': valeurs.get('impact'),
+        'probabilite': valeurs.get('probabilite'),
+        'niveau_risque': valeurs.get('niveau_risque') or 'Non évalué',
+        'cartographie': risque.cartographie.nom if risque.cartographie else None
+    }
+
 @app.route('/export/risques')
 @login_required
 def export_risques():
-    risques = Risque.query.all()
-    data = []
+    """
+    Export des risques non archivés, avec leur dernière évaluation validée.
+
+    Par défaut : tableau JSON complet, envoyé en flux (fichier téléchargé).
+    ?curseur=&limite= : une page {'risques', 'pagination'} (parcours par API).
+    ?format=xlsx|csv : fichier tableur complet en flux.
+    """
+    from sqlalchemy.orm import joinedload
     
-    for risque in risques:
-        derniere_eval = EvaluationRisque.query.filter_by(
-            risque_id=risque.id, 
-            statut='valide'
-        ).order_by(EvaluationRisque.created_at.desc()).first()
-        
-        data.append({
-            'reference': risque.reference,
-            'intitule': risque.intitule,
-            'categorie': risque.categorie,
-            'impact': derniere_eval.impact if derniere_eval else None,
-            'probabilite': derniere_eval.probabilite if derniere_eval else None,
-            'niveau_risque': derniere_eval.niveau_risque if derniere_eval else 'Non évalué',
-            'cartographie': risque.cartographie.nom
+    format_sortie = request.args.get('format', 'json').lower()
+    if format_sortie in ('xlsx', 'csv'):
+        from services.export_cartographie import export_risques as exporter_risques
+        client_id = None if current_user.role == 'super_admin' else current_user.client_id
+        return exporter_risques(format_sortie, client_id=client_id)
+    
+    risques_query = get_client_filter(Risque).filter(Risque.is_archived == False).options(
+        joinedload(Risque.cartographie)
+    )
+    
+    if 'curseur' in request.args or 'limite' in request.args:
+        try:
+            page = paginer_curseur(risques_query, (Risque.id,), descendant=False, defaut=100, maximum=500)
+        except CurseurInvalide as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        evaluations = evaluations_validees_par_risque([r.id for r in page.items]) \
+            if EVALUATION_COURANTE_AVAILABLE else {}
+        return jsonify({
+            'risques': [_ligne_export_risque(r, evaluations.get(r.id)) for r in page.items],
+            'pagination': page.meta()
         })
     
-    return jsonify(data)
+    def flux_json(taille_lot=500):
+        # Lots par clé (id croissant) : mémoire bornée quel que soit le nombre de risques
+        yield '['
+        dernier_id, separateur = 0, ''
+        while True:
+            lot = risques_query.filter(Risque.id > dernier_id).order_by(Risque.id).limit(taille_lot).all()
+            if not lot:
+                break
+            evaluations = evaluations_validees_par_risque([r.id for r in lot]) \
+                if EVALUATION_COURANTE_AVAILABLE else {}
+            for risque in lot:
+                yield separateur + json.dumps(_ligne_export_risque(risque, evaluations.get(risque.id)),
+                                              ensure_ascii=False)
+                separateur = ','
+            dernier_id = lot[-1].id
+        yield ']'
+    
+    return Response(stream_with_context(flux_json()), mimetype='application/json')
 
 
 @app.route('/api/guide-evaluation')
@@ -30756,11 +29636,15 @@ def api_constatations_audit(audit_id):
 @app.route('/api/risques/actifs')
 @login_required
 def api_risques_actifs():
-    """API pour récupérer les risques actifs"""
-    risques = Risque.query.filter_by(is_archived=False).all()
+    """API pour récupérer les risques actifs (pagination par curseur)"""
+    risques_query = get_client_filter(Risque).filter_by(is_archived=False)
+    try:
+        page = paginer_curseur(risques_query, (Risque.id,), descendant=False, defaut=100, maximum=500)
+    except CurseurInvalide as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     
     risques_data = []
-    for risque in risques:
+    for risque in page.items:
         risques_data.append({
             'id': risque.id,
             'reference': risque.reference,
@@ -30768,7 +29652,7 @@ def api_risques_actifs():
             'categorie': risque.categorie
         })
     
-    return jsonify(risques_data)
+    return jsonify({'risques': risques_data, 'pagination': page.meta()})
 
 # ============================================================================
 # ROUTES D'EXPORT POUR AUDIT
@@ -31235,57 +30119,37 @@ def analyse_ia_audit(audit_id):
     
     if form.validate_on_submit():
         try:
-            # Utiliser le service IA avec vos paramètres
-            resultat = service_ia.analyser_audit(
-                audit_id=audit_id,
-                type_analyse=form.type_analyse.data,
-                user_id=current_user.id
-            )
-            
-            # Vérifier que le résultat est valide
-            if not resultat:
-                flash('L\'analyse IA n\'a pas retourné de résultat', 'error')
+            from services.consommation_ia import etat_budget
+            budget = etat_budget(audit.client_id)
+            if budget['restants'] == 0:
+                flash(f"Budget IA mensuel épuisé ({budget['consommes']} / {budget['budget']} jetons).", 'error')
                 return redirect(url_for('detail_audit', id=audit_id))
             
-            # Convertir le résultat si c'est un objet
-            if hasattr(resultat, 'to_dict'):
-                resultat_dict = resultat.to_dict()
-            elif hasattr(resultat, '__dict__'):
-                resultat_dict = resultat.__dict__
-            elif isinstance(resultat, dict):
-                resultat_dict = resultat
-            else:
-                resultat_dict = {'resultat': str(resultat)}
-            
-            # Sauvegarder dans la base de données
-            analyse = AnalyseIA(
+            # L'analyse est mise en file : le worker web ne contacte pas le fournisseur IA
+            from services.file_analyse_ia import soumettre_analyse
+            analyse, creee = soumettre_analyse(
                 audit_id=audit_id,
                 type_analyse=form.type_analyse.data,
-                resultat=resultat_dict,
-                score_confiance=resultat_dict.get('metadata', {}).get('score_confiance', 75.0) if isinstance(resultat_dict, dict) else 75.0,
-                created_by=current_user.id,
+                user_id=current_user.id,
                 client_id=current_user.client_id
             )
             
-            db.session.add(analyse)
-            db.session.commit()
-            
-            # Journaliser l'action
-            log_activity(current_user.id, 'analyse_ia_audit',
-                        f"Analyse IA lancée sur audit {audit.reference}",
-                        'audit', audit_id)
-            
-            # Utiliser le score depuis le résultat
-            score = resultat_dict.get('metadata', {}).get('score_confiance', 75.0) if isinstance(resultat_dict, dict) else 75.0
-            flash(f'✅ Analyse IA terminée avec succès ! Score de confiance: {score:.1f}%', 'success')
-            return redirect(url_for('resultat_analyse_ia', audit_id=audit_id, analyse_id=analyse.id))
+            if creee and analyse.est_terminee:
+                flash('✅ Audit inchangé depuis la dernière analyse : résultat réutilisé sans nouvel appel IA.', 'success')
+                return redirect(url_for('resultat_analyse_ia', audit_id=audit_id, analyse_id=analyse.id))
+            elif creee:
+                log_activity(current_user.id, 'analyse_ia_audit',
+                            f"Analyse IA demandée sur audit {audit.reference}",
+                            'audit', audit_id)
+                flash('⏳ Analyse IA mise en file d\'attente. Cette page se met à jour automatiquement.', 'info')
+            else:
+                flash('Une analyse IA de ce type est déjà en cours pour cet audit.', 'warning')
+            return redirect(url_for('liste_analyses_ia', audit_id=audit_id))
             
         except Exception as e:
             db.session.rollback()
-            flash(f'❌ Erreur lors de l\'analyse IA: {str(e)}', 'error')
-            print(f"❌ Erreur analyse IA: {e}")
-            import traceback
-            traceback.print_exc()
+            flash(f'❌ Erreur lors de la demande d\'analyse IA: {str(e)}', 'error')
+            logger.exception("Erreur soumission analyse IA audit %s", audit_id)
             return redirect(url_for('detail_audit', id=audit_id))
     
     # Statistiques pour l'affichage
@@ -31311,6 +30175,13 @@ def resultat_analyse_ia(audit_id, analyse_id):
         # Récupérer l'analyse depuis la base
         analyse = get_client_object_or_404(AnalyseIA, analyse_id, audit_id=audit_id)
         
+        if not analyse.est_terminee:
+            if analyse.est_active:
+                flash('L\'analyse IA est encore en cours de traitement.', 'info')
+            else:
+                flash(f'L\'analyse IA a échoué : {analyse.erreur or "erreur inconnue"}', 'error')
+            return redirect(url_for('liste_analyses_ia', audit_id=audit_id))
+        
         # Convertir le résultat selon son type
         if analyse.resultat:
             if isinstance(analyse.resultat, dict):
@@ -31512,6 +30383,111 @@ def liste_analyses_ia(audit_id):
         flash(f'Erreur: {str(e)}', 'error')
         return redirect(url_for('liste_audits'))
 
+@app.route('/api/analyse-ia/<int:analyse_id>/statut')
+@login_required
+def statut_analyse_ia(analyse_id):
+    """Avancement d'une analyse IA (statut, progression, étape)"""
+    from services.file_analyse_ia import etat_analyse
+    analyse = get_client_object_or_404(AnalyseIA, analyse_id)
+    etat = etat_analyse(analyse)
+    if analyse.est_terminee:
+        etat['url_resultat'] = url_for('resultat_analyse_ia', audit_id=analyse.audit_id, analyse_id=analyse.id)
+    return jsonify(etat)
+
+@app.route('/api/audit/<int:audit_id>/analyses-ia/statut')
+@login_required
+def statut_analyses_ia_audit(audit_id):
+    """Avancement des analyses IA d'un audit (pour le rafraîchissement de la liste)"""
+    from services.file_analyse_ia import etat_analyse
+    audit = get_client_object_or_404(Audit, audit_id)
+    analyses = get_client_filter(AnalyseIA)\
+        .filter_by(audit_id=audit.id)\
+        .order_by(AnalyseIA.date_analyse.desc())\
+        .all()
+    etats = [etat_analyse(a) for a in analyses]
+    return jsonify({
+        'audit_id': audit.id,
+        'actives': sum(1 for a in analyses if a.est_active),
+        'analyses': etats
+    })
+
+
+# ============================================================================
+# RAPPORTS GÉNÉRÉS EN ARRIÈRE-PLAN (services/rapports_generes.py)
+# ============================================================================
+
+def _entite_rapport_accessible(entite_type, entite_id):
+    """Vérifie que l'utilisateur courant peut obtenir un rapport sur cette entité"""
+    if entite_type == 'client':
+        # 0 : tous les clients, réservé au super admin (le rendu est filtré sur entite_id)
+        if current_user.role == 'super_admin':
+            return True
+        return current_user.client_id is not None and entite_id == current_user.client_id
+    modeles = {'audit': Audit, 'cartographie': Cartographie, 'logigramme': ProcessusActivite}
+    entite = db.session.get(modeles[entite_type], entite_id)
+    return entite is not None and check_client_access(entite)
+
+def _etat_rapport_json(rapport):
+    from services.rapports_generes import etat_rapport
+    etat = etat_rapport(rapport)
+    etat['url_statut'] = url_for('statut_rapport', rapport_id=rapport.id)
+    if etat['disponible']:
+        etat['url_telechargement'] = url_for('telecharger_rapport', rapport_id=rapport.id)
+    return etat
+
+@app.route('/rapports/<type_rapport>/<int:entite_id>')
+@login_required
+def generer_rapport(type_rapport, entite_id):
+    """Demande un rapport : fichier en cache, sinon rendu en arrière-plan et page d'attente"""
+    from services.rapports_generes import TYPES_RAPPORT, fichier_disponible, soumettre_rapport
+    
+    definition = TYPES_RAPPORT.get(type_rapport)
+    if definition is None:
+        abort(404)
+    if not _entite_rapport_accessible(definition.entite, entite_id):
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'success': False, 'error': 'Accès non autorisé'}), 403
+        flash('Accès non autorisé', 'error')
+        return redirect(url_for('dashboard'))
+    
+    rapport, cree = soumettre_rapport(type_rapport, entite_id, user_id=current_user.id,
+                                      client_id=current_user.client_id)
+    
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(_etat_rapport_json(rapport)), 202 if rapport.est_actif else 200
+    if fichier_disponible(rapport):
+        return redirect(url_for('telecharger_rapport', rapport_id=rapport.id))
+    return render_template('rapports/attente.html', rapport=rapport, libelle=definition.libelle,
+                           etat=_etat_rapport_json(rapport))
+
+@app.route('/api/rapports/<int:rapport_id>/statut')
+@login_required
+def statut_rapport(rapport_id):
+    """Avancement d'un rapport (statut, position dans la file, disponibilité)"""
+    rapport = RapportGenere.query.get_or_404(rapport_id)
+    if not _entite_rapport_accessible(rapport.entite_type, rapport.entite_id):
+        return jsonify({'success': False, 'error': 'Accès non autorisé'}), 403
+    return jsonify(_etat_rapport_json(rapport))
+
+@app.route('/rapports/<int:rapport_id>/telecharger')
+@login_required
+def telecharger_rapport(rapport_id):
+    """Envoie le fichier d'un rapport rendu"""
+    from services.export_tableur import reponse_fichier
+    from services.rapports_generes import compter_telechargement, fichier_disponible
+    
+    rapport = RapportGenere.query.get_or_404(rapport_id)
+    if not _entite_rapport_accessible(rapport.entite_type, rapport.entite_id):
+        flash('Accès non autorisé', 'error')
+        return redirect(url_for('dashboard'))
+    if not fichier_disponible(rapport):
+        flash("Ce rapport n'est pas (ou plus) disponible", 'warning')
+        return redirect(url_for('generer_rapport', type_rapport=rapport.type_rapport, entite_id=rapport.entite_id))
+    
+    compter_telechargement(rapport.id)
+    return reponse_fichier(rapport.chemin, rapport.nom_fichier, rapport.mimetype or 'application/octet-stream',
+                           supprimer=False)
+
 @app.route('/analyse-ia/<int:analyse_id>/export')
 @login_required
 def export_analyse_ia(analyse_id):
@@ -32655,38 +31631,57 @@ def liste_audits():
     
     show_archived = request.args.get('show_archived', 'false').lower() == 'true'
     
+    from sqlalchemy import func, select
+    
     # CORRECTION : Utiliser get_client_filter
-    if show_archived:
-        audits_query = get_client_filter(Audit).filter_by(is_archived=True)
-    else:
-        audits_query = get_client_filter(Audit).filter_by(is_archived=False)
+    audits_query = get_client_filter(Audit).filter_by(is_archived=show_archived)
     
-    audits = audits_query.all()
+    # Statistiques sur l'ensemble des audits du client (agrégats SQL)
+    par_statut = dict(audits_query.with_entities(
+        Audit.statut, func.count(Audit.id)
+    ).group_by(Audit.statut).all())
+    par_sous_statut = dict(audits_query.with_entities(
+        Audit.sous_statut, func.count(Audit.id)
+    ).group_by(Audit.sous_statut).all())
     
-    # Vérifier l'accès pour chaque audit (sécurité supplémentaire)
-    accessible_audits = []
-    for audit in audits:
-        if check_client_access(audit):
-            accessible_audits.append(audit)
+    audit_ids = audits_query.with_entities(Audit.id).subquery()
+    
+    def compter_enfants(modele):
+        return db.session.query(func.count(modele.id)).filter(
+            modele.audit_id.in_(select(audit_ids.c.id))
+        ).scalar() or 0
     
-    # Calcul des statistiques
     stats = {
-        'total': len(accessible_audits),
-        'planifies': len([a for a in accessible_audits if a.statut == 'planifie']),
-        'en_preparation': len([a for a in accessible_audits if a.sous_statut == 'preparation']),
-        'en_collecte': len([a for a in accessible_audits if a.sous_statut == 'collecte']),
-        'en_analyse': len([a for a in accessible_audits if a.sous_statut == 'analyse']),
-        'en_redaction': len([a for a in accessible_audits if a.sous_statut == 'redaction']),
-        'en_validation': len([a for a in accessible_audits if a.sous_statut == 'validation']),
-        'clos': len([a for a in accessible_audits if a.statut == 'clos']),
-        'constatations_total': sum(len(a.constatations) for a in accessible_audits),
-        'recommandations_total': sum(len(a.recommandations) for a in accessible_audits),
-        'plans_action_total': sum(len(a.plans_action) for a in accessible_audits),
+        'total': sum(par_statut.values()),
+        'planifies': par_statut.get('planifie', 0),
+        'en_cours': par_statut.get('en_cours', 0),
+        'en_preparation': par_sous_statut.get('preparation', 0),
+        'en_collecte': par_sous_statut.get('collecte', 0),
+        'en_analyse': par_sous_statut.get('analyse', 0),
+        'en_redaction': par_sous_statut.get('redaction', 0),
+        'en_validation': par_sous_statut.get('validation', 0),
+        'clos': par_statut.get('clos', 0),
+        'constatations_total': compter_enfants(Constatation),
+        'recommandations_total': compter_enfants(Recommandation),
+        'plans_action_total': compter_enfants(PlanAction),
         'archives': get_client_filter(Audit).filter_by(is_archived=True).count()
     }
     
+    # Filtres de la liste (liens du menu déroulant)
+    statut = request.args.get('statut')
+    type_audit = request.args.get('type')
+    liste_query = audits_query
+    if statut:
+        liste_query = liste_query.filter(Audit.statut == statut)
+    if type_audit:
+        liste_query = liste_query.filter(Audit.type_audit == type_audit)
+    
+    pagination = paginer(liste_query.order_by(Audit.created_at.desc(), Audit.id.desc()))
+    accessible_audits = pagination.items
+    
     return render_template('audits.html', 
                          audits=accessible_audits, 
+                         pagination=pagination,
                          stats=stats,
                          show_archived=show_archived,
                            now=datetime.now())
@@ -36826,6 +35821,10 @@ def admin_analyses_ia():
     
     stats['top_audits'] = top
     
+    # Consommation de jetons (mois courant et historique, cf. flask ia-statistiques)
+    from services.consommation_ia import statistiques_ia
+    stats['consommation'] = statistiques_ia()['consommation']
+    
     # Analyses récentes
     recent = AnalyseIA.query.order_by(
         AnalyseIA.date_analyse.desc()
@@ -185,9 +185,62 @@ class Config:
     # ============================================================================
     # CONFIGURATION CACHE
     # ============================================================================
-    CACHE_TYPE = 'simple'  # Pour production, utiliser 'redis' ou 'memcached'
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')  # 'redis' pour partager le cache entre workers
     CACHE_DEFAULT_TIMEOUT = 300  # 5 minutes
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    DASHBOARD_CACHE_ENABLED = os.environ.get('DASHBOARD_CACHE_ENABLED', 'true').lower() == 'true'
     
+    # ============================================================================
+    # NOTIFICATIONS EN TEMPS RÉEL (services/notifications_temps_reel.py)
+    # ============================================================================
+    # 'redis' pour diffuser entre workers web et worker.py (CACHE_REDIS_URL)
+    NOTIFICATIONS_BUS = os.environ.get('NOTIFICATIONS_BUS', 'redis' if CACHE_TYPE == 'redis' else 'memoire')
+    NOTIFICATIONS_SSE_ACTIF = os.environ.get('NOTIFICATIONS_SSE_ACTIF', 'true').lower() == 'true'
+    # Flux SSE simultanés par processus : chacun occupe un thread (au-delà, interrogation périodique)
+    NOTIFICATIONS_SSE_MAX_FLUX = int(os.environ.get('NOTIFICATIONS_SSE_MAX_FLUX', 1 if IS_RENDER else 20))
+    NOTIFICATIONS_SSE_DUREE = int(os.environ.get('NOTIFICATIONS_SSE_DUREE', 120))  # secondes avant reconnexion
+    
+    # ============================================================================
+    # CONFIGURATION JOURNALISATION
+    # ============================================================================
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT')  # 'json' ou 'texte' (défaut : texte en debug, json sinon)
+    LOG_NIVEAUX = os.environ.get('LOG_NIVEAUX', 'werkzeug=WARNING')  # "module=NIVEAU,autre=NIVEAU"
+    LOG_REQUETE_LENTE_MS = int(os.environ.get('LOG_REQUETE_LENTE_MS', 1000))
+    
+    # ============================================================================
+    # CONFIGURATION ANALYSES IA (services/file_analyse_ia.py)
+    # ============================================================================
+    IA_TRAITEURS = int(os.environ.get('IA_TRAITEURS', 2))  # threads par processus worker
+    IA_LIMITE_PAR_CLIENT = int(os.environ.get('IA_LIMITE_PAR_CLIENT', 1))  # analyses simultanées par client
+    # Traiteurs dans le processus web (développement) ; en production : python worker.py
+    IA_TRAITEUR_EMBARQUE = os.environ.get('IA_TRAITEUR_EMBARQUE', 'false' if IS_RENDER else 'true').lower() == 'true'
+    # Budget mensuel de jetons par client (services/consommation_ia.py) :
+    # features['budget_jetons_ia'] de la formule, sinon ce tableau par code de formule (None = illimité)
+    IA_BUDGETS_JETONS = {'standard': 200_000, 'premium': 1_000_000, 'enterprise': None}
+    IA_BUDGET_JETONS_DEFAUT = int(os.environ['IA_BUDGET_JETONS_DEFAUT']) if os.environ.get('IA_BUDGET_JETONS_DEFAUT') else None
+    
+    # ============================================================================
+    # RAPPORTS EN ARRIÈRE-PLAN (services/rapports_generes.py)
+    # ============================================================================
+    RAPPORTS_PROCESSUS = int(os.environ.get('RAPPORTS_PROCESSUS', 2))  # processus de rendu par worker
+    RAPPORTS_DOSSIER = os.environ.get('RAPPORTS_DOSSIER')  # défaut : instance/rapports
+    RAPPORTS_TRAITEUR_EMBARQUE = os.environ.get('RAPPORTS_TRAITEUR_EMBARQUE',
+                                                'false' if IS_RENDER else 'true').lower() == 'true'
+
+    # ============================================================================
+    # BOÎTE D'ENVOI DES EMAILS (services/emails_sortants.py, paramètres SMTP : MAIL_*)
+    # ============================================================================
+    EMAILS_TRAITEURS = int(os.environ.get('EMAILS_TRAITEURS', 1))  # threads (connexions SMTP) par worker
+    EMAILS_LOT = int(os.environ.get('EMAILS_LOT', 50))  # emails envoyés par connexion et par lot
+    EMAILS_MAX_TENTATIVES = int(os.environ.get('EMAILS_MAX_TENTATIVES', 5))
+    EMAILS_SMTP_INACTIVITE = int(os.environ.get('EMAILS_SMTP_INACTIVITE', 60))  # secondes avant fermeture
+    EMAILS_SMTP_TIMEOUT = int(os.environ.get('EMAILS_SMTP_TIMEOUT', 30))
+    EMAILS_RETENTION_JOURS = int(os.environ.get('EMAILS_RETENTION_JOURS', 30))
+    EMAILS_URL_APPLICATION = os.environ.get('EMAILS_URL_APPLICATION', os.environ.get('RENDER_EXTERNAL_URL', ''))
+    EMAILS_TRAITEUR_EMBARQUE = os.environ.get('EMAILS_TRAITEUR_EMBARQUE',
+                                              'false' if IS_RENDER else 'true').lower() == 'true'
+
     # ============================================================================
     # CONFIGURATION POUR LES TÂCHES PLANIFIÉES
     # ============================================================================
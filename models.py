@@ -190,6 +190,12 @@ class User(UserMixin, db.Model):
         'pause_until': None
     })
     
+    # Compteur des notifications non lues, maintenu à l'écriture (NULL : à recalculer)
+    # et version incrémentée à chaque changement (ETag de /api/notifications/recent)
+    # Voir services/notifications_temps_reel.py
+    notifications_non_lues = db.Column(db.Integer)
+    notifications_version = db.Column(db.Integer, default=0)
+    
     notifications_recues = db.relationship('Notification', 
                                           back_populates='destinataire',
                                           foreign_keys='Notification.destinataire_id',
@@ -204,209 +210,16 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
     
     def has_permission(self, permission):
-        """Vérifie si l'utilisateur a une permission spécifique - VERSION DÉFINITIVE"""
-        
-        print(f"🔐 [DEBUG] Vérification permission '{permission}' pour {self.username} (rôle: {self.role}, client_admin: {self.is_client_admin})")
-        
-        # 1. SUPER ADMIN : TOUJOURS AUTORISÉ (sauf exceptions)
+        """Vérifie si l'utilisateur a une permission spécifique (ensemble effectif précalculé)"""
+        # SUPER ADMIN : TOUJOURS AUTORISÉ
         if self.role == 'super_admin':
-            print(f"   ✅ Super admin - accès immédiat")
             return True
-        
-        # 2. Vérifier si l'utilisateur est un ADMIN CLIENT (deux façons de vérifier)
-        is_admin_client = (self.role == 'admin') or (getattr(self, 'is_client_admin', False))
-        
-        if is_admin_client:
-            print(f"   👑 Utilisateur est un ADMIN CLIENT")
-            
-            # Liste COMPLÈTE des permissions OBLIGATOIRES pour admin client
-            permissions_admin_obligatoires = {
-                # Tableau de bord et visualisation
-                'can_view_dashboard': True,
-                'can_view_reports': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                
-                # Gestion des risques
-                'can_manage_risks': True,
-                'can_validate_risks': True,
-                
-                # Gestion des KRI
-                'can_manage_kri': True,
-                
-                # Gestion des audits
-                'can_manage_audit': True,
-                'can_confirm_evaluations': True,
-                
-                # Plans d'action
-                'can_manage_action_plans': True,
-                'can_view_action_plans': True,
-                
-                # Gestion des utilisateurs
-                'can_view_users_list': True,
-                'can_edit_users': True,
-                'can_manage_users': True,
-                'can_create_users': True,
-                'can_deactivate_users': True,
-                'can_delete_users': True,
-                
-                # Gestion des départements
-                'can_manage_departments': True,
-                'can_access_all_departments': True,
-                
-                # Administration
-                'can_manage_settings': True,
-                'can_archive_data': True,
-                'can_export_data': True,
-                
-                # Veille règlementaire (si module activé)
-                'can_manage_regulatory': True if self.client and self.client.formule and 
-                                               self.client.formule.modules.get('veille_reglementaire', False) else False,
-                
-                # Processus (si module activé)
-                'can_manage_logigram': True if self.client and self.client.formule and 
-                                             self.client.formule.modules.get('gestion_processus', False) else False,
-                
-                # Permissions à TOUJOURS FALSE pour admin client
-                'can_manage_clients': False,
-                'can_provision_servers': False,
-                'can_manage_permissions': True,  # ADMIN client peut gérer les permissions de SES utilisateurs
-            }
-            
-            # Vérifier si la permission est dans la liste des permissions admin obligatoires
-            if permission in permissions_admin_obligatoires:
-                value = permissions_admin_obligatoires[permission]
-                print(f"   📋 Permission admin obligatoire '{permission}': {value}")
-                return value
-        
-        # 3. Vérifier si l'utilisateur est un GESTIONNAIRE (manager)
-        # 3. Vérifier si l'utilisateur est un GESTIONNAIRE (manager)
-        if self.role == 'manager':
-            print(f"   👤 Utilisateur est un GESTIONNAIRE (manager)")
-            
-            permissions_manager_base = {
-                # Visualisation de base
-                'can_view_dashboard': True,
-                'can_view_reports': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                
-                # Gestion des risques
-                'can_manage_risks': True,
-                'can_validate_risks': True,
-                
-                # KRI
-                'can_manage_kri': True,
-                
-                # Audit
-                'can_manage_audit': True,
-                
-                # Plans d'action
-                'can_view_action_plans': True,
-                'can_manage_action_plans': True,
-                
-                # Accès aux départements
-                'can_access_all_departments': True,
-                
-                # Export
-                'can_export_data': True,
-                
-                # Gestion des utilisateurs - CORRECTION ICI !
-                'can_manage_users': True,
-                'can_edit_users': True,
-                'can_view_users_list': True,
-                'can_create_users': True,           # AJOUTÉ
-                'can_deactivate_users': True,       # AJOUTÉ
-                'can_delete_users': True,           # AJOUTÉ
-                'can_manage_permissions': True,     # AJOUTÉ
-                
-                # Administration limitée
-                'can_manage_settings': True,        # Peut gérer certains paramètres
-                'can_manage_departments': True,     # Peut gérer les départements
-                
-                # Permissions réservées aux admin (toujours false pour manager)
-                'can_manage_clients': False,
-                'can_provision_servers': False,
-            }
-            
-            if permission in permissions_manager_base:
-                value = permissions_manager_base[permission]
-                print(f"   📋 Permission manager '{permission}': {value}")
-                return value
-        
-        # 4. Vérifier les permissions EXPLICITES dans user.permissions
-        if self.permissions and permission in self.permissions:
-            value = bool(self.permissions[permission])
-            print(f"   📋 Permission explicite dans DB: {value}")
-            return value
-        
-        # 5. Permissions par DÉFAUT selon le rôle (pour les rôles simples)
-        role_defaults = {
-            'auditeur': {
-                'can_view_dashboard': True,
-                'can_view_reports': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_manage_audit': True,
-                'can_view_action_plans': True,
-            },
-            'utilisateur': {
-                'can_view_dashboard': True,
-                'can_view_reports': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_view_action_plans': True,  # Peut voir les plans qui le concernent
-            },
-            'compliance': {
-                'can_view_dashboard': True,
-                'can_view_reports': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_manage_regulatory': True,
-            },
-            'consultant': {
-                'can_view_dashboard': True,
-                'can_view_reports': True,
-                'can_view_departments': True,
-                'can_create_users': True,
-            }
-        }
-        
-        if self.role in role_defaults and permission in role_defaults[self.role]:
-            value = role_defaults[self.role][permission]
-            print(f"   📋 Permission par défaut pour rôle '{self.role}': {value}")
-            return value
-        
-        # 6. Vérifier la formule du client pour les permissions liées aux modules
-        if self.client and self.client.formule:
-            formule = self.client.formule
-            
-            # Mapping des permissions liées aux modules
-            permission_to_module = {
-                'can_manage_regulatory': 'veille_reglementaire',
-                'can_manage_logigram': 'gestion_processus',
-                'can_manage_action_plans': 'audit_interne',
-                'can_view_action_plans': 'audit_interne',
-                'can_manage_risks': 'cartographie',
-                'can_manage_kri': 'suivi_kri',
-                'can_manage_audit': 'audit_interne',
-            }
-            
-            if permission in permission_to_module:
-                module_name = permission_to_module[permission]
-                if module_name in formule.modules:
-                    is_module_active = formule.modules[module_name]
-                    print(f"   🔍 Permission liée au module '{module_name}': {is_module_active}")
-                    
-                    # Si le module est activé, la permission est accordée
-                    if is_module_active:
-                        return True
-                    else:
-                        print(f"   ❌ Module '{module_name}' désactivé dans la formule")
-                        return False
-        
-        print(f"   ❌ Permission '{permission}' REFUSÉE par défaut")
-        return False
+        return permission in self.get_permissions_effectives()
+    
+    def get_permissions_effectives(self):
+        """Frozenset des permissions accordées (voir services/permissions_effectives.py)"""
+        from services.permissions_effectives import permissions_effectives
+        return permissions_effectives(self)
 
     
     def get_allowed_sections(self):
@@ -513,12 +326,9 @@ class User(UserMixin, db.Model):
         self.preferences_notifications[channel][event] = value
     
     def get_notifications_non_lues_count(self):
-        """Compter les notifications non lues"""
-        from models import Notification
-        return Notification.query.filter_by(
-            destinataire_id=self.id,
-            est_lue=False
-        ).count()
+        """Compter les notifications non lues (compteur maintenu, sans parcourir notifications)"""
+        from services.notifications_temps_reel import compteur_non_lues
+        return compteur_non_lues(self.id)
 
     def get_accessible_data(self):
         """Retourne uniquement les données accessibles par l'utilisateur"""
@@ -1001,6 +811,35 @@ class CampagneEvaluation(db.Model):
     def __repr__(self):
         return f'<CampagneEvaluation {self.id}: {self.nom}>'
 
+
+# -------------------- ÉVALUATION COURANTE (PROJECTION) --------------------
+class RisqueEvaluationCourante(db.Model):
+    """Projection de la dernière évaluation de chaque risque.
+
+    Une ligne par risque, maintenue par services/evaluation_courante.py à
+    chaque insertion/modification/suppression d'EvaluationRisque. Évite la
+    sous-requête max(created_at) dans les tableaux de bord et statistiques.
+    """
+    __tablename__ = 'risques_evaluation_courante'
+
+    risque_id = db.Column(db.Integer, db.ForeignKey('risques.id', ondelete='CASCADE'), primary_key=True)
+    evaluation_id = db.Column(db.Integer, db.ForeignKey('evaluations_risque.id', ondelete='CASCADE'),
+                              nullable=False, index=True)
+    score_risque = db.Column(db.Integer)
+    niveau_risque = db.Column(db.String(20), index=True)
+    impact = db.Column(db.Integer)
+    probabilite = db.Column(db.Integer)
+    date_evaluation = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Relations
+    risque = db.relationship('Risque', backref=db.backref('evaluation_courante', uselist=False, lazy=True,
+                                                          passive_deletes=True))
+    evaluation = db.relationship('EvaluationRisque')
+
+    def __repr__(self):
+        return f'<RisqueEvaluationCourante risque {self.risque_id} -> evaluation {self.evaluation_id}>'
+
 # -------------------- KRI (CORRIGÉ) --------------------
 class KRI(db.Model):
     __tablename__ = 'kri'
@@ -1096,24 +935,14 @@ class KRI(db.Model):
         self.updated_at = datetime.utcnow()
 
     def get_derniere_mesure(self):
-        """Obtenir la dernière mesure"""
-        if self.mesures:
-            return max(self.mesures, key=lambda x: x.date_mesure)
-        return None
+        """Obtenir la dernière mesure (sans charger self.mesures)"""
+        from services.series_kri import derniere_mesure
+        return derniere_mesure(self.id)
 
     def get_statistiques(self):
-        """Obtenir les statistiques de l'indicateur"""
-        if not self.mesures:
-            return None
-            
-        valeurs = [m.valeur for m in self.mesures]
-        return {
-            'moyenne': sum(valeurs) / len(valeurs) if valeurs else 0,
-            'min': min(valeurs) if valeurs else 0,
-            'max': max(valeurs) if valeurs else 0,
-            'nb_mesures': len(valeurs),
-            'derniere_valeur': valeurs[-1] if valeurs else None
-        }
+        """Obtenir les statistiques de l'indicateur (agrégats, voir services/series_kri.py)"""
+        from services.series_kri import statistiques
+        return statistiques(self.id)
 
     def get_etat_alerte(self, valeur):
         """Retourne l'état d'alerte basé sur le sens d'évaluation"""
@@ -1228,7 +1057,7 @@ class KRI(db.Model):
     def peut_etre_supprime(self):
         """Vérifie si l'indicateur peut être supprimé"""
         # Un indicateur sans mesure peut être supprimé
-        return len(self.mesures) == 0
+        return not db.session.query(MesureKRI.query.filter_by(kri_id=self.id).exists()).scalar()
     
     def clone(self, nouveau_nom=None, nouveau_createur_id=None):
         """Clone l'indicateur avec un nouveau nom"""
@@ -1321,6 +1150,112 @@ class MesureKRI(db.Model):
     createur = db.relationship('User', back_populates='mesures_prises', foreign_keys=[created_by])
     client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_mesure_kri_kri_date', 'kri_id', 'date_mesure'),
+    )
+
+
+class AgregatKRI(db.Model):
+    """Agrégat d'une période (jour, semaine, mois) des mesures d'un indicateur.
+
+    Tenu à jour à l'écriture des mesures par services/series_kri.py : les
+    statistiques et graphiques lisent ces lignes au lieu des mesures brutes.
+    """
+    __tablename__ = 'kri_agregats'
+
+    GRANULARITE_JOUR = 'jour'
+    GRANULARITE_SEMAINE = 'semaine'
+    GRANULARITE_MOIS = 'mois'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kri_id = db.Column(db.Integer, db.ForeignKey('kri.id', ondelete='CASCADE'), nullable=False)
+    granularite = db.Column(db.String(10), nullable=False)
+    debut_periode = db.Column(db.Date, nullable=False)
+    nb = db.Column(db.Integer, nullable=False, default=0)
+    somme = db.Column(db.Float, nullable=False, default=0)
+    somme_carres = db.Column(db.Float, nullable=False, default=0)  # écart-type sans relire les mesures
+    minimum = db.Column(db.Float)
+    maximum = db.Column(db.Float)
+    derniere_valeur = db.Column(db.Float)
+    derniere_date = db.Column(db.DateTime)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('kri_id', 'granularite', 'debut_periode', name='uq_kri_agregats_periode'),
+    )
+
+    @property
+    def moyenne(self):
+        return self.somme / self.nb if self.nb else None
+
+    def __repr__(self):
+        return f'<AgregatKRI {self.kri_id} {self.granularite} {self.debut_periode} n={self.nb}>'
+
+
+class EtatKRI(db.Model):
+    """Dernier état calculé d'un indicateur (valeur, tendance, seuils).
+
+    Calculé par lots par services/analyse_kri.py ; la liste des KRI et la
+    synchronisation lisent ces lignes. `perime` est posé à chaque écriture
+    de mesure pour forcer le recalcul à la lecture suivante.
+    """
+    __tablename__ = 'kri_etats'
+
+    kri_id = db.Column(db.Integer, db.ForeignKey('kri.id', ondelete='CASCADE'), primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+    nb_mesures = db.Column(db.Integer, nullable=False, default=0)
+    derniere_valeur = db.Column(db.Float)
+    derniere_date = db.Column(db.DateTime)
+    valeur_precedente = db.Column(db.Float)
+    variation_pct = db.Column(db.Float)  # dernière valeur vs précédente, en %
+    pente = db.Column(db.Float)          # régression sur la période de tendance
+    tendance = db.Column(db.String(10), nullable=False, default='stable')
+    etat = db.Column(db.String(20), nullable=False, default='inconnu')  # KRI.get_etat_alerte
+    etat_signale = db.Column(db.String(20))  # dernier état ayant donné lieu à une alerte
+    perime = db.Column(db.Boolean, nullable=False, default=False)
+    calcule_le = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<EtatKRI {self.kri_id} {self.etat} {self.tendance}>'
+
+
+class PrevisionKRI(db.Model):
+    """Prévision à court terme d'un indicateur (modèle retenu et dates de franchissement des seuils).
+
+    Calculée par lots par services/prevision_kri.py et conservée jusqu'à la
+    prochaine écriture de mesure (`perime`) : la lecture ne réajuste rien.
+    """
+    __tablename__ = 'kri_previsions'
+
+    MODELE_LINEAIRE = 'lineaire'
+    MODELE_EWMA = 'ewma'
+    MODELE_HOLT = 'holt'
+
+    kri_id = db.Column(db.Integer, db.ForeignKey('kri.id', ondelete='CASCADE'), primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+    modele = db.Column(db.String(10))    # None : pas assez de mesures
+    nb_points = db.Column(db.Integer, nullable=False, default=0)
+    erreur = db.Column(db.Float)         # RMSE des prévisions à un pas sur la fenêtre
+    niveau = db.Column(db.Float)         # valeur lissée à la date de la dernière mesure
+    pente_jour = db.Column(db.Float)     # variation prévue par jour
+    derniere_date = db.Column(db.DateTime)
+    horizon_jours = db.Column(db.Integer)
+    valeur_horizon = db.Column(db.Float)
+    date_seuil_alerte = db.Column(db.DateTime)    # franchissement prévu dans l'horizon
+    date_seuil_critique = db.Column(db.DateTime)
+    niveau_signale = db.Column(db.String(10))     # dernier avertissement envoyé ('alerte', 'critique')
+    perime = db.Column(db.Boolean, nullable=False, default=False)
+    calcule_le = db.Column(db.DateTime)
+
+    def valeur_prevue(self, moment):
+        """Valeur prévue à une date (droite niveau + pente, sans réajustement)"""
+        if self.modele is None or self.derniere_date is None:
+            return None
+        return self.niveau + self.pente_jour * (moment - self.derniere_date).total_seconds() / 86400
+
+    def __repr__(self):
+        return f'<PrevisionKRI {self.kri_id} {self.modele}>'
+
 # -------------------- SOUS-ETAPE PROCESSUS --------------------
 class SousEtapeProcessus(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -2849,6 +2784,146 @@ class UserSession(db.Model):
     def __repr__(self):
         return f'<UserSession {self.user_id} - {self.session_id}>'
 
+
+# -------------------- TÂCHES PLANIFIÉES (WORKER) --------------------
+class VerrouTache(db.Model):
+    """Bail de leader des tâches planifiées (une ligne par verrou).
+
+    Seul le processus worker.py qui détient un bail non expiré exécute les
+    tâches ; il le renouvelle régulièrement (voir services/taches_planifiees.py).
+    Utilisé quand la base ne propose pas de verrou consultatif (SQLite).
+    """
+    __tablename__ = 'verrous_taches'
+
+    nom = db.Column(db.String(100), primary_key=True)
+    detenteur = db.Column(db.String(200), nullable=False)
+    acquis_le = db.Column(db.DateTime, default=datetime.utcnow)
+    expire_le = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<VerrouTache {self.nom} -> {self.detenteur}>'
+
+
+class ExecutionTache(db.Model):
+    """Historique des exécutions des tâches planifiées"""
+    __tablename__ = 'executions_taches'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tache = db.Column(db.String(100), nullable=False)
+    detenteur = db.Column(db.String(200))
+    statut = db.Column(db.String(20), default='en_cours')  # en_cours, succes, echec, ignoree
+    debut = db.Column(db.DateTime, default=datetime.utcnow)
+    fin = db.Column(db.DateTime)
+    duree_ms = db.Column(db.Integer)
+    resultat = db.Column(db.JSON)
+    erreur = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_executions_taches_tache_debut', 'tache', 'debut'),
+    )
+
+    def __repr__(self):
+        return f'<ExecutionTache {self.tache} {self.statut}>'
+
+
+# -------------------- RAPPORTS GÉNÉRÉS (ARRIÈRE-PLAN) --------------------
+class RapportGenere(db.Model):
+    """Rendu d'un rapport (PDF, Word) : tâche en file puis fichier en cache.
+
+    Une ligne par (entité, type de rapport, version des données). Tant que
+    l'audit, la cartographie ou le logigramme ne change pas, le fichier
+    déjà rendu est resservi (voir services/rapports_generes.py).
+    """
+    __tablename__ = 'rapports_generes'
+
+    STATUT_EN_ATTENTE = 'en_attente'
+    STATUT_EN_COURS = 'en_cours'
+    STATUT_TERMINE = 'termine'
+    STATUT_ECHEC = 'echec'
+
+    id = db.Column(db.Integer, primary_key=True)
+    type_rapport = db.Column(db.String(50), nullable=False)
+    entite_type = db.Column(db.String(50), nullable=False)
+    entite_id = db.Column(db.Integer, nullable=False)
+    version_donnees = db.Column(db.String(64), nullable=False)
+    statut = db.Column(db.String(20), default=STATUT_EN_ATTENTE, nullable=False, index=True)
+    etape = db.Column(db.String(100))
+    erreur = db.Column(db.Text)
+    tentatives = db.Column(db.Integer, default=0)
+    detenteur = db.Column(db.String(100))
+    chemin = db.Column(db.String(500))
+    nom_fichier = db.Column(db.String(255))
+    mimetype = db.Column(db.String(100))
+    taille = db.Column(db.Integer)
+    nb_telechargements = db.Column(db.Integer, default=0)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    date_debut = db.Column(db.DateTime)
+    date_fin = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_rapports_generes_cle', 'entite_type', 'entite_id', 'type_rapport', 'version_donnees'),
+    )
+
+    @property
+    def est_termine(self):
+        return self.statut == self.STATUT_TERMINE
+
+    @property
+    def est_actif(self):
+        return self.statut in (self.STATUT_EN_ATTENTE, self.STATUT_EN_COURS)
+
+    def __repr__(self):
+        return f'<RapportGenere {self.type_rapport} {self.entite_type}:{self.entite_id} {self.statut}>'
+
+
+class EmailSortant(db.Model):
+    """Email en boîte d'envoi, expédié par les traiteurs de services/emails_sortants.py.
+
+    Le message est enregistré dans la transaction de la requête (ou de la
+    notification) ; le modèle Jinja est rendu au moment de l'envoi, par lot.
+    Les échecs temporaires sont retentés avec un délai croissant (prochain_essai).
+    """
+    __tablename__ = 'emails_sortants'
+
+    STATUT_EN_ATTENTE = 'en_attente'
+    STATUT_EN_COURS = 'en_cours'
+    STATUT_ENVOYE = 'envoye'
+    STATUT_SIMULE = 'simule'
+    STATUT_ECHEC = 'echec'
+
+    id = db.Column(db.Integer, primary_key=True)
+    destinataires = db.Column(db.JSON, nullable=False)
+    cc = db.Column(db.JSON)
+    bcc = db.Column(db.JSON)
+    sujet = db.Column(db.String(255), nullable=False)
+    # Corps fourni tel quel, ou modèle (templates/emails/...) rendu avec contexte
+    corps_texte = db.Column(db.Text)
+    corps_html = db.Column(db.Text)
+    modele = db.Column(db.String(150))
+    contexte = db.Column(db.JSON)
+    # Contenu effacé après l'envoi (mots de passe temporaires...)
+    sensible = db.Column(db.Boolean, default=False)
+    categorie = db.Column(db.String(50))
+    notification_id = db.Column(db.Integer, db.ForeignKey('notifications.id', ondelete='SET NULL'))
+    statut = db.Column(db.String(20), default=STATUT_EN_ATTENTE, nullable=False)
+    tentatives = db.Column(db.Integer, default=0)
+    prochain_essai = db.Column(db.DateTime, default=datetime.utcnow)
+    detenteur = db.Column(db.String(100))
+    erreur = db.Column(db.Text)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    date_envoi = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_emails_sortants_file', 'statut', 'prochain_essai'),
+    )
+
+    def __repr__(self):
+        return f'<EmailSortant {self.id} {self.sujet[:30]!r} {self.statut}>'
+
 # -------------------- CONFIGURATION DES CHAMPS DE RISQUE --------------------
 class ConfigurationChampRisque(db.Model):
     __tablename__ = 'configuration_champs_risque'
@@ -3395,14 +3470,64 @@ class AnalyseIA(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True)
 
+    # File d'attente (services/file_analyse_ia.py) : en_attente -> en_cours -> termine / echec
+    STATUT_EN_ATTENTE = 'en_attente'
+    STATUT_EN_COURS = 'en_cours'
+    STATUT_TERMINE = 'termine'
+    STATUT_ECHEC = 'echec'
+
+    statut = db.Column(db.String(20), default=STATUT_TERMINE, index=True)
+    progression = db.Column(db.Integer, default=100)
+    etape = db.Column(db.String(100))
+    erreur = db.Column(db.Text)
+    tentatives = db.Column(db.Integer, default=0)
+    detenteur = db.Column(db.String(100))
+    date_debut = db.Column(db.DateTime)
+    date_fin = db.Column(db.DateTime)
+
+    # Cache par contenu (services/consommation_ia.py) : empreinte (modèle, prompt, version des données)
+    empreinte = db.Column(db.String(64), index=True)
+    jetons = db.Column(db.Integer, default=0)
+
     # CORRECTION: foreign_keys=[audit_id]
     audit = db.relationship('Audit', foreign_keys=[audit_id], backref='analyses_ia')
+
+    @property
+    def est_terminee(self):
+        """Les analyses antérieures à la file d'attente n'ont pas de statut"""
+        return self.statut in (None, self.STATUT_TERMINE)
+
+    @property
+    def est_active(self):
+        return self.statut in (self.STATUT_EN_ATTENTE, self.STATUT_EN_COURS)
     
     utilisateur = db.relationship('User', foreign_keys=[created_by], backref='analyses_ia_crees')
     
     def __repr__(self):
         return f'<AnalyseIA {self.id} - Audit {self.audit_id}>'
 
+class ConsommationIA(db.Model):
+    """Consommation IA agrégée par client, mois et modèle (jetons, appels, réponses en cache)"""
+    __tablename__ = 'consommations_ia'
+    __table_args__ = (
+        db.UniqueConstraint('client_id', 'periode', 'modele', name='uq_consommation_ia_client_periode_modele'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+    periode = db.Column(db.String(7), nullable=False)  # 'AAAA-MM'
+    fournisseur = db.Column(db.String(50))
+    modele = db.Column(db.String(100), nullable=False)
+    nb_appels = db.Column(db.Integer, default=0, nullable=False)
+    nb_cache = db.Column(db.Integer, default=0, nullable=False)
+    jetons_prompt = db.Column(db.Integer, default=0, nullable=False)
+    jetons_reponse = db.Column(db.Integer, default=0, nullable=False)
+    jetons_total = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ConsommationIA client={self.client_id} {self.periode} {self.modele}: {self.jetons_total}>'
+
 class Notification(db.Model):
     __tablename__ = 'notifications'
     
@@ -3,6 +3,9 @@ from flask import Blueprint, render_template, jsonify, request, redirect, url_fo
 from flask_login import login_required, current_user
 from datetime import datetime
 from models import db, Notification
+from services.notifications_temps_reel import (
+    avec_etag, etag_notifications, flux_notifications, reponse_non_modifiee
+)
 
 # Créer le blueprint
 notifications_bp = Blueprint('notifications', __name__)
@@ -137,19 +140,23 @@ def supprimer_toutes_lues():
 @login_required
 def api_notifications_count():
     """API pour obtenir le nombre de notifications non lues"""
-    count = Notification.query.filter_by(
-        destinataire_id=current_user.id,
-        est_lue=False
-    ).count()
+    count, etag = etag_notifications(current_user.id)
+    if request.if_none_match.contains(etag):
+        return reponse_non_modifiee(etag)
     
-    return jsonify({'count': count})
+    return avec_etag(jsonify({'count': count}), etag)
 
 @notifications_bp.route('/api/notifications/recent')
 @login_required
 def api_notifications_recent():
-    """API pour les notifications récentes (pour dropdown)"""
+    """API pour les notifications récentes (pour dropdown, repli sans flux SSE)"""
     limit = request.args.get('limit', 5, type=int)
     
+    # Rien n'a changé depuis le dernier appel : ni liste ni comptage
+    count, etag = etag_notifications(current_user.id, limit)
+    if request.if_none_match.contains(etag):
+        return reponse_non_modifiee(etag)
+    
     notifications = Notification.query.filter_by(
         destinataire_id=current_user.id
     ).order_by(
@@ -170,13 +177,20 @@ def api_notifications_recent():
             'color': notif.get_color() if hasattr(notif, 'get_color') else 'primary'
         })
     
-    return jsonify({
+    return avec_etag(jsonify({
         'notifications': notifications_data,
-        'count': Notification.query.filter_by(
-            destinataire_id=current_user.id,
-            est_lue=False
-        ).count()
-    })
+        'count': count
+    }), etag)
+
+@notifications_bp.route('/api/notifications/flux')
+@login_required
+def api_notifications_flux():
+    """Flux Server-Sent Events : nouvelles notifications et compteur de non lues"""
+    reponse = flux_notifications(current_user.id)
+    if reponse is None:
+        # Limite de flux atteinte : le navigateur interroge /api/notifications/recent
+        return jsonify({'error': 'Flux indisponible'}), 503, {'Retry-After': '60'}
+    return reponse
 
 @notifications_bp.route('/api/notifications/<int:notification_id>/toggle-lue', methods=['POST'])
 @login_required
@@ -1,13 +1,90 @@
 # services/analyse_ia.py - Version corrigée
 import os
 import json
+import logging
 import time
 from datetime import datetime
 from typing import Optional, Dict, Any
 
+logger = logging.getLogger(__name__)
+
+# Test de connexion fait une fois par processus (et par clé) au lieu d'un
+# models.list() à chaque instanciation du service
+_CONNEXIONS_TESTEES = {}
+DUREE_TEST_CONNEXION = 3600  # secondes
+
+
+class _Objet:
+    """Objet simple à attributs (mime les réponses du SDK OpenAI)"""
+
+    def __init__(self, **attributs):
+        self.__dict__.update(attributs)
+
+
+class ClientIASimule:
+    """
+    Fournisseur local qui imite l'interface du client OpenAI
+    (chat.completions.create, models.list) : permet de faire tourner toute
+    la chaîne (file d'attente, progression, stockage) hors ligne.
+
+    IA_FOURNISSEUR=simule, IA_SIMULE_LATENCE (s), IA_SIMULE_TAUX_ECHEC (0-1)
+    """
+
+    MODELE = 'simulateur-local'
+
+    def __init__(self, latence=None, taux_echec=None):
+        self.latence = float(os.environ.get('IA_SIMULE_LATENCE', 2.0) if latence is None else latence)
+        self.taux_echec = float(os.environ.get('IA_SIMULE_TAUX_ECHEC', 0) if taux_echec is None else taux_echec)
+        self.chat = _Objet(completions=_Objet(create=self._completion))
+        self.models = _Objet(list=lambda **kwargs: _Objet(data=[_Objet(id=self.MODELE)]))
+
+    def _completion(self, model=None, messages=None, **kwargs):
+        import hashlib
+        import random
+
+        time.sleep(self.latence)
+        if self.taux_echec and random.random() < self.taux_echec:
+            raise RuntimeError("Erreur simulée du fournisseur IA (IA_SIMULE_TAUX_ECHEC)")
+
+        prompt = '\n'.join(m.get('content', '') for m in (messages or []))
+        graine = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8], 16)
+        generateur = random.Random(graine)
+        themes = ['documentation', 'séparation des tâches', 'contrôles d\'accès', 'suivi des délais', 'formation']
+        generateur.shuffle(themes)
+
+        contenu = {
+            'analyse': "Analyse générée par le fournisseur simulé à partir du contexte de l'audit.",
+            'points_forts': ['Procédures existantes', 'Implication des équipes'],
+            'risques': [{'nom': f"Risque lié à {t}", 'niveau': generateur.choice(['faible', 'moyen', 'eleve']),
+                         'probabilite': round(generateur.uniform(0.1, 0.6), 2)} for t in themes[:2]],
+            'recommandations_ia': [{
+                'id': i + 1,
+                'titre': f"Renforcer {t}",
+                'description': f"Formaliser et contrôler {t} sur le périmètre audité.",
+                'priorite': generateur.choice(['haute', 'moyenne', 'basse']),
+                'score_confiance': generateur.randint(65, 92),
+                'delai_suggere': f"{generateur.choice([30, 45, 60, 90])} jours",
+            } for i, t in enumerate(themes[:3])],
+            'causes_racines': [{'cause': f"Insuffisance sur {themes[0]}", 'frequence': 2, 'impact': 'moyen',
+                                'solutions': ['Formaliser la procédure', 'Désigner un responsable']}],
+        }
+        texte = json.dumps(contenu, ensure_ascii=False)
+        jetons_prompt = max(1, len(prompt) // 4)
+        jetons_reponse = max(1, len(texte) // 4)
+        return _Objet(
+            model=model or self.MODELE,
+            choices=[_Objet(message=_Objet(content=texte), finish_reason='stop')],
+            usage=_Objet(prompt_tokens=jetons_prompt, completion_tokens=jetons_reponse,
+                         total_tokens=jetons_prompt + jetons_reponse),
+        )
+
+
 class ServiceAnalyseIA:
-    def __init__(self):
-        """Initialiser le service IA avec la nouvelle API OpenAI"""
+    def __init__(self, fournisseur=None):
+        """Initialiser le service IA (fournisseur : 'openai', 'multi' ou 'simule')"""
+        
+        self.fournisseur = (fournisseur or os.environ.get('IA_FOURNISSEUR', 'openai')).lower()
+        self.modele = os.environ.get('IA_MODELE', 'gpt-3.5-turbo')
         
         # Récupérer la clé depuis l'environnement
         self.api_key = os.environ.get("OPENAI_API_KEY")
@@ -17,87 +94,112 @@ class ServiceAnalyseIA:
         self.client = None
         self.quota_error = False
         
-        print(f"\n🔍 INITIALISATION SERVICE IA")
-        print(f"   Clé API: {'✅ Présente' if self.api_key else '❌ Absente'}")
+        if self.fournisseur == 'simule':
+            self.client = ClientIASimule()
+            self.modele = ClientIASimule.MODELE
+            self.mode_simulation = False
+            logger.info("Service IA : fournisseur simulé local")
+            return
+        
+        if self.fournisseur == 'multi':
+            # OpenAI / Anthropic / Gemini avec relance et secours (services/repartiteur_ia.py)
+            from services.repartiteur_ia import repartiteur_depuis_environnement
+            self.client = repartiteur_depuis_environnement()
+            if self.client is None:
+                logger.info("Service IA : mode simulation (aucun fournisseur configuré)")
+                return
+            self.modele = self.client.modele
+            self.mode_simulation = False
+            return
         
         if not self.api_key or self.api_key.startswith("mode-simulation"):
-            print("   🔧 Mode simulation activé (pas de clé API valide)")
+            logger.info("Service IA : mode simulation (pas de clé API valide)")
             return
         
         # Vérifier le format de la clé
         if not self.api_key.startswith("sk-"):
-            print(f"   ⚠️ Format clé invalide (doit commencer par 'sk-')")
+            logger.warning("Service IA : format de clé invalide (doit commencer par 'sk-')")
             return
         
         # Initialiser OpenAI
         try:
             from openai import OpenAI
             self.client = OpenAI(api_key=self.api_key)
-            print("   ✅ Client OpenAI initialisé")
             
-            # Tester la connexion
+            # Tester la connexion (résultat mémorisé pour le processus)
             if self._tester_connexion():
                 self.mode_simulation = False
-                print("   ✅ Mode réel activé")
-            else:
-                print("   🔧 Mode simulation activé (test échoué)")
                 
         except ImportError:
-            print("   ⚠️ Package OpenAI non installé")
-            print("      pip install openai")
+            logger.warning("Service IA : package OpenAI non installé (pip install openai)")
         except Exception as e:
-            print(f"   ⚠️ Erreur: {e}")
+            logger.warning("Service IA : erreur d'initialisation: %s", e)
     
     def _tester_connexion(self):
-        """Tester la connexion à l'API - retourne True si succès"""
+        """Tester la connexion à l'API - retourne True si succès (mémorisé DUREE_TEST_CONNEXION)"""
         if not self.client:
             return False
         
+        memorise = _CONNEXIONS_TESTEES.get(self.api_key)
+        if memorise and time.monotonic() - memorise['instant'] < DUREE_TEST_CONNEXION:
+            self.quota_error = memorise['quota_error']
+            return memorise['ok']
+        
+        ok = False
         try:
             # Test très basique pour vérifier l'authentification
             response = self.client.models.list(timeout=10.0)
-            print(f"   ✅ Connexion API OK - {len(response.data)} modèles disponibles")
-            return True
+            logger.info("Connexion API OK - %d modèles disponibles", len(response.data))
+            ok = True
             
         except Exception as e:
             error_msg = str(e)
-            print(f"   ❌ Erreur connexion API")
             
             # Messages d'erreur spécifiques
             if "insufficient_quota" in error_msg or "429" in error_msg:
-                print("   💸 ERREUR QUOTA: Plus de crédit sur votre compte")
-                print("      https://platform.openai.com/billing")
+                logger.warning("Erreur connexion API : quota épuisé (https://platform.openai.com/billing)")
                 self.quota_error = True
             elif "Invalid API key" in error_msg:
-                print("   🔑 Clé API invalide")
+                logger.warning("Erreur connexion API : clé API invalide")
             elif "rate limit" in error_msg.lower():
-                print("   ⏳ Limite de taux, réessayez plus tard")
+                logger.warning("Erreur connexion API : limite de taux, réessayez plus tard")
             else:
-                print(f"   Détails: {error_msg[:100]}...")
-            
-            return False
-    
-    def analyser_audit(self, audit_id, type_analyse='complet', user_id=None):
-        """Analyser un audit avec l'IA"""
+                logger.warning("Erreur connexion API: %s", error_msg[:100])
         
-        print(f"\n🎯 ANALYSE IA DÉMARRÉE")
-        print(f"   Audit ID: {audit_id}")
-        print(f"   Mode: {'Simulation' if self.mode_simulation else 'Réel'}")
+        _CONNEXIONS_TESTEES[self.api_key] = {'ok': ok, 'quota_error': self.quota_error,
+                                             'instant': time.monotonic()}
+        return ok
+    
+    def analyser_audit(self, audit_id, type_analyse='complet', user_id=None, progression=None):
+        """
+        Analyser un audit avec l'IA.
+
+        `progression(pourcentage, etape)` est appelé aux étapes clés
+        (utilisé par la file d'attente, services/file_analyse_ia.py).
+        """
+        progression = progression or (lambda pourcentage, etape: None)
+        logger.info("Analyse IA audit %s (%s, mode %s)", audit_id, type_analyse,
+                    'simulation' if self.mode_simulation else self.fournisseur)
         
         if self.mode_simulation:
+            progression(50, 'Simulation de l\'analyse')
             return self._simuler_analyse_detaille(audit_id, type_analyse)
         
         try:
-            # Mode réel avec OpenAI
-            return self._analyser_reel(audit_id, type_analyse)
+            # Mode réel (OpenAI ou fournisseur simulé local)
+            return self._analyser_reel(audit_id, type_analyse, progression)
             
         except Exception as e:
-            print(f"❌ Erreur analyse réelle: {e}")
-            print("   Fallback vers la simulation")
+            from services.consommation_ia import BudgetIADepasse
+            if isinstance(e, BudgetIADepasse):
+                raise
+            logger.warning("Erreur analyse réelle, fallback vers la simulation: %s", e)
+            progression(80, 'Repli sur la simulation')
             return self._simuler_analyse_detaille(audit_id, type_analyse)
     
-    def _analyser_reel(self, audit_id, type_analyse):
+    def _analyser_reel(self, audit_id, type_analyse, progression=None):
         """Analyse réelle avec OpenAI"""
+        progression = progression or (lambda pourcentage, etape: None)
         try:
             # Créer un contexte d'application
             app_context = self.get_app_context()  # CORRECTION : utiliser self.
@@ -114,44 +216,177 @@ class ServiceAnalyseIA:
                 if not audit:
                     raise ValueError(f"Audit {audit_id} non trouvé")
                 
-                # Construire un prompt intelligent
-                prompt = self._construire_prompt_intelligent(audit, type_analyse)
+                from services.consommation_ia import (
+                    analyse_en_cache, enregistrer_consommation, verifier_budget
+                )
+                from services.contexte_ia import estimer_jetons, prompt_analyse
+                
+                # Contexte classé, dédoublonné et borné en jetons
+                progression(20, 'Préparation du contexte')
+                contexte, empreinte = self.preparer_requete(audit, type_analyse)
+                
+                # Même modèle, même prompt, mêmes données : résultat déjà payé
+                en_cache = analyse_en_cache(empreinte, audit.id)
+                if en_cache is not None:
+                    enregistrer_consommation(audit.client_id, self.modele, fournisseur=self.fournisseur,
+                                             depuis_cache=True)
+                    logger.info("Analyse IA audit %s servie par le cache (analyse %s)", audit_id, en_cache.id)
+                    return self.resultat_depuis_cache(en_cache, empreinte)
+                
+                verifier_budget(audit.client_id)
+                
+                # Audit trop volumineux : synthèse des lots en parallèle (map)
+                syntheses, jetons_map = None, 0
+                if contexte.map_reduce:
+                    progression(30, f"Synthèse de {len(contexte.morceaux)} lots de constatations")
+                    syntheses, jetons_map = self._synthetiser_morceaux(audit, contexte)
                 
                 # Appel à l'API
-                response = self.client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {
-                            "role": "system", 
-                            "content": "Tu es un expert en audit interne, gestion des risques et conformité. Réponds en français avec des analyses structurées."
-                        },
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=1500
-                )
+                progression(60 if syntheses else 40, 'Interrogation du modèle')
+                response = self._completer(self._messages(prompt_analyse(contexte.texte(syntheses), type_analyse)),
+                                           max_tokens=1500, format_json=True, audit=audit)
+                
+                usage = response.usage
+                fournisseur = self._enregistrer_usage(audit, response)
                 
                 # Traiter la réponse
+                progression(90, 'Traitement de la réponse')
                 resultat = self._traiter_reponse_ia(response, audit_id)
                 
                 # Ajouter les métadonnées
                 resultat['metadata'] = {
                     'audit_id': audit_id,
-                    'mode': 'reel',
+                    'mode': 'fournisseur_simule' if self.fournisseur == 'simule' else 'reel',
+                    'fournisseur': fournisseur,
+                    'latence_ms': getattr(response, 'latence_ms', None),
                     'model': response.model,
-                    'tokens': response.usage.total_tokens,
+                    'tokens': usage.total_tokens + jetons_map,
+                    'contexte': dict(contexte.stats, jetons_estimes=estimer_jetons(contexte.texte(syntheses))),
+                    'empreinte': empreinte,
+                    'cache': False,
                     'score_confiance': 85.0,
                     'timestamp': datetime.now().isoformat()
                 }
                 
-                print(f"   ✅ Analyse réelle terminée")
-                print(f"   Tokens utilisés: {response.usage.total_tokens}")
+                logger.info("Analyse réelle terminée (%s jetons)", usage.total_tokens)
                 
                 return resultat
                 
         except Exception as e:
+            from services.consommation_ia import BudgetIADepasse
+            if isinstance(e, BudgetIADepasse):
+                raise
             raise Exception(f"Erreur analyse réelle: {e}")
     
+    @staticmethod
+    def _messages(prompt):
+        return [
+            {
+                "role": "system", 
+                "content": "Tu es un expert en audit interne, gestion des risques et conformité. Réponds en français avec des analyses structurées."
+            },
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _completer(self, messages, max_tokens, format_json=False, audit=None):
+        """
+        format_json : le répartiteur rejette un corps non JSON et passe au fournisseur suivant.
+        audit : les réponses que le répartiteur écarte sont imputées au budget de son client.
+        """
+        options = {'response_format': {'type': 'json_object'}} if format_json else {}
+        if self.fournisseur == 'multi' and audit is not None:
+            options['sur_reponse_ecartee'] = self._imputer_reponse_ecartee(audit.client_id)
+        return self.client.chat.completions.create(
+            model=self.modele,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=max_tokens,
+            timeout=float(os.environ.get('IA_TIMEOUT', 60)),
+            **options
+        )
+    
+    def _enregistrer_usage(self, audit, response):
+        """Comptabilise les jetons d'un appel ; retourne le fournisseur qui a répondu"""
+        from services.consommation_ia import enregistrer_consommation
+        usage = response.usage
+        fournisseur = getattr(response, 'fournisseur', self.fournisseur)
+        enregistrer_consommation(audit.client_id, response.model or self.modele,
+                                 jetons_prompt=getattr(usage, 'prompt_tokens', 0),
+                                 jetons_reponse=getattr(usage, 'completion_tokens', 0),
+                                 jetons_total=usage.total_tokens, fournisseur=fournisseur)
+        return fournisseur
+    
+    def _imputer_reponse_ecartee(self, client_id):
+        """Rappel du répartiteur (éventuellement hors du thread de la requête) : jetons d'une réponse écartée"""
+        def imputer(reponse):
+            from services.consommation_ia import enregistrer_consommation
+            app_context = self.get_app_context()
+            if app_context is None:
+                return
+            usage = reponse.usage
+            with app_context:
+                enregistrer_consommation(client_id, reponse.model or self.modele,
+                                         jetons_prompt=getattr(usage, 'prompt_tokens', 0),
+                                         jetons_reponse=getattr(usage, 'completion_tokens', 0),
+                                         jetons_total=usage.total_tokens,
+                                         fournisseur=getattr(reponse, 'fournisseur', self.fournisseur))
+        return imputer
+    
+    def _synthetiser_morceaux(self, audit, contexte):
+        """Appels de synthèse concurrents (IA_PARALLELISME_MAP) ; retourne (synthèses, jetons)"""
+        from concurrent.futures import ThreadPoolExecutor
+        from services.contexte_ia import prompt_morceau
+        from services.repartiteur_ia import extraire_json
+        
+        total = len(contexte.morceaux)
+        prompts = [prompt_morceau(contexte.entete, morceau, i, total)
+                   for i, morceau in enumerate(contexte.morceaux, 1)]
+        parallelisme = max(1, min(total, int(os.environ.get('IA_PARALLELISME_MAP', 4))))
+        with ThreadPoolExecutor(max_workers=parallelisme, thread_name_prefix='analyse-ia-map') as executeur:
+            reponses = list(executeur.map(
+                lambda prompt: self._completer(self._messages(prompt), max_tokens=400, format_json=True,
+                                               audit=audit),
+                prompts))
+        
+        jetons = 0
+        for reponse in reponses:
+            self._enregistrer_usage(audit, reponse)
+            jetons += reponse.usage.total_tokens
+        logger.info("Analyse IA audit %s : %s lots synthétisés (%s jetons)", audit.id, total, jetons)
+        syntheses = []
+        for reponse in reponses:
+            contenu = reponse.choices[0].message.content.strip()
+            objet = extraire_json(contenu)
+            synthese = objet.get('synthese') if isinstance(objet, dict) else None
+            syntheses.append(synthese.strip() if isinstance(synthese, str) and synthese.strip() else contenu)
+        return syntheses, jetons
+    
+    def preparer_requete(self, audit, type_analyse):
+        """Contexte de l'analyse et empreinte (modèle, type, contexte déterministe, version des données)"""
+        from services.consommation_ia import empreinte_prompt, version_donnees_audit
+        from services.contexte_ia import construire_contexte, prompt_analyse
+        
+        contexte = construire_contexte(audit)
+        cle = self._messages(prompt_analyse(contexte.cle(), type_analyse))
+        return contexte, empreinte_prompt(self.modele, cle, version_donnees_audit(audit.id))
+    
+    def chercher_en_cache(self, audit, type_analyse):
+        """Analyse terminée réutilisable pour l'audit dans son état actuel (None en mode simulation)"""
+        if self.mode_simulation:
+            return None, None
+        from services.consommation_ia import analyse_en_cache
+        _, empreinte = self.preparer_requete(audit, type_analyse)
+        return analyse_en_cache(empreinte, audit.id), empreinte
+    
+    @staticmethod
+    def resultat_depuis_cache(analyse, empreinte):
+        import copy
+        resultat = copy.deepcopy(analyse.resultat or {})
+        metadata = resultat.setdefault('metadata', {})
+        metadata.update({'cache': True, 'analyse_source_id': analyse.id, 'empreinte': empreinte,
+                         'tokens': 0, 'timestamp': datetime.now().isoformat()})
+        return resultat
+    
     def get_app_context(self):
         """Obtenir ou créer un contexte d'application Flask"""
         try:
@@ -431,23 +666,9 @@ class ServiceAnalyseIA:
         }
     
     def _construire_prompt_intelligent(self, audit, type_analyse):
-        """Construire un prompt intelligent pour l'analyse"""
-        # Cette méthode est utilisée en mode réel
-        return f"""
-        Analyse l'audit suivant :
-        
-        Référence: {audit.reference}
-        Titre: {audit.titre}
-        Objectif: {getattr(audit, 'objectif', 'Non spécifié')}
-        
-        Fournis une analyse structurée avec:
-        1. Points forts
-        2. Risques identifiés
-        3. Recommandations prioritaires
-        4. Causes racines
-        
-        Format de réponse: JSON structuré.
-        """
+        """Prompt complet dans le budget de jetons (sans map-reduce : détail tronqué au classement)"""
+        from services.contexte_ia import construire_contexte, prompt_analyse
+        return prompt_analyse(construire_contexte(audit).texte(), type_analyse)
     
     def _traiter_reponse_ia(self, response, audit_id):
         """Traiter la réponse de l'IA (mode réel)"""
@@ -475,6 +696,7 @@ class ServiceAnalyseIA:
         """Obtenir le statut du service"""
         return {
             'mode': 'simulation' if self.mode_simulation else 'reel',
+            'fournisseur': self.fournisseur,
             'quota_error': self.quota_error,
             'client_initialise': self.client is not None,
             'api_key_presente': self.api_key is not None
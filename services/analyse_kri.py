@@ -0,0 +1,361 @@
+# services/analyse_kri.py
+"""
+Analyse par lots des indicateurs (KRI/KPI).
+
+Au lieu d'un np.polyfit par indicateur sur une liste Python, les mesures
+de tous les indicateurs à recalculer sont lues en une requête (triées par
+kri_id puis date_mesure, index ix_mesure_kri_kri_date) et rangées dans
+des tableaux NumPy groupés. Une seule passe vectorisée calcule pour tous :
+
+- nombre de mesures, dernière valeur, valeur précédente, variation en % ;
+- pente de la régression sur les `periode_jours` derniers jours (même règle
+  que utils.calculer_tendance_kri : abscisse = rang de la mesure) ;
+- état vis-à-vis des seuils, selon sens_evaluation_seuil (même règle que
+  KRI.get_etat_alerte).
+
+Les résultats sont enregistrés dans kri_etats (une ligne par indicateur).
+Toute écriture de mesure marque la ligne `perime` (ainsi que celles des
+autres tables de TABLES_PERIMABLES, ex. kri_previsions) ; elle est aussi
+recalculée après DUREE_VALIDITE (la fenêtre de tendance glisse) ou si
+l'indicateur a été modifié (seuils, sens) depuis le calcul.
+
+    rafraichir(kri_ids)        -> recalcule les états périmés ou absents
+    recalculer(kri_ids=None)   -> recalcule sans condition
+    etats(kri_ids)             -> {kri_id: EtatKRI}, après rafraîchissement
+    signaler_alertes(kri_ids)  -> crée les Alerte des indicateurs entrés en alerte
+"""
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import and_, delete, event, false, inspect, or_, select, true, update
+from sqlalchemy.dialects.postgresql import insert as insert_postgres
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+from sqlalchemy.orm import Session
+
+from models import db, Alerte, EtatKRI, KRI, MesureKRI
+
+logger = logging.getLogger(__name__)
+
+PERIODE_TENDANCE_JOURS = 30
+SEUIL_PENTE = 0.1
+DUREE_VALIDITE = timedelta(hours=1)
+TAILLE_LOT = 1000
+
+# Libellés de KRI.get_etat_alerte, par niveau (0 inconnu, 1 normal, 2 alerte, 3 critique)
+LIBELLES_KRI = np.array(['inconnu', 'normal', 'alerte', 'critique'], dtype=object)
+LIBELLES_KPI = np.array(['inconnu', 'dans_cible', 'sous_performance', 'hors_cible'], dtype=object)
+ETATS_ALERTE = {'alerte': 'kri_alerte', 'sous_performance': 'kri_alerte',
+                'critique': 'kri_critique', 'hors_cible': 'kri_critique'}
+
+_CLE_PERIMES = 'analyse_kri_perimes'
+
+# Tables par indicateur (kri_id, perime) invalidées à chaque écriture de mesure
+TABLES_PERIMABLES = [EtatKRI.__table__]
+
+
+# ========================
+# CALCUL VECTORISÉ
+# ========================
+
+def _flottants(valeurs):
+    return np.array([np.nan if v is None else v for v in valeurs], dtype=float)
+
+
+def evaluer(indicateurs, mesures, maintenant=None, periode_jours=PERIODE_TENDANCE_JOURS):
+    """
+    Calcule l'état de tous les indicateurs en une passe.
+
+    indicateurs : lignes (id, type_indicateur, seuil_alerte, seuil_critique, sens_evaluation_seuil)
+    mesures     : lignes (kri_id, date_mesure, valeur) triées par kri_id puis date_mesure
+    Retourne un dict de tableaux NumPy alignés sur les identifiants (triés).
+    """
+    maintenant = maintenant or datetime.now()
+    indicateurs = sorted(indicateurs, key=lambda ligne: ligne[0])
+    ids = np.array([ligne[0] for ligne in indicateurs], dtype=np.int64)
+    est_kri = np.array([ligne[1] == 'kri' for ligne in indicateurs], dtype=bool)
+    seuil_alerte = _flottants(ligne[2] for ligne in indicateurs)
+    seuil_critique = _flottants(ligne[3] for ligne in indicateurs)
+    inferieur = np.array([ligne[4] == 'inferieur' for ligne in indicateurs], dtype=bool)
+    k = len(ids)
+
+    mesures = [m for m in mesures if m[1] is not None and m[2] is not None]
+    if mesures:
+        kri_mesures, dates, valeurs = zip(*mesures)
+        groupes = np.searchsorted(ids, np.array(kri_mesures, dtype=np.int64))
+        dates = np.array(dates, dtype='datetime64[us]')
+        valeurs = np.array(valeurs, dtype=float)
+    else:
+        groupes = np.zeros(0, dtype=np.int64)
+        dates = np.zeros(0, dtype='datetime64[us]')
+        valeurs = np.zeros(0, dtype=float)
+
+    # Dernière et avant-dernière valeur : fin de chaque groupe
+    nb = np.bincount(groupes, minlength=k)
+    fin = np.cumsum(nb) - 1
+    derniere_valeur = np.full(k, np.nan)
+    derniere_date = np.full(k, np.datetime64('NaT'), dtype='datetime64[us]')
+    valeur_precedente = np.full(k, np.nan)
+    avec = nb > 0
+    derniere_valeur[avec] = valeurs[fin[avec]]
+    derniere_date[avec] = dates[fin[avec]]
+    avec_precedente = nb > 1
+    valeur_precedente[avec_precedente] = valeurs[fin[avec_precedente] - 1]
+
+    variation_pct = np.full(k, np.nan)
+    calculable = avec_precedente & (valeur_precedente != 0)
+    variation_pct[calculable] = (
+        (derniere_valeur[calculable] - valeur_precedente[calculable])
+        / np.abs(valeur_precedente[calculable]) * 100
+    )
+
+    # Pente des moindres carrés sur la fenêtre récente, par sommes groupées
+    recentes = dates >= np.datetime64(maintenant - timedelta(days=periode_jours), 'us')
+    g, y = groupes[recentes], valeurs[recentes]
+    n = np.bincount(g, minlength=k).astype(float)
+    debut = np.cumsum(n) - n
+    x = np.arange(len(g), dtype=float) - debut[g]
+    sx = np.bincount(g, weights=x, minlength=k)
+    sy = np.bincount(g, weights=y, minlength=k)
+    sxx = np.bincount(g, weights=x * x, minlength=k)
+    sxy = np.bincount(g, weights=x * y, minlength=k)
+    pente = np.full(k, np.nan)
+    regression = n >= 2
+    pente[regression] = (
+        (n[regression] * sxy[regression] - sx[regression] * sy[regression])
+        / (n[regression] * sxx[regression] - sx[regression] ** 2)
+    )
+    tendance = np.select([pente > SEUIL_PENTE, pente < -SEUIL_PENTE], ['hausse', 'baisse'], 'stable').astype(object)
+
+    # Seuils : les comparaisons avec NaN (seuil absent) sont fausses
+    with np.errstate(invalid='ignore'):
+        critique = np.where(inferieur, derniere_valeur <= seuil_critique, derniere_valeur >= seuil_critique)
+        alerte = np.where(inferieur, derniere_valeur <= seuil_alerte, derniere_valeur >= seuil_alerte)
+    niveau = np.select([~avec, critique, alerte], [0, 3, 2], 1)
+    etat = np.where(est_kri, LIBELLES_KRI[niveau], LIBELLES_KPI[niveau])
+
+    return {
+        'kri_id': ids,
+        'nb_mesures': nb,
+        'derniere_valeur': derniere_valeur,
+        'derniere_date': derniere_date,
+        'valeur_precedente': valeur_precedente,
+        'variation_pct': variation_pct,
+        'pente': pente,
+        'tendance': tendance,
+        'etat': etat,
+    }
+
+
+def _lignes_etats(resultats, clients, calcule_le):
+    def nombre(valeur):
+        return None if np.isnan(valeur) else float(valeur)
+
+    for i, kri_id in enumerate(resultats['kri_id'].tolist()):
+        date = resultats['derniere_date'][i]
+        yield {
+            'kri_id': kri_id,
+            'client_id': clients.get(kri_id),
+            'nb_mesures': int(resultats['nb_mesures'][i]),
+            'derniere_valeur': nombre(resultats['derniere_valeur'][i]),
+            'derniere_date': None if np.isnat(date) else date.astype(datetime),
+            'valeur_precedente': nombre(resultats['valeur_precedente'][i]),
+            'variation_pct': nombre(resultats['variation_pct'][i]),
+            'pente': nombre(resultats['pente'][i]),
+            'tendance': resultats['tendance'][i],
+            'etat': resultats['etat'][i],
+            'perime': False,
+            'calcule_le': calcule_le,
+        }
+
+
+# ========================
+# ENREGISTREMENT
+# ========================
+
+def _enregistrer(connexion, lignes):
+    insert = insert_postgres if connexion.dialect.name == 'postgresql' else insert_sqlite
+    colonnes = [nom for nom in lignes[0] if nom != 'kri_id']
+    for i in range(0, len(lignes), TAILLE_LOT):
+        instruction = insert(EtatKRI.__table__).values(lignes[i:i + TAILLE_LOT])
+        connexion.execute(instruction.on_conflict_do_update(
+            index_elements=['kri_id'],
+            set_={nom: instruction.excluded[nom] for nom in colonnes},
+        ))
+
+
+def _calculer(connexion, kri_ids):
+    """Lit métadonnées et mesures des indicateurs en deux requêtes, calcule et enregistre"""
+    kri_ids = sorted(set(kri_ids))
+    if not kri_ids:
+        return 0
+    indicateurs, mesures = [], []
+    for i in range(0, len(kri_ids), TAILLE_LOT):
+        lot = kri_ids[i:i + TAILLE_LOT]
+        indicateurs += connexion.execute(select(
+            KRI.id, KRI.type_indicateur, KRI.seuil_alerte, KRI.seuil_critique,
+            KRI.sens_evaluation_seuil, KRI.client_id,
+        ).where(KRI.id.in_(lot))).all()
+        mesures += connexion.execute(
+            select(MesureKRI.kri_id, MesureKRI.date_mesure, MesureKRI.valeur)
+            .where(MesureKRI.kri_id.in_(lot))
+            .order_by(MesureKRI.kri_id, MesureKRI.date_mesure)
+        ).all()
+    if not indicateurs:
+        return 0
+    resultats = evaluer([ligne[:5] for ligne in indicateurs], mesures)
+    clients = {ligne[0]: ligne[5] for ligne in indicateurs}
+    _enregistrer(connexion, list(_lignes_etats(resultats, clients, datetime.utcnow())))
+    return len(indicateurs)
+
+
+def _selection_ids(kri_ids):
+    """Indicateurs actifs, restreints à kri_ids si fourni"""
+    selection = select(KRI.id).where(KRI.est_actif == true())
+    if kri_ids is not None:
+        selection = selection.where(KRI.id.in_(kri_ids))
+    return selection
+
+
+def recalculer(kri_ids=None, connexion=None):
+    """Recalcule sans condition l'état des indicateurs actifs (tous par défaut)"""
+    connexion = connexion or db.session.connection()
+    return _calculer(connexion, connexion.execute(_selection_ids(kri_ids)).scalars().all())
+
+
+def rafraichir(kri_ids=None, connexion=None):
+    """Recalcule les états absents, périmés, trop anciens ou antérieurs à une modification de l'indicateur"""
+    connexion = connexion or db.session.connection()
+    limite = datetime.utcnow() - DUREE_VALIDITE
+    a_recalculer = connexion.execute(
+        _selection_ids(kri_ids)
+        .outerjoin(EtatKRI, EtatKRI.kri_id == KRI.id)
+        .where(or_(
+            EtatKRI.kri_id.is_(None),
+            EtatKRI.perime == true(),
+            EtatKRI.calcule_le < limite,
+            EtatKRI.calcule_le < KRI.updated_at,
+        ))
+    ).scalars().all()
+    nb = _calculer(connexion, a_recalculer)
+    if nb:
+        logger.debug("États KRI recalculés : %d indicateur(s)", nb)
+    return nb
+
+
+def etats(kri_ids):
+    """{kri_id: EtatKRI} des indicateurs demandés, rafraîchis au besoin"""
+    rafraichir(kri_ids)
+    return {etat.kri_id: etat for etat in EtatKRI.query.filter(EtatKRI.kri_id.in_(kri_ids))}
+
+
+def signaler_alertes(kri_ids=None, createur_id=1):
+    """
+    Crée une Alerte pour chaque indicateur actif entré dans un état d'alerte
+    (ou passé d'alerte à critique) depuis le dernier signalement. Un état
+    inchangé n'est pas signalé de nouveau. À appeler après rafraichir().
+    """
+    requete = db.session.query(EtatKRI, KRI).join(KRI, KRI.id == EtatKRI.kri_id).filter(
+        KRI.est_actif == true(),
+        or_(EtatKRI.etat_signale.is_(None), EtatKRI.etat_signale != EtatKRI.etat),
+    )
+    if kri_ids is not None:
+        requete = requete.filter(KRI.id.in_(kri_ids))
+
+    nb = 0
+    for etat, kri in requete.all():
+        type_alerte = ETATS_ALERTE.get(etat.etat)
+        if type_alerte is not None:
+            critique = type_alerte == 'kri_critique'
+            seuil = kri.seuil_critique if critique else kri.seuil_alerte
+            libelle = 'critique' if critique else "d'alerte"
+            db.session.add(Alerte(
+                type=type_alerte,
+                gravite='haute' if critique else 'moyenne',
+                titre=f"KRI {kri.nom} - Seuil {libelle} dépassé",
+                description=f"Le KRI {kri.nom} a atteint la valeur {etat.derniere_valeur}, "
+                            f"dépassant le seuil {libelle} de {seuil}",
+                entite_type='kri',
+                entite_id=kri.id,
+                client_id=kri.client_id,
+                created_by=createur_id,
+            ))
+            nb += 1
+        etat.etat_signale = etat.etat
+    return nb
+
+
+# ========================
+# INVALIDATION (ÉVÉNEMENTS)
+# ========================
+
+def _marquer(session, kri_ids):
+    session.info.setdefault(_CLE_PERIMES, set()).update(k for k in kri_ids if k is not None)
+
+
+def _apres_ecriture_mesure(mapper, connexion, mesure):
+    etat = inspect(mesure)
+    _marquer(etat.session, set(etat.attrs['kri_id'].history.deleted) | {mesure.kri_id})
+
+
+def _perimer(connexion, kri_ids):
+    for table in TABLES_PERIMABLES:
+        connexion.execute(
+            update(table).where(and_(table.c.kri_id.in_(kri_ids), table.c.perime == false())).values(perime=True)
+        )
+
+
+def _apres_suppression_kri(mapper, connexion, kri):
+    for table in TABLES_PERIMABLES:
+        connexion.execute(delete(table).where(table.c.kri_id == kri.id))
+
+
+def _apres_flush(session, contexte_flush):
+    perimes = session.info.pop(_CLE_PERIMES, None)
+    if perimes:
+        _perimer(session.connection(), perimes)
+
+
+def _apres_rollback(session, transaction_precedente):
+    session.info.pop(_CLE_PERIMES, None)
+
+
+def _avant_execution_orm(etat):
+    """Instructions groupées sur MesureKRI : marque les indicateurs concernés avant exécution"""
+    if not (etat.is_insert or etat.is_update or etat.is_delete) or not etat.is_orm_statement:
+        return None
+    mapper = etat.bind_arguments.get('mapper')
+    if mapper is None or mapper.class_ is not MesureKRI:
+        return None
+    if etat.is_insert:
+        lignes = etat.parameters if isinstance(etat.parameters, list) else [etat.parameters or {}]
+        kri_ids = {ligne.get('kri_id') for ligne in lignes}
+    else:
+        selection = select(MesureKRI.kri_id).distinct()
+        if isinstance(etat.parameters, list):
+            # Mise à jour groupée par clé primaire
+            selection = selection.where(MesureKRI.id.in_([ligne.get('id') for ligne in etat.parameters]))
+        elif etat.statement.whereclause is not None:
+            selection = selection.where(etat.statement.whereclause)
+        kri_ids = set(etat.session.connection().execute(selection).scalars())
+    kri_ids.discard(None)
+    if kri_ids:
+        _perimer(etat.session.connection(), kri_ids)
+    return None
+
+
+# ========================
+# INITIALISATION
+# ========================
+
+def init_analyse_kri(app):
+    if not event.contains(MesureKRI, 'after_insert', _apres_ecriture_mesure):
+        event.listen(MesureKRI, 'after_insert', _apres_ecriture_mesure)
+        event.listen(MesureKRI, 'after_update', _apres_ecriture_mesure)
+        event.listen(MesureKRI, 'after_delete', _apres_ecriture_mesure)
+        event.listen(KRI, 'after_delete', _apres_suppression_kri)
+        event.listen(Session, 'after_flush', _apres_flush)
+        event.listen(Session, 'after_soft_rollback', _apres_rollback)
+        # En tête : series_kri exécute lui-même les update/delete groupés,
+        # ce qui interrompt les écouteurs do_orm_execute suivants.
+        event.listen(Session, 'do_orm_execute', _avant_execution_orm, insert=True)
@@ -1,21 +1,93 @@
 """
 Intégration avec les APIs IA externes
+
+Les appels passent par services/repartiteur_ia.py : une session HTTP par
+fournisseur (connexions réutilisées), délais stricts et nouvelles tentatives
+sur 429. analyser() interroge la chaîne complète (relance / secours).
 """
-import os
 import json
+import logging
+import os
 from typing import Optional, Dict, Any
 
-try:
-    import openai
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
-    print("⚠️ OpenAI non disponible")
+from services.repartiteur_ia import (
+    FOURNISSEURS, VARIABLES_ENV, ErreurFournisseurIA, extraire_json, repartiteur_depuis_environnement
+)
+
+logger = logging.getLogger(__name__)
+
+SYSTEME = "Tu es un expert en audit et contrôle interne. Tu fournis des analyses précises et des recommandations pratiques."
+
+# Fournisseurs déjà construits, par (nom, clé) : la session HTTP est conservée d'un appel à l'autre
+_FOURNISSEURS = {}
+
+
+def _fournisseur(nom, api_key=None):
+    variable_cle, variable_url, variable_modele = VARIABLES_ENV[nom]
+    api_key = api_key or os.getenv(variable_cle)
+    if not api_key:
+        logger.error("Clé API %s manquante", nom)
+        return None
+    cle = (nom, api_key)
+    if cle not in _FOURNISSEURS:
+        _FOURNISSEURS[cle] = FOURNISSEURS[nom](api_key, modele=os.getenv(variable_modele),
+                                               base_url=os.getenv(variable_url))
+    return _FOURNISSEURS[cle]
+
+
+def _prompt(audit_data: Dict[str, Any]) -> str:
+    return f"""
+    Analyse cet audit et fournis des recommandations:
+    
+    Titre: {audit_data.get('titre', 'Non spécifié')}
+    Description: {audit_data.get('description', 'Non spécifiée')}
+    Nombre de constatations: {audit_data.get('nb_constatations', 0)}
+    Nombre de recommandations: {audit_data.get('nb_recommandations', 0)}
+    
+    Constatations principales:
+    {json.dumps(audit_data.get('constatations', []), ensure_ascii=False, indent=2)}
+    
+    Fournis une analyse structurée avec:
+    1. 3-5 recommandations concrètes et actionnables
+    2. Les causes racines identifiées
+    3. Une évaluation de la gravité globale
+    4. Des suggestions d'actions prioritaires
+    
+    Format de réponse JSON avec ces champs:
+    - recommandations_ia (liste)
+    - causes_racines (liste)
+    - evaluation_gravite (texte)
+    - actions_prioritaires (liste)
+    - score_confiance (nombre)
+    """
+
+
+def _messages(audit_data: Dict[str, Any]):
+    return [{"role": "system", "content": SYSTEME}, {"role": "user", "content": _prompt(audit_data)}]
+
+
+def _resultat(reponse) -> Dict[str, Any]:
+    contenu = reponse.choices[0].message.content
+    resultat = extraire_json(contenu)
+    return resultat if isinstance(resultat, dict) else {'reponse_textuelle': contenu}
+
 
 class APIIntegration:
     """Intégration avec les APIs IA externes"""
     
+    @staticmethod
+    def _analyser_avec(nom: str, audit_data: Dict[str, Any], api_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        fournisseur = _fournisseur(nom, api_key)
+        if fournisseur is None:
+            return None
+        try:
+            reponse = fournisseur.completer(_messages(audit_data), temperature=0.7, max_tokens=1500,
+                                            format_json=True)
+        except ErreurFournisseurIA as e:
+            logger.error("Erreur API %s: %s", nom, e)
+            return None
+        return _resultat(reponse)
+    
     @staticmethod
     def analyser_avec_openai(audit_data: Dict[str, Any], api_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
@@ -28,189 +100,37 @@ class APIIntegration:
         Returns:
             Dict avec les résultats de l'analyse ou None en cas d'erreur
         """
-        if not OPENAI_AVAILABLE:
-            print("❌ OpenAI non disponible")
-            return None
-        
-        try:
-            # Utiliser la clé fournie ou celle de l'environnement
-            api_key = api_key or os.getenv('OPENAI_API_KEY')
-            
-            if not api_key:
-                print("❌ Clé API OpenAI manquante")
-                return None
-            
-            client = OpenAI(api_key=api_key)
-            
-            # Construire le prompt
-            prompt = f"""
-            Analyse cet audit et fournis des recommandations:
-            
-            Titre: {audit_data.get('titre', 'Non spécifié')}
-            Description: {audit_data.get('description', 'Non spécifiée')}
-            Nombre de constatations: {audit_data.get('nb_constatations', 0)}
-            Nombre de recommandations: {audit_data.get('nb_recommandations', 0)}
-            
-            Constatations principales:
-            {json.dumps(audit_data.get('constatations', []), ensure_ascii=False, indent=2)}
-            
-            Fournis une analyse structurée avec:
-            1. 3-5 recommandations concrètes et actionnables
-            2. Les causes racines identifiées
-            3. Une évaluation de la gravité globale
-            4. Des suggestions d'actions prioritaires
-            
-            Format de réponse JSON avec ces champs:
-            - recommandations_ia (liste)
-            - causes_racines (liste)
-            - evaluation_gravite (texte)
-            - actions_prioritaires (liste)
-            - score_confiance (nombre)
-            """
-            
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",  # ou "gpt-3.5-turbo" pour un coût réduit
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": "Tu es un expert en audit et contrôle interne. Tu fournis des analyses précises et des recommandations pratiques."
-                    },
-                    {
-                        "role": "user", 
-                        "content": prompt
-                    }
-                ],
-                temperature=0.7,
-                max_tokens=1500,
-                response_format={"type": "json_object"}
-            )
-            
-            result_text = response.choices[0].message.content
-            
-            try:
-                result = json.loads(result_text)
-                return result
-            except json.JSONDecodeError as e:
-                print(f"❌ Erreur décodage JSON: {e}")
-                print(f"Texte reçu: {result_text[:500]}...")
-                return None
-            
-        except openai.OpenAIError as e:
-            print(f"❌ Erreur OpenAI API: {e}")
-            return None
-        except Exception as e:
-            print(f"❌ Erreur inattendue: {e}")
-            return None
+        return APIIntegration._analyser_avec('openai', audit_data, api_key)
     
     @staticmethod
     def analyser_avec_gemini(audit_data: Dict[str, Any], api_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
         Analyser avec Google Gemini
         """
-        try:
-            import google.generativeai as genai
-            
-            api_key = api_key or os.getenv('GEMINI_API_KEY')
-            
-            if not api_key:
-                print("❌ Clé API Gemini manquante")
-                return None
-            
-            genai.configure(api_key=api_key)
-            
-            # Sélectionner un modèle
-            model = genai.GenerativeModel('gemini-pro')
-            
-            prompt = f"""
-            Analyse cet audit et fournis des recommandations:
-            
-            {json.dumps(audit_data, indent=2)}
-            
-            Fournis une réponse en JSON.
-            """
-            
-            response = model.generate_content(prompt)
-            
-            # Essayer d'extraire du JSON de la réponse
-            import re
-            
-            # Chercher du JSON dans la réponse
-            json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
-            
-            if json_match:
-                try:
-                    result = json.loads(json_match.group())
-                    return result
-                except json.JSONDecodeError:
-                    # Si échec, retourner la réponse textuelle
-                    return {'reponse_textuelle': response.text}
-            else:
-                return {'reponse_textuelle': response.text}
-                
-        except ImportError:
-            print("❌ Google Generative AI non installé")
-            return None
-        except Exception as e:
-            print(f"❌ Erreur Gemini: {e}")
-            return None
+        return APIIntegration._analyser_avec('gemini', audit_data, api_key)
     
     @staticmethod
     def analyser_avec_anthropic(audit_data: Dict[str, Any], api_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
         Analyser avec Anthropic Claude
         """
-        try:
-            import anthropic
-            
-            api_key = api_key or os.getenv('ANTHROPIC_API_KEY')
-            
-            if not api_key:
-                print("❌ Clé API Anthropic manquante")
-                return None
-            
-            client = anthropic.Anthropic(api_key=api_key)
-            
-            prompt = f"""
-            Analyse cet audit et fournis des recommandations:
-            
-            {json.dumps(audit_data, indent=2)}
-            
-            Fournis une réponse en JSON.
-            """
-            
-            response = client.messages.create(
-                model="claude-3-opus-20240229",  # ou "claude-3-sonnet-20240229" pour un coût réduit
-                max_tokens=1000,
-                temperature=0.7,
-                system="Tu es un expert en audit et contrôle interne.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            )
-            
-            # Traiter la réponse
-            result_text = response.content[0].text
-            
-            try:
-                # Essayer d'extraire du JSON
-                import re
-                json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
-                
-                if json_match:
-                    result = json.loads(json_match.group())
-                    return result
-                else:
-                    return {'reponse_textuelle': result_text}
-                    
-            except json.JSONDecodeError:
-                return {'reponse_textuelle': result_text}
-                
-        except ImportError:
-            print("❌ Anthropic non installé")
+        return APIIntegration._analyser_avec('anthropic', audit_data, api_key)
+    
+    @staticmethod
+    def analyser(audit_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Analyser avec tous les fournisseurs configurés (IA_FOURNISSEURS) :
+        première réponse structurée valide, avec relance ou secours (IA_MODE_REPARTITION)
+        """
+        repartiteur = repartiteur_depuis_environnement()
+        if repartiteur is None:
+            logger.error("Aucun fournisseur IA configuré")
             return None
-        except Exception as e:
-            print(f"❌ Erreur Anthropic: {e}")
+        try:
+            reponse = repartiteur.completer(_messages(audit_data), format_json=True)
+        except ErreurFournisseurIA as e:
+            logger.error("Analyse IA impossible: %s", e)
             return None
+        resultat = _resultat(reponse)
+        resultat.setdefault('_fournisseur', reponse.fournisseur)
+        return resultat
@@ -0,0 +1,148 @@
+# services/archive_zip.py
+"""
+Archives ZIP envoyées en flux (preuves d'audit, fichiers de rapport).
+
+L'archive n'est jamais construite en mémoire : chaque fichier est lu par
+blocs et les octets compressés sont envoyés au client au fur et à mesure.
+zipfile écrit dans un flux non positionnable (descripteurs de données après
+chaque entrée) ; la mémoire utilisée ne dépend pas de la taille de l'archive.
+
+Les formats déjà compressés (images, pdf, zip, bureautique OOXML) sont
+stockés tels quels : les dégonfler coûte du CPU sans gain de taille.
+
+    entrees = list(entrees_preuves_audit(audit))
+    return reponse_zip(entrees, 'preuves.zip')
+"""
+import logging
+import os
+import zipfile
+
+from flask import Response, stream_with_context
+
+from services.export_tableur import disposition
+
+logger = logging.getLogger(__name__)
+
+DOSSIER_PREUVES = os.path.join('static', 'uploads', 'preuves')
+TAILLE_BLOC = 64 * 1024
+EXTENSIONS_COMPRESSEES = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic',
+    'pdf', 'zip', 'rar', '7z', 'gz', 'bz2', 'xz',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp',
+    'mp3', 'mp4', 'mov', 'avi',
+}
+
+
+def mode_compression(nom_fichier):
+    extension = nom_fichier.rsplit('.', 1)[-1].lower() if '.' in nom_fichier else ''
+    return zipfile.ZIP_STORED if extension in EXTENSIONS_COMPRESSEES else zipfile.ZIP_DEFLATED
+
+
+class _Tampon:
+    """Flux en écriture seule dont le contenu est vidé par le générateur"""
+
+    def __init__(self):
+        self._blocs = []
+
+    def write(self, donnees):
+        self._blocs.append(bytes(donnees))
+        return len(donnees)
+
+    def flush(self):
+        pass
+
+    def vider(self):
+        donnees = b''.join(self._blocs)
+        self._blocs = []
+        return donnees
+
+
+def flux_zip(entrees):
+    """
+    Générateur d'octets d'une archive ZIP.
+
+    `entrees` : itérable de (chemin sur disque, nom dans l'archive). Les
+    fichiers absents sont ignorés (journalisés).
+    """
+    tampon = _Tampon()
+    with zipfile.ZipFile(tampon, 'w') as archive:
+        for chemin, nom in entrees:
+            if not os.path.isfile(chemin):
+                logger.warning("Fichier absent ignoré dans l'archive: %s", chemin)
+                continue
+            info = zipfile.ZipInfo.from_file(chemin, nom)
+            info.compress_type = mode_compression(nom)
+            with open(chemin, 'rb') as source, archive.open(info, 'w', force_zip64=True) as cible:
+                while True:
+                    bloc = source.read(TAILLE_BLOC)
+                    if not bloc:
+                        break
+                    cible.write(bloc)
+                    donnees = tampon.vider()
+                    if donnees:
+                        yield donnees
+            donnees = tampon.vider()
+            if donnees:
+                yield donnees
+    # Répertoire central
+    yield tampon.vider()
+
+
+def reponse_zip(entrees, nom_fichier):
+    return Response(stream_with_context(flux_zip(entrees)), mimetype='application/zip', headers={
+        'Content-Disposition': disposition(nom_fichier),
+    })
+
+
+# ========================
+# SOURCES DE FICHIERS
+# ========================
+
+def entrees_preuves_audit(audit, prefixe=''):
+    """Preuves des constatations : preuves/<référence constatation>/<fichier>"""
+    from models import Constatation
+
+    constatations = Constatation.query.filter(
+        Constatation.audit_id == audit.id, Constatation.preuves.isnot(None)
+    ).order_by(Constatation.id)
+    for constatation in constatations:
+        for nom_preuve in constatation.get_preuves_list:
+            nom_preuve = os.path.basename(nom_preuve)
+            yield (os.path.join(DOSSIER_PREUVES, nom_preuve),
+                   f"{prefixe}preuves/{constatation.reference}/{nom_preuve}")
+
+
+def entrees_fichiers_rapport(audit, prefixe=''):
+    """Pièces jointes du rapport : rapport/<id>_<nom du fichier>"""
+    from models import FichierRapport
+
+    fichiers = FichierRapport.query.filter_by(audit_id=audit.id).order_by(FichierRapport.id)
+    for fichier in fichiers:
+        # L'identifiant évite les collisions entre fichiers de même nom
+        yield fichier.chemin, f"{prefixe}rapport/{fichier.id}_{os.path.basename(fichier.nom_fichier)}"
+
+
+def entrees_client(client_id, tous_clients=False):
+    """
+    Toutes les preuves et pièces jointes des audits d'un client.
+
+    client_id None désigne les audits sans client (comme get_client_filter) ;
+    seul tous_clients=True (super admin) lève le filtre.
+    """
+    from models import Audit
+
+    audits = Audit.query.order_by(Audit.id)
+    if not tous_clients:
+        if client_id is None:
+            audits = audits.filter(Audit.client_id.is_(None))
+        else:
+            audits = audits.filter(Audit.client_id == client_id)
+    for audit in audits:
+        prefixe = f"{audit.reference or audit.id}/"
+        yield from entrees_preuves_audit(audit, prefixe)
+        yield from entrees_fichiers_rapport(audit, prefixe)
+
+
+def entrees_existantes(entrees):
+    """Liste des entrées dont le fichier existe (pour refuser une archive vide avant l'envoi)"""
+    return [(chemin, nom) for chemin, nom in entrees if os.path.isfile(chemin)]
@@ -0,0 +1,227 @@
+# services/automatisation_audits.py
+"""
+Automatisation ensembliste des statuts d'audit.
+
+Remplace la boucle audit par audit (deux COUNT + progression_globale
+recalculée plusieurs fois + un commit par audit) par :
+
+1. un seul GROUP BY (audit_id, statut, is_archived) sur les constatations ;
+2. le calcul en mémoire du statut / sous-statut de chaque audit ouvert ;
+3. des UPDATE groupés par transition, par lots (transactions courtes) ;
+4. une insertion groupée des notifications de clôture.
+
+Les règles sont celles de l'ancienne boucle :
+- un audit dont toutes les constatations non archivées sont closes est clos
+  (sous-statut « cloture ») et son responsable est notifié ;
+- sinon, le sous-statut suit la progression globale (Audit.progression_globale :
+  clos = 100, en_cours = 50, a_valider = 25 points, sur toutes les constatations).
+
+Seuls les audits qui changent sont mis à jour. Le mode simulation (dry_run)
+calcule le même rapport sans rien écrire :
+
+    flask automatiser-audits --dry-run
+"""
+from collections import defaultdict
+from datetime import datetime
+
+import click
+from sqlalchemy import func, insert, update
+
+from models import db, Audit, Constatation, Notification
+
+TAILLE_LOT = 500
+TAILLE_APERCU = 50
+
+POINTS_STATUT = {'clos': 100, 'en_cours': 50, 'a_valider': 25}
+SEUILS_SOUS_STATUT = (
+    (25, 'planification'),
+    (50, 'collecte'),
+    (75, 'analyse'),
+    (90, 'redaction'),
+    (100, 'validation'),
+)
+STATUTS_FIGES = ('clos', 'archive')
+
+
+def _lots(elements, taille):
+    for i in range(0, len(elements), taille):
+        yield elements[i:i + taille]
+
+
+# ========================
+# CALCUL
+# ========================
+
+def histogrammes_constatations():
+    """
+    Histogramme des constatations par audit non archivé, en une requête.
+
+    Retourne {audit_id: {'total': n, 'non_closes': n, 'points': n, 'nombre': n}}
+    où total/non_closes portent sur les constatations non archivées et
+    points/nombre sur toutes (comme progression_globale).
+    """
+    lignes = db.session.query(
+        Constatation.audit_id, Constatation.statut, Constatation.is_archived, func.count(Constatation.id)
+    ).join(Audit, Audit.id == Constatation.audit_id)\
+        .filter(Audit.is_archived == False)\
+        .group_by(Constatation.audit_id, Constatation.statut, Constatation.is_archived)\
+        .all()
+
+    histogrammes = defaultdict(lambda: {'total': 0, 'non_closes': 0, 'points': 0, 'nombre': 0})
+    for audit_id, statut, archivee, nombre in lignes:
+        h = histogrammes[audit_id]
+        h['nombre'] += nombre
+        h['points'] += POINTS_STATUT.get(statut, 0) * nombre
+        if archivee is False or archivee == 0:
+            h['total'] += nombre
+            if statut != 'clos':
+                h['non_closes'] += nombre
+    return histogrammes
+
+
+def sous_statut_pour(progression):
+    """Sous-statut correspondant à une progression (None à 100 % : inchangé)"""
+    for seuil, sous_statut in SEUILS_SOUS_STATUT:
+        if progression < seuil:
+            return sous_statut
+    return None
+
+
+def calculer_changements():
+    """Liste des audits ouverts dont le statut ou le sous-statut doit changer"""
+    histogrammes = histogrammes_constatations()
+    audits = db.session.query(
+        Audit.id, Audit.reference, Audit.statut, Audit.sous_statut, Audit.responsable_id, Audit.client_id
+    ).filter(Audit.is_archived == False).all()
+
+    changements = []
+    for audit in audits:
+        h = histogrammes.get(audit.id)
+        statut, sous_statut, cloture = audit.statut, audit.sous_statut, False
+
+        if h and h['total'] > 0 and h['non_closes'] == 0 and statut != 'clos':
+            statut, sous_statut, cloture = 'clos', 'cloture', True
+
+        progression = round(h['points'] / h['nombre'], 2) if h and h['nombre'] else 0
+        if statut not in STATUTS_FIGES:
+            sous_statut = sous_statut_pour(progression) or sous_statut
+
+        if (statut, sous_statut) != (audit.statut, audit.sous_statut):
+            changements.append({
+                'id': audit.id,
+                'reference': audit.reference,
+                'client_id': audit.client_id,
+                'responsable_id': audit.responsable_id,
+                'ancien_statut': audit.statut,
+                'ancien_sous_statut': audit.sous_statut,
+                'statut': statut,
+                'sous_statut': sous_statut,
+                'progression': progression,
+                'cloture': cloture,
+            })
+    return len(audits), changements
+
+
+# ========================
+# APPLICATION
+# ========================
+
+def _notifications_cloture(changements, maintenant):
+    return [{
+        'type_notification': 'audit_clos',
+        'titre': f"Audit {c['reference']} clos",
+        'message': (f"L'audit {c['reference']} a été automatiquement clos car toutes "
+                    f"les constatations sont traitées."),
+        'destinataire_id': c['responsable_id'],
+        'entite_type': 'audit',
+        'entite_id': c['id'],
+        'client_id': c['client_id'],
+        'created_at': maintenant,
+    } for c in changements if c['cloture'] and c['responsable_id']]
+
+
+def appliquer_changements(changements, taille_lot=TAILLE_LOT):
+    """
+    Applique les transitions par UPDATE groupés, un commit par lot.
+
+    La clause WHERE reprend l'ancien statut : un audit modifié entre le calcul
+    et l'écriture n'est pas écrasé. Retourne (audits modifiés, notifications).
+    """
+    maintenant = datetime.utcnow()
+    par_transition = defaultdict(list)
+    for c in changements:
+        par_transition[(c['ancien_statut'], c['ancien_sous_statut'], c['statut'], c['sous_statut'])].append(c['id'])
+
+    modifies = set()
+    for (ancien_statut, ancien_sous_statut, statut, sous_statut), ids in par_transition.items():
+        for lot in _lots(ids, taille_lot):
+            resultat = db.session.execute(
+                update(Audit.__table__)
+                .where(Audit.__table__.c.id.in_(lot),
+                       Audit.__table__.c.statut.is_not_distinct_from(ancien_statut),
+                       Audit.__table__.c.sous_statut.is_not_distinct_from(ancien_sous_statut))
+                .values(statut=statut, sous_statut=sous_statut, updated_at=maintenant)
+                .returning(Audit.__table__.c.id)
+            )
+            modifies.update(resultat.scalars().all())
+            db.session.commit()
+
+    notifications = _notifications_cloture([c for c in changements if c['id'] in modifies], maintenant)
+    if notifications:
+        db.session.execute(insert(Notification.__table__), notifications)
+        db.session.commit()
+
+    _invalider_caches({c['client_id'] for c in changements if c['id'] in modifies})
+    return len(modifies), len(notifications)
+
+
+def _invalider_caches(clients):
+    """Les UPDATE groupés ne passent pas par les événements ORM du cache des tableaux de bord"""
+    try:
+        from services.cache_tableau_bord import cache_tableau_bord, PORTEE_GLOBALE
+        cache_tableau_bord.invalider(PORTEE_GLOBALE, *(f'client:{c}' for c in clients if c is not None))
+    except Exception as e:
+        print(f"⚠️ Invalidation du cache après automatisation impossible: {e}")
+
+
+def automatiser_statuts_audits_lot(dry_run=False, taille_lot=TAILLE_LOT):
+    """
+    Exécute l'automatisation et retourne un rapport sérialisable en JSON.
+
+    En dry_run, aucune écriture : le rapport liste ce qui serait modifié.
+    """
+    nombre_audits, changements = calculer_changements()
+    rapport = {
+        'dry_run': dry_run,
+        'audits_analyses': nombre_audits,
+        'changements_prevus': len(changements),
+        'clotures_prevues': sum(1 for c in changements if c['cloture']),
+        'apercu': changements[:TAILLE_APERCU],
+    }
+
+    if dry_run:
+        print(f"🧪 Simulation : {len(changements)} audit(s) sur {nombre_audits} seraient modifiés "
+              f"({rapport['clotures_prevues']} clôture(s))")
+        return rapport
+
+    modifies, notifications = appliquer_changements(changements, taille_lot)
+    rapport.update({'audits_modifies': modifies, 'notifications': notifications})
+    print(f"✅ Automatisation audits : {modifies} audit(s) modifié(s) sur {nombre_audits}, "
+          f"{notifications} notification(s)")
+    return rapport
+
+
+def init_automatisation_audits(app):
+    """Enregistre la commande CLI `flask automatiser-audits`"""
+
+    @app.cli.command('automatiser-audits')
+    @click.option('--dry-run', is_flag=True, help='Afficher les changements sans les appliquer')
+    @click.option('--taille-lot', default=TAILLE_LOT, show_default=True, help='Audits par UPDATE')
+    def automatiser_audits_command(dry_run, taille_lot):
+        """Met à jour les statuts/sous-statuts des audits ouverts."""
+        rapport = automatiser_statuts_audits_lot(dry_run=dry_run, taille_lot=taille_lot)
+        for c in rapport['apercu']:
+            click.echo(f"  {c['reference']}: {c['ancien_statut']}/{c['ancien_sous_statut']} -> "
+                       f"{c['statut']}/{c['sous_statut']} ({c['progression']} %)")
+        if rapport['changements_prevus'] > len(rapport['apercu']):
+            click.echo(f"  … {rapport['changements_prevus'] - len(rapport['apercu'])} autre(s)")
@@ -0,0 +1,356 @@
+# services/cache_tableau_bord.py
+"""
+Cache des agrégats des tableaux de bord, par client (et par utilisateur si besoin).
+
+Les valeurs sont calculées à la demande puis conservées jusqu'à ce qu'une
+écriture sur un modèle surveillé (Risque, EvaluationRisque, KRI, MesureKRI,
+Audit, ActionConformite, VeilleReglementaire...) soit validée pour le client.
+L'invalidation se fait par numéro de génération : incrémenter la génération
+d'un client rend toutes ses clés obsolètes sans avoir à les énumérer.
+
+Backends :
+    CACHE_TYPE = 'simple'  -> mémoire du processus (un worker)
+    CACHE_TYPE = 'redis'   -> Redis partagé entre workers (CACHE_REDIS_URL)
+"""
+import json
+import threading
+import time
+
+from sqlalchemy import event, select, inspect as sa_inspect
+from sqlalchemy.orm import Session, object_session
+
+PORTEE_GLOBALE = 'tous'
+_CLE_SESSION = 'cache_tableau_bord_portees'
+
+
+# ========================
+# BACKENDS
+# ========================
+
+class BackendMemoire:
+    """Backend en mémoire du processus, protégé par un verrou"""
+
+    def __init__(self, max_entrees=5000):
+        self._donnees = {}
+        self._verrou = threading.Lock()
+        self.max_entrees = max_entrees
+
+    def get(self, cle):
+        with self._verrou:
+            entree = self._donnees.get(cle)
+            if entree is None:
+                return None
+            expiration, valeur = entree
+            if expiration and expiration < time.time():
+                del self._donnees[cle]
+                return None
+            return valeur
+
+    def set(self, cle, valeur, timeout=None):
+        with self._verrou:
+            if len(self._donnees) >= self.max_entrees:
+                self._purger()
+            expiration = time.time() + timeout if timeout else None
+            self._donnees[cle] = (expiration, valeur)
+
+    def incr(self, cle):
+        with self._verrou:
+            expiration, valeur = self._donnees.get(cle, (None, 0))
+            valeur = int(valeur) + 1
+            self._donnees[cle] = (expiration, valeur)
+            return valeur
+
+    def delete(self, cle):
+        with self._verrou:
+            self._donnees.pop(cle, None)
+
+    def clear(self):
+        with self._verrou:
+            self._donnees.clear()
+
+    def _purger(self):
+        """Supprime les entrées expirées, puis la plus ancienne moitié si nécessaire.
+
+        Les compteurs de génération ne sont jamais évincés : les remettre à zéro
+        rendrait de nouveau valides d'anciennes valeurs.
+        """
+        maintenant = time.time()
+        for cle in [c for c, (exp, _) in self._donnees.items() if exp and exp < maintenant]:
+            del self._donnees[cle]
+        if len(self._donnees) >= self.max_entrees:
+            valeurs = [c for c in self._donnees if not c.startswith('gen:')]
+            for cle in valeurs[:len(valeurs) // 2]:
+                del self._donnees[cle]
+
+
+class BackendRedis:
+    """Backend partagé Redis (valeurs sérialisées en JSON)"""
+
+    def __init__(self, url, prefixe='fkci:tdb:'):
+        import redis  # Dépendance optionnelle
+        self._client = redis.Redis.from_url(url)
+        self.prefixe = prefixe
+
+    def get(self, cle):
+        brut = self._client.get(self.prefixe + cle)
+        return json.loads(brut) if brut is not None else None
+
+    def set(self, cle, valeur, timeout=None):
+        self._client.set(self.prefixe + cle, json.dumps(valeur, default=str), ex=timeout or None)
+
+    def incr(self, cle):
+        return self._client.incr(self.prefixe + cle)
+
+    def delete(self, cle):
+        self._client.delete(self.prefixe + cle)
+
+    def clear(self):
+        for cle in self._client.scan_iter(self.prefixe + '*'):
+            self._client.delete(cle)
+
+
+# ========================
+# CACHE
+# ========================
+
+class CacheTableauBord:
+    """Cache paresseux des agrégats avec invalidation par génération"""
+
+    def __init__(self, backend=None, timeout=300):
+        self.backend = backend or BackendMemoire()
+        self.timeout = timeout
+        self.actif = True
+
+    def init_app(self, app):
+        type_cache = app.config.get('CACHE_TYPE', 'simple')
+        self.timeout = app.config.get('CACHE_DEFAULT_TIMEOUT', self.timeout)
+        self.actif = app.config.get('DASHBOARD_CACHE_ENABLED', True)
+
+        if type_cache == 'redis':
+            try:
+                self.backend = BackendRedis(app.config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+                print("✅ Cache tableaux de bord : backend Redis")
+            except Exception as e:
+                print(f"⚠️ Redis indisponible pour le cache tableaux de bord ({e}), repli en mémoire")
+                self.backend = BackendMemoire()
+        else:
+            self.backend = BackendMemoire()
+
+        app.extensions['cache_tableau_bord'] = self
+
+    # --- Générations ---
+
+    def _generation(self, portee):
+        return self.backend.get(f'gen:{portee}') or 0
+
+    def invalider(self, *portees):
+        """Rend obsolètes toutes les valeurs des portées données"""
+        for portee in portees:
+            try:
+                self.backend.incr(f'gen:{portee}')
+            except Exception as e:
+                print(f"⚠️ Erreur invalidation cache {portee}: {e}")
+
+    def invalider_client(self, client_id):
+        """Invalide un client et la vue globale (super admin)"""
+        self.invalider(f'client:{client_id}', PORTEE_GLOBALE)
+
+    def invalider_cartographie(self, cartographie_id, client_id=None):
+        portees = [f'cartographie:{cartographie_id}', PORTEE_GLOBALE]
+        if client_id is not None:
+            portees.append(f'client:{client_id}')
+        self.invalider(*portees)
+
+    def version(self, portee):
+        """Version courante d'une portée (utilisable dans des clés de cache externes)"""
+        return self._generation(portee)
+
+    # --- Lecture ---
+
+    def obtenir(self, section, client_id, calcul, user_id=None, timeout=None):
+        """
+        Retourne la valeur en cache de `section` pour le client, ou la calcule.
+
+        client_id=None désigne la vue globale (super admin sans client choisi).
+        user_id permet de séparer les données propres à un utilisateur.
+        """
+        portee = PORTEE_GLOBALE if client_id is None else f'client:{client_id}'
+        return self.obtenir_portee(section, portee, calcul, user_id=user_id, timeout=timeout)
+
+    def obtenir_portee(self, section, portee, calcul, user_id=None, timeout=None):
+        """
+        Comme obtenir(), pour une portée explicite ('cartographie:12', 'tous'...).
+
+        Utilisé par les caches indexés sur une cartographie plutôt que sur un client.
+        """
+        if not self.actif:
+            return calcul()
+
+        try:
+            generation = self._generation(portee)
+            cle = f'val:{section}:{portee}:u{user_id or 0}:g{generation}'
+
+            valeur = self.backend.get(cle)
+            if valeur is not None:
+                return valeur
+        except Exception as e:
+            print(f"⚠️ Cache tableaux de bord indisponible: {e}")
+            return calcul()
+
+        valeur = calcul()
+        try:
+            self.backend.set(cle, valeur, timeout or self.timeout)
+        except Exception as e:
+            print(f"⚠️ Erreur écriture cache {section}: {e}")
+        return valeur
+
+    def vider(self):
+        self.backend.clear()
+
+
+cache_tableau_bord = CacheTableauBord()
+
+
+# ========================
+# INVALIDATION PAR ÉVÉNEMENTS
+# ========================
+
+# Changements de User/Client pris en compte (les mises à jour de last_login sont ignorées)
+_CHAMPS_USER_SURVEILLES = ('is_active', 'client_id', 'role', 'formule_id')
+
+
+def _portees_cible(mapper, connection, target):
+    portees = {PORTEE_GLOBALE}
+
+    client_id = target.id if mapper.class_.__tablename__ == 'clients' else getattr(target, 'client_id', None)
+    if client_id is not None:
+        portees.add(f'client:{client_id}')
+
+    cartographie_id = getattr(target, 'cartographie_id', None)
+    if cartographie_id is None and getattr(target, 'risque_id', None) is not None:
+        # Évaluations et KRI : la cartographie est portée par le risque
+        from models import Risque
+        cartographie_id = connection.execute(
+            select(Risque.__table__.c.cartographie_id).where(Risque.__table__.c.id == target.risque_id)
+        ).scalar()
+    if cartographie_id is not None:
+        portees.add(f'cartographie:{cartographie_id}')
+    if getattr(target, 'kri_id', None) is not None:
+        portees |= _portees_kri(connection, {target.kri_id})
+    return portees
+
+
+def _portees_kri(connection, kri_ids):
+    """Mesures : client et cartographie sont portés par l'indicateur (et son risque)"""
+    from models import KRI, Risque
+
+    kri, risque = KRI.__table__, Risque.__table__
+    lignes = connection.execute(
+        select(kri.c.client_id, risque.c.cartographie_id)
+        .select_from(kri.outerjoin(risque, risque.c.id == kri.c.risque_id))
+        .where(kri.c.id.in_(kri_ids))
+    )
+    portees = set()
+    for client_id, cartographie_id in lignes:
+        if client_id is not None:
+            portees.add(f'client:{client_id}')
+        if cartographie_id is not None:
+            portees.add(f'cartographie:{cartographie_id}')
+    return portees
+
+
+def _marquer(mapper, connection, target):
+    portees = _portees_cible(mapper, connection, target)
+    session = object_session(target)
+    if session is None:
+        cache_tableau_bord.invalider(*portees)
+        return
+    session.info.setdefault(_CLE_SESSION, set()).update(portees)
+
+
+def _marquer_user(mapper, connection, target):
+    etat = sa_inspect(target)
+    if any(champ in etat.attrs and etat.attrs[champ].history.has_changes()
+           for champ in _CHAMPS_USER_SURVEILLES):
+        _marquer(mapper, connection, target)
+
+
+def _avant_execution_orm(etat):
+    """insert/update/delete groupés sur MesureKRI : les événements de mapper ne sont pas émis"""
+    from models import MesureKRI
+
+    if not (etat.is_insert or etat.is_update or etat.is_delete) or not etat.is_orm_statement:
+        return None
+    mapper = etat.bind_arguments.get('mapper')
+    if mapper is None or mapper.class_ is not MesureKRI:
+        return None
+
+    lignes = etat.parameters if isinstance(etat.parameters, list) else [etat.parameters or {}]
+    kri_ids = {ligne.get('kri_id') for ligne in lignes}
+    client_ids = {ligne.get('client_id') for ligne in lignes}
+    if not etat.is_insert:
+        # Lignes touchées, avant écriture
+        selection = select(MesureKRI.kri_id, MesureKRI.client_id).distinct()
+        if isinstance(etat.parameters, list):
+            # Mise à jour groupée par clé primaire
+            selection = selection.where(MesureKRI.id.in_([ligne.get('id') for ligne in etat.parameters]))
+        elif etat.statement.whereclause is not None:
+            selection = selection.where(etat.statement.whereclause)
+        for kri_id, client_id in etat.session.connection().execute(selection):
+            kri_ids.add(kri_id)
+            client_ids.add(client_id)
+    kri_ids.discard(None)
+    client_ids.discard(None)
+
+    portees = {PORTEE_GLOBALE} | {f'client:{client_id}' for client_id in client_ids}
+    if kri_ids:
+        portees |= _portees_kri(etat.session.connection(), kri_ids)
+    etat.session.info.setdefault(_CLE_SESSION, set()).update(portees)
+    return None
+
+
+def _apres_commit(session):
+    portees = session.info.pop(_CLE_SESSION, None)
+    if portees:
+        cache_tableau_bord.invalider(*portees)
+
+
+def _apres_rollback(session, transaction_precedente):
+    session.info.pop(_CLE_SESSION, None)
+
+
+def enregistrer_invalidations(modeles, modeles_user=()):
+    """Branche l'invalidation sur after_insert/after_update/after_delete"""
+    for modele in modeles:
+        for nom in ('after_insert', 'after_update', 'after_delete'):
+            if not event.contains(modele, nom, _marquer):
+                event.listen(modele, nom, _marquer)
+
+    for modele in modeles_user:
+        for nom, fonction in (('after_insert', _marquer), ('after_update', _marquer_user),
+                              ('after_delete', _marquer)):
+            if not event.contains(modele, nom, fonction):
+                event.listen(modele, nom, fonction)
+
+    if not event.contains(Session, 'after_commit', _apres_commit):
+        event.listen(Session, 'after_commit', _apres_commit)
+        event.listen(Session, 'after_soft_rollback', _apres_rollback)
+        # En tête : series_kri exécute lui-même les update/delete groupés,
+        # ce qui interrompt les écouteurs do_orm_execute suivants.
+        event.listen(Session, 'do_orm_execute', _avant_execution_orm, insert=True)
+
+
+def init_cache_tableau_bord(app):
+    """Initialise le backend et les invalidations sur les modèles métier"""
+    from models import (
+        Risque, EvaluationRisque, KRI, Audit, ActionConformite, VeilleReglementaire,
+        Processus, ProcessusActivite, MesureKRI, User, Client
+    )
+
+    cache_tableau_bord.init_app(app)
+    enregistrer_invalidations(
+        [Risque, EvaluationRisque, KRI, Audit, ActionConformite, VeilleReglementaire,
+         Processus, ProcessusActivite, MesureKRI],
+        modeles_user=[User, Client]
+    )
+    return cache_tableau_bord
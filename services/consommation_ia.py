@@ -0,0 +1,252 @@
+# services/consommation_ia.py
+"""
+Cache des analyses IA par contenu, comptage des jetons et budgets par client.
+
+- Cache : une analyse est identifiée par l'empreinte SHA-256 de
+  (modèle, messages envoyés, version des données de l'audit). Si une analyse
+  terminée du même audit porte la même empreinte, son résultat est réutilisé
+  sans appel au fournisseur (l'audit, ses constatations et recommandations
+  n'ont pas changé depuis).
+- Comptage : chaque appel réel alimente ConsommationIA (client propriétaire
+  de l'audit, mois, modèle)
+  à partir de response.usage ; les réponses servies par le cache y sont
+  comptées à part (nb_cache).
+- Budget : jetons par mois et par client, selon la formule d'abonnement.
+  Sans module « analyse_ia » actif le budget est nul ; sinon
+  features['budget_jetons_ia'] de la formule, à défaut IA_BUDGETS_JETONS[code],
+  à défaut IA_BUDGET_JETONS_DEFAUT (None = illimité).
+- Statistiques : statistiques_ia() remplace l'ancien fichier
+  ia_statistics.json (flask ia-statistiques).
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy import func, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, AnalyseIA, Audit, Client, ConsommationIA, Constatation, Recommandation
+
+logger = logging.getLogger(__name__)
+
+BUDGETS_JETONS = {'standard': 200_000, 'premium': 1_000_000, 'enterprise': None}
+SEUILS_SCORE = ((85, 'excellent'), (70, 'bon'), (50, 'moyen'), (0, 'faible'))
+
+
+class BudgetIADepasse(Exception):
+    """Le budget mensuel de jetons IA du client est épuisé"""
+
+    def __init__(self, client_id, consommes, budget):
+        self.client_id, self.consommes, self.budget = client_id, consommes, budget
+        super().__init__(f"Budget IA mensuel atteint ({consommes} / {budget} jetons)")
+
+
+def periode_courante(instant=None):
+    return (instant or datetime.utcnow()).strftime('%Y-%m')
+
+
+# ========================
+# CACHE PAR CONTENU
+# ========================
+
+def version_donnees_audit(audit_id):
+    """
+    Version des données analysées : dates de mise à jour et volumes de l'audit,
+    de ses constatations et de ses recommandations (3 agrégats, sans charger les lignes).
+    """
+    audit_maj = db.session.query(Audit.updated_at).filter(Audit.id == audit_id).scalar()
+    constatations = db.session.query(func.count(Constatation.id), func.max(Constatation.updated_at))\
+        .filter(Constatation.audit_id == audit_id).one()
+    recommandations = db.session.query(func.count(Recommandation.id), func.max(Recommandation.updated_at))\
+        .filter(Recommandation.audit_id == audit_id).one()
+    return json.dumps([audit_maj, tuple(constatations), tuple(recommandations)], default=str)
+
+
+def empreinte_prompt(modele, messages, version):
+    contenu = json.dumps({'modele': modele, 'messages': messages, 'version': version},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(contenu.encode('utf-8')).hexdigest()
+
+
+def _terminee():
+    return or_(AnalyseIA.statut.is_(None), AnalyseIA.statut == AnalyseIA.STATUT_TERMINE)
+
+
+def analyse_en_cache(empreinte, audit_id):
+    """
+    Dernière analyse terminée du même audit avec la même empreinte (le filtre
+    sur l'audit garantit qu'un résultat ne passe jamais d'un client à l'autre)
+    """
+    if not empreinte:
+        return None
+    return AnalyseIA.query.filter(
+        AnalyseIA.empreinte == empreinte,
+        AnalyseIA.audit_id == audit_id,
+        _terminee(),
+    ).order_by(AnalyseIA.id.desc()).first()
+
+
+# ========================
+# BUDGETS
+# ========================
+
+def budget_mensuel(client_id):
+    """Budget de jetons du mois pour le client (None = illimité)"""
+    if client_id is None:
+        return None  # analyses hors client (super admin)
+    client = db.session.get(Client, client_id)
+    formule = client.formule if client else None
+    if formule is None:
+        return current_app.config.get('IA_BUDGET_JETONS_DEFAUT')
+
+    modules = formule.modules or {}
+    if not (modules.get('analyse_ia') or modules.get('ia_analyse')):
+        return 0
+
+    budget_formule = (formule.features or {}).get('budget_jetons_ia')
+    if budget_formule is not None:
+        return int(budget_formule)
+    budgets = current_app.config.get('IA_BUDGETS_JETONS', BUDGETS_JETONS)
+    if formule.code in budgets:
+        return budgets[formule.code]
+    return current_app.config.get('IA_BUDGET_JETONS_DEFAUT')
+
+
+def consommation_mensuelle(client_id, periode=None):
+    return db.session.query(func.coalesce(func.sum(ConsommationIA.jetons_total), 0)).filter(
+        ConsommationIA.client_id.is_(None) if client_id is None else ConsommationIA.client_id == client_id,
+        ConsommationIA.periode == (periode or periode_courante())
+    ).scalar()
+
+
+def etat_budget(client_id):
+    budget = budget_mensuel(client_id)
+    consommes = consommation_mensuelle(client_id)
+    return {
+        'periode': periode_courante(),
+        'budget': budget,
+        'consommes': consommes,
+        'restants': None if budget is None else max(budget - consommes, 0),
+    }
+
+
+def verifier_budget(client_id):
+    """Lève BudgetIADepasse si le client n'a plus de jetons ce mois-ci"""
+    budget = budget_mensuel(client_id)
+    if budget is None:
+        return
+    consommes = consommation_mensuelle(client_id)
+    if consommes >= budget:
+        raise BudgetIADepasse(client_id, consommes, budget)
+
+
+# ========================
+# COMPTAGE
+# ========================
+
+def enregistrer_consommation(client_id, modele, jetons_prompt=0, jetons_reponse=0, jetons_total=None,
+                             fournisseur=None, depuis_cache=False):
+    """Incrémente le compteur (client, mois, modèle) : UPDATE, ou INSERT au premier appel du mois"""
+    jetons_total = jetons_total if jetons_total is not None else (jetons_prompt or 0) + (jetons_reponse or 0)
+    periode = periode_courante()
+    increments = {
+        'nb_appels': ConsommationIA.nb_appels + (0 if depuis_cache else 1),
+        'nb_cache': ConsommationIA.nb_cache + (1 if depuis_cache else 0),
+        'jetons_prompt': ConsommationIA.jetons_prompt + (jetons_prompt or 0),
+        'jetons_reponse': ConsommationIA.jetons_reponse + (jetons_reponse or 0),
+        'jetons_total': ConsommationIA.jetons_total + (jetons_total or 0),
+        'updated_at': datetime.utcnow(),
+    }
+    criteres = (
+        ConsommationIA.client_id.is_(None) if client_id is None else ConsommationIA.client_id == client_id,
+        ConsommationIA.periode == periode,
+        ConsommationIA.modele == modele,
+    )
+    for _ in range(2):
+        if db.session.execute(
+            update(ConsommationIA).where(*criteres).values(**increments)
+            .execution_options(synchronize_session=False)
+        ).rowcount:
+            db.session.commit()
+            return
+        try:
+            db.session.add(ConsommationIA(
+                client_id=client_id, periode=periode, modele=modele, fournisseur=fournisseur,
+                nb_appels=0 if depuis_cache else 1, nb_cache=1 if depuis_cache else 0,
+                jetons_prompt=jetons_prompt or 0, jetons_reponse=jetons_reponse or 0,
+                jetons_total=jetons_total or 0,
+            ))
+            db.session.commit()
+            return
+        except IntegrityError:
+            # Insertion concurrente du même compteur : on repasse par l'UPDATE
+            db.session.rollback()
+
+
+# ========================
+# STATISTIQUES
+# ========================
+
+def _categorie_score(score):
+    for seuil, categorie in SEUILS_SCORE:
+        if (score or 0) >= seuil:
+            return categorie
+    return 'faible'
+
+
+def statistiques_ia(client_id=None, nb_recentes=10):
+    """Statistiques agrégées des analyses IA (ancien ia_statistics.json) calculées en base"""
+    def filtrer(requete, modele=AnalyseIA):
+        return requete.filter(modele.client_id == client_id) if client_id is not None else requete
+
+    terminees = _terminee()
+
+    par_type = filtrer(db.session.query(AnalyseIA.type_analyse, func.count(AnalyseIA.id))
+                       .filter(terminees)).group_by(AnalyseIA.type_analyse).all()
+    scores = filtrer(db.session.query(AnalyseIA.score_confiance, func.count(AnalyseIA.id))
+                     .filter(terminees)).group_by(AnalyseIA.score_confiance).all()
+    par_audit = filtrer(db.session.query(Audit.reference, func.count(AnalyseIA.id))
+                        .join(AnalyseIA, AnalyseIA.audit_id == Audit.id).filter(terminees))\
+        .group_by(Audit.reference).order_by(func.count(AnalyseIA.id).desc()).limit(20).all()
+    recentes = filtrer(db.session.query(AnalyseIA.id, Audit.reference, AnalyseIA.type_analyse,
+                                        AnalyseIA.score_confiance, AnalyseIA.date_analyse, AnalyseIA.jetons)
+                       .join(Audit, Audit.id == AnalyseIA.audit_id).filter(terminees))\
+        .order_by(AnalyseIA.id.desc()).limit(nb_recentes).all()
+    consommation = filtrer(db.session.query(
+        ConsommationIA.periode, func.sum(ConsommationIA.nb_appels), func.sum(ConsommationIA.nb_cache),
+        func.sum(ConsommationIA.jetons_total)
+    ), ConsommationIA).group_by(ConsommationIA.periode).order_by(ConsommationIA.periode.desc()).limit(12).all()
+
+    par_score = {categorie: 0 for _, categorie in SEUILS_SCORE}
+    for score, nombre in scores:
+        par_score[_categorie_score(score)] += nombre
+
+    return {
+        'total_analyses': sum(n for _, n in par_type),
+        'by_type': {t: n for t, n in par_type},
+        'by_score': par_score,
+        'by_audit': [{'audit': reference, 'analyses': n} for reference, n in par_audit],
+        'recent_activity': [{
+            'id': r.id, 'audit': r.reference, 'type': r.type_analyse, 'score': r.score_confiance,
+            'jetons': r.jetons or 0, 'date': r.date_analyse.isoformat() if r.date_analyse else None,
+        } for r in recentes],
+        'consommation': [{
+            'periode': periode, 'appels': appels or 0, 'cache': cache or 0, 'jetons': jetons or 0,
+        } for periode, appels, cache, jetons in consommation],
+    }
+
+
+def init_consommation_ia(app):
+    """Enregistre la commande CLI `flask ia-statistiques`"""
+
+    @app.cli.command('ia-statistiques')
+    @click.option('--client-id', type=int, default=None, help='Limiter à un client')
+    def ia_statistiques_command(client_id):
+        """Affiche les statistiques et la consommation IA (JSON)."""
+        statistiques = statistiques_ia(client_id)
+        if client_id is not None:
+            statistiques['budget'] = etat_budget(client_id)
+        click.echo(json.dumps(statistiques, indent=2, ensure_ascii=False))
@@ -0,0 +1,285 @@
+# services/contexte_ia.py
+"""
+Construction du contexte envoyé au modèle pour l'analyse IA d'un audit,
+dans un budget de jetons.
+
+1. Constatations classées par criticité puis gravité (critique d'abord),
+   à défaut par nombre de recommandations rattachées et par date.
+2. Dédoublonnage des constatations quasi identiques (similarité de Jaccard
+   sur les trigrammes de mots du texte normalisé) : un seul exemplaire est
+   gardé, avec le nombre d'occurrences.
+3. Synthèse par thème (processus concerné, à défaut type de constatation) :
+   volumes par criticité, toujours incluse.
+4. Détail des constatations dans l'ordre du classement tant que le budget
+   (IA_BUDGET_CONTEXTE jetons) le permet. S'il n'y suffit pas, les
+   constatations sont découpées en morceaux (IA_BUDGET_MORCEAU, au plus
+   IA_MAX_MORCEAUX, les moins critiques au-delà sont omises) synthétisés
+   en parallèle par le modèle (map), puis ces synthèses sont assemblées dans
+   le prompt final (reduce) — cf. ServiceAnalyseIA._analyser_reel.
+
+Les jetons sont estimés localement (tiktoken s'il est installé, sinon une
+heuristique caractères / mots), sans appel au fournisseur.
+"""
+import os
+import re
+import unicodedata
+from collections import Counter, OrderedDict
+
+try:
+    import tiktoken
+    _ENCODAGE = tiktoken.get_encoding('cl100k_base')
+except Exception:  # ImportError, ou table d'encodage non téléchargeable
+    _ENCODAGE = None
+
+BUDGET_CONTEXTE = 6000       # jetons du prompt final (hors réponse)
+BUDGET_MORCEAU = 3000        # jetons par appel de synthèse (map)
+MAX_MORCEAUX = 8             # au-delà, les constatations les moins critiques ne sont pas détaillées
+SEUIL_SIMILARITE = 0.8
+LONGUEUR_MAX_DESCRIPTION = 600   # caractères par constatation dans le détail
+
+RANG_CRITICITE = {'critique': 3, 'majeure': 2, 'moyenne': 1, 'mineure': 0}
+RANG_GRAVITE = {'critique': 3, 'majeure': 2, 'elevee': 2, 'moyenne': 1, 'mineure': 0, 'faible': 0}
+
+FOCUS_ANALYSE = {
+    'recommandations': "Concentre-toi sur des recommandations concrètes, priorisées et actionnables.",
+    'causes_racines': "Concentre-toi sur les causes racines communes aux constatations.",
+    'risques_potentiels': "Concentre-toi sur les risques potentiels et leur niveau.",
+    'complet': "Couvre les points forts, les risques, les recommandations et les causes racines.",
+}
+
+
+# ========================
+# ESTIMATION DES JETONS
+# ========================
+
+def estimer_jetons(texte):
+    """Nombre de jetons estimé localement"""
+    if not texte:
+        return 0
+    if _ENCODAGE is not None:
+        return len(_ENCODAGE.encode(texte, disallowed_special=()))
+    # Français : ~3,5 caractères par jeton, jamais moins d'1,3 jeton par mot
+    return max(int(len(texte) / 3.5), int(len(texte.split()) * 1.3)) + 1
+
+
+def tronquer(texte, jetons_max):
+    """Coupe un texte à environ `jetons_max` jetons (sur une limite de mot)"""
+    texte = texte or ''
+    if estimer_jetons(texte) <= jetons_max:
+        return texte
+    coupure = max(0, int(len(texte) * jetons_max / max(estimer_jetons(texte), 1)))
+    return texte[:coupure].rsplit(' ', 1)[0] + '…'
+
+
+# ========================
+# CLASSEMENT ET DÉDOUBLONNAGE
+# ========================
+
+def _normaliser(texte):
+    texte = unicodedata.normalize('NFKD', (texte or '').lower())
+    texte = ''.join(c for c in texte if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9]+', ' ', texte).strip()
+
+
+def _trigrammes(texte_normalise):
+    mots = texte_normalise.split()
+    if len(mots) < 3:
+        return {texte_normalise}
+    return {' '.join(mots[i:i + 3]) for i in range(len(mots) - 2)}
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def cle_classement(constatation):
+    """Plus la clé est grande, plus la constatation passe en premier"""
+    return (
+        RANG_CRITICITE.get((constatation.criticite or '').lower(), -1),
+        RANG_GRAVITE.get((constatation.gravite or '').lower(), -1),
+        len(constatation.recommandations or []),
+        constatation.created_at.timestamp() if constatation.created_at else 0,
+    )
+
+
+def dedoublonner(constatations, seuil=SEUIL_SIMILARITE):
+    """
+    [(constatation représentative, occurrences)] en conservant l'ordre.
+    Les doublons exacts (texte normalisé) sont regroupés par hachage, les
+    quasi-doublons par comparaison au sein du même thème uniquement.
+    """
+    groupes = []           # [constatation, occurrences, trigrammes]
+    par_texte = {}
+    par_theme = {}
+    for constatation in constatations:
+        normalise = _normaliser(constatation.description)
+        if normalise in par_texte:
+            par_texte[normalise][1] += 1
+            continue
+        trigrammes = _trigrammes(normalise)
+        candidats = par_theme.setdefault(theme(constatation), [])
+        similaire = next((g for g in candidats if _jaccard(trigrammes, g[2]) >= seuil), None)
+        if similaire is not None:
+            similaire[1] += 1
+            par_texte[normalise] = similaire
+            continue
+        groupe = [constatation, 1, trigrammes]
+        groupes.append(groupe)
+        candidats.append(groupe)
+        par_texte[normalise] = groupe
+    return [(constatation, occurrences) for constatation, occurrences, _ in groupes]
+
+
+def theme(constatation):
+    return (constatation.processus_concerne or constatation.type_constatation or 'Autre').strip()
+
+
+# ========================
+# CONTEXTE
+# ========================
+
+class ContexteAnalyse:
+    """Sections du prompt ; `morceaux` non vide quand un map-reduce est nécessaire"""
+
+    def __init__(self, entete, syntheses, details, morceaux, budget, stats):
+        self.entete = entete
+        self.syntheses = syntheses
+        self.details = details
+        self.morceaux = morceaux
+        self.budget = budget
+        self.stats = stats
+
+    @property
+    def map_reduce(self):
+        return bool(self.morceaux)
+
+    def texte(self, syntheses_morceaux=None):
+        """Contexte final ; en map-reduce, les synthèses des morceaux remplacent le détail"""
+        sections = [self.entete, self.syntheses]
+        if syntheses_morceaux:
+            # Marge pour les intitulés de section et de lot
+            jetons_restants = self.budget - estimer_jetons('\n\n'.join(sections)) - 20
+            part = max(50, jetons_restants // len(syntheses_morceaux) - 8)
+            sections.append("Synthèses des constatations (par lot) :\n" + '\n'.join(
+                f"- Lot {i}: {tronquer(s, part)}" for i, s in enumerate(syntheses_morceaux, 1)
+            ))
+        elif self.details:
+            sections.append(self.details)
+        return '\n\n'.join(s for s in sections if s)
+
+    def cle(self):
+        """Contenu déterministe du contexte (empreinte du cache), sans appel au modèle"""
+        return '\n\n'.join([self.entete, self.syntheses, self.details or '', *self.morceaux])
+
+
+def _compacter(texte):
+    return re.sub(r'\s+', ' ', texte or '').strip()
+
+
+def _ligne_constatation(constatation, occurrences):
+    description = _compacter(constatation.description)
+    if len(description) > LONGUEUR_MAX_DESCRIPTION:
+        description = description[:LONGUEUR_MAX_DESCRIPTION].rsplit(' ', 1)[0] + '…'
+    attributs = [a for a in (constatation.criticite, constatation.gravite) if a]
+    ligne = f"- [{constatation.reference}] ({'/'.join(attributs) or 'non évaluée'}) {theme(constatation)} : {description}"
+    if occurrences > 1:
+        ligne += f" (×{occurrences} constatations similaires)"
+    if constatation.cause_racine:
+        ligne += f" Cause identifiée : {_compacter(constatation.cause_racine)[:200]}"
+    return ligne
+
+
+def _synthese_themes(groupes):
+    themes = OrderedDict()
+    for constatation, occurrences in groupes:
+        compteur = themes.setdefault(theme(constatation), Counter())
+        compteur[(constatation.criticite or 'non évaluée').lower()] += occurrences
+    lignes = ["Synthèse par thème :"]
+    for nom, compteur in themes.items():
+        detail = ', '.join(f"{n} {c}" for c, n in sorted(
+            compteur.items(), key=lambda item: -RANG_CRITICITE.get(item[0], -1)))
+        lignes.append(f"- {nom} : {sum(compteur.values())} constatation(s) ({detail})")
+    return '\n'.join(lignes)
+
+
+def _synthese_recommandations(recommandations):
+    if not recommandations:
+        return "Recommandations existantes : aucune."
+    statuts = Counter(r.statut or 'a_traiter' for r in recommandations)
+    prioritaires = sorted(recommandations, key=lambda r: -(r.score_priorite or 0))[:5]
+    lignes = [f"Recommandations existantes : {len(recommandations)} ("
+              + ', '.join(f"{n} {s}" for s, n in statuts.most_common()) + ")"]
+    lignes += [f"- [{r.reference}] {_compacter(r.description)[:160]}" for r in prioritaires]
+    return '\n'.join(lignes)
+
+
+def _decouper(lignes, budget_morceau):
+    morceaux, courant, jetons = [], [], 0
+    for ligne in lignes:
+        jetons_ligne = estimer_jetons(ligne)
+        if courant and jetons + jetons_ligne > budget_morceau:
+            morceaux.append('\n'.join(courant))
+            courant, jetons = [], 0
+        courant.append(tronquer(ligne, budget_morceau))
+        jetons += jetons_ligne
+    if courant:
+        morceaux.append('\n'.join(courant))
+    return morceaux
+
+
+def construire_contexte(audit, budget=None, budget_morceau=None):
+    """Contexte classé, dédoublonné et résumé de l'audit, dans `budget` jetons"""
+    budget = budget or int(os.environ.get('IA_BUDGET_CONTEXTE', BUDGET_CONTEXTE))
+    budget_morceau = budget_morceau or int(os.environ.get('IA_BUDGET_MORCEAU', BUDGET_MORCEAU))
+
+    constatations = sorted((c for c in audit.constatations if not c.is_archived), key=cle_classement,
+                           reverse=True)
+    groupes = dedoublonner(constatations)
+
+    entete = '\n'.join(filter(None, [
+        f"Référence: {audit.reference}",
+        f"Titre: {audit.titre}",
+        f"Type: {audit.type_audit}" if audit.type_audit else None,
+        f"Objectifs: {tronquer(audit.objectifs, 200)}" if audit.objectifs else None,
+        f"Portée: {tronquer(audit.portee, 150)}" if audit.portee else None,
+        f"Constatations: {len(constatations)} ({len(groupes)} après regroupement des doublons)",
+    ]))
+    syntheses = _synthese_themes(groupes) + '\n\n' + _synthese_recommandations(audit.recommandations)
+    # Les synthèses doivent toujours tenir : la moitié du budget au plus
+    syntheses = tronquer(syntheses, budget // 2)
+
+    lignes = [_ligne_constatation(c, n) for c, n in groupes]
+    disponible = budget - estimer_jetons(entete) - estimer_jetons(syntheses) - 50
+    details, morceaux = None, []
+    if sum(estimer_jetons(ligne) for ligne in lignes) <= disponible:
+        details = "Constatations (de la plus critique à la moins critique) :\n" + '\n'.join(lignes)
+    else:
+        morceaux = _decouper(lignes, budget_morceau)[:int(os.environ.get('IA_MAX_MORCEAUX', MAX_MORCEAUX))]
+
+    return ContexteAnalyse(entete, syntheses, details, morceaux, budget, stats={
+        'constatations': len(constatations),
+        'apres_dedoublonnage': len(groupes),
+        'morceaux': len(morceaux),
+    })
+
+
+def prompt_analyse(texte_contexte, type_analyse):
+    return (
+        "Analyse l'audit suivant.\n\n"
+        f"{texte_contexte}\n\n"
+        f"{FOCUS_ANALYSE.get(type_analyse, FOCUS_ANALYSE['complet'])}\n"
+        "Fournis une analyse structurée avec :\n"
+        "1. Points forts\n2. Risques identifiés\n3. Recommandations prioritaires\n4. Causes racines\n\n"
+        "Format de réponse : JSON structuré (points_forts, risques, recommandations_ia, causes_racines)."
+    )
+
+
+def prompt_morceau(entete, morceau, numero, total):
+    return (
+        f"Audit :\n{entete}\n\n"
+        f"Lot {numero}/{total} des constatations :\n{morceau}\n\n"
+        "Résume ce lot en 5 phrases au plus : thèmes récurrents, risques majeurs, "
+        "causes probables. Réponds en JSON : {\"synthese\": \"...\"}, sans introduction."
+    )
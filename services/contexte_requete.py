@@ -0,0 +1,263 @@
+# services/contexte_requete.py
+"""
+Contexte de requête résolu une seule fois par requête.
+
+Le tenant, le client consulté par un super admin, la formule, le mode de vue
+et les permissions déjà vérifiées sont mémorisés sur `g.contexte_requete`.
+Le middleware unique de app.py (preparer_contexte_requete) et le context
+processor (inject_contexte_requete) lisent tous les deux cet objet : aucune
+requête Client/FormuleAbonnement n'est faite tant qu'un template ou une
+vérification n'en a pas besoin, et jamais deux fois dans la même requête.
+
+Les tables « endpoint → permission » sont compilées au démarrage en un
+dictionnaire : endpoint -> ((permission, message), ...), dans l'ordre où les
+contrôles doivent être faits.
+"""
+from flask import g, session
+from flask_login import current_user
+from werkzeug.local import LocalProxy
+
+from models import db, Client, FormuleAbonnement
+
+MESSAGE_PERMISSION_INSUFFISANTE = 'Accès refusé : permissions insuffisantes'
+MESSAGE_PERMISSION_MODULE = 'Accès non autorisé au module {endpoint}. Permission "{permission}" requise.'
+MESSAGE_PERMISSION_GESTIONNAIRE = ('Permission "{permission}" manquante. Les gestionnaires doivent avoir '
+                                   '"can_manage_users = True" pour accéder à cette fonctionnalité.')
+
+
+# ========================
+# TABLES ENDPOINT → PERMISSION
+# ========================
+
+# Contrôles généraux (anciens check_permissions_middleware / check_permissions)
+PERMISSIONS_ENDPOINTS_GENERALES = {
+    'liste_cartographies': 'can_manage_risks',
+    'nouvelle_cartographie': 'can_manage_risks',
+    'liste_kri': 'can_manage_kri',
+    'nouveau_kri': 'can_manage_kri',
+    'liste_audits': 'can_manage_audit',
+    'nouvel_audit': 'can_manage_audit',
+    'veille_reglementaire': 'can_manage_regulatory',
+    'liste_logigrammes': 'can_manage_logigram',
+    'admin_dashboard': 'can_manage_users',
+    'rapports': 'can_view_reports',
+    'export_risques': 'can_export_data',
+    'admin_directions': 'can_view_departments',
+    'nouvelle_direction': 'can_manage_departments',
+    'modifier_direction': 'can_manage_departments',
+    'nouveau_service': 'can_manage_departments',
+}
+
+# La liste des utilisateurs exige les deux permissions (les anciens middlewares
+# se cumulaient : can_view_users_list puis can_manage_users)
+PERMISSIONS_ENDPOINTS_MULTIPLES = {
+    'admin_utilisateurs': ('can_view_users_list', 'can_manage_users'),
+}
+
+# Contrôles par module (ancien check_module_access_middleware)
+PERMISSIONS_ENDPOINTS_MODULES = {
+    # Risques
+    'liste_cartographies': 'can_manage_risks',
+    'nouvelle_cartographie': 'can_manage_risks',
+    'modifier_cartographie': 'can_manage_risks',
+    'detail_cartographie': 'can_manage_risks',
+
+    # KRI
+    'liste_kri': 'can_manage_kri',
+    'nouveau_kri': 'can_manage_kri',
+    'modifier_kri': 'can_manage_kri',
+
+    # Audit
+    'liste_audits': 'can_manage_audit',
+    'nouvel_audit': 'can_manage_audit',
+    'detail_audit': 'can_manage_audit',
+
+    # Veille
+    'veille_reglementaire': 'can_manage_regulatory',
+    'nouvelle_veille': 'can_manage_regulatory',
+
+    # Logigrammes
+    'liste_logigrammes': 'can_manage_logigram',
+    'nouveau_logigramme': 'can_manage_logigram',
+    'editer_logigramme': 'can_manage_logigram',
+
+    # Plans d'action
+    'liste_plans_action': 'can_view_action_plans',
+
+    # Utilisateurs
+    'admin_utilisateurs': 'can_view_users_list',
+    'admin_nouvel_utilisateur': 'can_create_users',
+    'admin_editer_utilisateur': 'can_edit_users',
+
+    # Routes gestionnaire
+    'gestionnaire_utilisateurs': 'can_view_users_list',
+    'gestionnaire_creer_utilisateur': 'can_create_users',
+    'gestionnaire_editer_utilisateur': 'can_edit_users',
+    'gestionnaire_gerer_permissions': 'can_manage_permissions',
+
+    # Directions
+    'admin_directions': 'can_view_departments',
+    'nouvelle_direction': 'can_manage_departments',
+
+    # Paramétrage
+    'parametrage_risque': 'can_manage_settings',
+    'parametrage_champs': 'can_manage_settings',
+    'parametrage_fichiers': 'can_manage_settings',
+}
+
+# Endpoints soumis aux limites de la formule (requêtes POST/PUT)
+LIMITES_ENDPOINTS = {
+    'admin_nouvel_utilisateur': 'utilisateurs',
+    'nouveau_risque': 'risques',
+    'nouvel_audit': 'audits',
+    'nouveau_processus': 'processus',
+    'nouveau_logigramme': 'logigrammes',
+}
+
+
+def compiler_permissions_endpoints():
+    """
+    Fusionne les tables en endpoint -> ((permission, message), ...).
+
+    Une permission déjà exigée pour un endpoint n'est pas revérifiée ; l'ordre
+    (contrôles généraux puis modules) fixe le message affiché en cas de refus.
+    """
+    compile = {}
+
+    def ajouter(endpoint, permission, message):
+        regles = compile.setdefault(endpoint, [])
+        if permission not in (p for p, _ in regles):
+            regles.append((permission, message))
+
+    for endpoint, permission in PERMISSIONS_ENDPOINTS_GENERALES.items():
+        ajouter(endpoint, permission, MESSAGE_PERMISSION_INSUFFISANTE)
+    for endpoint, permissions in PERMISSIONS_ENDPOINTS_MULTIPLES.items():
+        for permission in permissions:
+            ajouter(endpoint, permission, MESSAGE_PERMISSION_INSUFFISANTE)
+    for endpoint, permission in PERMISSIONS_ENDPOINTS_MODULES.items():
+        message = MESSAGE_PERMISSION_GESTIONNAIRE if endpoint.startswith('gestionnaire_') \
+            else MESSAGE_PERMISSION_MODULE
+        ajouter(endpoint, permission, message.format(endpoint=endpoint, permission=permission))
+
+    return {endpoint: tuple(regles) for endpoint, regles in compile.items()}
+
+
+PERMISSIONS_ENDPOINTS = compiler_permissions_endpoints()
+
+
+# ========================
+# CONTEXTE
+# ========================
+
+_ABSENT = object()
+
+
+class ContexteRequete:
+    """Informations de tenant/vue/formule d'une requête, calculées à la demande"""
+
+    def __init__(self, user):
+        self.user = user
+        self.authentifie = bool(user.is_authenticated)
+        self.est_super_admin = self.authentifie and user.role == 'super_admin'
+        self.viewing_client_id = session.get('viewing_client_id')
+        self.view_mode = session.get('view_mode', 'my_client')
+        # Super admin : pas de filtre (get_client_filter applique la vue choisie)
+        self.client_id = user.client_id if self.authentifie and not self.est_super_admin else None
+        self._memo = {}
+        self._permissions = {}
+
+    def _memoriser(self, cle, calcul):
+        valeur = self._memo.get(cle, _ABSENT)
+        if valeur is _ABSENT:
+            valeur = self._memo[cle] = calcul()
+        return valeur
+
+    @property
+    def filter_by_client(self):
+        return self.authentifie and not self.est_super_admin
+
+    @property
+    def client(self):
+        if not self.authentifie:
+            return None
+        return self._memoriser('client', lambda: self.user.client)
+
+    @property
+    def formule(self):
+        return self._memoriser('formule', lambda: self.client.formule if self.client else None)
+
+    @property
+    def viewing_client(self):
+        if not self.viewing_client_id:
+            return None
+        return self._memoriser('viewing_client', lambda: db.session.get(Client, self.viewing_client_id))
+
+    @property
+    def clients_disponibles(self):
+        def calcul():
+            if self.est_super_admin:
+                return Client.query.filter_by(is_active=True).order_by(Client.nom).all()
+            client = self.client
+            return [client] if client is not None and client.is_active else []
+        return self._memoriser('clients_disponibles', calcul)
+
+    @property
+    def can_upgrade(self):
+        def calcul():
+            formule = self.formule
+            if formule is None:
+                return False
+            return FormuleAbonnement.query.filter(
+                FormuleAbonnement.is_active == True,
+                FormuleAbonnement.max_utilisateurs > formule.max_utilisateurs
+            ).count() > 0
+        return self._memoriser('can_upgrade', calcul)
+
+    def has_permission(self, permission):
+        """User.has_permission mémorisé pour la durée de la requête"""
+        if not self.authentifie:
+            return False
+        if self.est_super_admin:
+            return True
+        resultat = self._permissions.get(permission)
+        if resultat is None:
+            resultat = self._permissions[permission] = bool(self.user.has_permission(permission))
+        return resultat
+
+    def oublier_permissions(self):
+        """À appeler après une modification des permissions pendant la requête"""
+        self._permissions.clear()
+
+    def permission_refusee(self, endpoint):
+        """Retourne le message du premier contrôle refusé pour l'endpoint, sinon None"""
+        if self.est_super_admin:
+            return None
+        for permission, message in PERMISSIONS_ENDPOINTS.get(endpoint, ()):
+            if not self.has_permission(permission):
+                return message
+        return None
+
+    # --- Affichage de la vue (barre super admin) ---
+
+    @property
+    def affichage_vue(self):
+        def calcul():
+            if self.viewing_client:
+                return f"Vue: {self.viewing_client.reference}", "fas fa-eye", "is-success"
+            if self.view_mode == 'my_data_only':
+                return "Mes données", "fas fa-user", "is-warning"
+            return "Mon client", "fas fa-building", "is-info"
+        return self._memoriser('affichage_vue', calcul)
+
+
+def obtenir_contexte():
+    """Retourne le contexte de la requête courante (créé au premier appel)"""
+    contexte = g.get('contexte_requete')
+    if contexte is None:
+        contexte = g.contexte_requete = ContexteRequete(current_user)
+    return contexte
+
+
+def paresseux(calcul):
+    """Valeur de template évaluée seulement si le template l'utilise"""
+    return LocalProxy(calcul)
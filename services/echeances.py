@@ -0,0 +1,356 @@
+# services/echeances.py
+"""
+Moteur ensembliste des échéances et alertes.
+
+Remplace la boucle ligne par ligne de verifier_echeances_et_alertes
+(un SELECT de doublon + une notification + un commit par élément) par :
+
+- une requête par type d'alerte, bornée par dates en SQL (échéance dans les
+  7 jours / échéance dépassée) ;
+- un anti-jointure NOT EXISTS sur les notifications déjà émises, ce qui rend
+  le traitement idempotent : une alerte n'est pas recréée tant qu'une
+  notification identique (type, entité) est non lue ou a été créée le jour même ;
+- des UPDATE groupés pour les changements de statut (retards, plans terminés) ;
+- une seule insertion groupée des notifications.
+
+Sources couvertes : recommandations, plans d'action, actions de conformité
+(veille réglementaire) et seuils des KRI (dernière mesure de chaque KRI actif).
+
+    flask verifier-echeances --dry-run
+"""
+from datetime import datetime, time, timedelta
+
+import click
+
+from sqlalchemy import and_, exists, func, insert, or_, select, update
+from sqlalchemy.orm import aliased
+
+from models import (
+    db, Audit, Recommandation, PlanAction, SousAction, ActionConformite,
+    KRI, MesureKRI, Notification
+)
+
+DELAI_ECHEANCE_PROCHE = 7  # jours
+
+TYPE_ECHEANCE_PROCHE = 'echeance_proche'
+TYPE_RETARD = Notification.TYPE_RETARD
+TYPE_PLAN_TERMINE = 'plan_termine'
+TYPE_KRI_ALERTE = Notification.TYPE_KRI_ALERTE
+
+EXPIRATIONS = {TYPE_ECHEANCE_PROCHE: 7, TYPE_RETARD: 14}  # jours, 30 par défaut
+
+
+def _statut_hors(colonne, statuts):
+    """statut NOT IN (...) en conservant les statuts NULL (comme la comparaison Python)"""
+    return or_(colonne.is_(None), colonne.notin_(statuts))
+
+
+def _sans_alerte(type_notification, entite_type, colonne_id, debut_jour):
+    """Anti-jointure : aucune notification identique non lue ou émise aujourd'hui"""
+    n = aliased(Notification)
+    return ~exists().where(
+        n.type_notification == type_notification,
+        n.entite_type == entite_type,
+        n.entite_id == colonne_id,
+        or_(n.est_lue == False, n.est_lue.is_(None), n.created_at >= debut_jour)
+    )
+
+
+# ========================
+# SOURCES À ÉCHÉANCE
+# ========================
+
+def _source_recommandations():
+    return {
+        'entite_type': 'recommandation',
+        'id': Recommandation.id,
+        'date': Recommandation.date_echeance,
+        'colonnes': [Recommandation.id, Recommandation.reference.label('libelle'),
+                     Recommandation.date_echeance.label('date'), Recommandation.client_id,
+                     func.coalesce(Recommandation.responsable_id, Audit.responsable_id).label('destinataire')],
+        'jointure': (Audit, Audit.id == Recommandation.audit_id),
+        'filtres': [Audit.is_archived == False],
+        'ouvert': _statut_hors(Recommandation.statut, ['termine']),
+        'retard': {'modele': Recommandation, 'statut': 'retarde',
+                   'sauf': ['termine', 'retarde'],
+                   'perimetre': Recommandation.audit_id.in_(select(Audit.id).where(Audit.is_archived == False))},
+        'proche': lambda l, j: (f"Échéance proche pour la recommandation {l}",
+                                f"La recommandation {l} arrive à échéance dans {j} jour(s)"),
+        'en_retard': lambda l, j: (f"Retard sur la recommandation {l}",
+                                   f"La recommandation {l} est en retard de {j} jour(s)"),
+    }
+
+
+def _source_plans():
+    return {
+        'entite_type': 'plan_action',
+        'id': PlanAction.id,
+        'date': PlanAction.date_fin_prevue,
+        'colonnes': [PlanAction.id, PlanAction.nom.label('libelle'),
+                     PlanAction.date_fin_prevue.label('date'), PlanAction.client_id,
+                     func.coalesce(PlanAction.responsable_id, Audit.responsable_id).label('destinataire')],
+        'jointure': (Audit, Audit.id == PlanAction.audit_id),
+        'filtres': [PlanAction.is_archived == False],
+        'ouvert': _statut_hors(PlanAction.statut, ['termine', 'suspendu']),
+        'retard': {'modele': PlanAction, 'statut': 'retarde',
+                   'sauf': ['termine', 'suspendu', 'retarde'],
+                   'perimetre': PlanAction.is_archived == False},
+        'proche': lambda l, j: (f"Échéance proche pour le plan {l}",
+                                f"Le plan {l} arrive à échéance dans {j} jour(s)"),
+        'en_retard': lambda l, j: (f"Retard sur le plan {l}",
+                                   f"Le plan {l} est en retard de {j} jour(s)"),
+    }
+
+
+def _source_actions_conformite():
+    return {
+        'entite_type': 'action_conformite',
+        'id': ActionConformite.id,
+        'date': ActionConformite.date_echeance,
+        'colonnes': [ActionConformite.id, func.substr(ActionConformite.description, 1, 80).label('libelle'),
+                     ActionConformite.date_echeance.label('date'), ActionConformite.client_id,
+                     ActionConformite.responsable_id.label('destinataire')],
+        'jointure': None,
+        'filtres': [ActionConformite.is_archived == False],
+        # Mêmes critères que les indicateurs « actions retardées » des tableaux de bord
+        'ouvert': ActionConformite.statut.in_(['a_faire', 'en_cours']),
+        'retard': None,
+        'proche': lambda l, j: ("Échéance proche pour une action de conformité",
+                                f"L'action « {l} » arrive à échéance dans {j} jour(s)"),
+        'en_retard': lambda l, j: ("Retard sur une action de conformité",
+                                   f"L'action « {l} » est en retard de {j} jour(s)"),
+    }
+
+
+SOURCES = (_source_recommandations, _source_plans, _source_actions_conformite)
+
+
+def _requete_source(source):
+    requete = db.session.query(*source['colonnes'])
+    if source['jointure'] is not None:
+        requete = requete.join(*source['jointure'])
+    return requete.filter(source['ouvert'], *source['filtres'])
+
+
+def _notification(type_notification, entite_type, ligne, titre, message, maintenant, urgence=None, donnees=None):
+    return {
+        'type_notification': type_notification,
+        'titre': titre[:200],
+        'message': message,
+        'urgence': urgence or Notification.URGENCE_IMPORTANT,
+        'destinataire_id': ligne.destinataire,
+        'entite_type': entite_type,
+        'entite_id': ligne.id,
+        'client_id': ligne.client_id,
+        'donnees_supplementaires': donnees or {},
+        'actions_possibles': [],
+        'created_at': maintenant,
+        'expires_at': maintenant + timedelta(days=EXPIRATIONS.get(type_notification, 30)),
+    }
+
+
+def alertes_echeances(source, aujourdhui, debut_jour, maintenant):
+    """Notifications à créer pour une source (échéances proches + retards)"""
+    notifications = []
+    entite_type = source['entite_type']
+
+    proches = _requete_source(source).filter(
+        source['date'] > aujourdhui,
+        source['date'] <= aujourdhui + timedelta(days=DELAI_ECHEANCE_PROCHE),
+        _sans_alerte(TYPE_ECHEANCE_PROCHE, entite_type, source['id'], debut_jour)
+    )
+    for ligne in proches:
+        jours = (ligne.date - aujourdhui).days
+        titre, message = source['proche'](ligne.libelle, jours)
+        notifications.append(_notification(TYPE_ECHEANCE_PROCHE, entite_type, ligne, titre, message, maintenant,
+                                           donnees={'date_echeance': ligne.date.isoformat(),
+                                                    'jours_restants': jours}))
+
+    retards = _requete_source(source).filter(
+        source['date'] < aujourdhui,
+        _sans_alerte(TYPE_RETARD, entite_type, source['id'], debut_jour)
+    )
+    for ligne in retards:
+        jours = (aujourdhui - ligne.date).days
+        titre, message = source['en_retard'](ligne.libelle, jours)
+        notifications.append(_notification(TYPE_RETARD, entite_type, ligne, titre, message, maintenant,
+                                           urgence=Notification.URGENCE_URGENT,
+                                           donnees={'date_echeance': ligne.date.isoformat(),
+                                                    'jours_retard': jours}))
+    return notifications
+
+
+def marquer_retards(source, aujourdhui):
+    """UPDATE groupé du statut « retardé » des éléments échus (retourne le nombre de lignes)"""
+    retard = source['retard']
+    if retard is None:
+        return 0
+    modele = retard['modele']
+    return db.session.execute(
+        update(modele)
+        .where(source['date'] < aujourdhui, _statut_hors(modele.statut, retard['sauf']), retard['perimetre'])
+        .values(statut=retard['statut'])
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+# ========================
+# PLANS TERMINÉS
+# ========================
+
+def terminer_plans_acheves(aujourdhui, maintenant, dry_run=False):
+    """
+    Plans dont toutes les sous-actions sont à 100 % : statut « termine »
+    (UPDATE groupé) et notification du responsable.
+    """
+    sous_action_incomplete = exists().where(
+        SousAction.plan_action_id == PlanAction.id,
+        or_(SousAction.pourcentage_realisation.is_(None), SousAction.pourcentage_realisation != 100)
+    )
+    plans = db.session.query(
+        PlanAction.id, PlanAction.nom.label('libelle'), PlanAction.client_id,
+        func.coalesce(PlanAction.responsable_id, Audit.responsable_id).label('destinataire')
+    ).join(Audit, Audit.id == PlanAction.audit_id).filter(
+        PlanAction.is_archived == False,
+        _statut_hors(PlanAction.statut, ['termine']),
+        exists().where(SousAction.plan_action_id == PlanAction.id),
+        ~sous_action_incomplete
+    ).all()
+
+    if plans and not dry_run:
+        db.session.execute(
+            update(PlanAction)
+            .where(PlanAction.id.in_([p.id for p in plans]))
+            .values(statut='termine', date_fin_reelle=aujourdhui, pourcentage_realisation=100)
+            .execution_options(synchronize_session=False)
+        )
+
+    return len(plans), [
+        _notification(TYPE_PLAN_TERMINE, 'plan_action', p,
+                      f"Plan d'action terminé: {p.libelle}",
+                      f"Le plan d'action '{p.libelle}' a été automatiquement marqué comme terminé "
+                      f"car toutes les sous-actions sont complètes.",
+                      maintenant, urgence=Notification.URGENCE_NORMAL)
+        for p in plans
+    ]
+
+
+# ========================
+# SEUILS KRI
+# ========================
+
+def alertes_kri(debut_jour, maintenant):
+    """Alertes pour les KRI actifs dont la dernière mesure franchit un seuil"""
+    derniere = db.session.query(
+        MesureKRI.kri_id, func.max(MesureKRI.date_mesure).label('date_mesure')
+    ).group_by(MesureKRI.kri_id).subquery()
+
+    lignes = db.session.query(
+        KRI.id, KRI.nom.label('libelle'), KRI.client_id, KRI.unite_mesure, KRI.type_indicateur,
+        KRI.seuil_alerte, KRI.seuil_critique, KRI.sens_evaluation_seuil,
+        KRI.responsable_mesure_id.label('destinataire'),
+        MesureKRI.valeur, MesureKRI.date_mesure
+    ).join(derniere, derniere.c.kri_id == KRI.id)\
+        .join(MesureKRI, and_(MesureKRI.kri_id == KRI.id, MesureKRI.date_mesure == derniere.c.date_mesure))\
+        .filter(KRI.est_actif == True,
+                KRI.responsable_mesure_id.isnot(None),
+                or_(KRI.seuil_alerte.isnot(None), KRI.seuil_critique.isnot(None)),
+                _sans_alerte(TYPE_KRI_ALERTE, 'kri', KRI.id, debut_jour))\
+        .all()
+
+    notifications, deja_vus = [], set()
+    for ligne in lignes:
+        if ligne.id in deja_vus:  # deux mesures à la même date
+            continue
+        deja_vus.add(ligne.id)
+        # Même règle que KRI.get_etat_alerte (sens d'évaluation, KRI/KPI)
+        etat = KRI.get_etat_alerte(ligne, ligne.valeur)
+        if etat not in ('critique', 'alerte'):
+            continue
+        notifications.append(_notification(
+            TYPE_KRI_ALERTE, 'kri', ligne,
+            f"Alerte KRI: {ligne.libelle}",
+            f"Valeur: {ligne.valeur}{' ' + ligne.unite_mesure if ligne.unite_mesure else ''} - État: {etat}",
+            maintenant,
+            urgence=Notification.URGENCE_URGENT if etat == 'critique' else Notification.URGENCE_IMPORTANT,
+            donnees={'valeur': ligne.valeur, 'etat': etat,
+                     'seuil_alerte': ligne.seuil_alerte, 'seuil_critique': ligne.seuil_critique,
+                     'date_mesure': ligne.date_mesure.isoformat() if ligne.date_mesure else None}
+        ))
+    return notifications
+
+
+# ========================
+# MOTEUR
+# ========================
+
+def verifier_echeances(aujourdhui=None, dry_run=False):
+    """
+    Exécute toutes les vérifications et retourne un rapport sérialisable en JSON.
+
+    Idempotent sur la journée : une seconde exécution ne crée aucune
+    notification supplémentaire. En dry_run, rien n'est écrit.
+    """
+    maintenant = datetime.utcnow()
+    aujourdhui = aujourdhui or maintenant.date()
+    debut_jour = datetime.combine(aujourdhui, time.min)
+
+    rapport = {'dry_run': dry_run, 'date': aujourdhui.isoformat(), 'retards_marques': {}, 'notifications': {}}
+    notifications = []
+
+    # Plans achevés d'abord : un plan terminé ne doit pas recevoir d'alerte de retard
+    nb_termines, notifs_termines = terminer_plans_acheves(aujourdhui, maintenant, dry_run)
+    rapport['plans_termines'] = nb_termines
+    notifications += notifs_termines
+    if not dry_run:
+        db.session.flush()
+
+    for fabrique in SOURCES:
+        source = fabrique()
+        notifications += alertes_echeances(source, aujourdhui, debut_jour, maintenant)
+        if source['retard'] is not None:
+            if dry_run:
+                modele = source['retard']['modele']
+                rapport['retards_marques'][source['entite_type']] = db.session.query(func.count(modele.id)).filter(
+                    source['date'] < aujourdhui, _statut_hors(modele.statut, source['retard']['sauf']),
+                    source['retard']['perimetre']
+                ).scalar()
+            else:
+                rapport['retards_marques'][source['entite_type']] = marquer_retards(source, aujourdhui)
+
+    notifications += alertes_kri(debut_jour, maintenant)
+
+    # Une alerte sans destinataire n'est visible par personne
+    notifications = [n for n in notifications if n['destinataire_id']]
+    for n in notifications:
+        cle = f"{n['entite_type']}:{n['type_notification']}"
+        rapport['notifications'][cle] = rapport['notifications'].get(cle, 0) + 1
+    rapport['total_notifications'] = len(notifications)
+
+    if dry_run:
+        db.session.rollback()
+        print(f"🧪 Simulation échéances : {len(notifications)} notification(s) seraient créées")
+        return rapport
+
+    if notifications:
+        db.session.execute(insert(Notification.__table__), notifications)
+    db.session.commit()
+
+    print(f"✅ Échéances : {len(notifications)} notification(s), "
+          f"{sum(rapport['retards_marques'].values())} retard(s) marqué(s), {nb_termines} plan(s) terminé(s)")
+    return rapport
+
+
+def init_echeances(app):
+    """Enregistre la commande CLI `flask verifier-echeances`"""
+
+    @app.cli.command('verifier-echeances')
+    @click.option('--dry-run', is_flag=True, help='Afficher les alertes sans les créer')
+    def verifier_echeances_command(dry_run):
+        """Crée les alertes d'échéance, de retard et de seuil KRI du jour."""
+        rapport = verifier_echeances(dry_run=dry_run)
+        for cle, nombre in sorted(rapport['notifications'].items()):
+            click.echo(f"  {cle}: {nombre}")
+        for entite_type, nombre in rapport['retards_marques'].items():
+            click.echo(f"  {entite_type} marqué(s) en retard: {nombre}")
+        click.echo(f"  plans terminés: {rapport['plans_termines']}")
@@ -0,0 +1,693 @@
+# services/emails_sortants.py
+"""
+Boîte d'envoi des emails et expédition en arrière-plan.
+
+Les routes ne parlent plus au serveur SMTP : mettre_en_file() enregistre un
+EmailSortant dans la transaction en cours et rend la main. Des traiteurs
+(worker.py, ou le processus web en développement) vident la file :
+
+    en_attente -> en_cours -> envoye (ou simule sans mot de passe SMTP)
+                          \\-> en_attente (nouvel essai après 1, 2, 4... min)
+                          \\-> echec (refus définitif ou EMAILS_MAX_TENTATIVES)
+
+- Réservation par lot (EMAILS_LOT messages) par UPDATE conditionnel, sûre
+  entre threads et entre processus ; pendant l'envoi, prochain_essai sert de
+  bail et un lot abandonné (redémarrage) est remis en file à son expiration.
+- Une connexion SMTP par traiteur, réutilisée d'un lot à l'autre : NOOP avant
+  réemploi, reconnexion si le serveur l'a fermée, fermeture après
+  EMAILS_SMTP_INACTIVITE secondes sans envoi.
+- Modèles (templates/emails/) rendus au moment de l'envoi, une fois par lot :
+  les messages d'un lot qui partagent modèle et contexte réutilisent le rendu.
+
+Canal email des notifications (préférences 'email' et 'frequence_email') :
+    'immediat'                          -> un email par notification, mis en
+                                           file dans la même transaction
+    'quotidien', 'hebdomadaire', 'mensuel' -> résumé par la tâche resume_emails
+
+Serveur de débogage : ServeurSMTPDebug reçoit les messages en local sans les
+transmettre (python worker.py --smtp-debug 1025), avec
+    MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS=false MAIL_USERNAME=
+"""
+import html
+import json
+import logging
+import os
+import re
+import smtplib
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+from email.utils import formataddr, make_msgid
+
+from flask import current_app
+from sqlalchemy import event, or_, update
+from sqlalchemy.orm import Session
+
+from models import db, EmailSortant, Notification, User
+
+logger = logging.getLogger(__name__)
+
+TAILLE_LOT = 50
+MAX_TENTATIVES = 5
+DELAI_BASE = 60             # secondes, doublé à chaque tentative
+DELAI_MAX = 3600
+DUREE_BAIL = 600            # secondes pour envoyer un lot réservé
+INACTIVITE_SMTP = 60        # secondes avant de fermer la connexion inutilisée
+INTERVALLE_SCRUTATION = 5   # secondes
+RETENTION_JOURS = 30
+
+FREQUENCES_RESUME = ('immediat', 'quotidien', 'hebdomadaire', 'mensuel')
+_CLE_REVEIL = 'emails_sortants_a_reveiller'
+
+_traiteur_embarque = None
+_verrou_embarque = threading.Lock()
+
+
+# ========================
+# MISE EN FILE
+# ========================
+
+def _liste(adresses):
+    if not adresses:
+        return []
+    if isinstance(adresses, str):
+        adresses = [adresses]
+    return [a.strip() for a in adresses if a and a.strip()]
+
+
+def mettre_en_file(destinataires, sujet, corps_texte=None, corps_html=None, modele=None, contexte=None,
+                   cc=None, bcc=None, categorie=None, sensible=False, notification_id=None,
+                   client_id=None, commit=True):
+    """
+    Enregistre un email dans la boîte d'envoi.
+
+    Soit un corps (texte et/ou HTML), soit un modèle templates/emails/... et
+    son contexte JSON, rendu par le traiteur. Avec commit=False, l'email
+    rejoint la transaction de l'appelant : il n'existe que si elle est validée.
+    """
+    destinataires = _liste(destinataires)
+    if not destinataires:
+        raise ValueError("Aucun destinataire")
+    if not (corps_texte or corps_html or modele):
+        raise ValueError("Corps ou modèle requis")
+
+    email = EmailSortant(
+        destinataires=destinataires, cc=_liste(cc) or None, bcc=_liste(bcc) or None,
+        sujet=sujet[:255], corps_texte=corps_texte, corps_html=corps_html,
+        modele=modele, contexte=contexte, sensible=sensible, categorie=categorie,
+        notification_id=notification_id, client_id=client_id,
+        statut=EmailSortant.STATUT_EN_ATTENTE, tentatives=0, prochain_essai=datetime.utcnow(),
+    )
+    db.session.add(email)
+    db.session.info[_CLE_REVEIL] = True
+    if commit:
+        db.session.commit()
+    return email
+
+
+def _apres_commit(session):
+    if session.info.pop(_CLE_REVEIL, False):
+        _reveiller_traiteur_embarque()
+
+
+def _apres_rollback(session, transaction_precedente):
+    session.info.pop(_CLE_REVEIL, None)
+
+
+# ========================
+# CANAL EMAIL DES NOTIFICATIONS
+# ========================
+
+def url_application(chemin=None):
+    base = (current_app.config.get('EMAILS_URL_APPLICATION') or '').rstrip('/')
+    if not chemin:
+        return base or None
+    return f"{base}{chemin}" if base else chemin
+
+
+def email_souhaite(prefs, type_notification):
+    """Le type doit être explicitement activé dans prefs['email'] (les types système ne partent pas)"""
+    return bool((prefs or {}).get('email', {}).get(type_notification, False))
+
+
+def frequence_email(prefs):
+    return (prefs or {}).get('frequence_email') or 'quotidien'
+
+
+def _contexte_notification(notification):
+    return {
+        'titre': notification.titre,
+        'message': notification.message,
+        'urgence': notification.urgence,
+        'date': notification.created_at.strftime('%d/%m/%Y %H:%M') if notification.created_at else None,
+        'url': url_application(notification.get_url()),
+    }
+
+
+def mettre_en_file_notification(user, notification):
+    """Email immédiat d'une notification (même transaction que la notification, déjà flushée)"""
+    if not user.email:
+        return None
+    notification.est_envoyee_email = True
+    return mettre_en_file(
+        user.email, notification.titre, modele='emails/notification.html',
+        contexte={'nom': user.username, 'notification': _contexte_notification(notification),
+                  'url_preferences': url_application('/notifications/preferences')},
+        categorie='notification', notification_id=notification.id, client_id=notification.client_id,
+        commit=False,
+    )
+
+
+def frequences_dues(jour):
+    """Fréquences de résumé à traiter ce jour-là ('immediat' : notifications non parties)"""
+    frequences = ['immediat', 'quotidien']
+    if jour.weekday() == 0:
+        frequences.append('hebdomadaire')
+    if jour.day == 1:
+        frequences.append('mensuel')
+    return frequences
+
+
+def preparer_resumes(maintenant=None, dry_run=False):
+    """
+    Résumés des notifications non lues et pas encore parties par email, un
+    email par utilisateur dont la fréquence est due aujourd'hui. Tâche
+    planifiée resume_emails (worker.py).
+    """
+    maintenant = maintenant or datetime.utcnow()
+    dues = set(frequences_dues(maintenant))
+    depuis = maintenant - timedelta(days=31)
+
+    notifications = Notification.query.filter(
+        Notification.est_envoyee_email.isnot(True),
+        Notification.est_lue.isnot(True),
+        Notification.destinataire_id.isnot(None),
+        Notification.created_at >= depuis,
+    ).order_by(Notification.destinataire_id, Notification.created_at).all()
+
+    par_user = {}
+    for notification in notifications:
+        par_user.setdefault(notification.destinataire_id, []).append(notification)
+    users = {u.id: u for u in User.query.filter(User.id.in_(list(par_user)), User.is_active.isnot(False))} \
+        if par_user else {}
+
+    rapport = {'resumes': 0, 'notifications': 0}
+    incluses = []
+    for user_id, liste in par_user.items():
+        user = users.get(user_id)
+        if user is None or not user.email:
+            continue
+        prefs = user.preferences_notifications or {}
+        if frequence_email(prefs) not in dues:
+            continue
+        retenues = [n for n in liste if email_souhaite(prefs, n.type_notification)]
+        if not retenues:
+            continue
+        rapport['resumes'] += 1
+        rapport['notifications'] += len(retenues)
+        if dry_run:
+            continue
+        incluses.extend(n.id for n in retenues)
+        mettre_en_file(
+            user.email, f"Résumé de vos notifications ({len(retenues)})",
+            modele='emails/resume_notifications.html',
+            contexte={'nom': user.username, 'frequence': frequence_email(prefs),
+                      'notifications': [_contexte_notification(n) for n in retenues],
+                      'url_notifications': url_application('/notifications'),
+                      'url_preferences': url_application('/notifications/preferences')},
+            categorie='resume_notifications', client_id=user.client_id, commit=False,
+        )
+
+    if incluses:
+        # Sans effet sur les compteurs de non lues (services/notifications_temps_reel.py)
+        db.session.execute(
+            update(Notification).where(Notification.id.in_(incluses)).values(est_envoyee_email=True)
+            .execution_options(synchronize_session=False, compteurs_notifications=False)
+        )
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    rapport['purges'] = 0 if dry_run else purger_envoyes()
+    logger.info("Résumés email: %d email(s), %d notification(s)", rapport['resumes'], rapport['notifications'])
+    return rapport
+
+
+def purger_envoyes(jours=None):
+    """Supprime les emails partis (ou définitivement en échec) depuis plus de EMAILS_RETENTION_JOURS"""
+    jours = jours or current_app.config.get('EMAILS_RETENTION_JOURS', RETENTION_JOURS)
+    limite = datetime.utcnow() - timedelta(days=jours)
+    supprimes = EmailSortant.query.filter(
+        EmailSortant.statut.in_([EmailSortant.STATUT_ENVOYE, EmailSortant.STATUT_SIMULE, EmailSortant.STATUT_ECHEC]),
+        or_(EmailSortant.date_envoi < limite,
+            (EmailSortant.date_envoi.is_(None)) & (EmailSortant.created_at < limite)),
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return supprimes
+
+
+# ========================
+# RENDU ET CONSTRUCTION DES MESSAGES
+# ========================
+
+def texte_depuis_html(contenu_html):
+    """Version texte d'un corps HTML (partie text/plain)"""
+    texte = re.sub(r'(?is)<(style|script|head)[^>]*>.*?</\1>', '', contenu_html)
+    texte = re.sub(r'(?is)<a\s[^>]*href="([^"]+)"[^>]*>(.*?)</a>', r'\2 (\1)', texte)
+    texte = re.sub(r'(?i)<br\s*/?>|</(p|div|h[1-6]|li|tr)>', '\n', texte)
+    texte = html.unescape(re.sub(r'<[^>]+>', '', texte))
+    lignes = [re.sub(r'[ \t]+', ' ', ligne).strip() for ligne in texte.splitlines()]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lignes)).strip()
+
+
+def rendre_contenu(email, rendus):
+    """(texte, html) d'un email ; `rendus` mémorise les rendus du lot"""
+    if not email.modele:
+        corps_html = email.corps_html
+        return email.corps_texte or texte_depuis_html(corps_html or ''), corps_html
+
+    cle = (email.modele, json.dumps(email.contexte or {}, sort_keys=True, default=str))
+    if cle not in rendus:
+        # Sans render_template : pas de processeur de contexte (ni requête ni utilisateur ici)
+        modele = current_app.jinja_env.get_template(email.modele)
+        corps_html = modele.render(**(email.contexte or {}))
+        rendus[cle] = (texte_depuis_html(corps_html), corps_html)
+    texte, corps_html = rendus[cle]
+    return email.corps_texte or texte, corps_html
+
+
+def construire_message(email, expediteur, texte, corps_html):
+    message = EmailMessage()
+    message['Subject'] = email.sujet
+    message['From'] = expediteur
+    message['To'] = ', '.join(email.destinataires)
+    if email.cc:
+        message['Cc'] = ', '.join(email.cc)
+    message['Message-ID'] = make_msgid(domain=expediteur.rsplit('@', 1)[-1].rstrip('>'))
+    message.set_content(texte or '')
+    if corps_html:
+        message.add_alternative(corps_html, subtype='html')
+    return message
+
+
+# ========================
+# CONNEXION SMTP
+# ========================
+
+def parametres_smtp(app):
+    config = app.config
+    expediteur = config.get('MAIL_DEFAULT_SENDER') or config.get('MAIL_USERNAME') or 'noreply@localhost'
+    if isinstance(expediteur, (tuple, list)):
+        adresse = expediteur[1]
+        expediteur = formataddr(tuple(expediteur))
+    else:
+        adresse = expediteur
+    utilisateur = config.get('MAIL_USERNAME') or None
+    mot_de_passe = config.get('MAIL_PASSWORD') or os.environ.get('GMAIL_APP_PASSWORD', '')
+    return {
+        'serveur': config.get('MAIL_SERVER', 'localhost'),
+        'port': int(config.get('MAIL_PORT', 25)),
+        'tls': bool(config.get('MAIL_USE_TLS')),
+        'ssl': bool(config.get('MAIL_USE_SSL')),
+        'utilisateur': utilisateur,
+        'mot_de_passe': mot_de_passe,
+        'expediteur': expediteur,
+        'adresse': adresse,
+        # Compte configuré sans mot de passe : rien ne part (comme l'ancien mode simulation)
+        'simulation': bool(utilisateur) and not mot_de_passe,
+        'timeout': config.get('EMAILS_SMTP_TIMEOUT', 30),
+    }
+
+
+class ConnexionSMTP:
+    """Connexion SMTP d'un traiteur, ouverte à la demande et réutilisée"""
+
+    def __init__(self, parametres, inactivite=INACTIVITE_SMTP):
+        self.parametres = parametres
+        self.inactivite = inactivite
+        self.nb_connexions = 0
+        self._smtp = None
+        self._dernier_usage = 0.0
+
+    def _ouvrir(self):
+        p = self.parametres
+        if p['ssl']:
+            smtp = smtplib.SMTP_SSL(p['serveur'], p['port'], timeout=p['timeout'])
+        else:
+            smtp = smtplib.SMTP(p['serveur'], p['port'], timeout=p['timeout'])
+            if p['tls']:
+                smtp.starttls()
+        if p['utilisateur']:
+            smtp.login(p['utilisateur'], p['mot_de_passe'])
+        self.nb_connexions += 1
+        logger.debug("Connexion SMTP ouverte vers %s:%s", p['serveur'], p['port'])
+        return smtp
+
+    def obtenir(self):
+        """Connexion prête : réutilisée si elle répond encore, sinon rouverte"""
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.fermer()
+        self._smtp = self._ouvrir()
+        return self._smtp
+
+    def envoyer(self, message, expediteur, destinataires):
+        smtp = self._smtp or self.obtenir()
+        try:
+            smtp.send_message(message, from_addr=expediteur, to_addrs=destinataires)
+        except smtplib.SMTPServerDisconnected:
+            # Connexion fermée par le serveur entre deux messages : une reconnexion
+            self.fermer()
+            self.obtenir().send_message(message, from_addr=expediteur, to_addrs=destinataires)
+        self._dernier_usage = time.monotonic()
+
+    def fermer_si_inactive(self):
+        if self._smtp is not None and time.monotonic() - self._dernier_usage > self.inactivite:
+            self.fermer()
+
+    def fermer(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                self._smtp.close()
+            except OSError:
+                pass
+        self._smtp = None
+
+
+# ========================
+# RÉSERVATION ET ENVOI
+# ========================
+
+def reserver_lot(detenteur, taille=TAILLE_LOT, duree_bail=DUREE_BAIL):
+    """Réserve atomiquement jusqu'à `taille` emails dus ; retourne les EmailSortant réservés"""
+    maintenant = datetime.utcnow()
+    ids = [i for (i,) in db.session.query(EmailSortant.id).filter(
+        EmailSortant.statut == EmailSortant.STATUT_EN_ATTENTE,
+        EmailSortant.prochain_essai <= maintenant,
+    ).order_by(EmailSortant.prochain_essai, EmailSortant.id).limit(taille)]
+    if not ids:
+        return []
+    db.session.execute(
+        update(EmailSortant)
+        .where(EmailSortant.id.in_(ids), EmailSortant.statut == EmailSortant.STATUT_EN_ATTENTE)
+        .values(statut=EmailSortant.STATUT_EN_COURS, detenteur=detenteur,
+                tentatives=EmailSortant.tentatives + 1,
+                prochain_essai=maintenant + timedelta(seconds=duree_bail))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    # Un autre traiteur a pu prendre une partie des lignes entre le choix et l'UPDATE
+    return EmailSortant.query.filter(
+        EmailSortant.id.in_(ids), EmailSortant.statut == EmailSortant.STATUT_EN_COURS,
+        EmailSortant.detenteur == detenteur,
+    ).order_by(EmailSortant.id).all()
+
+
+def reprendre_expires():
+    """Remet en file les lots dont le traiteur a disparu (bail expiré)"""
+    remis = db.session.execute(
+        update(EmailSortant)
+        .where(EmailSortant.statut == EmailSortant.STATUT_EN_COURS, EmailSortant.prochain_essai < datetime.utcnow())
+        .values(statut=EmailSortant.STATUT_EN_ATTENTE, detenteur=None, prochain_essai=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if remis:
+        logger.warning("%d email(s) remis en file (bail expiré)", remis)
+    return remis
+
+
+def delai_nouvel_essai(tentatives):
+    return min(DELAI_BASE * 2 ** max(tentatives - 1, 0), DELAI_MAX)
+
+
+def _erreur_definitive(erreur):
+    """Refus définitif du serveur (5xx) pour ce message : inutile de réessayer"""
+    if isinstance(erreur, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in erreur.recipients.values())
+    if isinstance(erreur, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(erreur, smtplib.SMTPResponseException) and erreur.smtp_code >= 500
+
+
+def _erreur_connexion(erreur):
+    """Erreur qui touche tout le lot (serveur injoignable, authentification refusée)"""
+    return isinstance(erreur, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                               smtplib.SMTPAuthenticationError, smtplib.SMTPHeloError, OSError))
+
+
+def envoyer_lot(emails, connexion, max_tentatives=MAX_TENTATIVES):
+    """Envoie des emails réservés sur une connexion partagée ; une validation pour tout le lot"""
+    parametres = connexion.parametres
+    rendus = {}
+    maintenant = datetime.utcnow()
+    resultats = {'envoyes': 0, 'reessais': 0, 'echecs': 0}
+
+    def reessayer(email, erreur):
+        if (email.tentatives or 1) >= max_tentatives:
+            echouer(email, erreur)
+            return
+        email.statut = EmailSortant.STATUT_EN_ATTENTE
+        email.prochain_essai = maintenant + timedelta(seconds=delai_nouvel_essai(email.tentatives or 1))
+        email.erreur = str(erreur)[:2000]
+        email.detenteur = None
+        resultats['reessais'] += 1
+
+    def echouer(email, erreur):
+        email.statut = EmailSortant.STATUT_ECHEC
+        email.erreur = str(erreur)[:2000]
+        email.detenteur = None
+        email.date_envoi = maintenant
+        resultats['echecs'] += 1
+
+    for position, email in enumerate(emails):
+        try:
+            texte, corps_html = rendre_contenu(email, rendus)
+            message = construire_message(email, parametres['expediteur'], texte, corps_html)
+        except Exception as e:
+            logger.exception("Rendu de l'email %s impossible", email.id)
+            echouer(email, e)
+            continue
+
+        destinataires = email.destinataires + (email.cc or []) + (email.bcc or [])
+        try:
+            if parametres['simulation']:
+                logger.info("📧 [SIMULATION] Email %s à %s: %s", email.id, ', '.join(email.destinataires), email.sujet)
+            else:
+                if position == 0 or connexion._smtp is None:
+                    connexion.obtenir()
+                connexion.envoyer(message, parametres['adresse'], destinataires)
+        except Exception as e:
+            if _erreur_definitive(e):
+                logger.warning("Email %s refusé définitivement: %s", email.id, e)
+                echouer(email, e)
+                continue
+            logger.warning("Envoi de l'email %s impossible (tentative %s): %s", email.id, email.tentatives, e)
+            reessayer(email, e)
+            if _erreur_connexion(e):
+                # Serveur indisponible : le reste du lot attendra aussi
+                connexion.fermer()
+                for suivant in emails[position + 1:]:
+                    reessayer(suivant, e)
+                break
+            continue
+
+        email.statut = EmailSortant.STATUT_SIMULE if parametres['simulation'] else EmailSortant.STATUT_ENVOYE
+        email.date_envoi = maintenant
+        email.erreur = None
+        email.detenteur = None
+        if email.sensible:
+            email.corps_texte = email.corps_html = email.contexte = None
+        resultats['envoyes'] += 1
+
+    db.session.commit()
+    if any(resultats.values()):
+        logger.info("Lot d'emails: %d envoyé(s), %d à réessayer, %d en échec (%d rendu(s) de modèle)",
+                    resultats['envoyes'], resultats['reessais'], resultats['echecs'], len(rendus))
+    return resultats
+
+
+# ========================
+# TRAITEURS
+# ========================
+
+class TraiteurEmails:
+    """Threads qui vident la boîte d'envoi, chacun avec sa connexion SMTP"""
+
+    def __init__(self, app, nb_traiteurs=None, taille_lot=None, intervalle=INTERVALLE_SCRUTATION):
+        self.app = app
+        self.nb_traiteurs = nb_traiteurs or app.config.get('EMAILS_TRAITEURS', 1)
+        self.taille_lot = taille_lot or app.config.get('EMAILS_LOT', TAILLE_LOT)
+        self.max_tentatives = app.config.get('EMAILS_MAX_TENTATIVES', MAX_TENTATIVES)
+        self.inactivite = app.config.get('EMAILS_SMTP_INACTIVITE', INACTIVITE_SMTP)
+        self.intervalle = intervalle
+        self._arret = threading.Event()
+        self._reveil = threading.Event()
+        self._threads = []
+
+    def demarrer(self):
+        from services.taches_planifiees import identifiant_processus
+
+        for numero in range(self.nb_traiteurs):
+            thread = threading.Thread(
+                target=self._boucle, args=(f"{identifiant_processus()}:email{numero}", numero == 0),
+                name=f'emails-{numero}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info("%d traiteur(s) d'emails démarré(s), lots de %d", self.nb_traiteurs, self.taille_lot)
+        return self
+
+    def reveiller(self):
+        self._reveil.set()
+
+    def arreter(self, delai=30):
+        self._arret.set()
+        self._reveil.set()
+        for thread in self._threads:
+            thread.join(delai)
+
+    def _boucle(self, detenteur, surveillant):
+        connexion = ConnexionSMTP(parametres_smtp(self.app), inactivite=self.inactivite)
+        try:
+            while not self._arret.is_set():
+                emails = []
+                with self.app.app_context():
+                    try:
+                        if surveillant:
+                            reprendre_expires()
+                        emails = reserver_lot(detenteur, self.taille_lot)
+                        if emails:
+                            envoyer_lot(emails, connexion, self.max_tentatives)
+                    except Exception:
+                        db.session.rollback()
+                        logger.exception("Erreur du traiteur d'emails %s", detenteur)
+                if not emails:
+                    connexion.fermer_si_inactive()
+                    self._reveil.wait(self.intervalle)
+                    self._reveil.clear()
+        finally:
+            connexion.fermer()
+
+
+def _reveiller_traiteur_embarque():
+    """En développement, démarre le traiteur dans le processus web au premier email validé"""
+    global _traiteur_embarque
+
+    if not current_app.config.get('EMAILS_TRAITEUR_EMBARQUE'):
+        return
+    with _verrou_embarque:
+        if _traiteur_embarque is None:
+            _traiteur_embarque = TraiteurEmails(current_app._get_current_object()).demarrer()
+    _traiteur_embarque.reveiller()
+
+
+# ========================
+# SERVEUR SMTP DE DÉBOGAGE
+# ========================
+
+class _SessionSMTP(socketserver.StreamRequestHandler):
+    """Sous-ensemble de SMTP suffisant pour smtplib (EHLO, MAIL, RCPT, DATA, NOOP, RSET, QUIT)"""
+
+    def repondre(self, ligne):
+        self.wfile.write(f"{ligne}\r\n".encode())
+
+    def handle(self):
+        serveur = self.server
+        serveur.nb_connexions += 1
+        expediteur, destinataires = None, []
+        self.repondre('220 localhost SMTP de débogage')
+        while True:
+            ligne = self.rfile.readline()
+            if not ligne:
+                return
+            commande = ligne.decode('utf-8', 'replace').strip()
+            verbe = commande[:4].upper()
+            if verbe == 'EHLO':
+                self.wfile.write(b"250-localhost\r\n250-8BITMIME\r\n250 SMTPUTF8\r\n")
+            elif verbe == 'HELO':
+                self.repondre('250 localhost')
+            elif verbe == 'MAIL':
+                expediteur, destinataires = commande.split(':', 1)[1].split()[0].strip('<>'), []
+                self.repondre('250 OK')
+            elif verbe == 'RCPT':
+                destinataires.append(commande.split(':', 1)[1].strip().strip('<>'))
+                self.repondre('250 OK')
+            elif verbe == 'DATA':
+                self.repondre('354 Fin par <CRLF>.<CRLF>')
+                lignes = []
+                while True:
+                    donnee = self.rfile.readline()
+                    if donnee in (b'.\r\n', b'.\n', b''):
+                        break
+                    lignes.append(donnee[1:] if donnee.startswith(b'..') else donnee)
+                serveur.recevoir(expediteur, destinataires, b''.join(lignes))
+                self.repondre('250 OK message reçu')
+            elif verbe in ('NOOP', 'RSET'):
+                if verbe == 'RSET':
+                    expediteur, destinataires = None, []
+                self.repondre('250 OK')
+            elif verbe == 'QUIT':
+                self.repondre('221 Au revoir')
+                return
+            else:
+                self.repondre('502 Commande non prise en charge')
+
+
+class ServeurSMTPDebug(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Serveur SMTP local qui garde les messages reçus en mémoire (et les
+    journalise) sans les transmettre. Pour les tests et le développement :
+
+        serveur = ServeurSMTPDebug(port=0).demarrer()   # port libre : serveur.port
+        ...
+        serveur.messages  # [(expéditeur, destinataires, email.message.EmailMessage)]
+        serveur.arreter()
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, hote='127.0.0.1', port=1025, afficher=False):
+        super().__init__((hote, port), _SessionSMTP)
+        self.messages = []
+        self.nb_connexions = 0
+        self.afficher = afficher
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def recevoir(self, expediteur, destinataires, donnees):
+        message = message_from_bytes(donnees, policy=policy.default)
+        self.messages.append((expediteur, destinataires, message))
+        logger.info("📧 [SMTP débogage] %s -> %s: %s", expediteur, ', '.join(destinataires), message['Subject'])
+        if self.afficher:
+            print(donnees.decode('utf-8', 'replace'))
+
+    def demarrer(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='smtp-debug', daemon=True)
+        self._thread.start()
+        return self
+
+    def arreter(self):
+        self.shutdown()
+        self.server_close()
+
+
+def init_emails_sortants(app):
+    """Réveil du traiteur embarqué après validation des emails mis en file"""
+    if not event.contains(Session, 'after_commit', _apres_commit):
+        event.listen(Session, 'after_commit', _apres_commit)
+        event.listen(Session, 'after_soft_rollback', _apres_rollback)
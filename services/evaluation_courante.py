@@ -0,0 +1,226 @@
+# services/evaluation_courante.py
+"""
+Projection « évaluation courante » des risques.
+
+La table risques_evaluation_courante contient, pour chaque risque, la
+dernière EvaluationRisque (created_at le plus récent, puis id le plus grand).
+Elle est maintenue par des événements SQLAlchemy sur EvaluationRisque et
+Risque, et peut être entièrement reconstruite avec la commande :
+
+    flask recalculer-evaluations-courantes
+"""
+import click
+from datetime import datetime
+from sqlalchemy import event, select, insert, delete, func, inspect as sa_inspect
+
+from models import db, Risque, EvaluationRisque, RisqueEvaluationCourante
+
+NIVEAUX_RISQUE = ['Critique', 'Élevé', 'Moyen', 'Faible']
+
+_t_eval = EvaluationRisque.__table__
+_t_courante = RisqueEvaluationCourante.__table__
+
+
+def _colonnes_source(table):
+    """Colonnes projetées depuis evaluations_risque (ou une sous-requête équivalente)"""
+    c = table.c
+    return [
+        c.risque_id,
+        c.id.label('evaluation_id'),
+        c.score_risque,
+        c.niveau_risque,
+        func.coalesce(c.impact_conf, c.impact_val, c.impact_pre).label('impact'),
+        func.coalesce(c.probabilite_conf, c.probabilite_val, c.probabilite_pre).label('probabilite'),
+        c.created_at.label('date_evaluation'),
+    ]
+
+
+_COLONNES_CIBLE = ['risque_id', 'evaluation_id', 'score_risque', 'niveau_risque',
+                   'impact', 'probabilite', 'date_evaluation']
+
+
+def _ordre_recent(table):
+    return (table.c.created_at.desc().nulls_last(), table.c.id.desc())
+
+
+def recalculer_risque(connection, risque_id):
+    """Recalcule la ligne de projection d'un risque sur la connexion donnée"""
+    if risque_id is None:
+        return
+
+    derniere = connection.execute(
+        select(*_colonnes_source(_t_eval))
+        .where(_t_eval.c.risque_id == risque_id)
+        .order_by(*_ordre_recent(_t_eval))
+        .limit(1)
+    ).mappings().first()
+
+    connection.execute(delete(_t_courante).where(_t_courante.c.risque_id == risque_id))
+    if derniere:
+        valeurs = dict(derniere)
+        valeurs['updated_at'] = datetime.utcnow()
+        connection.execute(insert(_t_courante).values(**valeurs))
+
+
+def recalculer_evaluations_courantes(risque_ids=None):
+    """
+    Reconstruit la projection en une seule requête ensembliste (ROW_NUMBER).
+
+    Si risque_ids est fourni, seuls ces risques sont recalculés.
+    Retourne le nombre de lignes de projection écrites.
+    """
+    rang = func.row_number().over(
+        partition_by=_t_eval.c.risque_id,
+        order_by=_ordre_recent(_t_eval)
+    ).label('rang')
+
+    classees = select(*_colonnes_source(_t_eval), rang)
+    if risque_ids is not None:
+        classees = classees.where(_t_eval.c.risque_id.in_(list(risque_ids)))
+    classees = classees.subquery('classees')
+
+    source = select(
+        *[classees.c[nom] for nom in _COLONNES_CIBLE],
+        func.current_timestamp().label('updated_at')
+    ).where(classees.c.rang == 1)
+
+    purge = delete(_t_courante)
+    if risque_ids is not None:
+        purge = purge.where(_t_courante.c.risque_id.in_(list(risque_ids)))
+
+    try:
+        db.session.execute(purge)
+        resultat = db.session.execute(
+            insert(_t_courante).from_select(_COLONNES_CIBLE + ['updated_at'], source)
+        )
+        db.session.commit()
+        return resultat.rowcount
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# ========================
+# REQUÊTES DE LECTURE
+# ========================
+
+def requete_evaluations_courantes(*entites, client_id=None, inclure_archives=False):
+    """
+    Requête de base jointe Risque ⟷ projection.
+
+    Sans entités, sélectionne RisqueEvaluationCourante. Le filtre client suit la
+    même règle que les routes : None = pas de filtre (super admin).
+    """
+    query = db.session.query(*(entites or (RisqueEvaluationCourante,))).select_from(
+        RisqueEvaluationCourante
+    ).join(Risque, Risque.id == RisqueEvaluationCourante.risque_id)
+
+    if not inclure_archives:
+        query = query.filter(Risque.is_archived == False)
+    if client_id is not None:
+        query = query.filter(Risque.client_id == client_id)
+    return query
+
+
+def repartition_niveaux(query=None, **filtres):
+    """Retourne {niveau: nombre} pour les évaluations courantes"""
+    if query is None:
+        query = requete_evaluations_courantes(
+            RisqueEvaluationCourante.niveau_risque,
+            func.count(RisqueEvaluationCourante.risque_id),
+            **filtres
+        )
+    lignes = query.filter(
+        RisqueEvaluationCourante.niveau_risque.isnot(None)
+    ).group_by(RisqueEvaluationCourante.niveau_risque).all()
+
+    repartition = {niveau: 0 for niveau in NIVEAUX_RISQUE}
+    for niveau, nombre in lignes:
+        repartition[niveau] = nombre
+    return repartition
+
+
+def evaluations_courantes_par_risque(risque_ids):
+    """Retourne {risque_id: EvaluationRisque} pour une liste de risques (une requête)"""
+    risque_ids = list(risque_ids)
+    if not risque_ids:
+        return {}
+    lignes = db.session.query(RisqueEvaluationCourante.risque_id, EvaluationRisque).join(
+        EvaluationRisque, EvaluationRisque.id == RisqueEvaluationCourante.evaluation_id
+    ).filter(RisqueEvaluationCourante.risque_id.in_(risque_ids)).all()
+    return {risque_id: evaluation for risque_id, evaluation in lignes}
+
+
+def evaluations_validees_par_risque(risque_ids):
+    """
+    Retourne {risque_id: EvaluationRisque} : dernière évaluation validée
+    (statut_validation 'valide') de chaque risque, en une requête. La
+    projection, elle, retient la dernière évaluation quel que soit son statut.
+    """
+    risque_ids = list(risque_ids)
+    if not risque_ids:
+        return {}
+    rang = func.row_number().over(
+        partition_by=_t_eval.c.risque_id,
+        order_by=_ordre_recent(_t_eval)
+    ).label('rang')
+    classees = select(_t_eval.c.id, rang).where(
+        _t_eval.c.risque_id.in_(risque_ids), _t_eval.c.statut_validation == 'valide'
+    ).subquery('classees')
+    evaluations = EvaluationRisque.query.join(classees, classees.c.id == EvaluationRisque.id).filter(
+        classees.c.rang == 1
+    ).all()
+    return {evaluation.risque_id: evaluation for evaluation in evaluations}
+
+
+# ========================
+# SYNCHRONISATION PAR ÉVÉNEMENTS
+# ========================
+
+def _apres_ecriture_evaluation(mapper, connection, target):
+    recalculer_risque(connection, target.risque_id)
+
+    # Si l'évaluation a changé de risque, recalculer aussi l'ancien
+    historique = sa_inspect(target).attrs.risque_id.history
+    for ancien_risque_id in historique.deleted or ():
+        if ancien_risque_id != target.risque_id:
+            recalculer_risque(connection, ancien_risque_id)
+
+
+def _apres_suppression_evaluation(mapper, connection, target):
+    recalculer_risque(connection, target.risque_id)
+
+
+def _avant_suppression_risque(mapper, connection, target):
+    connection.execute(delete(_t_courante).where(_t_courante.c.risque_id == target.id))
+
+
+_ECOUTEURS = [
+    (EvaluationRisque, 'after_insert', _apres_ecriture_evaluation),
+    (EvaluationRisque, 'after_update', _apres_ecriture_evaluation),
+    (EvaluationRisque, 'after_delete', _apres_suppression_evaluation),
+    (Risque, 'before_delete', _avant_suppression_risque),
+]
+
+
+def init_evaluation_courante(app):
+    """Enregistre les écouteurs, la commande CLI et amorce la projection si vide"""
+    for modele, nom, fonction in _ECOUTEURS:
+        if not event.contains(modele, nom, fonction):
+            event.listen(modele, nom, fonction)
+
+    @app.cli.command('recalculer-evaluations-courantes')
+    def recalculer_evaluations_courantes_command():
+        """Reconstruit la table risques_evaluation_courante."""
+        nombre = recalculer_evaluations_courantes()
+        click.echo(f"✅ {nombre} évaluations courantes recalculées")
+
+    with app.app_context():
+        try:
+            projection_vide = db.session.query(RisqueEvaluationCourante.risque_id).first() is None
+            if projection_vide and db.session.query(EvaluationRisque.id).first() is not None:
+                nombre = recalculer_evaluations_courantes()
+                print(f"✅ Projection des évaluations courantes initialisée ({nombre} risques)")
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️ Initialisation projection évaluations courantes impossible: {e}")
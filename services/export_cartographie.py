@@ -0,0 +1,350 @@
+# services/export_cartographie.py
+"""
+Exports tableur des risques (cartographies, /export/risques, matrice).
+
+Toutes les colonnes du détail viennent d'une seule requête pré-jointe,
+lue par lots (yield_per) :
+    Risque ⟕ évaluation courante (risques_evaluation_courante → EvaluationRisque)
+           ⟕ créateur / évaluateurs (User)
+           ⟕ premier KRI actif ⟕ sa dernière mesure (ROW_NUMBER)
+           ⟕ champs personnalisés priorite / cout_estime / date_echeance
+au lieu de 4 à 6 requêtes par risque via les relations paresseuses.
+Les feuilles sont écrites avec services/export_tableur.py.
+"""
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.orm import aliased
+
+from models import (
+    db, Cartographie, ChampPersonnaliseRisque, EvaluationRisque, KRI, MesureKRI, Risque,
+    RisqueEvaluationCourante, User
+)
+from services.export_tableur import Cellule, ClasseurFlux, reponse_csv, style_niveau
+
+TAILLE_LOT = 500
+NIVEAUX = ['Critique', 'Élevé', 'Moyen', 'Faible']
+A_EVALUER = 'À évaluer'
+
+COLONNES_DETAIL = [
+    'Référence', 'Intitulé', 'Description', 'Catégorie', 'Type de risque',
+    'Processus concerné', 'Cause racine', 'Conséquences',
+    'Date création', 'Créé par',
+    # Évaluation
+    'Impact', 'Probabilité', 'Niveau de maîtrise', 'Score', 'Niveau de risque',
+    'Date dernière évaluation', 'Évaluateur', 'Commentaire évaluation',
+    # Informations complémentaires
+    'KRI associé', 'Dernière mesure KRI', 'Statut KRI',
+    'Priorité', 'Coût estimé', 'Date échéance'
+]
+LARGEURS_DETAIL = [15, 40, 50, 15, 15, 20, 30, 30, 12, 15,
+                   10, 12, 12, 10, 15, 12, 15, 30, 20, 15, 12, 12, 15, 12]
+CHAMPS_PERSONNALISES = ('priorite', 'cout_estime', 'date_echeance')
+
+
+def niveau_depuis_score(impact, probabilite):
+    """Même barème que calculer_niveau_risque (app.py)"""
+    score = impact * probabilite
+    if score <= 4:
+        return 'Faible'
+    if score <= 9:
+        return 'Moyen'
+    if score <= 16:
+        return 'Élevé'
+    return 'Critique'
+
+
+def _valeur_finale(conf, val, pre):
+    """Hiérarchie triphasée : confirmation > validation > pré-évaluation (valeurs > 0)"""
+    return case((conf > 0, conf), (val > 0, val), else_=pre)
+
+
+def requete_detail_risques(cartographie_id=None, client_id=None):
+    """SELECT unique du détail des risques non archivés"""
+    evaluation = aliased(EvaluationRisque)
+    createur = aliased(User)
+    evaluateur_final, validateur, referent = aliased(User), aliased(User), aliased(User)
+
+    premier_kri = select(KRI.risque_id, func.min(KRI.id).label('kri_id'))\
+        .where(KRI.est_actif == True).group_by(KRI.risque_id).subquery('premier_kri')
+    kri = aliased(KRI)
+    mesures = select(
+        MesureKRI.kri_id, MesureKRI.valeur,
+        func.row_number().over(partition_by=MesureKRI.kri_id,
+                               order_by=(MesureKRI.date_mesure.desc(), MesureKRI.id.desc())).label('rang')
+    ).subquery('mesures')
+
+    # Alias nommés : la ligne résultat expose ligne.priorite, ligne.cout_estime...
+    champs = {nom: aliased(ChampPersonnaliseRisque, name=nom) for nom in CHAMPS_PERSONNALISES}
+
+    requete = select(
+        Risque.id, Risque.reference, Risque.intitule, Risque.description, Risque.categorie, Risque.type_risque,
+        Risque.processus_concerne, Risque.cause_racine, Risque.consequences, Risque.created_at,
+        createur.username.label('createur'), Cartographie.nom.label('cartographie'),
+        evaluation.id.label('evaluation_id'),
+        _valeur_finale(evaluation.impact_conf, evaluation.impact_val, evaluation.impact_pre).label('impact'),
+        _valeur_finale(evaluation.probabilite_conf, evaluation.probabilite_val,
+                       evaluation.probabilite_pre).label('probabilite'),
+        _valeur_finale(evaluation.niveau_maitrise_conf, evaluation.niveau_maitrise_val,
+                       evaluation.niveau_maitrise_pre).label('niveau_maitrise'),
+        evaluation.created_at.label('date_evaluation'),
+        evaluation.score_risque, evaluation.niveau_risque.label('niveau_enregistre'),
+        func.coalesce(evaluateur_final.username, validateur.username, referent.username).label('evaluateur'),
+        func.coalesce(evaluation.commentaire_confirmation, evaluation.commentaire_validation,
+                      evaluation.commentaire_pre_evaluation).label('commentaire'),
+        kri.nom.label('kri_nom'), kri.unite_mesure.label('kri_unite'),
+        mesures.c.valeur.label('kri_valeur'),
+        *champs.values(),
+    ).select_from(Risque)\
+        .outerjoin(Cartographie, Cartographie.id == Risque.cartographie_id)\
+        .outerjoin(createur, createur.id == Risque.created_by)\
+        .outerjoin(RisqueEvaluationCourante, RisqueEvaluationCourante.risque_id == Risque.id)\
+        .outerjoin(evaluation, evaluation.id == RisqueEvaluationCourante.evaluation_id)\
+        .outerjoin(evaluateur_final, evaluateur_final.id == evaluation.evaluateur_final_id)\
+        .outerjoin(validateur, validateur.id == evaluation.validateur_id)\
+        .outerjoin(referent, referent.id == evaluation.referent_pre_evaluation_id)\
+        .outerjoin(premier_kri, premier_kri.c.risque_id == Risque.id)\
+        .outerjoin(kri, kri.id == premier_kri.c.kri_id)\
+        .outerjoin(mesures, and_(mesures.c.kri_id == kri.id, mesures.c.rang == 1))
+    for nom, champ in champs.items():
+        requete = requete.outerjoin(champ, and_(champ.risque_id == Risque.id, champ.nom_technique == nom))
+
+    requete = requete.where(Risque.is_archived == False)
+    if cartographie_id is not None:
+        requete = requete.where(Risque.cartographie_id == cartographie_id)
+    if client_id is not None:
+        requete = requete.where(Risque.client_id == client_id)
+    return requete.order_by(Risque.reference, Risque.id)
+
+
+def lignes_risques(cartographie_id=None, client_id=None, taille_lot=TAILLE_LOT):
+    """Lignes du détail lues par lots (curseur côté serveur en PostgreSQL)"""
+    resultat = db.session.execute(
+        requete_detail_risques(cartographie_id, client_id).execution_options(yield_per=taille_lot)
+    )
+    for ligne in resultat:
+        yield ligne
+
+
+def _valeur_champ(champ):
+    return champ.get_valeur() if champ is not None else ''
+
+
+def niveau_calcule(ligne):
+    if ligne.evaluation_id is None or not (ligne.impact and ligne.probabilite):
+        return A_EVALUER
+    return niveau_depuis_score(ligne.impact, ligne.probabilite)
+
+
+def valeurs_detail(ligne):
+    """Valeurs d'une ligne du détail, avec les styles de l'export historique"""
+    a_evaluer = Cellule(A_EVALUER, 'a_evaluer')
+    valeurs = [
+        ligne.reference, ligne.intitule, ligne.description or '', ligne.categorie or '',
+        ligne.type_risque or '', ligne.processus_concerne or '', ligne.cause_racine or '',
+        ligne.consequences or '',
+        ligne.created_at.strftime('%d/%m/%Y') if ligne.created_at else '',
+        ligne.createur or '',
+    ]
+    if ligne.evaluation_id is not None:
+        niveau = niveau_calcule(ligne)
+        score = ligne.impact * ligne.probabilite if ligne.impact and ligne.probabilite else None
+        valeurs += [
+            Cellule(ligne.impact, 'centre') if ligne.impact else a_evaluer,
+            Cellule(ligne.probabilite, 'centre') if ligne.probabilite else a_evaluer,
+            Cellule(ligne.niveau_maitrise, 'centre') if ligne.niveau_maitrise else a_evaluer,
+            Cellule(score, 'centre') if score else a_evaluer,
+            Cellule('À ÉVALUER' if niveau == A_EVALUER else niveau, style_niveau(niveau)),
+            ligne.date_evaluation.strftime('%d/%m/%Y') if ligne.date_evaluation else '',
+            ligne.evaluateur or '',
+            ligne.commentaire or '',
+        ]
+    else:
+        valeurs += [a_evaluer] * 4 + [Cellule('À ÉVALUER', style_niveau(A_EVALUER)), '', '', '']
+
+    if ligne.kri_nom:
+        mesure = f"{ligne.kri_valeur} {ligne.kri_unite or ''}".strip() if ligne.kri_valeur is not None \
+            else "Pas de mesure"
+        valeurs += [ligne.kri_nom, mesure, 'Actif']
+    else:
+        valeurs += ['', '', '']
+
+    valeurs += [_valeur_champ(getattr(ligne, nom)) or '' for nom in CHAMPS_PERSONNALISES]
+    return valeurs
+
+
+def _nom_fichier(prefixe, nom, extension):
+    return f"{prefixe}_{(nom or '').replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M')}.{extension}"
+
+
+# ========================
+# CARTOGRAPHIE (4 FEUILLES)
+# ========================
+
+def export_cartographie_excel(cartographie):
+    """Détail, risques à évaluer, tableau de Bordeaux et statistiques en un seul parcours"""
+    nb_risques = db.session.query(func.count(Risque.id)).filter(
+        Risque.cartographie_id == cartographie.id, Risque.is_archived == False
+    ).scalar()
+    direction = cartographie.direction.nom if cartographie.direction else 'Non spécifiée'
+    service = cartographie.service.nom if cartographie.service else 'Non spécifié'
+    date_export = datetime.now().strftime('%d/%m/%Y à %H:%M')
+
+    classeur = ClasseurFlux()
+    detail = classeur.feuille(
+        'Détail Risques', COLONNES_DETAIL, LARGEURS_DETAIL,
+        bandeau=f"CARTOGRAPHIE DES RISQUES - {cartographie.nom.upper()}",
+        infos=[f"Direction : {direction}", f"Service : {service}", f"Date d'export : {date_export}",
+               f"Nombre de risques : {nb_risques}"],
+    )
+    a_evaluer = classeur.feuille(
+        'Risques à évaluer',
+        ['Référence', 'Intitulé', 'Catégorie', 'Date création', 'Créé par', 'Dernière évaluation'],
+        [20] * 6, bandeau="RISQUES À ÉVALUER",
+        infos=[f"Cartographie : {cartographie.nom}", f"Nombre total de risques : {nb_risques}"],
+    )
+    bordeaux = classeur.feuille('Tableau de Bordeaux', largeurs=[15, 40, 10, 12],
+                                bandeau="TABLEAU DE BORDEAUX - CLASSEMENT DES RISQUES",
+                                infos=[f"Cartographie : {cartographie.nom}"])
+    statistiques = classeur.feuille('Statistiques', largeurs=[25, 15, 15],
+                                    bandeau="STATISTIQUES DE LA CARTOGRAPHIE",
+                                    infos=[f"Cartographie : {cartographie.nom}", f"Direction : {direction}",
+                                           f"Service : {service}", f"Nombre total de risques : {nb_risques}",
+                                           f"Date d'export : {date_export}"])
+
+    par_niveau = {niveau: [] for niveau in NIVEAUX}
+    niveaux = Counter()
+    etats = Counter()
+
+    for ligne in lignes_risques(cartographie_id=cartographie.id):
+        detail.ajouter(valeurs_detail(ligne))
+
+        complete = ligne.evaluation_id is not None and ligne.impact and ligne.probabilite
+        etats['sans' if ligne.evaluation_id is None else 'complete' if complete else 'incomplete'] += 1
+        if not complete:
+            jamais = ligne.evaluation_id is None
+            a_evaluer.ajouter([Cellule(v, 'surligne') for v in (
+                ligne.reference, ligne.intitule, ligne.categorie or '',
+                ligne.created_at.strftime('%d/%m/%Y') if ligne.created_at else '', ligne.createur or '',
+            )] + [
+                Cellule('Jamais', 'alerte') if jamais else
+                Cellule(ligne.date_evaluation.strftime('%d/%m/%Y') if ligne.date_evaluation else '', 'surligne'),
+            ])
+
+        niveau_enregistre = ligne.niveau_enregistre if ligne.evaluation_id is not None else None
+        if not niveau_enregistre:
+            niveaux[A_EVALUER] += 1
+        elif niveau_enregistre in NIVEAUX:
+            niveaux[niveau_enregistre] += 1
+        if niveau_enregistre in par_niveau:
+            intitule = ligne.intitule or ''
+            par_niveau[niveau_enregistre].append(
+                (ligne.reference, intitule[:50] + "..." if len(intitule) > 50 else intitule, ligne.score_risque or 0)
+            )
+
+    if a_evaluer.nb_lignes <= 5:  # bandeau, 2 infos, ligne vide, en-tête
+        a_evaluer.ajouter([Cellule("✅ Tous les risques sont à jour !", 'succes')])
+
+    _ecrire_bordeaux(bordeaux, par_niveau)
+    _ecrire_statistiques(statistiques, niveaux, etats, nb_risques)
+
+    nom = _nom_fichier('risques', cartographie.nom, 'xlsx')
+    return classeur.reponse(nom)
+
+
+def _ecrire_bordeaux(feuille, par_niveau):
+    categories = [
+        ('ACTIONS PRIORITAIRES (Critiques)', 'Critique'),
+        ('SURVEILLANCE RENFORCÉE (Élevés)', 'Élevé'),
+        ('SURVEILLANCE COURANTE (Moyens)', 'Moyen'),
+        ('ACTIONS LIMITÉES (Faibles)', 'Faible'),
+    ]
+    for libelle, niveau in categories:
+        feuille.ajouter([Cellule(libelle, style_niveau(niveau))])
+        feuille.entete(['Référence', 'Intitulé', 'Score', 'Niveau'], style='sous_entete')
+        risques = sorted(par_niveau[niveau], key=lambda r: r[2], reverse=True)
+        for reference, intitule, score in risques:
+            feuille.ajouter([reference, intitule, score, Cellule(niveau, style_niveau(niveau))])
+        if not risques:
+            feuille.ajouter([Cellule("Aucun risque", 'discret')])
+        feuille.vide()
+        feuille.vide()
+
+
+def _ecrire_statistiques(feuille, niveaux, etats, total):
+    def pourcentage(nombre):
+        return f"{(nombre / total * 100) if total else 0:.1f}%"
+
+    feuille.entete(['NIVEAU DE RISQUE', 'NOMBRE', 'POURCENTAGE'])
+    for niveau in NIVEAUX + [A_EVALUER]:
+        feuille.ajouter([Cellule(niveau, style_niveau(niveau)), niveaux[niveau], pourcentage(niveaux[niveau])])
+    feuille.vide()
+    feuille.vide()
+    feuille.entete(['ÉTAT ÉVALUATION', 'NOMBRE', 'POURCENTAGE'])
+    for libelle, cle in (('Évaluations complètes', 'complete'), ('Évaluations incomplètes', 'incomplete'),
+                         ('Sans évaluation', 'sans')):
+        feuille.ajouter([libelle, etats[cle], pourcentage(etats[cle])])
+
+
+# ========================
+# LISTE DES RISQUES (/export/risques)
+# ========================
+
+COLONNES_LISTE = COLONNES_DETAIL[:2] + ['Cartographie'] + COLONNES_DETAIL[2:]
+
+
+def export_risques(format_sortie, client_id=None):
+    """Tous les risques non archivés (du client) en xlsx ou csv, lus en flux"""
+    def lignes():
+        for ligne in lignes_risques(client_id=client_id):
+            valeurs = valeurs_detail(ligne)
+            yield valeurs[:2] + [ligne.cartographie or ''] + valeurs[2:]
+
+    nom = _nom_fichier('risques', 'export', format_sortie)
+    if format_sortie == 'csv':
+        def avec_entete():
+            yield COLONNES_LISTE
+            yield from lignes()
+        return reponse_csv(avec_entete(), nom)
+
+    classeur = ClasseurFlux()
+    feuille = classeur.feuille('Risques', COLONNES_LISTE, LARGEURS_DETAIL[:2] + [25] + LARGEURS_DETAIL[2:])
+    for valeurs in lignes():
+        feuille.ajouter(valeurs)
+    return classeur.reponse(nom)
+
+
+# ========================
+# MATRICE (/cartographie/<id>/export/matrice?format=xlsx)
+# ========================
+
+def export_matrice_excel(cartographie, echelle=5):
+    """Grille probabilité × impact (nombre de risques par case) et liste des risques évalués"""
+    cases = Counter({
+        (impact, probabilite): nombre
+        for impact, probabilite, nombre in db.session.query(
+            RisqueEvaluationCourante.impact, RisqueEvaluationCourante.probabilite,
+            func.count(RisqueEvaluationCourante.risque_id)
+        ).join(Risque, Risque.id == RisqueEvaluationCourante.risque_id).filter(
+            Risque.cartographie_id == cartographie.id, Risque.is_archived == False
+        ).group_by(RisqueEvaluationCourante.impact, RisqueEvaluationCourante.probabilite)
+    })
+
+    classeur = ClasseurFlux()
+    matrice = classeur.feuille('Matrice', largeurs=[18] + [12] * echelle,
+                               bandeau=f"MATRICE DES RISQUES - {cartographie.nom.upper()}",
+                               infos=[f"Date d'export : {datetime.now().strftime('%d/%m/%Y à %H:%M')}",
+                                      "Lignes : probabilité, colonnes : impact (nombre de risques)"])
+    matrice.entete(['Probabilité \\ Impact'] + list(range(1, echelle + 1)))
+    for probabilite in range(echelle, 0, -1):
+        matrice.ajouter([Cellule(probabilite, 'sous_entete')] + [
+            Cellule(cases.get((impact, probabilite), 0), style_niveau(niveau_depuis_score(impact, probabilite)))
+            for impact in range(1, echelle + 1)
+        ])
+
+    liste = classeur.feuille('Risques', COLONNES_DETAIL, LARGEURS_DETAIL)
+    for ligne in lignes_risques(cartographie_id=cartographie.id):
+        liste.ajouter(valeurs_detail(ligne))
+
+    return classeur.reponse(_nom_fichier('matrice', cartographie.nom, 'xlsx'))
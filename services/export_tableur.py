@@ -0,0 +1,221 @@
+# services/export_tableur.py
+"""
+Moteur d'export tableur en flux (Excel et CSV).
+
+- Excel : classeur openpyxl en mode écriture seule (write_only) — chaque
+  ligne est sérialisée dès qu'elle est ajoutée, la mémoire ne dépend pas du
+  nombre de lignes. Les styles sont des NamedStyle partagés, enregistrés une
+  fois par classeur, au lieu d'objets Font/PatternFill par cellule.
+  Le fichier est écrit dans un fichier temporaire puis envoyé au client par
+  blocs ; le fichier est supprimé une fois la réponse envoyée.
+- CSV : générateur de lignes envoyé directement (stream_with_context),
+  séparateur « ; » et BOM UTF-8 pour Excel.
+
+Usage :
+
+    with ClasseurFlux() as classeur:
+        feuille = classeur.feuille('Risques', colonnes=['Réf', 'Niveau'], largeurs=[15, 12])
+        for risque in requete.yield_per(500):
+            feuille.ajouter([risque.reference, Cellule(niveau, style_niveau(niveau))])
+        return classeur.reponse('risques.xlsx')
+"""
+import csv
+import io
+import os
+import tempfile
+from collections import namedtuple
+from urllib.parse import quote
+
+from flask import Response, stream_with_context
+
+MIME_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+MIME_CSV = 'text/csv; charset=utf-8'
+TAILLE_BLOC = 64 * 1024
+
+# Valeur accompagnée du nom d'un style partagé
+Cellule = namedtuple('Cellule', ['valeur', 'style'])
+
+COULEURS_NIVEAU = {
+    'Faible': '27AE60',
+    'Moyen': 'F39C12',
+    'Élevé': 'E74C3C',
+    'Critique': '8B0000',
+    'À évaluer': '95A5A6',
+}
+
+
+def _definitions_styles():
+    from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+
+    def plein(couleur):
+        return PatternFill(start_color=couleur, end_color=couleur, fill_type='solid')
+
+    styles = [
+        NamedStyle('titre', font=Font(size=14, bold=True, color='FFFFFF'), fill=plein('2C3E50'),
+                   alignment=Alignment(horizontal='left', vertical='center')),
+        NamedStyle('entete', font=Font(bold=True, color='FFFFFF'), fill=plein('34495E'),
+                   alignment=Alignment(horizontal='center'), border=Border(bottom=Side(style='thin'))),
+        NamedStyle('sous_entete', font=Font(bold=True), fill=plein('ECF0F1')),
+        NamedStyle('centre', alignment=Alignment(horizontal='center')),
+        NamedStyle('a_evaluer', font=Font(color='FF0000', italic=True), fill=plein('FFEAA7'),
+                   alignment=Alignment(horizontal='center')),
+        NamedStyle('surligne', fill=plein('FFEAA7')),
+        NamedStyle('alerte', font=Font(color='E74C3C', bold=True), fill=plein('FFEAA7')),
+        NamedStyle('succes', font=Font(color='27AE60', bold=True)),
+        NamedStyle('discret', font=Font(italic=True, color='95A5A6')),
+    ]
+    for niveau, couleur in COULEURS_NIVEAU.items():
+        styles.append(NamedStyle(style_niveau(niveau), font=Font(color='FFFFFF', bold=True), fill=plein(couleur),
+                                 alignment=Alignment(horizontal='center')))
+    return styles
+
+
+def style_niveau(niveau):
+    """Nom du style partagé d'un niveau de risque (None si niveau inconnu)"""
+    if niveau == 'Non évalué':
+        niveau = 'À évaluer'
+    return f"niveau_{niveau}" if niveau in COULEURS_NIVEAU else None
+
+
+def _valeur_simple(valeur):
+    return valeur.valeur if isinstance(valeur, Cellule) else valeur
+
+
+# ========================
+# EXCEL
+# ========================
+
+class FeuilleFlux:
+    """Feuille en écriture seule : les lignes sont ajoutées dans l'ordre, sans retour arrière"""
+
+    def __init__(self, classeur, feuille):
+        self._classeur = classeur
+        self._feuille = feuille
+        self.nb_lignes = 0
+
+    def ajouter(self, valeurs):
+        from openpyxl.cell import WriteOnlyCell
+
+        ligne = []
+        for valeur in valeurs:
+            if isinstance(valeur, Cellule):
+                cellule = WriteOnlyCell(self._feuille, value=valeur.valeur)
+                if valeur.style:
+                    cellule.style = valeur.style
+                ligne.append(cellule)
+            else:
+                ligne.append(valeur)
+        self._feuille.append(ligne)
+        self.nb_lignes += 1
+
+    def vide(self):
+        self.ajouter([])
+
+    def entete(self, colonnes, style='entete'):
+        self.ajouter([Cellule(colonne, style) for colonne in colonnes])
+
+
+class ClasseurFlux:
+    """Classeur Excel en écriture seule, enregistré dans un fichier temporaire"""
+
+    def __init__(self):
+        from openpyxl import Workbook
+
+        self.classeur = Workbook(write_only=True)
+        for style in _definitions_styles():
+            self.classeur.add_named_style(style)
+        self._chemin = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Le fichier est supprimé par la réponse ; ici seulement en cas d'erreur
+        if exc[0] is not None and self._chemin and os.path.exists(self._chemin):
+            os.unlink(self._chemin)
+        return False
+
+    def feuille(self, titre, colonnes=None, largeurs=None, bandeau=None, infos=()):
+        """
+        Nouvelle feuille : bandeau (titre stylé), lignes d'information, puis
+        ligne d'en-tête. Les largeurs doivent être fixées avant toute ligne.
+        """
+        from openpyxl.utils import get_column_letter
+
+        feuille = self.classeur.create_sheet(title=titre[:31])
+        for index, largeur in enumerate(largeurs or [], 1):
+            feuille.column_dimensions[get_column_letter(index)].width = largeur
+
+        flux = FeuilleFlux(self, feuille)
+        if bandeau:
+            flux.ajouter([Cellule(bandeau, 'titre')])
+        for info in infos:
+            flux.ajouter([info])
+        if bandeau or infos:
+            flux.vide()
+        if colonnes:
+            flux.entete(colonnes)
+        return flux
+
+    def enregistrer(self, destination=None):
+        """Écrit le classeur (fichier temporaire par défaut) et retourne son chemin"""
+        if destination is None:
+            descripteur, destination = tempfile.mkstemp(prefix='export_', suffix='.xlsx')
+            os.close(descripteur)
+        self._chemin = destination
+        self.classeur.save(destination)
+        return destination
+
+    def reponse(self, nom_fichier):
+        return reponse_fichier(self.enregistrer(), nom_fichier, MIME_XLSX)
+
+
+def disposition(nom_fichier):
+    """En-tête Content-Disposition (noms accentués encodés selon RFC 5987)"""
+    return f"attachment; filename*=UTF-8''{quote(nom_fichier)}"
+
+
+def reponse_fichier(chemin, nom_fichier, mimetype, supprimer=True):
+    """Envoie un fichier par blocs ; le supprime une fois la réponse envoyée"""
+    def generer():
+        try:
+            with open(chemin, 'rb') as fichier:
+                while True:
+                    bloc = fichier.read(TAILLE_BLOC)
+                    if not bloc:
+                        break
+                    yield bloc
+        finally:
+            if supprimer and os.path.exists(chemin):
+                os.unlink(chemin)
+
+    return Response(generer(), mimetype=mimetype, headers={
+        'Content-Disposition': disposition(nom_fichier),
+        'Content-Length': str(os.path.getsize(chemin)),
+    })
+
+
+# ========================
+# CSV
+# ========================
+
+def lignes_csv(lignes, delimiteur=';'):
+    """Encode un itérable de lignes en blocs CSV (UTF-8 avec BOM)"""
+    tampon = io.StringIO()
+    ecrivain = csv.writer(tampon, delimiter=delimiteur, quoting=csv.QUOTE_ALL)
+    yield '\ufeff'.encode('utf-8')
+    for ligne in lignes:
+        ecrivain.writerow([_valeur_simple(v) if v is not None else '' for v in ligne])
+        if tampon.tell() >= TAILLE_BLOC:
+            yield tampon.getvalue().encode('utf-8')
+            tampon.seek(0)
+            tampon.truncate()
+    if tampon.tell():
+        yield tampon.getvalue().encode('utf-8')
+
+
+def reponse_csv(lignes, nom_fichier, delimiteur=';'):
+    """Réponse CSV en flux ; `lignes` peut être un générateur lisant la base"""
+    return Response(stream_with_context(lignes_csv(lignes, delimiteur)), mimetype=MIME_CSV, headers={
+        'Content-Disposition': disposition(nom_fichier),
+    })
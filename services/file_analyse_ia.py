@@ -0,0 +1,456 @@
+# services/file_analyse_ia.py
+"""
+File d'attente des analyses IA.
+
+Les routes web ne contactent plus le fournisseur IA (10 à 60 s par appel) :
+elles créent une ligne AnalyseIA « en_attente » et rendent la main. Des
+traiteurs en arrière-plan (threads) prennent les analyses une à une :
+
+    en_attente -> en_cours -> termine
+                          \\-> echec (après MAX_TENTATIVES)
+
+- La table analyse_ia sert de file : une analyse est réservée par un UPDATE
+  conditionnel (statut = 'en_attente'), sûr entre threads et entre processus.
+- Concurrence bornée : IA_TRAITEURS threads par processus.
+- Équité entre clients : le prochain travail est pris chez le client qui a le
+  moins d'analyses en cours (au plus IA_LIMITE_PAR_CLIENT), puis par ancienneté ;
+  un client qui soumet 50 analyses ne bloque pas les autres.
+- Une analyse « en_cours » dont le traiteur a disparu (redémarrage) est remise
+  en file après DELAI_EXPIRATION.
+- Progression (pourcentage + étape) consultable par
+  /api/analyse-ia/<id>/statut pour les pages /audit/<id>/analyses-ia.
+- Un audit inchangé depuis une analyse terminée est servi immédiatement par
+  le cache (services/consommation_ia.py), sans passer par la file.
+
+Les traiteurs tournent dans worker.py ; en développement
+(IA_TRAITEUR_EMBARQUE) ils démarrent dans le processus web à la première
+soumission. IA_FOURNISSEUR=simule permet de tout exécuter hors ligne.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, inspect, text, update
+
+from models import db, AnalyseIA, Audit, Notification
+from services.consommation_ia import BudgetIADepasse, enregistrer_consommation
+
+logger = logging.getLogger(__name__)
+
+NB_TRAITEURS = 2
+LIMITE_PAR_CLIENT = 1
+MAX_TENTATIVES = 2
+DELAI_EXPIRATION = 900      # secondes
+INTERVALLE_SCRUTATION = 3   # secondes
+
+STATUTS_ACTIFS = (AnalyseIA.STATUT_EN_ATTENTE, AnalyseIA.STATUT_EN_COURS)
+
+# Colonnes ajoutées à une table analyse_ia existante (create_all ne modifie pas les tables)
+COLONNES_FILE = (
+    ('statut', "VARCHAR(20) DEFAULT 'termine'"),
+    ('progression', 'INTEGER DEFAULT 100'),
+    ('etape', 'VARCHAR(100)'),
+    ('erreur', 'TEXT'),
+    ('tentatives', 'INTEGER DEFAULT 0'),
+    ('detenteur', 'VARCHAR(100)'),
+    ('date_debut', 'TIMESTAMP'),
+    ('date_fin', 'TIMESTAMP'),
+    ('empreinte', 'VARCHAR(64)'),
+    ('jetons', 'INTEGER DEFAULT 0'),
+)
+
+_traiteur_embarque = None
+_verrou_embarque = threading.Lock()
+
+
+# ========================
+# SCHÉMA
+# ========================
+
+def assurer_colonnes_file():
+    """Ajoute les colonnes de la file à une table analyse_ia créée avant elle"""
+    table = AnalyseIA.__tablename__
+    existantes = {c['name'] for c in inspect(db.engine).get_columns(table)}
+    ajoutees = [nom for nom, _ in COLONNES_FILE if nom not in existantes]
+    if not ajoutees:
+        return []
+    with db.engine.begin() as connexion:
+        for nom, definition in COLONNES_FILE:
+            if nom in ajoutees:
+                connexion.execute(text(f"ALTER TABLE {table} ADD COLUMN {nom} {definition}"))
+        for colonne in ('statut', 'empreinte'):
+            connexion.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{colonne} ON {table} ({colonne})"))
+    logger.info("Colonnes de file ajoutées à %s: %s", table, ', '.join(ajoutees))
+    return ajoutees
+
+
+# ========================
+# SOUMISSION ET SUIVI
+# ========================
+
+def soumettre_analyse(audit_id, type_analyse, user_id=None, client_id=None):
+    """
+    Met une analyse en file. Retourne (analyse, creee) : une analyse du même
+    type déjà en file ou en cours pour cet audit est réutilisée.
+    """
+    existante = AnalyseIA.query.filter(
+        AnalyseIA.audit_id == audit_id,
+        AnalyseIA.type_analyse == type_analyse,
+        AnalyseIA.statut.in_(STATUTS_ACTIFS)
+    ).first()
+    if existante is not None:
+        return existante, False
+
+    en_cache = _resultat_en_cache(audit_id, type_analyse)
+    if en_cache is not None:
+        source, empreinte, client_audit = en_cache
+        service = _service_ia()
+        resultat = service.resultat_depuis_cache(source, empreinte)
+        maintenant = datetime.utcnow()
+        analyse = AnalyseIA(
+            audit_id=audit_id, type_analyse=type_analyse, resultat=resultat,
+            score_confiance=source.score_confiance, created_by=user_id, client_id=client_id,
+            statut=AnalyseIA.STATUT_TERMINE, progression=100, etape='Terminée (cache)',
+            tentatives=0, empreinte=empreinte, jetons=0, date_debut=maintenant, date_fin=maintenant,
+        )
+        db.session.add(analyse)
+        db.session.commit()
+        enregistrer_consommation(client_audit, service.modele, fournisseur=service.fournisseur, depuis_cache=True)
+        logger.info("Analyse IA de l'audit %s servie par le cache (analyse %s)", audit_id, source.id)
+        return analyse, True
+
+    analyse = AnalyseIA(
+        audit_id=audit_id,
+        type_analyse=type_analyse,
+        resultat={},
+        score_confiance=0.0,
+        created_by=user_id,
+        client_id=client_id,
+        statut=AnalyseIA.STATUT_EN_ATTENTE,
+        progression=0,
+        etape="En file d'attente",
+        tentatives=0,
+    )
+    db.session.add(analyse)
+    db.session.commit()
+
+    _reveiller_traiteur_embarque()
+    return analyse, True
+
+
+def _resultat_en_cache(audit_id, type_analyse):
+    """(analyse source, empreinte, client de l'audit) si l'audit n'a pas changé depuis une analyse terminée"""
+    audit = db.session.get(Audit, audit_id)
+    if audit is None:
+        return None
+    try:
+        source, empreinte = _service_ia().chercher_en_cache(audit, type_analyse)
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Recherche du cache IA impossible pour l'audit %s: %s", audit_id, e)
+        return None
+    return (source, empreinte, audit.client_id) if source is not None else None
+
+
+def position_dans_file(analyse):
+    """
+    Rang de l'analyse dans l'ordre de réservation de _choisir_prochaine, si
+    aucune analyse ne se terminait d'ici là : chaque réservation va au client
+    le moins chargé (en cours + déjà servis), puis à la plus ancienne. La
+    n-ième analyse en file d'un client passe donc après les analyses de rang
+    inférieur des autres clients, quelle que soit leur ancienneté.
+    """
+    if analyse.statut != AnalyseIA.STATUT_EN_ATTENTE:
+        return 0
+    charge = _en_cours_par_client()
+    cles, cle_analyse = [], None
+    for client_id, analyse_id in db.session.query(AnalyseIA.client_id, AnalyseIA.id)\
+            .filter(AnalyseIA.statut == AnalyseIA.STATUT_EN_ATTENTE).order_by(AnalyseIA.id):
+        cle = (charge.get(client_id, 0), analyse_id)
+        charge[client_id] = cle[0] + 1
+        cles.append(cle)
+        if analyse_id == analyse.id:
+            cle_analyse = cle
+    if cle_analyse is None:  # réservée entre-temps
+        return 0
+    return sum(1 for cle in cles if cle < cle_analyse) + 1
+
+
+def etat_analyse(analyse):
+    """Représentation JSON de l'avancement d'une analyse"""
+    return {
+        'id': analyse.id,
+        'audit_id': analyse.audit_id,
+        'type_analyse': analyse.type_analyse,
+        'statut': analyse.statut or AnalyseIA.STATUT_TERMINE,
+        'progression': analyse.progression if analyse.progression is not None else 100,
+        'etape': analyse.etape,
+        'erreur': analyse.erreur,
+        'tentatives': analyse.tentatives or 0,
+        'position': position_dans_file(analyse),
+        'score_confiance': analyse.score_confiance,
+        'date_debut': analyse.date_debut.isoformat() if analyse.date_debut else None,
+        'date_fin': analyse.date_fin.isoformat() if analyse.date_fin else None,
+    }
+
+
+# ========================
+# RÉSERVATION
+# ========================
+
+def _en_cours_par_client():
+    return dict(db.session.query(AnalyseIA.client_id, func.count(AnalyseIA.id))
+                .filter(AnalyseIA.statut == AnalyseIA.STATUT_EN_COURS)
+                .group_by(AnalyseIA.client_id).all())
+
+
+def _choisir_prochaine(limite_par_client):
+    """Plus ancienne analyse en file du client le moins servi (sous sa limite)"""
+    en_cours = _en_cours_par_client()
+    candidats = db.session.query(AnalyseIA.client_id, func.min(AnalyseIA.id))\
+        .filter(AnalyseIA.statut == AnalyseIA.STATUT_EN_ATTENTE)\
+        .group_by(AnalyseIA.client_id).all()
+
+    eligibles = [(en_cours.get(client_id, 0), premier_id)
+                 for client_id, premier_id in candidats
+                 if en_cours.get(client_id, 0) < limite_par_client]
+    return min(eligibles)[1] if eligibles else None
+
+
+def reserver_prochaine(detenteur, limite_par_client=LIMITE_PAR_CLIENT):
+    """Réserve atomiquement la prochaine analyse ; retourne son id ou None"""
+    for _ in range(3):  # un autre traiteur peut la prendre entre le choix et l'UPDATE
+        analyse_id = _choisir_prochaine(limite_par_client)
+        if analyse_id is None:
+            return None
+        prise = db.session.execute(
+            update(AnalyseIA)
+            .where(AnalyseIA.id == analyse_id, AnalyseIA.statut == AnalyseIA.STATUT_EN_ATTENTE)
+            .values(statut=AnalyseIA.STATUT_EN_COURS, detenteur=detenteur, date_debut=datetime.utcnow(),
+                    tentatives=func.coalesce(AnalyseIA.tentatives, 0) + 1,
+                    progression=5, etape='Démarrage', erreur=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if prise:
+            return analyse_id
+    return None
+
+
+def reprendre_expirees(delai=DELAI_EXPIRATION, max_tentatives=MAX_TENTATIVES):
+    """Remet en file (ou en échec) les analyses dont le traiteur a disparu"""
+    limite = datetime.utcnow() - timedelta(seconds=delai)
+    expirees = (AnalyseIA.statut == AnalyseIA.STATUT_EN_COURS, AnalyseIA.date_debut < limite)
+    remises = db.session.execute(
+        update(AnalyseIA).where(*expirees, func.coalesce(AnalyseIA.tentatives, 0) < max_tentatives)
+        .values(statut=AnalyseIA.STATUT_EN_ATTENTE, etape="Remise en file (délai dépassé)", detenteur=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    abandonnees = db.session.execute(
+        update(AnalyseIA).where(*expirees)
+        .values(statut=AnalyseIA.STATUT_ECHEC, etape='Échec', erreur='Délai de traitement dépassé',
+                date_fin=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if remises or abandonnees:
+        logger.warning("Analyses IA expirées: %d remise(s) en file, %d en échec", remises, abandonnees)
+    return remises, abandonnees
+
+
+# ========================
+# EXÉCUTION
+# ========================
+
+_service = None
+
+
+def _service_ia():
+    global _service
+    if _service is None:
+        from services.analyse_ia import ServiceAnalyseIA
+        _service = ServiceAnalyseIA()
+    return _service
+
+
+def _en_dict(resultat):
+    if isinstance(resultat, dict):
+        return resultat
+    if hasattr(resultat, 'to_dict'):
+        return resultat.to_dict()
+    if hasattr(resultat, 'resultat') and isinstance(resultat.resultat, dict):
+        return resultat.resultat
+    return {'analyse': str(resultat)}
+
+
+def _mettre_a_jour(analyse_id, detenteur, **valeurs):
+    """
+    Écrit l'état d'une analyse tant que ce traiteur la détient (comme la
+    réservation) : une analyse expirée puis reprise par un autre traiteur, ou
+    déjà terminée, n'est pas écrasée. Retourne True si la ligne a été écrite.
+    """
+    ecrite = db.session.execute(
+        update(AnalyseIA)
+        .where(AnalyseIA.id == analyse_id, AnalyseIA.statut == AnalyseIA.STATUT_EN_COURS,
+               AnalyseIA.detenteur == detenteur)
+        .values(**valeurs)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if not ecrite:
+        logger.warning("Analyse IA %s reprise par un autre traiteur : résultat de %s ignoré",
+                       analyse_id, detenteur)
+    return bool(ecrite)
+
+
+def executer_analyse(analyse_id, max_tentatives=MAX_TENTATIVES):
+    """Exécute une analyse réservée (statut en_cours) et enregistre le résultat"""
+    analyse = db.session.get(AnalyseIA, analyse_id)
+    audit_id, type_analyse, user_id = analyse.audit_id, analyse.type_analyse, analyse.created_by
+    tentatives, client_id = analyse.tentatives or 1, analyse.client_id
+    detenteur = analyse.detenteur
+
+    def progression(pourcentage, etape):
+        db.session.execute(
+            update(AnalyseIA)
+            .where(AnalyseIA.id == analyse_id, AnalyseIA.statut == AnalyseIA.STATUT_EN_COURS,
+                   AnalyseIA.detenteur == detenteur)
+            .values(progression=int(pourcentage), etape=str(etape)[:100])
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    try:
+        resultat = _en_dict(_service_ia().analyser_audit(
+            audit_id=audit_id, type_analyse=type_analyse, user_id=user_id, progression=progression
+        ))
+    except BudgetIADepasse as e:
+        # Inutile de réessayer avant le mois prochain
+        db.session.rollback()
+        logger.warning("Analyse IA %s refusée: %s", analyse_id, e)
+        if _mettre_a_jour(analyse_id, detenteur, statut=AnalyseIA.STATUT_ECHEC, etape='Budget IA épuisé',
+                          erreur=str(e), date_fin=datetime.utcnow()):
+            _notifier(analyse_id, audit_id, user_id, client_id, succes=False)
+        return False
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Analyse IA %s en erreur (tentative %s)", analyse_id, tentatives)
+        if tentatives < max_tentatives:
+            _mettre_a_jour(analyse_id, detenteur, statut=AnalyseIA.STATUT_EN_ATTENTE,
+                           etape='Nouvelle tentative en file', erreur=str(e)[:2000], detenteur=None)
+        elif _mettre_a_jour(analyse_id, detenteur, statut=AnalyseIA.STATUT_ECHEC, etape='Échec',
+                            erreur=str(e)[:2000], date_fin=datetime.utcnow()):
+            _notifier(analyse_id, audit_id, user_id, client_id, succes=False)
+        return False
+
+    metadata = resultat.get('metadata', {})
+    score = metadata.get('score_confiance', 75.0)
+    if not _mettre_a_jour(analyse_id, detenteur, statut=AnalyseIA.STATUT_TERMINE, resultat=resultat,
+                          score_confiance=score, progression=100,
+                          etape='Terminée (cache)' if metadata.get('cache') else 'Terminée',
+                          erreur=None, date_fin=datetime.utcnow(), empreinte=metadata.get('empreinte'),
+                          jetons=metadata.get('tokens') or 0):
+        return False
+    _notifier(analyse_id, audit_id, user_id, client_id, succes=True)
+    logger.info("Analyse IA %s terminée (audit %s, score %s)", analyse_id, audit_id, score)
+    return True
+
+
+def _notifier(analyse_id, audit_id, user_id, client_id, succes):
+    if not user_id:
+        return
+    try:
+        db.session.add(Notification(
+            type_notification=Notification.TYPE_SUCCESS if succes else Notification.TYPE_ERROR,
+            titre='Analyse IA terminée' if succes else "Échec de l'analyse IA",
+            message=("L'analyse IA de l'audit est disponible." if succes
+                     else "L'analyse IA de l'audit n'a pas pu aboutir."),
+            destinataire_id=user_id,
+            entite_type='analyse_ia',
+            entite_id=analyse_id,
+            client_id=client_id,
+            donnees_supplementaires={'audit_id': audit_id},
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Notification de fin d'analyse IA impossible: %s", e)
+
+
+# ========================
+# TRAITEURS
+# ========================
+
+class TraiteurAnalysesIA:
+    """Pool borné de threads qui vident la file des analyses IA"""
+
+    def __init__(self, app, nb_traiteurs=None, limite_par_client=None, intervalle=INTERVALLE_SCRUTATION):
+        self.app = app
+        self.nb_traiteurs = nb_traiteurs or app.config.get('IA_TRAITEURS', NB_TRAITEURS)
+        self.limite_par_client = limite_par_client or app.config.get('IA_LIMITE_PAR_CLIENT', LIMITE_PAR_CLIENT)
+        self.intervalle = intervalle
+        self._arret = threading.Event()
+        self._reveil = threading.Event()
+        self._threads = []
+
+    def demarrer(self):
+        from services.taches_planifiees import identifiant_processus
+
+        for numero in range(self.nb_traiteurs):
+            thread = threading.Thread(
+                target=self._boucle, args=(f"{identifiant_processus()}:ia{numero}", numero == 0),
+                name=f'analyse-ia-{numero}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info("%d traiteur(s) d'analyses IA démarré(s), %d par client",
+                    self.nb_traiteurs, self.limite_par_client)
+        return self
+
+    def reveiller(self):
+        self._reveil.set()
+
+    def arreter(self, delai=30):
+        self._arret.set()
+        self._reveil.set()
+        for thread in self._threads:
+            thread.join(delai)
+
+    def _boucle(self, detenteur, surveillant):
+        while not self._arret.is_set():
+            analyse_id = None
+            with self.app.app_context():
+                try:
+                    if surveillant:
+                        reprendre_expirees()
+                    analyse_id = reserver_prochaine(detenteur, self.limite_par_client)
+                    if analyse_id is not None:
+                        executer_analyse(analyse_id)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Erreur du traiteur d'analyses IA %s", detenteur)
+            if analyse_id is None:
+                self._reveil.wait(self.intervalle)
+                self._reveil.clear()
+
+
+def _reveiller_traiteur_embarque():
+    """En développement, démarre les traiteurs dans le processus web à la première soumission"""
+    global _traiteur_embarque
+    from flask import current_app
+
+    if not current_app.config.get('IA_TRAITEUR_EMBARQUE'):
+        return
+    with _verrou_embarque:
+        if _traiteur_embarque is None:
+            _traiteur_embarque = TraiteurAnalysesIA(current_app._get_current_object()).demarrer()
+    _traiteur_embarque.reveiller()
+
+
+def init_file_analyse_ia(app):
+    """Ajoute les colonnes de file si nécessaire"""
+    with app.app_context():
+        try:
+            assurer_colonnes_file()
+        except Exception as e:
+            logger.error("Colonnes de la file d'analyses IA non vérifiées: %s", e)
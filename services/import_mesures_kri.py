@@ -0,0 +1,361 @@
+# services/import_mesures_kri.py
+"""
+Import groupé de mesures d'indicateurs (CSV, XLSX ou JSON).
+
+Un fichier peut porter des mesures de plusieurs indicateurs. Colonnes :
+kri_id (ou kri : nom de l'indicateur), date_mesure (ou date), valeur et,
+en option, commentaire.
+
+- Chaque ligne est validée ; les lignes invalides sont listées dans le
+  rapport avec leur numéro (ligne du fichier ou rang JSON) sans bloquer
+  les autres.
+- Les mesures sont écrites par lots de TAILLE_LOT, une transaction par
+  lot : la clé est (kri_id, date_mesure). Une mesure existante dont la
+  valeur ou le commentaire diffère est mise à jour, une mesure identique
+  est laissée telle quelle : renvoyer le même fichier ne crée aucun doublon.
+- Insertions et mises à jour sont des instructions groupées : les agrégats
+  (series_kri) et les états (analyse_kri) suivent via leurs écouteurs.
+- Les seuils sont vérifiés une fois, à la fin, pour tous les indicateurs
+  touchés (analyse_kri.rafraichir puis signaler_alertes).
+
+    rapport = importer(lire_fichier(flux, 'mesures.csv'), client_id=3, utilisateur_id=12)
+"""
+import csv
+import io
+import json
+import logging
+import math
+import os
+from datetime import date, datetime, timezone
+
+from sqlalchemy import insert, select, true, update
+
+from models import db, KRI, MesureKRI
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'xlsx', 'json')
+TAILLE_LOT = 500
+ERREURS_MAX = 1000  # au-delà, le rapport ne liste plus les erreurs (elles restent comptées)
+
+# Noms de colonnes acceptés (en minuscules, espaces et tirets normalisés en _)
+COLONNES = {
+    'kri_id': ('kri_id', 'id_kri', 'indicateur_id'),
+    'kri': ('kri', 'indicateur', 'nom_kri'),
+    'date_mesure': ('date_mesure', 'date'),
+    'valeur': ('valeur', 'value'),
+    'commentaire': ('commentaire', 'comment'),
+}
+FORMATS_DATE = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%d/%m/%Y', '%d/%m/%Y %H:%M')
+
+
+class ErreurImport(ValueError):
+    """Fichier illisible ou format non pris en charge (le lot entier est refusé)"""
+
+
+# ========================
+# LECTURE DES FICHIERS
+# ========================
+
+def detecter_format(nom_fichier=None, type_contenu=None):
+    extension = os.path.splitext(nom_fichier or '')[1].lower().lstrip('.')
+    if extension in FORMATS:
+        return extension
+    type_contenu = (type_contenu or '').lower()
+    if 'json' in type_contenu:
+        return 'json'
+    if 'csv' in type_contenu or type_contenu.startswith('text/'):
+        return 'csv'
+    if 'spreadsheetml' in type_contenu:
+        return 'xlsx'
+    raise ErreurImport(f"Format non pris en charge (attendu : {', '.join(FORMATS)})")
+
+
+def _cle_colonne(nom):
+    nom = str(nom or '').strip().lower().replace(' ', '_').replace('-', '_')
+    for cle, alias in COLONNES.items():
+        if nom in alias:
+            return cle
+    return None
+
+
+def _lignes_tableau(entetes, lignes, premiere_ligne):
+    cles = [_cle_colonne(entete) for entete in entetes]
+    if 'valeur' not in cles or 'date_mesure' not in cles or not ({'kri_id', 'kri'} & set(cles)):
+        raise ErreurImport("Colonnes requises : kri_id (ou kri), date_mesure (ou date), valeur")
+    for numero, cellules in enumerate(lignes, start=premiere_ligne):
+        if not any(c not in (None, '') for c in cellules):
+            continue
+        yield numero, {cle: cellule for cle, cellule in zip(cles, cellules) if cle}
+
+
+def _lire_csv(flux):
+    texte = flux.read()
+    if isinstance(texte, bytes):
+        texte = texte.decode('utf-8-sig')
+    try:
+        dialecte = csv.Sniffer().sniff(texte[:4096], delimiters=';,\t')
+    except csv.Error:
+        dialecte = csv.excel
+    lecteur = csv.reader(io.StringIO(texte), dialecte)
+    entetes = next(lecteur, None)
+    if entetes is None:
+        return iter(())
+    return _lignes_tableau(entetes, lecteur, premiere_ligne=2)
+
+
+def _lire_xlsx(flux):
+    from openpyxl import load_workbook
+    try:
+        classeur = load_workbook(flux, read_only=True, data_only=True)
+    except Exception as e:
+        raise ErreurImport(f"Classeur illisible : {e}")
+    lignes = classeur.worksheets[0].iter_rows(values_only=True)
+    entetes = next(lignes, None)
+    if entetes is None:
+        return iter(())
+    return _lignes_tableau(entetes, lignes, premiere_ligne=2)
+
+
+def _lire_json(flux):
+    try:
+        donnees = json.load(flux)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ErreurImport(f"JSON invalide : {e}")
+    if isinstance(donnees, dict):
+        donnees = donnees.get('mesures')
+    if not isinstance(donnees, list):
+        raise ErreurImport('JSON attendu : une liste de mesures ou {"mesures": [...]}')
+    return _lignes_json(donnees)
+
+
+def _lignes_json(donnees):
+    for numero, objet in enumerate(donnees, start=1):
+        if not isinstance(objet, dict):
+            yield numero, None
+            continue
+        ligne = {}
+        for nom, valeur in objet.items():
+            cle = _cle_colonne(nom)
+            if cle:
+                ligne[cle] = valeur
+        yield numero, ligne
+
+
+def lire_fichier(flux, nom_fichier=None, format_fichier=None, type_contenu=None):
+    """Itérateur (numéro, dict brut) des lignes d'un fichier ouvert en binaire"""
+    format_fichier = format_fichier or detecter_format(nom_fichier, type_contenu)
+    if format_fichier == 'csv':
+        return _lire_csv(flux)
+    if format_fichier == 'xlsx':
+        return _lire_xlsx(flux)
+    if format_fichier == 'json':
+        return _lire_json(flux)
+    raise ErreurImport(f"Format non pris en charge : {format_fichier}")
+
+
+# ========================
+# VALIDATION
+# ========================
+
+def _valeur(brut):
+    if isinstance(brut, bool):
+        raise ValueError
+    if isinstance(brut, (int, float)):
+        valeur = float(brut)
+    else:
+        valeur = float(str(brut).strip().replace('\u00a0', '').replace(' ', '').replace(',', '.'))
+    if not math.isfinite(valeur):
+        raise ValueError
+    return valeur
+
+
+def _date(brut):
+    if isinstance(brut, datetime):
+        moment = brut
+    elif isinstance(brut, date):
+        moment = datetime(brut.year, brut.month, brut.day)
+    else:
+        texte = str(brut).strip()
+        try:
+            moment = datetime.fromisoformat(texte.replace('Z', '+00:00'))
+        except ValueError:
+            for format_date in FORMATS_DATE:
+                try:
+                    moment = datetime.strptime(texte, format_date)
+                    break
+                except ValueError:
+                    continue
+            else:
+                raise
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _indicateurs_autorises(client_id, tous_clients):
+    requete = select(KRI.id, KRI.nom, KRI.client_id).where(KRI.est_actif == true())
+    if not tous_clients:
+        requete = requete.where(KRI.client_id == client_id)
+    par_id, par_nom = {}, {}
+    for kri_id, nom, kri_client_id in db.session.execute(requete):
+        par_id[kri_id] = kri_client_id
+        cle = (nom or '').strip().lower()
+        par_nom[cle] = None if cle in par_nom else kri_id  # None : nom ambigu
+    return par_id, par_nom
+
+
+def valider(brut, par_id, par_nom):
+    """Retourne (mesure, None) ou (None, message d'erreur)"""
+    if brut is None:
+        return None, 'Ligne invalide (objet attendu)'
+
+    kri_id = brut.get('kri_id')
+    if kri_id not in (None, ''):
+        try:
+            kri_id = int(float(str(kri_id).strip()))
+        except ValueError:
+            return None, f"kri_id invalide : {kri_id}"
+    elif brut.get('kri') not in (None, ''):
+        nom = str(brut['kri']).strip()
+        if nom.lower() not in par_nom:
+            return None, f"Indicateur inconnu : {nom}"
+        kri_id = par_nom[nom.lower()]
+        if kri_id is None:
+            return None, f"Nom d'indicateur ambigu, utiliser kri_id : {nom}"
+    else:
+        return None, 'kri_id manquant'
+    if kri_id not in par_id:
+        return None, f"Indicateur {kri_id} introuvable, inactif ou non accessible"
+
+    if brut.get('date_mesure') in (None, ''):
+        return None, 'date_mesure manquante'
+    try:
+        date_mesure = _date(brut['date_mesure'])
+    except (ValueError, TypeError):
+        return None, f"date_mesure invalide : {brut['date_mesure']}"
+
+    if brut.get('valeur') in (None, ''):
+        return None, 'valeur manquante'
+    try:
+        valeur = _valeur(brut['valeur'])
+    except (ValueError, TypeError):
+        return None, f"valeur invalide : {brut['valeur']}"
+
+    commentaire = brut.get('commentaire')
+    return {
+        'kri_id': kri_id,
+        'date_mesure': date_mesure,
+        'valeur': valeur,
+        'commentaire': None if commentaire in (None, '') else str(commentaire),
+    }, None
+
+
+# ========================
+# ÉCRITURE PAR LOTS
+# ========================
+
+def _ecrire_lot(lot, par_id, utilisateur_id):
+    """Upsert d'un lot sur (kri_id, date_mesure). Retourne (insérées, mises à jour, inchangées)."""
+    existantes = {}
+    for mesure_id, kri_id, date_mesure, valeur, commentaire in db.session.execute(
+        select(MesureKRI.id, MesureKRI.kri_id, MesureKRI.date_mesure, MesureKRI.valeur, MesureKRI.commentaire)
+        .where(MesureKRI.kri_id.in_({m['kri_id'] for _, m in lot}),
+               MesureKRI.date_mesure.in_({m['date_mesure'] for _, m in lot}))
+        .order_by(MesureKRI.id)
+    ):
+        existantes.setdefault((kri_id, date_mesure), (mesure_id, valeur, commentaire))
+
+    nouvelles, modifiees, inchangees = [], [], 0
+    maintenant = datetime.utcnow()
+    for _, mesure in lot:
+        existante = existantes.get((mesure['kri_id'], mesure['date_mesure']))
+        if existante is None:
+            nouvelles.append(dict(mesure, created_by=utilisateur_id, created_at=maintenant,
+                                  client_id=par_id[mesure['kri_id']]))
+            continue
+        mesure_id, valeur, commentaire = existante
+        changements = {}
+        if valeur != mesure['valeur']:
+            changements['valeur'] = mesure['valeur']
+        if mesure['commentaire'] is not None and commentaire != mesure['commentaire']:
+            changements['commentaire'] = mesure['commentaire']
+        if changements:
+            modifiees.append(dict(changements, id=mesure_id))
+        else:
+            inchangees += 1
+
+    if nouvelles:
+        db.session.execute(insert(MesureKRI), nouvelles)
+    # Mises à jour par clé primaire, regroupées par ensemble de colonnes
+    par_colonnes = {}
+    for ligne in modifiees:
+        par_colonnes.setdefault(frozenset(ligne), []).append(ligne)
+    for lignes in par_colonnes.values():
+        db.session.execute(update(MesureKRI), lignes)
+    return len(nouvelles), len(modifiees), inchangees
+
+
+def importer(lignes, client_id=None, tous_clients=False, utilisateur_id=None, taille_lot=TAILLE_LOT):
+    """
+    Valide et écrit les lignes (numéro, dict brut) par lots transactionnels.
+
+    Retourne le rapport : total, inserees, mises_a_jour, inchangees,
+    nb_erreurs, erreurs [{ligne, erreur}], indicateurs (touchés) et alertes.
+    """
+    from services.analyse_kri import rafraichir, signaler_alertes
+
+    par_id, par_nom = _indicateurs_autorises(client_id, tous_clients)
+    rapport = {'total': 0, 'inserees': 0, 'mises_a_jour': 0, 'inchangees': 0,
+               'nb_erreurs': 0, 'erreurs': [], 'indicateurs': 0, 'alertes': 0}
+    vues = {}
+    touches = set()
+
+    def erreur(numero, message):
+        rapport['nb_erreurs'] += 1
+        if len(rapport['erreurs']) < ERREURS_MAX:
+            rapport['erreurs'].append({'ligne': numero, 'erreur': message})
+
+    def ecrire(lot):
+        try:
+            inserees, mises_a_jour, inchangees = _ecrire_lot(lot, par_id, utilisateur_id)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.exception("Import de mesures KRI : échec d'un lot de %d ligne(s)", len(lot))
+            for numero, _ in lot:
+                erreur(numero, f"Lot non enregistré : {e}")
+            return
+        rapport['inserees'] += inserees
+        rapport['mises_a_jour'] += mises_a_jour
+        rapport['inchangees'] += inchangees
+        touches.update(mesure['kri_id'] for _, mesure in lot)
+
+    lot = []
+    for numero, brut in lignes:
+        rapport['total'] += 1
+        mesure, message = valider(brut, par_id, par_nom)
+        if message:
+            erreur(numero, message)
+            continue
+        cle = (mesure['kri_id'], mesure['date_mesure'])
+        if cle in vues:
+            erreur(numero, f"Doublon de la ligne {vues[cle]} (même indicateur, même date)")
+            continue
+        vues[cle] = numero
+        lot.append((numero, mesure))
+        if len(lot) >= taille_lot:
+            ecrire(lot)
+            lot = []
+    if lot:
+        ecrire(lot)
+
+    # Seuils : un seul calcul pour tous les indicateurs touchés
+    if touches:
+        rafraichir(touches)
+        rapport['alertes'] = signaler_alertes(touches, createur_id=utilisateur_id or 1)
+        db.session.commit()
+    rapport['indicateurs'] = len(touches)
+    logger.info("Import de mesures KRI : %d ligne(s), %d insérée(s), %d mise(s) à jour, %d erreur(s)",
+                rapport['total'], rapport['inserees'], rapport['mises_a_jour'], rapport['nb_erreurs'])
+    return rapport
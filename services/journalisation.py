@@ -0,0 +1,248 @@
+# services/journalisation.py
+"""
+Journalisation structurée et non bloquante.
+
+- Un logger par module (logging.getLogger(__name__)), niveaux réglés par la
+  configuration : LOG_LEVEL (global) et LOG_NIVEAUX
+  ("services.cache_tableau_bord=DEBUG,werkzeug=WARNING").
+- Les workers n'écrivent jamais directement sur stdout : les enregistrements
+  passent par une QueueHandler, un thread QueueListener se charge de
+  l'écriture (relancé après un fork de gunicorn).
+- Sortie JSON (LOG_FORMAT=json, défaut en production) ou texte lisible en
+  développement. Chaque ligne émise pendant une requête porte request_id,
+  client_id (tenant), user_id et endpoint.
+- Une ligne « requete » par requête HTTP avec méthode, chemin, statut et
+  durée ; au-delà de LOG_REQUETE_LENTE_MS elle passe en WARNING.
+
+Les messages DEBUG désactivés ne coûtent qu'un test de niveau : utiliser
+les arguments paresseux (logger.debug("KRI %s", kri_id)) plutôt qu'une f-string.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request
+
+CHAMPS_CONTEXTE = ('request_id', 'client_id', 'user_id', 'endpoint')
+EN_TETE_REQUEST_ID = 'X-Request-ID'
+
+# Attributs standards d'un LogRecord : tout le reste vient de `extra=` et part dans le JSON
+_ATTRIBUTS_STANDARDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_etat = {'listener': None, 'queue': None, 'handler_sortie': None, 'pid': None}
+
+
+# ========================
+# FORMATAGE
+# ========================
+
+def _user_id():
+    """Utilisateur déjà chargé par flask-login (jamais de requête SQL depuis un log)"""
+    utilisateur = getattr(g, '_login_user', None)
+    if utilisateur is None or not getattr(utilisateur, 'is_authenticated', False):
+        return None
+    return utilisateur.get_id()
+
+
+class FiltreContexte(logging.Filter):
+    """Ajoute le contexte de la requête courante (exécuté dans le thread émetteur)"""
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = getattr(g, 'request_id', None)
+            record.client_id = getattr(g, 'client_id', None)
+            record.user_id = _user_id()
+            record.endpoint = request.endpoint
+        else:
+            for champ in CHAMPS_CONTEXTE:
+                if not hasattr(record, champ):
+                    setattr(record, champ, None)
+        return True
+
+
+class FormateurJSON(logging.Formatter):
+    """Une ligne JSON par enregistrement"""
+
+    def format(self, record):
+        donnees = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'niveau': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for cle, valeur in vars(record).items():
+            if cle not in _ATTRIBUTS_STANDARDS and valeur is not None:
+                donnees[cle] = valeur
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            donnees['exception'] = record.exc_text
+        return json.dumps(donnees, ensure_ascii=False, default=str)
+
+
+class FormateurTexte(logging.Formatter):
+    """Format lisible pour le développement"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s %(name)s%(contexte)s: %(message)s', '%H:%M:%S')
+
+    def format(self, record):
+        record.contexte = f" [{record.request_id}]" if getattr(record, 'request_id', None) else ''
+        duree = getattr(record, 'duree_ms', None)
+        if duree is not None and record.getMessage() == 'requete':
+            record.msg = (f"{record.methode} {record.chemin} -> {record.statut} ({duree} ms)")
+            record.args = None
+        return super().format(record)
+
+
+class QueueHandlerStructure(logging.handlers.QueueHandler):
+    """
+    QueueHandler qui conserve les champs structurés : la trace d'exception est
+    formatée dans le thread émetteur (exc_info n'est pas sérialisable) mais le
+    message et les attributs restent séparés pour le formateur JSON.
+    """
+
+    def prepare(self, record):
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(vars(record))
+        record.msg, record.args, record.exc_info = message, None, None
+        return record
+
+
+# ========================
+# CONFIGURATION
+# ========================
+
+def _niveaux_modules(valeur):
+    """"module=NIVEAU,autre=NIVEAU" (ou dict) -> {module: NIVEAU}"""
+    if not valeur:
+        return {}
+    if isinstance(valeur, dict):
+        return {k: str(v).upper() for k, v in valeur.items()}
+    niveaux = {}
+    for element in str(valeur).split(','):
+        if '=' in element:
+            module, niveau = element.split('=', 1)
+            niveaux[module.strip()] = niveau.strip().upper()
+    return niveaux
+
+
+def _demarrer_listener():
+    if _etat['listener'] is not None:
+        _etat['listener'].stop()
+    _etat['listener'] = logging.handlers.QueueListener(
+        _etat['queue'], _etat['handler_sortie'], respect_handler_level=False
+    )
+    _etat['listener'].start()
+    _etat['pid'] = os.getpid()
+
+
+def _apres_fork():
+    """Le thread du listener ne survit pas au fork des workers gunicorn (--preload)"""
+    if _etat['queue'] is not None and _etat['pid'] != os.getpid():
+        _etat['queue'] = queue.SimpleQueue()
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, QueueHandlerStructure):
+                handler.queue = _etat['queue']
+        _etat['listener'] = None
+        _demarrer_listener()
+
+
+def arreter_journalisation():
+    """Vide la file (appelé à la sortie du processus)"""
+    if _etat['listener'] is not None:
+        _etat['listener'].stop()
+        _etat['listener'] = None
+
+
+def configurer_journalisation(niveau='INFO', format_sortie='json', niveaux_modules=None, flux=None):
+    """
+    Configure le logger racine : QueueHandler -> QueueListener -> flux (stdout).
+    Idempotent : un second appel remplace la configuration précédente.
+    """
+    racine = logging.getLogger()
+    for handler in list(racine.handlers):
+        if isinstance(handler, QueueHandlerStructure):
+            racine.removeHandler(handler)
+
+    sortie = logging.StreamHandler(flux or sys.stdout)
+    sortie.setFormatter(FormateurJSON() if format_sortie == 'json' else FormateurTexte())
+
+    _etat['queue'] = queue.SimpleQueue()
+    _etat['handler_sortie'] = sortie
+    _demarrer_listener()
+
+    handler = QueueHandlerStructure(_etat['queue'])
+    handler.addFilter(FiltreContexte())
+    racine.addHandler(handler)
+    racine.setLevel(str(niveau).upper())
+
+    for module, niveau_module in _niveaux_modules(niveaux_modules).items():
+        logging.getLogger(module).setLevel(niveau_module)
+
+    return handler
+
+
+atexit.register(arreter_journalisation)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_apres_fork)
+
+
+# ========================
+# INTÉGRATION FLASK
+# ========================
+
+def init_journalisation(app):
+    """Configure la journalisation depuis app.config et chronomètre les requêtes"""
+    format_sortie = app.config.get('LOG_FORMAT') or ('texte' if app.debug else 'json')
+    configurer_journalisation(
+        niveau=app.config.get('LOG_LEVEL', 'INFO'),
+        format_sortie=format_sortie,
+        niveaux_modules=app.config.get('LOG_NIVEAUX'),
+    )
+    # Les handlers de Flask écriraient en double sur stderr, de façon synchrone ;
+    # en debug Flask force aussi app.logger (logger « app ») au niveau DEBUG
+    app.logger.handlers.clear()
+    app.logger.propagate = True
+    app.logger.setLevel(logging.NOTSET)
+    for module, niveau_module in _niveaux_modules(app.config.get('LOG_NIVEAUX')).items():
+        logging.getLogger(module).setLevel(niveau_module)
+
+    seuil_lent_ms = app.config.get('LOG_REQUETE_LENTE_MS', 1000)
+    journal = logging.getLogger('requetes')
+
+    @app.before_request
+    def demarrer_chrono_requete():
+        entrant = request.headers.get(EN_TETE_REQUEST_ID, '')
+        g.request_id = entrant[:64] if entrant else uuid.uuid4().hex[:16]
+        g.debut_requete = time.perf_counter()
+
+    @app.after_request
+    def journaliser_requete(response):
+        if not hasattr(g, 'debut_requete'):
+            return response
+        response.headers.setdefault(EN_TETE_REQUEST_ID, g.request_id)
+        if request.endpoint == 'static':
+            return response
+
+        duree_ms = round((time.perf_counter() - g.debut_requete) * 1000, 1)
+        niveau = logging.WARNING if duree_ms >= seuil_lent_ms else logging.INFO
+        if journal.isEnabledFor(niveau):
+            journal.log(niveau, 'requete', extra={
+                'methode': request.method,
+                'chemin': request.path,
+                'statut': response.status_code,
+                'duree_ms': duree_ms,
+            })
+        return response
+
+    return journal
@@ -0,0 +1,345 @@
+# services/matrice_risques.py
+"""
+Moteur de rendu des matrices de risques (SVG / JSON).
+
+Remplace, pour l'affichage web, les figures matplotlib encodées en PNG base64
+de utils.py : la grille est calculée comme un tableau d'occupation NumPy
+(impact × probabilité, ou impact × maîtrise pour la priorisation), puis
+rendue en SVG texte (quelques Ko) ou exposée telle quelle en JSON pour le
+front.
+
+Le résultat est mis en cache par (cartographie, campagne, type de matrice,
+risque en surbrillance, empreinte de l'ensemble d'évaluations), dans la
+portée « cartographie:<id> » du cache des tableaux de bord : toute écriture
+validée sur un Risque ou une EvaluationRisque de la cartographie incrémente
+la génération et rend les matrices obsolètes.
+
+matplotlib n'est plus utilisé que par les exports hors ligne (PDF/PNG) de
+utils.py.
+"""
+import base64
+import hashlib
+from html import escape
+
+import numpy as np
+
+TAILLE_MATRICE = 5
+TYPES_MATRICE = ('classique', 'criticite', 'priorisation')
+
+LIBELLES_PROBABILITE = ['Très rare', 'Rare', 'Possible', 'Probable', 'Très probable']
+LIBELLES_IMPACT = ['Négligeable', 'Mineur', 'Modéré', 'Important', 'Critique']
+LIBELLES_MAITRISE = ['Insuffisant', 'Partiel', 'Adéquat', 'Bon', 'Excellent']
+
+TITRES = {
+    'classique': 'Matrice des Risques - Classique',
+    'criticite': 'Matrice de Criticité',
+    'priorisation': 'Matrice de Priorisation',
+    'specifique': 'Matrice des Risques - Vue Spécifique',
+}
+
+# Niveaux identiques à utils.get_couleur_risque : (libellé, score max, couleur)
+NIVEAUX = (
+    ('Faible (1-4)', 4, '#90ee90'),
+    ('Moyen (5-10)', 10, '#ffff00'),
+    ('Élevé (11-16)', 16, '#ffa500'),
+    ('Critique (17-25)', None, '#ff0000'),
+)
+_BORNES_NIVEAUX = np.array([n[1] for n in NIVEAUX if n[1] is not None])
+_COULEURS_NIVEAUX = [n[2] for n in NIVEAUX]
+
+COULEURS_POINTS = ['#0000ff', '#800080', '#8b0000', '#006400', '#ff8c00',
+                   '#008b8b', '#a52a2a', '#ffc0cb', '#000080', '#008080']
+
+# Géométrie du SVG (unités utilisateur)
+_CASE = 90
+_MARGE_GAUCHE = 120
+_MARGE_HAUT = 60
+_MARGE_BAS = 80
+_LARGEUR_LEGENDE = 230
+
+
+# ========================
+# CALCUL
+# ========================
+
+def valeurs_finales(evaluation):
+    """(impact, probabilité) selon la priorité confirmation > validation > pré-évaluation"""
+    impact = evaluation.impact_conf or evaluation.impact_val or evaluation.impact_pre
+    probabilite = evaluation.probabilite_conf or evaluation.probabilite_val or evaluation.probabilite_pre
+    return impact, probabilite
+
+
+def empreinte_evaluations(evaluations):
+    """Empreinte courte de l'ensemble d'évaluations (identifiants), pour les clés de cache"""
+    ids = sorted(e.id for e in evaluations if e.id is not None)
+    return hashlib.sha1(','.join(map(str, ids)).encode('ascii')).hexdigest()[:12]
+
+
+def _niveaux(scores):
+    """Indice de niveau (0 à 3) pour un tableau de scores"""
+    return np.searchsorted(_BORNES_NIVEAUX, scores, side='left')
+
+
+def construire_matrice(evaluations, matrice_type='classique', risque_cible_id=None, taille=TAILLE_MATRICE):
+    """
+    Calcule la matrice sous forme de dictionnaire sérialisable en JSON.
+
+    Lignes = impact (indice 0 = impact 1, en bas), colonnes = probabilité
+    (ou 5 - niveau de maîtrise pré pour la matrice de priorisation).
+    """
+    evaluations = list(evaluations)
+    lignes = np.array(
+        [(*valeurs_finales(e), e.niveau_maitrise_pre or 3) for e in evaluations],
+        dtype=object
+    ).reshape(-1, 3)
+    brut = np.where(lignes == None, 0, lignes).astype(np.int64)  # noqa: E711
+    impacts, probabilites, maitrises = brut[:, 0], brut[:, 1], brut[:, 2]
+
+    valides = (impacts > 0) & (probabilites > 0) & (impacts <= taille) & (probabilites <= taille)
+    indices = np.flatnonzero(valides)
+
+    y = impacts[indices] - 1
+    if matrice_type == 'priorisation':
+        x = np.clip(taille - maitrises[indices], 0, taille - 1)
+    else:
+        x = probabilites[indices] - 1
+    scores = impacts[indices] * probabilites[indices]
+
+    occupation = np.zeros((taille, taille), dtype=np.int64)
+    np.add.at(occupation, (y, x), 1)
+
+    echelle = np.arange(1, taille + 1)
+    scores_cases = np.outer(echelle, echelle)
+    niveaux_cases = _niveaux(scores_cases)
+
+    points = []
+    for rang, (i, xi, yi, score) in enumerate(zip(indices.tolist(), x.tolist(), y.tolist(), scores.tolist())):
+        evaluation = evaluations[i]
+        risque = evaluation.risque
+        points.append({
+            'evaluation_id': evaluation.id,
+            'risque_id': evaluation.risque_id,
+            'reference': risque.reference if risque is not None else str(evaluation.risque_id),
+            'intitule': risque.intitule if risque is not None else '',
+            'impact': int(impacts[i]),
+            'probabilite': int(probabilites[i]),
+            'score': score,
+            'x': xi,
+            'y': yi,
+            'couleur': COULEURS_POINTS[rang % len(COULEURS_POINTS)],
+            'cible': risque_cible_id is not None and evaluation.risque_id == risque_cible_id,
+        })
+
+    statistiques = {
+        'nb_evaluations': len(evaluations),
+        'nb_positionnees': int(indices.size),
+        'nb_ignorees': int(len(evaluations) - indices.size),
+        'score_moyen': round(float(scores.mean()), 1) if scores.size else None,
+        'score_min': int(scores.min()) if scores.size else None,
+        'score_max': int(scores.max()) if scores.size else None,
+        'repartition_niveaux': {
+            NIVEAUX[n][0]: int(c) for n, c in enumerate(np.bincount(_niveaux(scores), minlength=len(NIVEAUX)))
+        },
+    }
+
+    if matrice_type == 'priorisation':
+        axe_x = {'libelle': 'Niveau de Maîtrise', 'graduations': LIBELLES_MAITRISE[:taille]}
+    else:
+        axe_x = {'libelle': 'Probabilité', 'graduations': LIBELLES_PROBABILITE[:taille]}
+
+    titre = TITRES.get(matrice_type, TITRES['classique'])
+    cible = next((p for p in points if p['cible']), None)
+    if risque_cible_id is not None:
+        titre = TITRES['specifique']
+        if cible is not None:
+            titre += f" - {cible['reference']} en surbrillance"
+
+    return {
+        'type': matrice_type,
+        'titre': titre,
+        'taille': taille,
+        'axes': {
+            'x': axe_x,
+            'y': {'libelle': 'Impact', 'graduations': LIBELLES_IMPACT[:taille]},
+        },
+        'cases': {
+            'scores': scores_cases.tolist(),
+            'couleurs': [[_COULEURS_NIVEAUX[n] for n in ligne] for ligne in niveaux_cases.tolist()],
+            'occupation': occupation.tolist(),
+        },
+        'points': points,
+        'risque_cible': cible,
+        'statistiques': statistiques,
+    }
+
+
+# ========================
+# RENDU SVG
+# ========================
+
+def _texte(x, y, contenu, taille=12, gras=False, ancre='middle', couleur='#000', extra=''):
+    poids = ' font-weight="bold"' if gras else ''
+    return (f'<text x="{x:.1f}" y="{y:.1f}" font-size="{taille}"{poids} text-anchor="{ancre}" '
+            f'dominant-baseline="middle" fill="{couleur}"{extra}>{escape(str(contenu))}</text>')
+
+
+def _etiquette(x, y, contenu, taille=10, fond='#fff', bordure='#808080'):
+    largeur = 7 + len(contenu) * taille * 0.62
+    return (f'<rect x="{x:.1f}" y="{y - taille:.1f}" width="{largeur:.1f}" height="{taille * 1.8:.1f}" '
+            f'rx="4" fill="{fond}" fill-opacity="0.9" stroke="{bordure}"/>'
+            + _texte(x + 4, y - taille * 0.1, contenu, taille, gras=True, ancre='start'))
+
+
+def rendre_svg(matrice):
+    """Rend la matrice calculée par construire_matrice() en document SVG autonome"""
+    n = matrice['taille']
+    largeur = _MARGE_GAUCHE + n * _CASE + _LARGEUR_LEGENDE
+    hauteur = _MARGE_HAUT + n * _CASE + _MARGE_BAS
+
+    def centre(x, y):
+        return _MARGE_GAUCHE + (x + 0.5) * _CASE, _MARGE_HAUT + (n - 1 - y + 0.5) * _CASE
+
+    parties = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {largeur} {hauteur}" '
+        f'width="{largeur}" height="{hauteur}" font-family="Arial, Helvetica, sans-serif">',
+        f'<rect width="{largeur}" height="{hauteur}" fill="#fff"/>',
+        _texte(_MARGE_GAUCHE + n * _CASE / 2, _MARGE_HAUT / 2, matrice['titre'], 18, gras=True),
+    ]
+
+    # Grille colorée
+    scores = matrice['cases']['scores']
+    couleurs = matrice['cases']['couleurs']
+    for y in range(n):
+        for x in range(n):
+            cx, cy = centre(x, y)
+            parties.append(
+                f'<rect x="{cx - _CASE / 2:.1f}" y="{cy - _CASE / 2:.1f}" width="{_CASE}" height="{_CASE}" '
+                f'fill="{couleurs[y][x]}" fill-opacity="0.7" stroke="#000" stroke-width="2"/>'
+            )
+            parties.append(_texte(cx, cy, scores[y][x], 16, gras=True, couleur='#333'))
+
+    # Graduations et libellés d'axes
+    axe_x, axe_y = matrice['axes']['x'], matrice['axes']['y']
+    base_grille = _MARGE_HAUT + n * _CASE
+    for i in range(n):
+        cx, _ = centre(i, 0)
+        parties.append(_texte(cx, base_grille + 16, i + 1, 12, gras=True))
+        parties.append(_texte(cx, base_grille + 32, axe_x['graduations'][i], 11))
+        _, cy = centre(0, i)
+        parties.append(_texte(_MARGE_GAUCHE - 10, cy - 8, i + 1, 12, gras=True, ancre='end'))
+        parties.append(_texte(_MARGE_GAUCHE - 10, cy + 8, axe_y['graduations'][i], 11, ancre='end'))
+    parties.append(_texte(_MARGE_GAUCHE + n * _CASE / 2, base_grille + 58, axe_x['libelle'], 14, gras=True))
+    milieu_y = _MARGE_HAUT + n * _CASE / 2
+    parties.append(_texte(18, milieu_y, axe_y['libelle'], 14, gras=True,
+                          extra=f' transform="rotate(-90 18 {milieu_y:.1f})"'))
+
+    # Risques, regroupés par case
+    par_case = {}
+    for point in matrice['points']:
+        par_case.setdefault((point['x'], point['y']), []).append(point)
+
+    for (x, y), groupe in par_case.items():
+        cx, cy = centre(x, y)
+        rayon = 0.22 * _CASE if len(groupe) > 1 else 0
+        angles = np.linspace(0, 2 * np.pi, len(groupe), endpoint=False)
+        if len(groupe) > 1:
+            parties.append(f'<rect x="{cx - 5:.1f}" y="{cy - 5:.1f}" width="10" height="10" fill="#ff0000" '
+                           f'fill-opacity="0.7" stroke="#ffff00" stroke-width="2"/>')
+        for point, angle in zip(groupe, angles):
+            px, py = cx + rayon * np.cos(angle), cy - rayon * np.sin(angle)
+            infobulle = f"<title>{escape(point['reference'])} - I{point['impact']} × P{point['probabilite']} = {point['score']}</title>"
+            if point['cible']:
+                parties.append(f'<circle cx="{px:.1f}" cy="{py:.1f}" r="{0.4 * _CASE:.1f}" fill="#ffff00" fill-opacity="0.3"/>')
+                parties.append(f'<circle cx="{px:.1f}" cy="{py:.1f}" r="14" fill="#ff0000" stroke="#ffff00" '
+                               f'stroke-width="4">{infobulle}</circle>')
+                parties.append(_etiquette(px + 18, py - 18, f"⭐ {point['reference']} (S:{point['score']})",
+                                          12, fond='#ffff00', bordure='#ffa500'))
+            else:
+                r = 10 if len(groupe) == 1 else 8
+                parties.append(f'<circle cx="{px:.1f}" cy="{py:.1f}" r="{r}" fill="{point["couleur"]}" '
+                               f'fill-opacity="0.9" stroke="#fff" stroke-width="2">{infobulle}</circle>')
+                parties.append(_etiquette(px + r + 2, py - r - 2, point['reference'], 9))
+
+    parties.extend(_legende(matrice, _MARGE_GAUCHE + n * _CASE + 25))
+    parties.append('</svg>')
+    return ''.join(parties)
+
+
+def _legende(matrice, x):
+    parties = []
+    y = _MARGE_HAUT + 10
+
+    if matrice['points']:
+        parties.append(_texte(x, y, 'LÉGENDE RISQUES :', 11, gras=True, ancre='start'))
+        y += 20
+        for point in matrice['points'][:4]:
+            parties.append(f'<circle cx="{x + 6}" cy="{y}" r="6" fill="{point["couleur"]}"/>')
+            parties.append(_texte(x + 18, y, f"{point['reference']} (S:{point['score']})", 10, ancre='start'))
+            y += 18
+        if len(matrice['points']) > 4:
+            parties.append(_texte(x + 18, y, f"… {len(matrice['points']) - 4} autre(s)", 10, ancre='start'))
+            y += 18
+        y += 12
+
+    parties.append(_texte(x, y, 'NIVEAUX DE RISQUE :', 11, gras=True, ancre='start'))
+    y += 20
+    for libelle, _, couleur in NIVEAUX:
+        parties.append(f'<rect x="{x}" y="{y - 7}" width="24" height="14" fill="{couleur}" stroke="#666"/>')
+        parties.append(_texte(x + 32, y, libelle, 10, ancre='start'))
+        y += 20
+
+    stats = matrice['statistiques']
+    lignes = [f"• {stats['nb_positionnees']} risque(s) évalué(s)"]
+    if stats['nb_ignorees']:
+        lignes.append(f"• {stats['nb_ignorees']} à évaluer")
+    if stats['score_moyen'] is not None:
+        lignes.append(f"• Score moyen : {stats['score_moyen']}")
+        lignes.append(f"• Min : {stats['score_min']} | Max : {stats['score_max']}")
+    cible = matrice.get('risque_cible')
+    if cible:
+        lignes += ['• Risque sélectionné :', f"  {cible['reference']}", f"  Impact : {cible['impact']}/5",
+                   f"  Prob : {cible['probabilite']}/5", f"  Score : {cible['score']}"]
+
+    y += 12
+    parties.append(_texte(x, y, 'STATISTIQUES :', 11, gras=True, ancre='start'))
+    for ligne in lignes:
+        y += 16
+        parties.append(_texte(x, y, ligne, 10, ancre='start', extra=' xml:space="preserve"'))
+    return parties
+
+
+def svg_data_uri(svg):
+    """URI data: utilisable directement dans <img src> (et par les exports JS)"""
+    return 'data:image/svg+xml;base64,' + base64.b64encode(svg.encode('utf-8')).decode('ascii')
+
+
+# ========================
+# CACHE
+# ========================
+
+def obtenir_matrice(evaluations, matrice_type='classique', cartographie_id=None, campagne_id=None,
+                    risque_cible_id=None):
+    """
+    Matrice calculée et rendue, depuis le cache si possible.
+
+    Retourne le dictionnaire de construire_matrice() complété de 'svg'.
+    cartographie_id=None (matrice consolidée) utilise la portée globale.
+    """
+    from services.cache_tableau_bord import cache_tableau_bord, PORTEE_GLOBALE
+
+    evaluations = list(evaluations)
+    portee = f'cartographie:{cartographie_id}' if cartographie_id is not None else PORTEE_GLOBALE
+    section = (f'matrice:{matrice_type}:c{campagne_id or 0}:r{risque_cible_id or 0}'
+               f':e{empreinte_evaluations(evaluations)}')
+
+    def calcul():
+        matrice = construire_matrice(evaluations, matrice_type, risque_cible_id)
+        matrice['svg'] = rendre_svg(matrice)
+        return matrice
+
+    return cache_tableau_bord.obtenir_portee(section, portee, calcul)
+
+
+def matrice_svg(evaluations, matrice_type='classique', **portee):
+    """Raccourci pour les templates : URI data: du SVG de la matrice"""
+    return svg_data_uri(obtenir_matrice(evaluations, matrice_type, **portee)['svg'])
@@ -1,55 +1,78 @@
 # services/notification_service.py
 from datetime import datetime, timedelta
 from flask import current_app
+from sqlalchemy.orm import load_only
 from models import db, Notification, User, Audit, Constatation, Recommandation, PlanAction, KRI, MesureKRI
+from services.emails_sortants import email_souhaite, frequence_email, mettre_en_file_notification
 
 class NotificationService:
     
+    # Issues par destinataire renvoyées par create_many
+    STATUT_CREEE = 'creee'
+    STATUT_EN_PAUSE = 'en_pause'
+    STATUT_INCONNU = 'destinataire_inconnu'
+    STATUT_ERREUR = 'erreur'
+
     @staticmethod
     def create(destinataire_id, type_notif, titre, message, **kwargs):
         """
         Créer une notification intelligente
         """
-        # Vérifier les préférences utilisateur
-        user = User.query.get(destinataire_id)
-        if not user:
-            current_app.logger.error(f"Utilisateur {destinataire_id} non trouvé")
-            return None
-        
-        # Vérifier si l'utilisateur a mis en pause les notifications
-        prefs = user.preferences_notifications
-        pause_until = prefs.get('pause_until')
-        if pause_until:
-            try:
-                pause_date = datetime.fromisoformat(pause_until)
-                if datetime.utcnow() < pause_date:
-                    current_app.logger.info(f"Notifications en pause pour l'utilisateur {destinataire_id}")
-                    return None
-            except (ValueError, TypeError):
-                pass
-        
-        # Vérifier la préférence web
-        if not user.get_notification_preference('web', type_notif):
-            current_app.logger.info(f"Notification web désactivée pour {type_notif}")
-            # On crée quand même la notification, mais on pourra la filtrer côté client
-        
-        # Déterminer l'urgence automatiquement
-        urgence = kwargs.get('urgence', Notification.URGENCE_NORMAL)
-        if type_notif in [Notification.TYPE_ECHEANCE, Notification.TYPE_RETARD, Notification.TYPE_KRI_ALERTE]:
-            urgence = Notification.URGENCE_IMPORTANT
-        elif 'urgent' in titre.lower() or 'critique' in titre.lower():
-            urgence = Notification.URGENCE_URGENT
-        
-        # Déterminer la date d'expiration
-        expires_at = None
-        if type_notif == Notification.TYPE_ECHEANCE:
-            expires_at = datetime.utcnow() + timedelta(days=7)
-        elif type_notif == Notification.TYPE_RETARD:
-            expires_at = datetime.utcnow() + timedelta(days=14)
-        else:
-            expires_at = datetime.utcnow() + timedelta(days=30)
-        
-        try:
+        resultat = NotificationService.create_many([destinataire_id], type_notif, titre, message, **kwargs)
+        return resultat[destinataire_id]['notification']
+
+    @staticmethod
+    def create_many(destinataire_ids, type_notif, titre, message, **kwargs):
+        """
+        Créer la même notification pour plusieurs destinataires.
+
+        Les destinataires et leurs préférences sont chargés en une requête,
+        les pauses et préférences de canal évaluées en mémoire, et toutes les
+        notifications insérées dans une seule transaction, avec les emails des
+        destinataires en fréquence 'immediat' (les autres : résumés planifiés,
+        voir services/emails_sortants.py).
+
+        Retourne {destinataire_id: {'statut', 'notification', 'web_active'}}
+        pour chaque destinataire demandé (doublons fusionnés).
+        """
+        destinataire_ids = list(dict.fromkeys(destinataire_ids))
+        resultats = {
+            destinataire_id: {'statut': NotificationService.STATUT_INCONNU, 'notification': None, 'web_active': False}
+            for destinataire_id in destinataire_ids
+        }
+        if not destinataire_ids:
+            return resultats
+
+        users = User.query.options(
+            load_only(User.id, User.username, User.email, User.preferences_notifications)
+        ).filter(User.id.in_(destinataire_ids)).all()
+        users_par_id = {user.id: user for user in users}
+
+        maintenant = datetime.utcnow()
+        urgence = NotificationService._determiner_urgence(type_notif, titre, kwargs.get('urgence'))
+        expires_at = NotificationService._date_expiration(type_notif, maintenant)
+
+        notifications = []
+        emails_immediats = []
+        for destinataire_id in destinataire_ids:
+            user = users_par_id.get(destinataire_id)
+            if not user:
+                current_app.logger.error(f"Utilisateur {destinataire_id} non trouvé")
+                continue
+
+            # Vérifier si l'utilisateur a mis en pause les notifications
+            prefs = user.preferences_notifications or {}
+            if NotificationService._est_en_pause(prefs, maintenant):
+                current_app.logger.info(f"Notifications en pause pour l'utilisateur {destinataire_id}")
+                resultats[destinataire_id]['statut'] = NotificationService.STATUT_EN_PAUSE
+                continue
+
+            # Vérifier la préférence web
+            web_active = user.get_notification_preference('web', type_notif)
+            if not web_active:
+                current_app.logger.info(f"Notification web désactivée pour {type_notif}")
+                # On crée quand même la notification, mais on pourra la filtrer côté client
+
             notification = Notification(
                 destinataire_id=destinataire_id,
                 type_notification=type_notif,
@@ -61,21 +84,67 @@ class NotificationService:
                 actions_possibles=kwargs.get('actions', []),
                 donnees_supplementaires=kwargs.get('donnees', {}),  # Renommé
                 expires_at=expires_at,
-                created_at=datetime.utcnow()
+                created_at=maintenant
             )
-            
-            db.session.add(notification)
-            db.session.flush()
-            
+            notifications.append((destinataire_id, notification))
+            if email_souhaite(prefs, type_notif) and frequence_email(prefs) == 'immediat':
+                emails_immediats.append((user, notification))
+            resultats[destinataire_id].update(notification=notification, web_active=web_active)
+
+        if not notifications:
+            return resultats
+
+        try:
+            db.session.add_all([notification for _, notification in notifications])
+            if emails_immediats:
+                db.session.flush()
+                for user, notification in emails_immediats:
+                    mettre_en_file_notification(user, notification)
             db.session.commit()
-            
-            current_app.logger.info(f"✅ Notification créée: {notification.id} pour utilisateur {destinataire_id}")
-            return notification
-            
         except Exception as e:
-            current_app.logger.error(f"❌ Erreur création notification: {e}")
+            current_app.logger.error(f"❌ Erreur création notifications: {e}")
             db.session.rollback()
-            return None
+            for destinataire_id, _ in notifications:
+                resultats[destinataire_id].update(
+                    statut=NotificationService.STATUT_ERREUR, notification=None
+                )
+            return resultats
+
+        for destinataire_id, _ in notifications:
+            resultats[destinataire_id]['statut'] = NotificationService.STATUT_CREEE
+        current_app.logger.info(
+            f"✅ {len(notifications)} notification(s) créée(s) sur {len(destinataire_ids)} destinataire(s)"
+        )
+        return resultats
+
+    @staticmethod
+    def _est_en_pause(prefs, maintenant):
+        """Pause des notifications en cours d'après les préférences"""
+        pause_until = prefs.get('pause_until')
+        if not pause_until:
+            return False
+        try:
+            return maintenant < datetime.fromisoformat(pause_until)
+        except (ValueError, TypeError):
+            return False
+
+    @staticmethod
+    def _determiner_urgence(type_notif, titre, urgence=None):
+        """Déterminer l'urgence automatiquement"""
+        if type_notif in [Notification.TYPE_ECHEANCE, Notification.TYPE_RETARD, Notification.TYPE_KRI_ALERTE]:
+            return Notification.URGENCE_IMPORTANT
+        if 'urgent' in titre.lower() or 'critique' in titre.lower():
+            return Notification.URGENCE_URGENT
+        return urgence or Notification.URGENCE_NORMAL
+
+    @staticmethod
+    def _date_expiration(type_notif, maintenant):
+        """Déterminer la date d'expiration"""
+        if type_notif == Notification.TYPE_ECHEANCE:
+            return maintenant + timedelta(days=7)
+        if type_notif == Notification.TYPE_RETARD:
+            return maintenant + timedelta(days=14)
+        return maintenant + timedelta(days=30)
     
     @staticmethod
     def notify_constatation_created(constatation, createur_id):
@@ -102,28 +171,30 @@ class NotificationService:
             except:
                 pass
         
-        # Notifier chaque destinataire
-        for user_id in destinataires:
-            actions = [
-                {'url': f'/audit/constatation/{constatation.id}', 'label': 'Voir la constatation', 'icon': 'eye'},
-                {'url': f'/audit/{audit.id}', 'label': "Voir l'audit", 'icon': 'clipboard-list'}
-            ]
-            
-            NotificationService.create(
-                destinataire_id=user_id,
-                type_notif=Notification.TYPE_CONSTATATION,
-                titre=f'Nouvelle constatation: {constatation.reference}',
-                message=constatation.description[:150] + ('...' if len(constatation.description) > 150 else ''),
-                entite_type='constatation',
-                entite_id=constatation.id,
-                actions=actions,
-                donnees={
-                    'audit_id': audit.id,
-                    'audit_titre': audit.titre,
-                    'createur_id': createur_id,
-                    'gravite': constatation.gravite if hasattr(constatation, 'gravite') else None
-                }
-            )
+        if not destinataires:
+            return {}
+
+        # Notifier tous les destinataires en une transaction
+        actions = [
+            {'url': f'/audit/constatation/{constatation.id}', 'label': 'Voir la constatation', 'icon': 'eye'},
+            {'url': f'/audit/{audit.id}', 'label': "Voir l'audit", 'icon': 'clipboard-list'}
+        ]
+        
+        return NotificationService.create_many(
+            destinataires,
+            type_notif=Notification.TYPE_CONSTATATION,
+            titre=f'Nouvelle constatation: {constatation.reference}',
+            message=constatation.description[:150] + ('...' if len(constatation.description) > 150 else ''),
+            entite_type='constatation',
+            entite_id=constatation.id,
+            actions=actions,
+            donnees={
+                'audit_id': audit.id,
+                'audit_titre': audit.titre,
+                'createur_id': createur_id,
+                'gravite': constatation.gravite if hasattr(constatation, 'gravite') else None
+            }
+        )
     
     @staticmethod
     def notify_plan_echeance(plan):
@@ -221,11 +292,9 @@ class NotificationService:
     
     @staticmethod
     def get_count_notifications_non_lues(user_id):
-        """Compter les notifications non lues"""
-        return Notification.query.filter_by(
-            destinataire_id=user_id, 
-            est_lue=False
-        ).count()
+        """Compter les notifications non lues (compteur maintenu à l'écriture)"""
+        from services.notifications_temps_reel import compteur_non_lues
+        return compteur_non_lues(user_id)
     
     @staticmethod
     def cleanup_expired_notifications():
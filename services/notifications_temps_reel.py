@@ -0,0 +1,523 @@
+# services/notifications_temps_reel.py
+"""
+Notifications en temps réel (Server-Sent Events) et compteur de non lues.
+
+Compteur : user.notifications_non_lues est maintenu à l'écriture par des
+événements SQLAlchemy sur Notification (insertion, changement de est_lue ou
+de destinataire, suppression), dans la même transaction que la modification.
+Les insertions groupées (insert(Notification.__table__)) l'ajustent d'après
+leurs paramètres ; les mises à jour groupées (query.update / query.delete)
+remettent le compteur des destinataires concernés à NULL : il est recalculé
+à la lecture suivante.
+user.notifications_version change à chaque modification et sert d'ETag à
+l'interrogation périodique (/api/notifications/recent, /api/notifications/count).
+
+Diffusion : après chaque commit, un message par destinataire est publié sur
+le bus ({'delta', 'notifications', 'resynchroniser'}) ; /api/notifications/flux
+le relaie aux navigateurs connectés.
+
+Backends du bus :
+    NOTIFICATIONS_BUS = 'memoire' -> abonnés du processus (un worker)
+    NOTIFICATIONS_BUS = 'redis'   -> pub/sub Redis partagé entre workers et
+                                     avec worker.py (CACHE_REDIS_URL)
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, stream_with_context
+from sqlalchemy import event, false, func, inspect, select, text, update
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Notification, User
+
+logger = logging.getLogger(__name__)
+
+_CLE_FLUSH = 'notifications_compteurs_flush'
+_CLE_PUBLICATION = 'notifications_a_publier'
+
+TAILLE_FILE_ABONNE = 100
+INTERVALLE_BATTEMENT = 20   # secondes
+DUREE_MAX_FLUX = 120        # secondes, le navigateur se reconnecte ensuite
+RETRY_MS = 5000
+
+# Colonnes ajoutées à une table user existante (create_all ne modifie pas les tables)
+COLONNES_COMPTEUR = (
+    ('notifications_non_lues', 'INTEGER'),
+    ('notifications_version', 'INTEGER DEFAULT 0'),
+)
+
+
+# ========================
+# BUS DE DIFFUSION
+# ========================
+
+class AbonnementMemoire:
+    """File des messages d'un abonné du processus"""
+
+    def __init__(self, bus, user_id):
+        self.bus = bus
+        self.user_id = user_id
+        self.file = queue.Queue(maxsize=TAILLE_FILE_ABONNE)
+
+    def recevoir(self, message):
+        try:
+            self.file.put_nowait(message)
+        except queue.Full:
+            # Abonné trop lent : messages abandonnés, il se resynchronisera sur le compteur
+            while True:
+                try:
+                    self.file.get_nowait()
+                except queue.Empty:
+                    break
+            self.file.put_nowait({'delta': 0, 'notifications': [], 'resynchroniser': True})
+
+    def attendre(self, timeout):
+        """Messages reçus, en attendant au plus `timeout` secondes le premier"""
+        try:
+            messages = [self.file.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                messages.append(self.file.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def fermer(self):
+        self.bus.desabonner(self)
+
+
+class BusMemoire:
+    """Pub/sub dans le processus, protégé par un verrou"""
+
+    def __init__(self):
+        self._abonnes = defaultdict(set)
+        self._verrou = threading.Lock()
+
+    def publier(self, user_id, message):
+        with self._verrou:
+            abonnes = list(self._abonnes.get(user_id, ()))
+        for abonnement in abonnes:
+            abonnement.recevoir(message)
+
+    def abonner(self, user_id):
+        abonnement = AbonnementMemoire(self, user_id)
+        with self._verrou:
+            self._abonnes[user_id].add(abonnement)
+        return abonnement
+
+    def desabonner(self, abonnement):
+        with self._verrou:
+            abonnes = self._abonnes.get(abonnement.user_id)
+            if abonnes is not None:
+                abonnes.discard(abonnement)
+                if not abonnes:
+                    del self._abonnes[abonnement.user_id]
+
+    def nb_abonnes(self):
+        with self._verrou:
+            return sum(len(abonnes) for abonnes in self._abonnes.values())
+
+
+class AbonnementRedis:
+    """Abonnement à un canal Redis (un par navigateur connecté)"""
+
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def attendre(self, timeout):
+        messages = []
+        message = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        while message is not None:
+            if message.get('type') == 'message':
+                messages.append(json.loads(message['data']))
+            message = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
+        return messages
+
+    def fermer(self):
+        self._pubsub.close()
+
+
+class BusRedis:
+    """Pub/sub Redis : les messages publiés par un worker atteignent tous les autres"""
+
+    def __init__(self, url, prefixe='fkci:notif:'):
+        import redis  # Dépendance optionnelle
+        self._client = redis.Redis.from_url(url)
+        self.prefixe = prefixe
+
+    def publier(self, user_id, message):
+        self._client.publish(f'{self.prefixe}{user_id}', json.dumps(message, default=str))
+
+    def abonner(self, user_id):
+        pubsub = self._client.pubsub()
+        pubsub.subscribe(f'{self.prefixe}{user_id}')
+        return AbonnementRedis(pubsub)
+
+
+class DiffusionNotifications:
+    """Point d'accès au bus et limite des flux ouverts par processus"""
+
+    def __init__(self, bus=None):
+        self.bus = bus or BusMemoire()
+        self.actif = True
+        self.max_flux = 20
+        self.duree_max = DUREE_MAX_FLUX
+        self._flux_ouverts = 0
+        self._verrou = threading.Lock()
+
+    def init_app(self, app):
+        self.actif = app.config.get('NOTIFICATIONS_SSE_ACTIF', True)
+        self.max_flux = app.config.get('NOTIFICATIONS_SSE_MAX_FLUX', self.max_flux)
+        self.duree_max = app.config.get('NOTIFICATIONS_SSE_DUREE', self.duree_max)
+
+        if app.config.get('NOTIFICATIONS_BUS', 'memoire') == 'redis':
+            try:
+                self.bus = BusRedis(app.config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+                logger.info("Diffusion des notifications : bus Redis")
+            except Exception as e:
+                logger.warning("Redis indisponible pour les notifications (%s), repli en mémoire", e)
+                self.bus = BusMemoire()
+        else:
+            self.bus = BusMemoire()
+
+        app.extensions['diffusion_notifications'] = self
+
+    def publier(self, user_id, message):
+        try:
+            self.bus.publier(user_id, message)
+        except Exception as e:
+            logger.warning("Publication de notification impossible pour %s: %s", user_id, e)
+
+    def reserver_flux(self):
+        """Réserve une place de flux SSE ; False si la limite du processus est atteinte"""
+        with self._verrou:
+            if not self.actif or self._flux_ouverts >= self.max_flux:
+                return False
+            self._flux_ouverts += 1
+            return True
+
+    def liberer_flux(self):
+        with self._verrou:
+            self._flux_ouverts -= 1
+
+
+diffusion_notifications = DiffusionNotifications()
+
+
+# ========================
+# COMPTEUR DE NON LUES
+# ========================
+
+def etat_notifications(user_id):
+    """(non lues, version) d'un utilisateur : une lecture par clé primaire"""
+    table = User.__table__
+    ligne = db.session.execute(
+        select(table.c.notifications_non_lues, table.c.notifications_version).where(table.c.id == user_id)
+    ).first()
+    if ligne is None:
+        return 0, 0
+    non_lues, version = ligne
+    if non_lues is None or non_lues < 0:
+        non_lues = recalculer_compteur(user_id)
+    return non_lues, version or 0
+
+
+def compteur_non_lues(user_id):
+    return etat_notifications(user_id)[0]
+
+
+def _requete_non_lues(user_id):
+    """Nombre de notifications non lues ; user_id peut être une colonne (sous-requête corrélée)"""
+    notifications = Notification.__table__
+    return select(func.count()).select_from(notifications).where(
+        notifications.c.destinataire_id == user_id,
+        notifications.c.est_lue == false()
+    )
+
+
+def recalculer_compteur(user_id):
+    """
+    Recompte les non lues d'un utilisateur et enregistre le compteur.
+
+    Le calcul et l'écriture se font en une instruction, sur une connexion
+    séparée : une lecture ne valide pas la transaction de la requête.
+    """
+    table = User.__table__
+    try:
+        with db.engine.begin() as connexion:
+            connexion.execute(
+                update(table).where(table.c.id == user_id)
+                .values(notifications_non_lues=_requete_non_lues(table.c.id).scalar_subquery())
+            )
+    except Exception as e:
+        logger.warning("Compteur de notifications non enregistré pour %s: %s", user_id, e)
+    return db.session.execute(_requete_non_lues(user_id)).scalar() or 0
+
+
+def etag_notifications(user_id, *parametres):
+    """(non lues, ETag) pour les réponses d'interrogation périodique"""
+    non_lues, version = etat_notifications(user_id)
+    return non_lues, '-'.join(str(p) for p in ('n', user_id, version) + parametres)
+
+
+def avec_etag(reponse, etag):
+    reponse.set_etag(etag)
+    # Le navigateur garde la réponse mais la revalide à chaque appel (If-None-Match)
+    reponse.headers['Cache-Control'] = 'private, no-cache'
+    return reponse
+
+
+def reponse_non_modifiee(etag):
+    return avec_etag(Response(status=304), etag)
+
+
+# ========================
+# MAINTENANCE PAR ÉVÉNEMENTS
+# ========================
+
+def _noter(target, user_id, delta, notification=None):
+    if user_id is None:
+        return
+    session = object_session(target)
+    if session is None:
+        return
+    changement = session.info.setdefault(_CLE_FLUSH, {}).setdefault(
+        user_id, {'delta': 0, 'notifications': []}
+    )
+    changement['delta'] += delta
+    if notification is not None:
+        changement['notifications'].append(notification)
+
+
+def _apres_insertion(mapper, connection, target):
+    _noter(target, target.destinataire_id, 0 if target.est_lue else 1, target.to_dict())
+
+
+def _apres_modification(mapper, connection, target):
+    etat = inspect(target)
+
+    def valeur_precedente(attribut):
+        historique = etat.attrs[attribut].history
+        if historique.deleted:
+            return historique.deleted[0]
+        return getattr(target, attribut)
+
+    ancien_destinataire = valeur_precedente('destinataire_id')
+    ancienne_lue = valeur_precedente('est_lue')
+    if ancien_destinataire != target.destinataire_id:
+        _noter(target, ancien_destinataire, 0 if ancienne_lue else -1)
+        _noter(target, target.destinataire_id, 0 if target.est_lue else 1)
+    else:
+        _noter(target, target.destinataire_id, int(bool(ancienne_lue)) - int(bool(target.est_lue)))
+
+
+def _apres_suppression(mapper, connection, target):
+    _noter(target, target.destinataire_id, 0 if target.est_lue else -1)
+
+
+def _maj_compteurs(connexion, user_ids, delta=None):
+    """Applique un delta (ou NULL si delta est None) et incrémente la version"""
+    table = User.__table__
+    valeurs = {'notifications_version': func.coalesce(table.c.notifications_version, 0) + 1}
+    valeurs['notifications_non_lues'] = None if delta is None else table.c.notifications_non_lues + delta
+    connexion.execute(update(table).where(table.c.id.in_(user_ids)).values(**valeurs))
+
+
+def _apres_flush(session, contexte_flush):
+    changements = session.info.pop(_CLE_FLUSH, None)
+    if not changements:
+        return
+
+    # Une instruction par valeur de delta (toute une diffusion : un seul UPDATE)
+    par_delta = defaultdict(list)
+    for user_id, changement in changements.items():
+        par_delta[changement['delta']].append(user_id)
+    connexion = session.connection()
+    for delta, user_ids in par_delta.items():
+        _maj_compteurs(connexion, user_ids, delta)
+
+    for user_id, changement in changements.items():
+        message = _a_publier(session, user_id)
+        message['delta'] += changement['delta']
+        message['notifications'].extend(changement['notifications'])
+
+
+def _vise_notifications(etat):
+    if any(mapper.class_ is Notification for mapper in etat.all_mappers):
+        return True
+    # insert(Notification.__table__) : instruction Core sans mapper
+    table = getattr(etat.statement, 'table', None)
+    return table is not None and getattr(table, 'name', None) == Notification.__tablename__
+
+
+def _a_publier(session, user_id):
+    return session.info.setdefault(_CLE_PUBLICATION, {}).setdefault(
+        user_id, {'delta': 0, 'notifications': [], 'resynchroniser': False}
+    )
+
+
+def _avant_execution_orm(etat):
+    """
+    Instructions groupées sur Notification, qui ne passent pas par les
+    événements du mapper :
+    - insertion groupée (services/echeances.py) : deltas lus dans les paramètres ;
+    - query.update() / query.delete() : compteurs à recalculer.
+    L'option d'exécution compteurs_notifications=False signale une mise à jour
+    qui ne touche pas est_lue (ex. est_envoyee_email des résumés email).
+    """
+    if not (etat.is_insert or etat.is_update or etat.is_delete) or not _vise_notifications(etat):
+        return
+    if etat.execution_options.get('compteurs_notifications', True) is False:
+        return
+    connexion = etat.session.connection()
+
+    if etat.is_insert:
+        lignes = etat.parameters if isinstance(etat.parameters, list) else [etat.parameters or {}]
+        deltas = defaultdict(int)
+        for ligne in lignes:
+            if ligne.get('destinataire_id') is not None:
+                deltas[ligne['destinataire_id']] += 0 if ligne.get('est_lue') else 1
+        par_delta = defaultdict(list)
+        for user_id, delta in deltas.items():
+            par_delta[delta].append(user_id)
+            _a_publier(etat.session, user_id)['delta'] += delta
+        for delta, user_ids in par_delta.items():
+            _maj_compteurs(connexion, user_ids, delta)
+        return
+
+    notifications = Notification.__table__
+    requete = select(notifications.c.destinataire_id).distinct().where(
+        notifications.c.destinataire_id.isnot(None)
+    )
+    if etat.statement.whereclause is not None:
+        requete = requete.where(etat.statement.whereclause)
+    user_ids = list(connexion.execute(requete).scalars())
+    if not user_ids:
+        return
+
+    _maj_compteurs(connexion, user_ids)
+    for user_id in user_ids:
+        _a_publier(etat.session, user_id)['resynchroniser'] = True
+
+
+def _apres_commit(session):
+    a_publier = session.info.pop(_CLE_PUBLICATION, None)
+    for user_id, message in (a_publier or {}).items():
+        diffusion_notifications.publier(user_id, message)
+
+
+def _apres_rollback(session, transaction_precedente):
+    session.info.pop(_CLE_FLUSH, None)
+    session.info.pop(_CLE_PUBLICATION, None)
+
+
+def enregistrer_evenements():
+    for nom, fonction in (('after_insert', _apres_insertion), ('after_update', _apres_modification),
+                          ('after_delete', _apres_suppression)):
+        if not event.contains(Notification, nom, fonction):
+            event.listen(Notification, nom, fonction)
+
+    for nom, fonction in (('after_flush', _apres_flush), ('do_orm_execute', _avant_execution_orm),
+                          ('after_commit', _apres_commit), ('after_soft_rollback', _apres_rollback)):
+        if not event.contains(Session, nom, fonction):
+            event.listen(Session, nom, fonction)
+
+
+# ========================
+# FLUX SSE
+# ========================
+
+def evenement_sse(nom, donnees):
+    return f"event: {nom}\ndata: {json.dumps(donnees, default=str)}\n\n"
+
+
+def flux_notifications(user_id):
+    """
+    Réponse text/event-stream d'un utilisateur, ou None si la limite de flux
+    du processus est atteinte (le navigateur se rabat sur l'interrogation).
+
+    Événements : 'compteur' ({non_lues, delta, version}) à l'ouverture puis à
+    chaque changement, 'notification' (Notification.to_dict()) pour chaque
+    nouvelle notification. Un commentaire est envoyé toutes les
+    INTERVALLE_BATTEMENT secondes ; le flux se ferme après duree_max et le
+    navigateur se reconnecte (retry).
+    """
+    if not diffusion_notifications.reserver_flux():
+        return None
+    try:
+        abonnement = diffusion_notifications.bus.abonner(user_id)
+    except Exception as e:
+        diffusion_notifications.liberer_flux()
+        logger.warning("Abonnement aux notifications impossible pour %s: %s", user_id, e)
+        return None
+
+    def compteur(delta=0):
+        non_lues, version = etat_notifications(user_id)
+        # Ne pas garder de connexion pendant l'attente
+        db.session.close()
+        return evenement_sse('compteur', {'non_lues': non_lues, 'delta': delta, 'version': version})
+
+    def generer():
+        yield f"retry: {RETRY_MS}\n\n" + compteur()
+        fin = time.monotonic() + diffusion_notifications.duree_max
+        while time.monotonic() < fin:
+            messages = abonnement.attendre(min(INTERVALLE_BATTEMENT, max(fin - time.monotonic(), 0)))
+            if not messages:
+                yield ": battement\n\n"
+                continue
+            for message in messages:
+                for notification in message.get('notifications', []):
+                    yield evenement_sse('notification', notification)
+            yield compteur(sum(message.get('delta', 0) for message in messages))
+
+    def fermer():
+        abonnement.fermer()
+        diffusion_notifications.liberer_flux()
+
+    reponse = Response(stream_with_context(generer()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # Appelé aussi quand le client part avant le premier octet
+    reponse.call_on_close(fermer)
+    return reponse
+
+
+# ========================
+# SCHÉMA
+# ========================
+
+def assurer_colonnes_compteur():
+    """Ajoute les colonnes du compteur à une table user créée avant elles"""
+    table = User.__tablename__
+    inspecteur = inspect(db.engine)
+    if not inspecteur.has_table(table):
+        return []  # create_all la créera avec les colonnes
+    existantes = {c['name'] for c in inspecteur.get_columns(table)}
+    ajoutees = [nom for nom, _ in COLONNES_COMPTEUR if nom not in existantes]
+    if not ajoutees:
+        return []
+    nom_table = db.engine.dialect.identifier_preparer.quote(table)
+    with db.engine.begin() as connexion:
+        for nom, definition in COLONNES_COMPTEUR:
+            if nom in ajoutees:
+                connexion.execute(text(f"ALTER TABLE {nom_table} ADD COLUMN {nom} {definition}"))
+    logger.info("Colonnes du compteur de notifications ajoutées à %s: %s", table, ', '.join(ajoutees))
+    return ajoutees
+
+
+def init_notifications_temps_reel(app):
+    """Colonnes du compteur, bus de diffusion et événements de maintenance"""
+    diffusion_notifications.init_app(app)
+    with app.app_context():
+        try:
+            assurer_colonnes_compteur()
+        except Exception as e:
+            logger.error("Colonnes du compteur de notifications non vérifiées: %s", e)
+    enregistrer_evenements()
+    return diffusion_notifications
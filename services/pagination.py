@@ -0,0 +1,136 @@
+# services/pagination.py
+"""
+Pagination commune des listes.
+
+- Pages HTML : paramètres ?page=&per_page=, objet Pagination de Flask-SQLAlchemy
+  (compatible avec la macro templates/includes/pagination.html).
+- API JSON : curseurs keyset opaques (?curseur=&limite=), signés avec la
+  SECRET_KEY, stables même si des lignes sont insérées pendant le parcours.
+
+Les requêtes passées ici doivent déjà être filtrées par client
+(get_client_filter) : la pagination ne fait que découper le résultat.
+"""
+from datetime import date, datetime
+
+from flask import current_app, request
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import and_, or_
+
+TAILLE_PAR_DEFAUT = 20
+TAILLE_MAX = 100
+_SEL_CURSEUR = 'curseur-pagination'
+
+
+class CurseurInvalide(ValueError):
+    """Curseur de pagination altéré ou illisible"""
+
+
+def parametres_pagination(defaut=TAILLE_PAR_DEFAUT, maximum=TAILLE_MAX):
+    """Retourne (page, per_page) depuis la requête, bornés"""
+    page = max(request.args.get('page', 1, type=int) or 1, 1)
+    per_page = request.args.get('per_page', defaut, type=int) or defaut
+    return page, min(max(per_page, 1), maximum)
+
+
+def paginer(query, defaut=TAILLE_PAR_DEFAUT, maximum=TAILLE_MAX):
+    """Pagine une requête ORM selon ?page= et ?per_page="""
+    page, per_page = parametres_pagination(defaut, maximum)
+    return query.paginate(page=page, per_page=per_page, max_per_page=maximum, error_out=False)
+
+
+# ========================
+# CURSEURS KEYSET
+# ========================
+
+def _serialiseur():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt=_SEL_CURSEUR)
+
+
+def _encoder_valeur(valeur):
+    if isinstance(valeur, datetime):
+        return {'dt': valeur.isoformat()}
+    if isinstance(valeur, date):
+        return {'d': valeur.isoformat()}
+    return valeur
+
+
+def _decoder_valeur(valeur):
+    if isinstance(valeur, dict):
+        if 'dt' in valeur:
+            return datetime.fromisoformat(valeur['dt'])
+        if 'd' in valeur:
+            return date.fromisoformat(valeur['d'])
+    return valeur
+
+
+def encoder_curseur(valeurs):
+    return _serialiseur().dumps([_encoder_valeur(v) for v in valeurs])
+
+
+def decoder_curseur(curseur):
+    try:
+        return [_decoder_valeur(v) for v in _serialiseur().loads(curseur)]
+    except (BadSignature, TypeError, ValueError) as e:
+        raise CurseurInvalide('Curseur de pagination invalide') from e
+
+
+def _condition_apres(colonnes, valeurs, descendant):
+    """(c1, c2, ...) strictement après (v1, v2, ...) dans l'ordre de tri"""
+    alternatives = []
+    for i, (colonne, valeur) in enumerate(zip(colonnes, valeurs)):
+        egalites = [c == v for c, v in zip(colonnes[:i], valeurs[:i])]
+        comparaison = colonne < valeur if descendant else colonne > valeur
+        alternatives.append(and_(*egalites, comparaison))
+    return or_(*alternatives)
+
+
+class PageCurseur:
+    """Une page de résultats parcourue par curseur"""
+
+    def __init__(self, items, curseur_suivant, limite):
+        self.items = items
+        self.curseur_suivant = curseur_suivant
+        self.limite = limite
+
+    @property
+    def has_next(self):
+        return self.curseur_suivant is not None
+
+    def meta(self):
+        return {
+            'limite': self.limite,
+            'nombre': len(self.items),
+            'curseur_suivant': self.curseur_suivant,
+            'has_next': self.has_next
+        }
+
+
+def paginer_curseur(query, colonnes, descendant=True, defaut=TAILLE_PAR_DEFAUT, maximum=TAILLE_MAX):
+    """
+    Pagine par keyset selon ?curseur= et ?limite=.
+
+    `colonnes` est la clé de tri ; elle doit être unique et non nulle
+    (terminer par la clé primaire, ex. (Risque.created_at, Risque.id)).
+    Lève CurseurInvalide si le curseur fourni est altéré.
+    """
+    colonnes = list(colonnes)
+    limite = request.args.get('limite', defaut, type=int) or defaut
+    limite = min(max(limite, 1), maximum)
+
+    curseur = request.args.get('curseur')
+    if curseur:
+        valeurs = decoder_curseur(curseur)
+        if len(valeurs) != len(colonnes):
+            raise CurseurInvalide('Curseur de pagination invalide')
+        query = query.filter(_condition_apres(colonnes, valeurs, descendant))
+
+    ordre = [c.desc() if descendant else c.asc() for c in colonnes]
+    lignes = query.order_by(None).order_by(*ordre).limit(limite + 1).all()
+
+    curseur_suivant = None
+    if len(lignes) > limite:
+        lignes = lignes[:limite]
+        dernier = lignes[-1]
+        curseur_suivant = encoder_curseur([getattr(dernier, c.key) for c in colonnes])
+
+    return PageCurseur(lignes, curseur_suivant, limite)
@@ -0,0 +1,284 @@
+# services/permissions_effectives.py
+"""
+Ensembles de permissions effectives des utilisateurs.
+
+User.has_permission ne réévalue plus ses règles à chaque appel : les règles
+(admin client, gestionnaire, permissions explicites de la colonne JSON,
+défauts par rôle, modules de la formule) sont appliquées une fois pour
+produire un frozenset des permissions accordées.
+
+Le résultat est mis en cache par « version » : une signature des données qui
+entrent dans le calcul (rôle, statut admin client, permissions explicites,
+modules de la formule). Toute modification de l'une d'elles, y compris une
+modification en place du JSON `permissions`, change la version et force le
+recalcul ; les utilisateurs qui partagent la même version partagent le même
+ensemble.
+
+Les PermissionTemplate et FormuleAbonnement.get_role_permissions sont déjà
+recopiés dans la colonne `permissions` à la création/édition des comptes :
+ils sont donc pris en compte via les permissions explicites.
+"""
+import hashlib
+from functools import lru_cache
+
+# ========================
+# RÈGLES
+# ========================
+
+PERMISSIONS_ADMIN_CLIENT = {
+    # Tableau de bord et visualisation
+    'can_view_dashboard': True,
+    'can_view_reports': True,
+    'can_view_departments': True,
+    'can_view_notifications': True,
+
+    # Gestion des risques
+    'can_manage_risks': True,
+    'can_validate_risks': True,
+
+    # Gestion des KRI
+    'can_manage_kri': True,
+
+    # Gestion des audits
+    'can_manage_audit': True,
+    'can_confirm_evaluations': True,
+
+    # Plans d'action
+    'can_manage_action_plans': True,
+    'can_view_action_plans': True,
+
+    # Gestion des utilisateurs
+    'can_view_users_list': True,
+    'can_edit_users': True,
+    'can_manage_users': True,
+    'can_create_users': True,
+    'can_deactivate_users': True,
+    'can_delete_users': True,
+
+    # Gestion des départements
+    'can_manage_departments': True,
+    'can_access_all_departments': True,
+
+    # Administration
+    'can_manage_settings': True,
+    'can_archive_data': True,
+    'can_export_data': True,
+
+    # Permissions à TOUJOURS FALSE pour admin client
+    'can_manage_clients': False,
+    'can_provision_servers': False,
+    'can_manage_permissions': True,  # ADMIN client peut gérer les permissions de SES utilisateurs
+}
+
+# Permissions de l'admin client accordées seulement si le module est actif
+PERMISSIONS_ADMIN_CLIENT_MODULES = {
+    'can_manage_regulatory': 'veille_reglementaire',
+    'can_manage_logigram': 'gestion_processus',
+}
+
+PERMISSIONS_MANAGER = {
+    # Visualisation de base
+    'can_view_dashboard': True,
+    'can_view_reports': True,
+    'can_view_departments': True,
+    'can_view_notifications': True,
+
+    # Gestion des risques
+    'can_manage_risks': True,
+    'can_validate_risks': True,
+
+    # KRI
+    'can_manage_kri': True,
+
+    # Audit
+    'can_manage_audit': True,
+
+    # Plans d'action
+    'can_view_action_plans': True,
+    'can_manage_action_plans': True,
+
+    # Accès aux départements
+    'can_access_all_departments': True,
+
+    # Export
+    'can_export_data': True,
+
+    # Gestion des utilisateurs
+    'can_manage_users': True,
+    'can_edit_users': True,
+    'can_view_users_list': True,
+    'can_create_users': True,
+    'can_deactivate_users': True,
+    'can_delete_users': True,
+    'can_manage_permissions': True,
+
+    # Administration limitée
+    'can_manage_settings': True,
+    'can_manage_departments': True,
+
+    # Permissions réservées aux admin (toujours false pour manager)
+    'can_manage_clients': False,
+    'can_provision_servers': False,
+}
+
+PERMISSIONS_PAR_ROLE = {
+    'auditeur': {
+        'can_view_dashboard': True,
+        'can_view_reports': True,
+        'can_view_departments': True,
+        'can_view_notifications': True,
+        'can_manage_audit': True,
+        'can_view_action_plans': True,
+    },
+    'utilisateur': {
+        'can_view_dashboard': True,
+        'can_view_reports': True,
+        'can_view_departments': True,
+        'can_view_notifications': True,
+        'can_view_action_plans': True,  # Peut voir les plans qui le concernent
+    },
+    'compliance': {
+        'can_view_dashboard': True,
+        'can_view_reports': True,
+        'can_view_departments': True,
+        'can_view_notifications': True,
+        'can_manage_regulatory': True,
+    },
+    'consultant': {
+        'can_view_dashboard': True,
+        'can_view_reports': True,
+        'can_view_departments': True,
+        'can_create_users': True,
+    }
+}
+
+# Permissions liées à un module de la formule (dernier recours)
+PERMISSION_VERS_MODULE = {
+    'can_manage_regulatory': 'veille_reglementaire',
+    'can_manage_logigram': 'gestion_processus',
+    'can_manage_action_plans': 'audit_interne',
+    'can_view_action_plans': 'audit_interne',
+    'can_manage_risks': 'cartographie',
+    'can_manage_kri': 'suivi_kri',
+    'can_manage_audit': 'audit_interne',
+}
+
+PERMISSIONS_CONNUES = frozenset().union(
+    PERMISSIONS_ADMIN_CLIENT, PERMISSIONS_ADMIN_CLIENT_MODULES, PERMISSIONS_MANAGER,
+    PERMISSION_VERS_MODULE, *PERMISSIONS_PAR_ROLE.values()
+)
+
+
+# ========================
+# RÉSOLUTION
+# ========================
+
+def _decider(permission, role, admin_client, explicites, modules):
+    """Applique les règles dans l'ordre historique de User.has_permission"""
+    # 1. Admin client
+    if admin_client:
+        if permission in PERMISSIONS_ADMIN_CLIENT:
+            return PERMISSIONS_ADMIN_CLIENT[permission]
+        if permission in PERMISSIONS_ADMIN_CLIENT_MODULES:
+            return modules is not None and bool(modules.get(PERMISSIONS_ADMIN_CLIENT_MODULES[permission]))
+
+    # 2. Gestionnaire
+    if role == 'manager' and permission in PERMISSIONS_MANAGER:
+        return PERMISSIONS_MANAGER[permission]
+
+    # 3. Permissions explicites (colonne JSON)
+    if permission in explicites:
+        return explicites[permission]
+
+    # 4. Défauts par rôle
+    defauts = PERMISSIONS_PAR_ROLE.get(role, {})
+    if permission in defauts:
+        return defauts[permission]
+
+    # 5. Modules de la formule
+    if modules is not None and permission in PERMISSION_VERS_MODULE:
+        module = PERMISSION_VERS_MODULE[permission]
+        if module in modules:
+            return bool(modules[module])
+
+    return False
+
+
+@lru_cache(maxsize=2048)
+def _resoudre(signature):
+    role, admin_client, explicites, modules = signature
+    explicites = dict(explicites)
+    modules = dict(modules) if modules is not None else None
+    candidates = PERMISSIONS_CONNUES.union(explicites)
+    return frozenset(
+        permission for permission in candidates
+        if _decider(permission, role, admin_client, explicites, modules)
+    )
+
+
+def _geler(valeurs):
+    return tuple(sorted((str(cle), bool(valeur)) for cle, valeur in (valeurs or {}).items()))
+
+
+def signature_permissions(user):
+    """Données qui déterminent les permissions effectives d'un utilisateur"""
+    client = user.client
+    formule = client.formule if client else None
+    modules = _geler(formule.modules) if formule is not None else None
+    return (
+        user.role,
+        bool(user.role == 'admin' or getattr(user, 'is_client_admin', False)),
+        _geler(user.permissions),
+        modules,
+    )
+
+
+def version_permissions(user):
+    """Empreinte courte de la signature (utilisable dans des clés de cache ou ETag)"""
+    return hashlib.sha1(repr(signature_permissions(user)).encode('utf-8')).hexdigest()[:12]
+
+
+def permissions_effectives(user):
+    """
+    Frozenset des permissions accordées à l'utilisateur.
+
+    Pour un super admin, retourne toutes les permissions connues
+    (User.has_permission lui accorde de toute façon tout).
+    """
+    if user.role == 'super_admin':
+        return PERMISSIONS_CONNUES.union(k for k, _ in _geler(user.permissions))
+
+    signature = signature_permissions(user)
+    memo = user.__dict__.get('_permissions_effectives')
+    if memo is not None and memo[0] == signature:
+        return memo[1]
+
+    ensemble = _resoudre(signature)
+    user.__dict__['_permissions_effectives'] = (signature, ensemble)
+    return ensemble
+
+
+def permissions_effectives_utilisateurs(users):
+    """
+    Permissions effectives d'une liste d'utilisateurs : {user_id: frozenset}.
+
+    Les clients et formules sont chargés en deux requêtes au total, et les
+    utilisateurs de même profil partagent le même calcul.
+    """
+    from sqlalchemy.orm import selectinload
+    from sqlalchemy.orm.attributes import set_committed_value
+    from models import Client
+
+    users = list(users)
+    ids_clients = {u.client_id for u in users if u.client_id}
+    clients = {}
+    if ids_clients:
+        clients = {c.id: c for c in Client.query.options(selectinload(Client.formule))
+                   .filter(Client.id.in_(ids_clients)).all()}
+
+    # Rattacher les clients chargés : user.client ne déclenche plus de requête
+    for user in users:
+        if 'client' not in user.__dict__:
+            set_committed_value(user, 'client', clients.get(user.client_id))
+
+    return {user.id: permissions_effectives(user) for user in users}
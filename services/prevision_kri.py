@@ -0,0 +1,405 @@
+# services/prevision_kri.py
+"""
+Prévisions à court terme des indicateurs (KRI/KPI) et alertes précoces.
+
+Pour chaque indicateur, trois modèles légers sont ajustés sur les
+FENETRE_POINTS dernières mesures (abscisse en jours, les mesures pouvant
+être irrégulières) :
+
+- lineaire : moindres carrés, niveau et pente ;
+- ewma     : lissage exponentiel simple (niveau, pente nulle) ;
+- holt     : lissage double de Holt (niveau et pente, pas de temps variable).
+
+Les mesures de tous les indicateurs à recalculer sont lues en une requête
+et rangées dans une matrice (indicateur x rang, alignée à droite). Les
+calculs sont vectorisés sur les indicateurs : sommes cumulées pour la
+régression, une boucle sur les FENETRE_POINTS colonnes pour les lissages.
+Le modèle retenu est celui dont l'erreur des prévisions à un pas (RMSE)
+est la plus faible sur la fenêtre.
+
+À partir du niveau et de la pente retenus, on estime la date de
+franchissement de seuil_alerte / seuil_critique (selon
+sens_evaluation_seuil) dans les HORIZON_JOURS suivant la dernière mesure.
+
+Les prévisions sont enregistrées dans kri_previsions et conservées jusqu'à
+la prochaine écriture de mesure (invalidation par services/analyse_kri.py)
+ou modification de l'indicateur : la lecture ne réajuste rien.
+
+    previsions(kri_ids)  -> {kri_id: PrevisionKRI}, recalculées si périmées
+    avertir(kri_ids)     -> notifications d'alerte précoce (une par niveau prévu)
+    actualiser()         -> tâche planifiée : rafraîchir puis avertir
+"""
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import or_, select, true
+from sqlalchemy.dialects.postgresql import insert as insert_postgres
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+
+from models import db, EtatKRI, KRI, MesureKRI, Notification, PrevisionKRI
+
+logger = logging.getLogger(__name__)
+
+FENETRE_POINTS = 30
+MIN_POINTS = 3
+HORIZON_JOURS = 90
+ALPHA_EWMA = 0.5
+ALPHA_HOLT, BETA_HOLT = 0.5, 0.3
+TAILLE_LOT = 1000
+
+MODELES = (PrevisionKRI.MODELE_LINEAIRE, PrevisionKRI.MODELE_EWMA, PrevisionKRI.MODELE_HOLT)
+JOUR = np.timedelta64(86400 * 10 ** 6, 'us')
+
+# États courants (KRI.get_etat_alerte) déjà au niveau d'un avertissement
+ETATS_ALERTE = {'alerte', 'sous_performance', 'critique', 'hors_cible'}
+ETATS_CRITIQUES = {'critique', 'hors_cible'}
+
+
+# ========================
+# CALCUL VECTORISÉ
+# ========================
+
+def _matrices(k, groupes, jours, valeurs, fenetre):
+    """Dernières mesures de chaque groupe, alignées à droite dans des matrices k x fenetre (NaN sinon)"""
+    nb = np.bincount(groupes, minlength=k)
+    fin = np.cumsum(nb) - 1
+    rang_depuis_fin = fin[groupes] - np.arange(len(groupes))
+    garder = rang_depuis_fin < fenetre
+    lignes, colonnes = groupes[garder], fenetre - 1 - rang_depuis_fin[garder]
+    t = np.full((k, fenetre), np.nan)
+    y = np.full((k, fenetre), np.nan)
+    t[lignes, colonnes] = jours[garder]
+    y[lignes, colonnes] = valeurs[garder]
+    return t, y, np.minimum(nb, fenetre)
+
+
+def _lineaire(t, y, present):
+    """Prévisions à un pas (régression sur les points précédents) et ajustement final"""
+    t0, y0 = np.where(present, t, 0.0), np.where(present, y, 0.0)
+    cumuls = [np.cumsum(m, axis=1) for m in (present.astype(float), t0, y0, t0 * t0, t0 * y0)]
+    # Sommes des points strictement antérieurs à chaque colonne
+    n, st, sy, stt, sty = [c - m for c, m in zip(cumuls, (present, t0, y0, t0 * t0, t0 * y0))]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pente = (n * sty - st * sy) / (n * stt - st ** 2)
+        origine = (sy - pente * st) / n
+        prevision = origine + pente * t
+
+        n, st, sy, stt, sty = [c[:, -1] for c in cumuls]
+        pente_finale = (n * sty - st * sy) / (n * stt - st ** 2)
+        niveau = (sy - pente_finale * st) / n  # t est relatif à la dernière mesure (t = 0)
+    return prevision, niveau, pente_finale
+
+
+def _lissages(t, y, present):
+    """EWMA et Holt, une itération par colonne pour tous les indicateurs"""
+    k, fenetre = y.shape
+    prev_ewma = np.full((k, fenetre), np.nan)
+    prev_holt = np.full((k, fenetre), np.nan)
+    niveau_ewma = np.full(k, np.nan)
+    niveau_holt = np.full(k, np.nan)
+    pente_holt = np.zeros(k)
+    t_prec = np.full(k, np.nan)
+
+    for j in range(fenetre):
+        yj, tj, pj = y[:, j], t[:, j], present[:, j]
+        debut = pj & np.isnan(niveau_holt)
+        suite = pj & ~debut
+        dt = np.where(suite, tj - t_prec, 0.0)
+
+        prev_ewma[suite, j] = niveau_ewma[suite]
+        prev_holt[suite, j] = niveau_holt[suite] + pente_holt[suite] * dt[suite]
+
+        niveau_ewma[debut] = yj[debut]
+        niveau_ewma[suite] = ALPHA_EWMA * yj[suite] + (1 - ALPHA_EWMA) * niveau_ewma[suite]
+
+        ancien = niveau_holt.copy()
+        niveau_holt[debut] = yj[debut]
+        niveau_holt[suite] = ALPHA_HOLT * yj[suite] + (1 - ALPHA_HOLT) * prev_holt[suite, j]
+        avance = suite & (dt > 0)
+        pente_holt[avance] = (
+            BETA_HOLT * (niveau_holt[avance] - ancien[avance]) / dt[avance]
+            + (1 - BETA_HOLT) * pente_holt[avance]
+        )
+        t_prec[pj] = tj[pj]
+
+    return (prev_ewma, niveau_ewma, np.zeros(k)), (prev_holt, niveau_holt, pente_holt)
+
+
+def _date_franchissement(niveau, pente, seuil, inferieur, horizon):
+    """Jours avant franchissement (0 si déjà franchi), NaN si pas dans l'horizon ou seuil absent"""
+    sens = np.where(inferieur, -1.0, 1.0)
+    distance = sens * (seuil - niveau)
+    vitesse = sens * pente
+    with np.errstate(invalid='ignore', divide='ignore'):
+        jours = np.where(distance <= 0, 0.0, np.where(vitesse > 0, distance / vitesse, np.inf))
+    return np.where(np.isfinite(jours) & (jours <= horizon), jours, np.nan)
+
+
+def prevoir(indicateurs, mesures, fenetre=FENETRE_POINTS, horizon=HORIZON_JOURS):
+    """
+    Ajuste les trois modèles et retient le meilleur, pour tous les indicateurs à la fois.
+
+    indicateurs : lignes (id, seuil_alerte, seuil_critique, sens_evaluation_seuil)
+    mesures     : lignes (kri_id, date_mesure, valeur) triées par kri_id puis date_mesure
+    Retourne un dict de tableaux NumPy alignés sur les identifiants (triés).
+    """
+    indicateurs = sorted(indicateurs, key=lambda ligne: ligne[0])
+    ids = np.array([ligne[0] for ligne in indicateurs], dtype=np.int64)
+    seuil_alerte = np.array([np.nan if ligne[1] is None else ligne[1] for ligne in indicateurs], dtype=float)
+    seuil_critique = np.array([np.nan if ligne[2] is None else ligne[2] for ligne in indicateurs], dtype=float)
+    inferieur = np.array([ligne[3] == 'inferieur' for ligne in indicateurs], dtype=bool)
+    k = len(ids)
+
+    mesures = [m for m in mesures if m[1] is not None and m[2] is not None]
+    if mesures:
+        kri_mesures, dates, valeurs = zip(*mesures)
+        groupes = np.searchsorted(ids, np.array(kri_mesures, dtype=np.int64))
+        dates = np.array(dates, dtype='datetime64[us]')
+        valeurs = np.array(valeurs, dtype=float)
+    else:
+        groupes = np.zeros(0, dtype=np.int64)
+        dates = np.zeros(0, dtype='datetime64[us]')
+        valeurs = np.zeros(0, dtype=float)
+
+    # Jours relatifs à la dernière mesure de chaque indicateur (t = 0 à la dernière)
+    nb = np.bincount(groupes, minlength=k)
+    derniere_date = np.full(k, np.datetime64('NaT'), dtype='datetime64[us]')
+    avec = nb > 0
+    derniere_date[avec] = dates[(np.cumsum(nb) - 1)[avec]]
+    jours = (dates - derniere_date[groupes]) / JOUR
+
+    t, y, nb_points = _matrices(k, groupes, jours, valeurs, fenetre)
+    present = ~np.isnan(y)
+    resultats_modeles = [_lineaire(t, y, present), *_lissages(t, y, present)]
+
+    # Erreur à un pas, comparée sur les mêmes colonnes (au moins deux points antérieurs)
+    evaluables = present & (np.cumsum(present, axis=1) > 2)
+    erreurs = []
+    for prevision, niveau, pente in resultats_modeles:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ecarts = np.where(evaluables, prevision - y, 0.0)
+            rmse = np.sqrt((ecarts ** 2).sum(axis=1) / evaluables.sum(axis=1))
+        valide = np.isfinite(rmse) & np.isfinite(niveau) & np.isfinite(pente)
+        erreurs.append(np.where(valide, rmse, np.inf))
+    erreurs = np.vstack(erreurs)
+    choix = np.argmin(erreurs, axis=0)
+    lignes = np.arange(k)
+    retenu = (nb_points >= MIN_POINTS) & np.isfinite(erreurs[choix, lignes])
+
+    niveau = np.vstack([r[1] for r in resultats_modeles])[choix, lignes]
+    pente = np.vstack([r[2] for r in resultats_modeles])[choix, lignes]
+    niveau[~retenu] = np.nan
+    pente[~retenu] = np.nan
+
+    jours_alerte = _date_franchissement(niveau, pente, seuil_alerte, inferieur, horizon)
+    jours_critique = _date_franchissement(niveau, pente, seuil_critique, inferieur, horizon)
+
+    def dates_depuis(jours_relatifs):
+        resultat = np.full(k, np.datetime64('NaT'), dtype='datetime64[us]')
+        ok = ~np.isnan(jours_relatifs)
+        resultat[ok] = derniere_date[ok] + np.round(jours_relatifs[ok] * 86400 * 10 ** 6).astype('timedelta64[us]')
+        return resultat
+
+    return {
+        'kri_id': ids,
+        'modele': np.where(retenu, np.array(MODELES, dtype=object)[choix], None),
+        'nb_points': nb_points,
+        'erreur': np.where(retenu, erreurs[choix, lignes], np.nan),
+        'niveau': niveau,
+        'pente_jour': pente,
+        'derniere_date': derniere_date,
+        'valeur_horizon': niveau + pente * horizon,
+        'date_seuil_alerte': dates_depuis(jours_alerte),
+        'date_seuil_critique': dates_depuis(jours_critique),
+    }
+
+
+# ========================
+# ENREGISTREMENT
+# ========================
+
+def _lignes_previsions(resultats, clients, horizon, calcule_le):
+    def nombre(valeur):
+        return None if np.isnan(valeur) else float(valeur)
+
+    def moment(valeur):
+        return None if np.isnat(valeur) else valeur.astype(datetime)
+
+    for i, kri_id in enumerate(resultats['kri_id'].tolist()):
+        yield {
+            'kri_id': kri_id,
+            'client_id': clients.get(kri_id),
+            'modele': resultats['modele'][i],
+            'nb_points': int(resultats['nb_points'][i]),
+            'erreur': nombre(resultats['erreur'][i]),
+            'niveau': nombre(resultats['niveau'][i]),
+            'pente_jour': nombre(resultats['pente_jour'][i]),
+            'derniere_date': moment(resultats['derniere_date'][i]),
+            'horizon_jours': horizon,
+            'valeur_horizon': nombre(resultats['valeur_horizon'][i]),
+            'date_seuil_alerte': moment(resultats['date_seuil_alerte'][i]),
+            'date_seuil_critique': moment(resultats['date_seuil_critique'][i]),
+            'perime': False,
+            'calcule_le': calcule_le,
+        }
+
+
+def _enregistrer(connexion, lignes):
+    insert = insert_postgres if connexion.dialect.name == 'postgresql' else insert_sqlite
+    colonnes = [nom for nom in lignes[0] if nom != 'kri_id']
+    for i in range(0, len(lignes), TAILLE_LOT):
+        instruction = insert(PrevisionKRI.__table__).values(lignes[i:i + TAILLE_LOT])
+        connexion.execute(instruction.on_conflict_do_update(
+            index_elements=['kri_id'],
+            set_={nom: instruction.excluded[nom] for nom in colonnes},
+        ))
+
+
+def recalculer(kri_ids, connexion=None, horizon=HORIZON_JOURS):
+    """Ajuste et enregistre les prévisions des indicateurs donnés (deux requêtes par lot)"""
+    connexion = connexion or db.session.connection()
+    kri_ids = sorted(set(kri_ids))
+    indicateurs, mesures = [], []
+    for i in range(0, len(kri_ids), TAILLE_LOT):
+        lot = kri_ids[i:i + TAILLE_LOT]
+        indicateurs += connexion.execute(select(
+            KRI.id, KRI.seuil_alerte, KRI.seuil_critique, KRI.sens_evaluation_seuil, KRI.client_id,
+        ).where(KRI.id.in_(lot))).all()
+        mesures += connexion.execute(
+            select(MesureKRI.kri_id, MesureKRI.date_mesure, MesureKRI.valeur)
+            .where(MesureKRI.kri_id.in_(lot))
+            .order_by(MesureKRI.kri_id, MesureKRI.date_mesure)
+        ).all()
+    if not indicateurs:
+        return 0
+    resultats = prevoir([ligne[:4] for ligne in indicateurs], mesures, horizon=horizon)
+    clients = {ligne[0]: ligne[4] for ligne in indicateurs}
+    _enregistrer(connexion, list(_lignes_previsions(resultats, clients, horizon, datetime.utcnow())))
+    return len(indicateurs)
+
+
+def rafraichir(kri_ids=None, connexion=None):
+    """Recalcule les prévisions absentes, périmées (nouvelle mesure) ou antérieures à une modification de l'indicateur"""
+    connexion = connexion or db.session.connection()
+    selection = (
+        select(KRI.id).where(KRI.est_actif == true())
+        .outerjoin(PrevisionKRI, PrevisionKRI.kri_id == KRI.id)
+        .where(or_(
+            PrevisionKRI.kri_id.is_(None),
+            PrevisionKRI.perime == true(),
+            PrevisionKRI.calcule_le < KRI.updated_at,
+        ))
+    )
+    if kri_ids is not None:
+        selection = selection.where(KRI.id.in_(kri_ids))
+    nb = recalculer(connexion.execute(selection).scalars().all(), connexion)
+    if nb:
+        logger.debug("Prévisions KRI recalculées : %d indicateur(s)", nb)
+    return nb
+
+
+def previsions(kri_ids):
+    """{kri_id: PrevisionKRI} des indicateurs demandés, recalculées seulement si périmées"""
+    rafraichir(kri_ids)
+    return {p.kri_id: p for p in PrevisionKRI.query.filter(PrevisionKRI.kri_id.in_(kri_ids))}
+
+
+def points_prevus(prevision, pas_jours=7):
+    """Points (date ISO, valeur) de la droite prévue jusqu'à l'horizon, pour les graphiques"""
+    if prevision is None or prevision.modele is None:
+        return []
+    points = []
+    for jours in range(0, (prevision.horizon_jours or HORIZON_JOURS) + 1, pas_jours):
+        moment = prevision.derniere_date + timedelta(days=jours)
+        points.append({'date': moment.isoformat(), 'valeur': round(prevision.valeur_prevue(moment), 4)})
+    return points
+
+
+# ========================
+# ALERTES PRÉCOCES
+# ========================
+
+def _niveau_prevu(prevision, etat):
+    """Niveau d'avertissement à envoyer : seuil dont le franchissement est prévu et pas encore atteint"""
+    if prevision.date_seuil_critique is not None and etat not in ETATS_CRITIQUES:
+        return 'critique'
+    if prevision.date_seuil_alerte is not None and etat not in ETATS_ALERTE:
+        return 'alerte'
+    return None
+
+
+def avertir(kri_ids=None):
+    """
+    Notifie le responsable de mesure (à défaut le créateur) des indicateurs
+    dont le franchissement d'un seuil est prévu dans l'horizon. Un niveau
+    déjà annoncé ne l'est pas de nouveau ; il est oublié dès que la
+    prévision ne l'annonce plus. À appeler après rafraichir().
+    """
+    from services.notification_service import NotificationService
+
+    requete = db.session.query(PrevisionKRI, KRI, EtatKRI.etat).join(
+        KRI, KRI.id == PrevisionKRI.kri_id
+    ).outerjoin(EtatKRI, EtatKRI.kri_id == PrevisionKRI.kri_id).filter(KRI.est_actif == true())
+    if kri_ids is not None:
+        requete = requete.filter(KRI.id.in_(kri_ids))
+
+    avertissements = []
+    for prevision, kri, etat in requete.all():
+        niveau = _niveau_prevu(prevision, etat)
+        if niveau is None:
+            prevision.niveau_signale = None
+            continue
+        if prevision.niveau_signale in (niveau, 'critique'):
+            continue
+        prevision.niveau_signale = niveau
+        destinataire_id = kri.responsable_mesure_id or kri.created_by
+        if destinataire_id:
+            avertissements.append((destinataire_id, kri, prevision, niveau))
+    db.session.commit()
+
+    for destinataire_id, kri, prevision, niveau in avertissements:
+        date_seuil = prevision.date_seuil_critique if niveau == 'critique' else prevision.date_seuil_alerte
+        seuil = kri.seuil_critique if niveau == 'critique' else kri.seuil_alerte
+        libelle = 'critique' if niveau == 'critique' else "d'alerte"
+        NotificationService.create(
+            destinataire_id=destinataire_id,
+            type_notif=Notification.TYPE_KRI_ALERTE,
+            titre=f"Prévision {kri.get_type_display()}: {kri.nom}",
+            message=f"Franchissement du seuil {libelle} ({seuil}) prévu vers le {date_seuil:%d/%m/%Y}",
+            urgence=Notification.URGENCE_IMPORTANT,
+            entite_type='kri',
+            entite_id=kri.id,
+            actions=[{'url': f'/kri/{kri.id}/detail', 'label': 'Voir le KRI', 'icon': 'chart-line'}],
+            donnees={
+                'prevision': True,
+                'niveau': niveau,
+                'date_prevue': date_seuil.isoformat(),
+                'modele': prevision.modele,
+                'valeur_actuelle': prevision.niveau,
+                'pente_jour': prevision.pente_jour,
+            },
+        )
+    return len(avertissements)
+
+
+def actualiser():
+    """Tâche planifiée : états et prévisions périmés recalculés, puis alertes précoces"""
+    from services.analyse_kri import rafraichir as rafraichir_etats
+
+    rafraichir_etats()
+    nb_previsions = rafraichir()
+    db.session.commit()
+    nb_avertissements = avertir()
+    return {'previsions': nb_previsions, 'avertissements': nb_avertissements}
+
+
+# ========================
+# INITIALISATION
+# ========================
+
+def init_prevision_kri(app):
+    from services.analyse_kri import TABLES_PERIMABLES
+    if PrevisionKRI.__table__ not in TABLES_PERIMABLES:
+        TABLES_PERIMABLES.append(PrevisionKRI.__table__)
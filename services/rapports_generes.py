@@ -0,0 +1,514 @@
+# services/rapports_generes.py
+"""
+Génération des rapports en arrière-plan, avec cache des fichiers produits.
+
+Les exports PDF/Word (reportlab, python-docx, weasyprint) prenaient le
+worker web pendant tout le rendu. Ils passent par une file :
+
+    en_attente -> en_cours -> termine   (fichier dans RAPPORTS_DOSSIER)
+                          \\-> echec
+
+- La table rapports_generes (RapportGenere) sert de file et de cache : une
+  ligne par (entité, type de rapport, version des données).
+- Version des données : empreinte des lignes de l'audit, de la cartographie
+  ou du logigramme (et de leurs constatations, risques, éléments...). Un
+  rapport déjà rendu pour la même version est resservi sans nouveau rendu ;
+  toute modification change la version et provoque un nouveau rendu. Les
+  fichiers des versions précédentes sont supprimés.
+- Rendu dans un pool de processus (RAPPORTS_PROCESSUS) : reportlab et
+  weasyprint sont liés au CPU et ne bloquent plus les threads du processus
+  web ou du worker. Chaque processus charge l'application une fois et
+  exécute la route d'export existante au nom du demandeur, dans un contexte
+  de requête ; le rendu lui-même n'est pas dupliqué.
+- Suivi : /api/rapports/<id>/statut, interrogé par la page d'attente.
+
+Les traiteurs tournent dans worker.py ; en développement
+(RAPPORTS_TRAITEUR_EMBARQUE) ils démarrent dans le processus web à la
+première demande.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select, update
+
+from models import db, RapportGenere
+
+logger = logging.getLogger(__name__)
+
+NB_PROCESSUS = 2
+MAX_TENTATIVES = 2
+DELAI_EXPIRATION = 600      # secondes
+INTERVALLE_SCRUTATION = 3   # secondes
+TAILLE_LOT = 500
+
+STATUTS_ACTIFS = (RapportGenere.STATUT_EN_ATTENTE, RapportGenere.STATUT_EN_COURS)
+
+# entite : 'audit', 'cartographie', 'logigramme' ou 'client' (tableau de bord, 0 : tous les clients)
+# argument : paramètre de la route d'export recevant l'identifiant de l'entité (chemin ou requête)
+TypeRapport = namedtuple('TypeRapport', ['libelle', 'entite', 'endpoint', 'argument'])
+
+TYPES_RAPPORT = {
+    'audit_pdf': TypeRapport("Rapport d'audit complet (PDF)", 'audit', 'export_rapport_audit_complet', 'audit_id'),
+    'audit_rapport_pdf': TypeRapport("Rapport d'audit et fichiers (PDF)", 'audit', 'export_rapport_audit_pdf',
+                                     'audit_id'),
+    'audit_word': TypeRapport("Rapport d'audit (Word)", 'audit', 'export_rapport_audit_word', 'audit_id'),
+    'audit_synthese_word': TypeRapport("Synthèse d'audit (Word)", 'audit', 'export_synthese_word', 'audit_id'),
+    'cartographie_excel': TypeRapport("Cartographie des risques (Excel)", 'cartographie',
+                                      'export_risques_excel', 'cartographie_id'),
+    'dashboard_pdf': TypeRapport("Tableau de bord (PDF)", 'client', 'export_dashboard', 'client_id'),
+    'logigramme_pdf': TypeRapport("Logigramme (PDF)", 'logigramme', 'export_logigramme_pdf', 'activite_id'),
+    'logigramme_diagramme_pdf': TypeRapport("Diagramme du logigramme (PDF)", 'logigramme',
+                                            'export_diagramme_complet', 'activite_id'),
+    'logigramme_visuel_pdf': TypeRapport("Logigramme visuel (PDF)", 'logigramme',
+                                         'export_logigramme_visuel', 'activite_id'),
+}
+
+_traiteur_embarque = None
+_verrou_embarque = threading.Lock()
+
+
+class RenduImpossible(Exception):
+    """La route d'export n'a pas produit de fichier (redirection, page d'erreur)"""
+
+
+def dossier_rapports(app):
+    return app.config.get('RAPPORTS_DOSSIER') or os.path.join(app.instance_path, 'rapports')
+
+
+# ========================
+# VERSION DES DONNÉES
+# ========================
+
+def _ajouter_lignes(empreinte, table, condition):
+    """Ajoute à l'empreinte toutes les colonnes des lignes sélectionnées (lues par lots)"""
+    resultat = db.session.execute(
+        select(table).where(condition).order_by(*table.primary_key.columns).execution_options(yield_per=TAILLE_LOT)
+    )
+    nombre = 0
+    for ligne in resultat:
+        empreinte.update(repr(tuple(ligne)).encode('utf-8'))
+        nombre += 1
+    empreinte.update(f"|{table.name}:{nombre}|".encode('utf-8'))
+
+
+def _ajouter_agregats(empreinte, modele, condition=None):
+    """Nombre de lignes, plus grand id et dernière mise à jour d'une table entière"""
+    colonnes = [func.count(modele.id), func.max(modele.id)]
+    if hasattr(modele, 'updated_at'):
+        colonnes.append(func.max(modele.updated_at))
+    requete = select(*colonnes)
+    if condition is not None:
+        requete = requete.where(condition)
+    empreinte.update(f"|{modele.__tablename__}:{tuple(db.session.execute(requete).one())!r}|".encode('utf-8'))
+
+
+def _version_audit(empreinte, audit_id):
+    from models import Audit, Constatation, FichierRapport, PlanAction, Recommandation
+
+    _ajouter_lignes(empreinte, Audit.__table__, Audit.id == audit_id)
+    for modele in (Constatation, Recommandation, PlanAction, FichierRapport):
+        _ajouter_lignes(empreinte, modele.__table__, modele.audit_id == audit_id)
+
+
+def _version_cartographie(empreinte, cartographie_id):
+    from models import Cartographie, ChampPersonnaliseRisque, EvaluationRisque, KRI, MesureKRI, Risque
+
+    risques = select(Risque.id).where(Risque.cartographie_id == cartographie_id).scalar_subquery()
+    _ajouter_lignes(empreinte, Cartographie.__table__, Cartographie.id == cartographie_id)
+    _ajouter_lignes(empreinte, Risque.__table__, Risque.cartographie_id == cartographie_id)
+    for modele in (EvaluationRisque, KRI, ChampPersonnaliseRisque):
+        _ajouter_lignes(empreinte, modele.__table__, modele.risque_id.in_(risques))
+    _ajouter_agregats(empreinte, MesureKRI, MesureKRI.kri_id.in_(
+        select(KRI.id).where(KRI.risque_id.in_(risques)).scalar_subquery()
+    ))
+
+
+def _version_logigramme(empreinte, activite_id):
+    from models import ElementLogigramme, LienLogigramme, ProcessusActivite
+
+    _ajouter_lignes(empreinte, ProcessusActivite.__table__, ProcessusActivite.id == activite_id)
+    for modele in (ElementLogigramme, LienLogigramme):
+        _ajouter_lignes(empreinte, modele.__table__, modele.activite_id == activite_id)
+
+
+def _version_client(empreinte, client_id):
+    """
+    Tableau de bord : agrégats des tables du client (client_id 0 : tous les
+    clients, vue du super admin), et la date (périodes glissantes)
+    """
+    from models import (
+        ActionConformite, Audit, EvaluationRisque, KRI, MesureKRI, Processus, ProcessusActivite, Risque,
+        VeilleReglementaire
+    )
+
+    empreinte.update(date.today().isoformat().encode('ascii'))
+    tous_clients = not client_id
+    for modele in (Risque, KRI, Audit, ActionConformite, VeilleReglementaire, Processus, ProcessusActivite):
+        _ajouter_agregats(empreinte, modele, None if tous_clients else modele.client_id == client_id)
+    # Évaluations et mesures : rattachées au client par leur risque et leur indicateur
+    _ajouter_agregats(empreinte, EvaluationRisque, None if tous_clients else EvaluationRisque.risque_id.in_(
+        select(Risque.id).where(Risque.client_id == client_id).scalar_subquery()
+    ))
+    _ajouter_agregats(empreinte, MesureKRI, None if tous_clients else MesureKRI.kri_id.in_(
+        select(KRI.id).where(KRI.client_id == client_id).scalar_subquery()
+    ))
+
+
+_VERSIONS = {
+    'audit': _version_audit,
+    'cartographie': _version_cartographie,
+    'logigramme': _version_logigramme,
+    'client': _version_client,
+}
+
+
+def version_donnees(entite, entite_id):
+    """Empreinte SHA-256 des données d'une entité : change dès qu'une ligne concernée change"""
+    empreinte = hashlib.sha256(f"{entite}:{entite_id}".encode('utf-8'))
+    _VERSIONS[entite](empreinte, entite_id)
+    return empreinte.hexdigest()
+
+
+# ========================
+# SOUMISSION ET SUIVI
+# ========================
+
+def fichier_disponible(rapport):
+    return rapport.est_termine and bool(rapport.chemin) and os.path.isfile(rapport.chemin)
+
+
+def soumettre_rapport(type_rapport, entite_id, user_id=None, client_id=None):
+    """
+    Demande un rapport. Retourne (rapport, cree) : un rapport de la même
+    version déjà rendu (cache) ou en cours de rendu est réutilisé.
+    """
+    if type_rapport not in TYPES_RAPPORT:
+        raise ValueError(f"Type de rapport inconnu: {type_rapport}")
+    definition = TYPES_RAPPORT[type_rapport]
+    version = version_donnees(definition.entite, entite_id)
+
+    existants = RapportGenere.query.filter(
+        RapportGenere.entite_type == definition.entite,
+        RapportGenere.entite_id == entite_id,
+        RapportGenere.type_rapport == type_rapport,
+        RapportGenere.version_donnees == version,
+        RapportGenere.statut.in_(STATUTS_ACTIFS + (RapportGenere.STATUT_TERMINE,)),
+    ).order_by(RapportGenere.id.desc()).all()
+    for existant in existants:
+        if existant.est_actif or fichier_disponible(existant):
+            logger.info("Rapport %s de %s %s réutilisé (%s, rapport %s)", type_rapport, definition.entite,
+                        entite_id, existant.statut, existant.id)
+            return existant, False
+
+    rapport = RapportGenere(
+        type_rapport=type_rapport, entite_type=definition.entite, entite_id=entite_id, version_donnees=version,
+        statut=RapportGenere.STATUT_EN_ATTENTE, etape="En file d'attente", tentatives=0,
+        client_id=client_id, created_by=user_id,
+    )
+    db.session.add(rapport)
+    db.session.commit()
+
+    _reveiller_traiteur_embarque()
+    return rapport, True
+
+
+def position_dans_file(rapport):
+    if rapport.statut != RapportGenere.STATUT_EN_ATTENTE:
+        return 0
+    return db.session.query(func.count(RapportGenere.id)).filter(
+        RapportGenere.statut == RapportGenere.STATUT_EN_ATTENTE, RapportGenere.id < rapport.id
+    ).scalar() + 1
+
+
+def etat_rapport(rapport):
+    """Représentation JSON de l'avancement d'un rapport"""
+    definition = TYPES_RAPPORT.get(rapport.type_rapport)
+    return {
+        'id': rapport.id,
+        'type_rapport': rapport.type_rapport,
+        'libelle': definition.libelle if definition else rapport.type_rapport,
+        'entite_type': rapport.entite_type,
+        'entite_id': rapport.entite_id,
+        'statut': rapport.statut,
+        'etape': rapport.etape,
+        'erreur': rapport.erreur,
+        'position': position_dans_file(rapport),
+        'disponible': fichier_disponible(rapport),
+        'nom_fichier': rapport.nom_fichier,
+        'taille': rapport.taille,
+        'date_debut': rapport.date_debut.isoformat() if rapport.date_debut else None,
+        'date_fin': rapport.date_fin.isoformat() if rapport.date_fin else None,
+    }
+
+
+def compter_telechargement(rapport_id):
+    db.session.execute(
+        update(RapportGenere).where(RapportGenere.id == rapport_id)
+        .values(nb_telechargements=func.coalesce(RapportGenere.nb_telechargements, 0) + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+# ========================
+# RÉSERVATION
+# ========================
+
+def _mettre_a_jour(rapport_id, **valeurs):
+    db.session.execute(
+        update(RapportGenere).where(RapportGenere.id == rapport_id).values(**valeurs)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def reserver_prochain(detenteur):
+    """Réserve atomiquement le plus ancien rapport en file ; retourne son id ou None"""
+    for _ in range(3):  # un autre traiteur peut le prendre entre la lecture et l'UPDATE
+        rapport_id = db.session.query(func.min(RapportGenere.id)).filter(
+            RapportGenere.statut == RapportGenere.STATUT_EN_ATTENTE
+        ).scalar()
+        if rapport_id is None:
+            return None
+        pris = db.session.execute(
+            update(RapportGenere)
+            .where(RapportGenere.id == rapport_id, RapportGenere.statut == RapportGenere.STATUT_EN_ATTENTE)
+            .values(statut=RapportGenere.STATUT_EN_COURS, detenteur=detenteur, date_debut=datetime.utcnow(),
+                    tentatives=func.coalesce(RapportGenere.tentatives, 0) + 1, etape='Rendu en cours', erreur=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if pris:
+            return rapport_id
+    return None
+
+
+def reprendre_expires(delai=DELAI_EXPIRATION, max_tentatives=MAX_TENTATIVES):
+    """Remet en file (ou en échec) les rapports dont le traiteur a disparu"""
+    limite = datetime.utcnow() - timedelta(seconds=delai)
+    expires = (RapportGenere.statut == RapportGenere.STATUT_EN_COURS, RapportGenere.date_debut < limite)
+    remis = db.session.execute(
+        update(RapportGenere).where(*expires, func.coalesce(RapportGenere.tentatives, 0) < max_tentatives)
+        .values(statut=RapportGenere.STATUT_EN_ATTENTE, etape="Remis en file (délai dépassé)", detenteur=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    abandonnes = db.session.execute(
+        update(RapportGenere).where(*expires)
+        .values(statut=RapportGenere.STATUT_ECHEC, etape='Échec', erreur='Délai de rendu dépassé',
+                date_fin=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if remis or abandonnes:
+        logger.warning("Rapports expirés: %d remis en file, %d en échec", remis, abandonnes)
+    return remis, abandonnes
+
+
+def purger_versions_precedentes(rapport):
+    """Supprime les fichiers et lignes des versions antérieures du même rapport"""
+    anciens = RapportGenere.query.filter(
+        RapportGenere.entite_type == rapport.entite_type,
+        RapportGenere.entite_id == rapport.entite_id,
+        RapportGenere.type_rapport == rapport.type_rapport,
+        RapportGenere.version_donnees != rapport.version_donnees,
+        RapportGenere.statut.in_((RapportGenere.STATUT_TERMINE, RapportGenere.STATUT_ECHEC)),
+    ).all()
+    for ancien in anciens:
+        if ancien.chemin and os.path.isfile(ancien.chemin):
+            try:
+                os.remove(ancien.chemin)
+            except OSError as e:
+                logger.warning("Fichier de rapport %s non supprimé: %s", ancien.chemin, e)
+        db.session.delete(ancien)
+    db.session.commit()
+    return len(anciens)
+
+
+# ========================
+# RENDU (PROCESSUS DU POOL)
+# ========================
+
+_application = None
+
+
+def _initialiser_processus():
+    """Chargée une fois par processus du pool : importe l'application Flask"""
+    global _application
+    from app import app
+    _application = app
+
+
+def rendre_rapport(rapport_id):
+    """
+    Exécutée dans un processus du pool : appelle la route d'export au nom du
+    demandeur et enregistre la réponse dans RAPPORTS_DOSSIER.
+    Retourne {'chemin', 'nom_fichier', 'mimetype', 'taille'}.
+    """
+    from flask import url_for
+    from flask_login import login_user
+    from werkzeug.http import parse_options_header
+    from werkzeug.utils import secure_filename
+    from models import User
+
+    app = _application
+    if app is None:
+        _initialiser_processus()
+        app = _application
+
+    with app.app_context():
+        rapport = db.session.get(RapportGenere, rapport_id)
+        definition = TYPES_RAPPORT[rapport.type_rapport]
+        utilisateur = db.session.get(User, rapport.created_by) if rapport.created_by else None
+        if utilisateur is None:
+            raise RenduImpossible("Demandeur du rapport introuvable")
+
+        arguments = {definition.argument: rapport.entite_id} if definition.argument else {}
+        with app.test_request_context():
+            chemin_route = url_for(definition.endpoint, **arguments)
+
+        with app.test_request_context(chemin_route):
+            login_user(utilisateur)
+            reponse = app.make_response(app.preprocess_request() or app.dispatch_request())
+
+        try:
+            if reponse.status_code != 200 or reponse.mimetype == 'text/html':
+                raise RenduImpossible(f"La route {definition.endpoint} a répondu {reponse.status_code} "
+                                      f"({reponse.mimetype}) au lieu d'un fichier")
+            _, options = parse_options_header(reponse.headers.get('Content-Disposition', ''))
+            nom_fichier = options.get('filename') or f"{rapport.type_rapport}_{rapport.entite_id}"
+
+            dossier = dossier_rapports(app)
+            os.makedirs(dossier, exist_ok=True)
+            chemin = os.path.join(dossier, f"{rapport.id}_{secure_filename(nom_fichier) or 'rapport'}")
+            with open(chemin, 'wb') as fichier:
+                for bloc in reponse.iter_encoded():
+                    fichier.write(bloc)
+        finally:
+            reponse.close()
+
+        return {'chemin': chemin, 'nom_fichier': nom_fichier, 'mimetype': reponse.mimetype,
+                'taille': os.path.getsize(chemin)}
+
+
+# ========================
+# TRAITEURS
+# ========================
+
+class TraiteurRapports:
+    """Threads qui vident la file et confient chaque rendu au pool de processus"""
+
+    def __init__(self, app, nb_processus=None, intervalle=INTERVALLE_SCRUTATION):
+        self.app = app
+        self.nb_processus = nb_processus or app.config.get('RAPPORTS_PROCESSUS', NB_PROCESSUS)
+        self.intervalle = intervalle
+        self._arret = threading.Event()
+        self._reveil = threading.Event()
+        self._threads = []
+        self._pool = None
+        self._verrou_pool = threading.Lock()
+
+    def _obtenir_pool(self):
+        with self._verrou_pool:
+            if self._pool is None:
+                # spawn : pas de fork d'un processus qui a déjà des threads et des connexions ouvertes
+                contexte = multiprocessing.get_context(self.app.config.get('RAPPORTS_DEMARRAGE_PROCESSUS', 'spawn'))
+                self._pool = ProcessPoolExecutor(max_workers=self.nb_processus, mp_context=contexte,
+                                                 initializer=_initialiser_processus)
+            return self._pool
+
+    def _recreer_pool(self, pool_casse):
+        with self._verrou_pool:
+            if self._pool is pool_casse:
+                self._pool = None
+        pool_casse.shutdown(wait=False, cancel_futures=True)
+
+    def demarrer(self):
+        from services.taches_planifiees import identifiant_processus
+
+        for numero in range(self.nb_processus):
+            thread = threading.Thread(
+                target=self._boucle, args=(f"{identifiant_processus()}:rapport{numero}", numero == 0),
+                name=f'rapports-{numero}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info("%d traiteur(s) de rapports démarré(s)", self.nb_processus)
+        return self
+
+    def reveiller(self):
+        self._reveil.set()
+
+    def arreter(self, delai=30):
+        self._arret.set()
+        self._reveil.set()
+        for thread in self._threads:
+            thread.join(delai)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def executer(self, rapport_id, max_tentatives=MAX_TENTATIVES):
+        """Rend un rapport réservé (statut en_cours) dans le pool et enregistre le résultat"""
+        rapport = db.session.get(RapportGenere, rapport_id)
+        tentatives = rapport.tentatives or 1
+        pool = self._obtenir_pool()
+        try:
+            fichier = pool.submit(rendre_rapport, rapport_id).result()
+        except Exception as e:
+            db.session.rollback()
+            if isinstance(e, BrokenProcessPool):
+                self._recreer_pool(pool)
+            definitif = isinstance(e, RenduImpossible) or tentatives >= max_tentatives
+            logger.log(logging.ERROR if definitif else logging.WARNING,
+                       "Rendu du rapport %s en erreur (tentative %s): %s", rapport_id, tentatives, e)
+            if definitif:
+                _mettre_a_jour(rapport_id, statut=RapportGenere.STATUT_ECHEC, etape='Échec', erreur=str(e)[:2000],
+                               date_fin=datetime.utcnow())
+            else:
+                _mettre_a_jour(rapport_id, statut=RapportGenere.STATUT_EN_ATTENTE, etape='Nouvelle tentative en file',
+                               erreur=str(e)[:2000], detenteur=None)
+            return False
+
+        _mettre_a_jour(rapport_id, statut=RapportGenere.STATUT_TERMINE, etape='Terminé', erreur=None,
+                       date_fin=datetime.utcnow(), **fichier)
+        db.session.expire_all()
+        purges = purger_versions_precedentes(db.session.get(RapportGenere, rapport_id))
+        logger.info("Rapport %s rendu (%s, %d octets, %d version(s) précédente(s) supprimée(s))",
+                    rapport_id, fichier['nom_fichier'], fichier['taille'], purges)
+        return True
+
+    def _boucle(self, detenteur, surveillant):
+        while not self._arret.is_set():
+            rapport_id = None
+            with self.app.app_context():
+                try:
+                    if surveillant:
+                        reprendre_expires()
+                    rapport_id = reserver_prochain(detenteur)
+                    if rapport_id is not None:
+                        self.executer(rapport_id)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Erreur du traiteur de rapports %s", detenteur)
+            if rapport_id is None:
+                self._reveil.wait(self.intervalle)
+                self._reveil.clear()
+
+
+def _reveiller_traiteur_embarque():
+    """En développement, démarre les traiteurs dans le processus web à la première demande"""
+    global _traiteur_embarque
+    from flask import current_app
+
+    if not current_app.config.get('RAPPORTS_TRAITEUR_EMBARQUE'):
+        return
+    with _verrou_embarque:
+        if _traiteur_embarque is None:
+            _traiteur_embarque = TraiteurRapports(current_app._get_current_object()).demarrer()
+    _traiteur_embarque.reveiller()
@@ -0,0 +1,520 @@
+# services/recherche.py
+"""
+Recherche plein texte sur les risques, constatations, recommandations,
+veilles réglementaires et actions de conformité.
+
+Un index unique, tenu à jour dans la transaction des écritures (événements
+du mapper) :
+- SQLite : table virtuelle FTS5 `recherche_fts`, classement bm25 ;
+- PostgreSQL : table `recherche_index` avec une colonne tsvector indexée en
+  GIN, classement ts_rank_cd.
+
+Les textes sont repliés (minuscules, sans accents) avant indexation. Chaque
+mot est indexé tel quel et sous sa racine française : les mots complets de
+la requête sont cherchés par leur racine ("contrôles" trouve "contrôle"),
+le dernier mot en cours de frappe par préfixe ("conformi" trouve
+"conformité"). Sur PostgreSQL la racine vient de la configuration 'french',
+sur SQLite du raciniseur léger de ce module.
+
+Les résultats sont filtrés par client dans l'index (client_id), sans
+jointure vers les tables sources, et les lignes archivées y sont masquées.
+"""
+import logging
+import re
+from unicodedata import normalize
+
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from models import db, Risque, Constatation, Recommandation, VeilleReglementaire, ActionConformite
+
+logger = logging.getLogger(__name__)
+
+TABLE_SQLITE = 'recherche_fts'
+TABLE_POSTGRES = 'recherche_index'
+LONGUEUR_RESUME = 240
+TAILLE_REINDEXATION = 500
+POIDS_TITRE = 10.0  # bm25 (SQLite) : le titre compte dix fois plus que le contenu
+
+MOTS_VIDES = frozenset("""
+    au aux avec ce ces cet cette dans de des du elle elles en est et il ils je la le les leur leurs
+    lui mais me ne nous on ou par pas pour qu que qui sa sans se ses son sont sur ta te tes ton tu
+    un une vos votre vous
+""".split())
+
+# Raciniseur léger (suffixes flexionnels et dérivationnels courants), du plus long au plus court
+SUFFIXES = tuple(sorted((
+    'issements', 'issement', 'atrices', 'ateurs', 'ations', 'atrice', 'ateur', 'ation',
+    'ements', 'ement', 'ances', 'ences', 'ismes', 'istes', 'iques', 'ables', 'euses',
+    'ites', 'ance', 'ence', 'isme', 'iste', 'ique', 'able', 'euse', 'eurs', 'eaux',
+    'eux', 'ite', 'eur', 'ees', 'ee', 'es', 'er', 'ez', 'e', 's', 'x',
+), key=len, reverse=True))
+
+
+def _extrait(*champs):
+    texte = ' '.join(str(c) for c in champs if c)
+    return texte[:LONGUEUR_RESUME]
+
+
+# Entités indexées : code (rowid FTS5 = id * 8 + code), colonnes lues, titre et
+# contenu indexés, masquage, libellé et lien affichés dans les résultats
+ENTITES = {
+    'risque': {
+        'modele': Risque, 'code': 1, 'libelle_type': 'Risque',
+        'colonnes': ('reference', 'intitule', 'description', 'cause_racine', 'consequences',
+                     'processus_concerne', 'categorie', 'is_archived'),
+        'titre': lambda o: f"{o.reference} {o.intitule}",
+        'contenu': lambda o: ' '.join(
+            filter(None, (o.description, o.cause_racine, o.consequences, o.processus_concerne, o.categorie))),
+        'masque': lambda o: bool(o.is_archived),
+        'libelle': lambda o: f"{o.reference} - {o.intitule}",
+        'resume': lambda o: _extrait(o.description),
+        'url': lambda o: f"/risque/{o.id}",
+    },
+    'constatation': {
+        'modele': Constatation, 'code': 2, 'libelle_type': 'Constatation',
+        'colonnes': ('reference', 'description', 'cause_racine', 'processus_concerne', 'conclusion',
+                     'audit_id', 'is_archived'),
+        'titre': lambda o: o.reference,
+        'contenu': lambda o: ' '.join(filter(None, (o.description, o.cause_racine, o.processus_concerne, o.conclusion))),
+        'masque': lambda o: bool(o.is_archived),
+        'libelle': lambda o: f"{o.reference} - {_extrait(o.description)[:80]}",
+        'resume': lambda o: _extrait(o.description),
+        'url': lambda o: f"/audit/{o.audit_id}#constatation-{o.id}",
+    },
+    'recommandation': {
+        'modele': Recommandation, 'code': 3, 'libelle_type': 'Recommandation',
+        'colonnes': ('reference', 'description', 'categorie', 'audit_id'),
+        'titre': lambda o: o.reference,
+        'contenu': lambda o: ' '.join(filter(None, (o.description, o.categorie))),
+        'masque': lambda o: False,
+        'libelle': lambda o: f"{o.reference} - {_extrait(o.description)[:80]}",
+        'resume': lambda o: _extrait(o.description),
+        'url': lambda o: f"/audit/{o.audit_id}#recommandation-{o.id}",
+    },
+    'veille': {
+        'modele': VeilleReglementaire, 'code': 4, 'libelle_type': 'Veille réglementaire',
+        'colonnes': ('titre', 'reference', 'description', 'type_reglementation', 'organisme_emetteur',
+                     'is_active', 'is_archived'),
+        'titre': lambda o: ' '.join(filter(None, (o.reference, o.titre))),
+        'contenu': lambda o: ' '.join(filter(None, (o.description, o.type_reglementation, o.organisme_emetteur))),
+        'masque': lambda o: bool(o.is_archived) or o.is_active is False,
+        'libelle': lambda o: o.titre,
+        'resume': lambda o: _extrait(o.description),
+        'url': lambda o: f"/veille/{o.id}",
+    },
+    'action_conformite': {
+        'modele': ActionConformite, 'code': 5, 'libelle_type': 'Action de conformité',
+        'colonnes': ('description', 'commentaire', 'veille_id', 'is_active', 'is_archived'),
+        'titre': lambda o: o.description,
+        'contenu': lambda o: o.commentaire,
+        'masque': lambda o: bool(o.is_archived) or o.is_active is False,
+        'libelle': lambda o: _extrait(o.description)[:100],
+        'resume': lambda o: _extrait(o.commentaire or o.description),
+        'url': lambda o: f"/veille/{o.veille_id}" if o.veille_id else None,
+    },
+}
+_ENTITE_PAR_MODELE = {definition['modele']: entite for entite, definition in ENTITES.items()}
+_index_actif = False
+
+
+# ========================
+# NORMALISATION DU TEXTE
+# ========================
+
+def replier(texte):
+    """Minuscules sans accents ni ligatures"""
+    if not texte:
+        return ''
+    return normalize('NFKD', str(texte)).encode('ascii', 'ignore').decode('ascii').lower()
+
+
+def mots(texte):
+    """Mots repliés significatifs (hors mots vides)"""
+    return [mot for mot in re.findall(r'[a-z0-9]+', replier(texte)) if mot not in MOTS_VIDES and (len(mot) > 1 or mot.isdigit())]
+
+
+def raciner(mot):
+    """Racine française légère d'un mot replié"""
+    if len(mot) <= 4 or mot.isdigit():
+        return mot
+    for suffixe in SUFFIXES:
+        if mot.endswith(suffixe) and len(mot) - len(suffixe) >= 3:
+            return mot[:-len(suffixe)]
+    return mot
+
+
+def texte_indexe(texte, racines=True):
+    """Texte stocké dans l'index : chaque mot, suivi de sa racine si elle diffère"""
+    resultat = []
+    for mot in mots(texte):
+        resultat.append(mot)
+        if racines:
+            racine = raciner(mot)
+            if racine != mot:
+                resultat.append(racine)
+    return ' '.join(resultat)
+
+
+def analyser_requete(requete):
+    """
+    (mots complets, préfixe) d'une requête saisie : le dernier mot est un
+    préfixe tant que la saisie ne se termine pas par une espace.
+    """
+    termes = mots(requete)
+    if termes and requete and not requete[-1].isspace() and re.search(r'[0-9A-Za-zÀ-ÿ]$', requete):
+        return termes[:-1], termes[-1]
+    return termes, None
+
+
+# ========================
+# MOTEURS (SQLITE FTS5 / POSTGRESQL)
+# ========================
+
+def _dialecte(connexion):
+    return connexion.dialect.name
+
+
+def document(entite, objet):
+    """Valeurs indexées d'une ligne source (objet ORM ou ligne Core)"""
+    definition = ENTITES[entite]
+    return {
+        'entite': entite,
+        'entite_id': objet.id,
+        'client_id': objet.client_id,
+        'masque': definition['masque'](objet),
+        'titre': definition['titre'](objet) or '',
+        'contenu': definition['contenu'](objet) or '',
+        'libelle': (definition['libelle'](objet) or '')[:300],
+        'resume': definition['resume'](objet) or '',
+        'url': definition['url'](objet),
+    }
+
+
+def _ecrire(connexion, documents):
+    """Remplace les entrées d'index des documents"""
+    if not documents:
+        return
+    if _dialecte(connexion) == 'postgresql':
+        connexion.execute(text(f"""
+            INSERT INTO {TABLE_POSTGRES} (entite, entite_id, client_id, masque, libelle, resume, url, vecteur)
+            VALUES (:entite, :entite_id, :client_id, :masque, :libelle, :resume, :url,
+                    setweight(to_tsvector('simple', :titre) || to_tsvector('french', :titre), 'A')
+                    || setweight(to_tsvector('simple', :contenu) || to_tsvector('french', :contenu), 'B'))
+            ON CONFLICT (entite, entite_id) DO UPDATE SET
+                client_id = EXCLUDED.client_id, masque = EXCLUDED.masque, libelle = EXCLUDED.libelle,
+                resume = EXCLUDED.resume, url = EXCLUDED.url, vecteur = EXCLUDED.vecteur
+        """), [dict(d, titre=texte_indexe(d['titre'], racines=False),
+                    contenu=texte_indexe(d['contenu'], racines=False)) for d in documents])
+        return
+    connexion.execute(
+        text(f"DELETE FROM {TABLE_SQLITE} WHERE rowid = :rowid"),
+        [{'rowid': _rowid(d['entite'], d['entite_id'])} for d in documents]
+    )
+    connexion.execute(text(f"""
+        INSERT INTO {TABLE_SQLITE} (rowid, titre, contenu, entite, entite_id, client_id, masque, libelle, resume, url)
+        VALUES (:rowid, :titre, :contenu, :entite, :entite_id, :client_id, :masque, :libelle, :resume, :url)
+    """), [dict(d, rowid=_rowid(d['entite'], d['entite_id']), masque=int(d['masque']),
+                titre=texte_indexe(d['titre']), contenu=texte_indexe(d['contenu'])) for d in documents])
+
+
+def _supprimer(connexion, entite, entite_ids):
+    if not entite_ids:
+        return
+    if _dialecte(connexion) == 'postgresql':
+        connexion.execute(text(f"DELETE FROM {TABLE_POSTGRES} WHERE entite = :entite AND entite_id = :entite_id"),
+                          [{'entite': entite, 'entite_id': i} for i in entite_ids])
+    else:
+        connexion.execute(text(f"DELETE FROM {TABLE_SQLITE} WHERE rowid = :rowid"),
+                          [{'rowid': _rowid(entite, i)} for i in entite_ids])
+
+
+def _rowid(entite, entite_id):
+    return entite_id * 8 + ENTITES[entite]['code']
+
+
+def _requete_sqlite(complets, prefixe):
+    termes = [f'"{raciner(mot)}"' for mot in complets]
+    if prefixe:
+        termes.append(f'"{prefixe}"*')
+    return ' '.join(termes)
+
+
+def _requete_postgres(complets, prefixe):
+    """Expression tsquery et paramètres (mots complets en 'french', préfixe en 'simple')"""
+    parties, parametres = [], {}
+    if complets:
+        parties.append("plainto_tsquery('french', :complets)")
+        parametres['complets'] = ' '.join(complets)
+    if prefixe:
+        parties.append("to_tsquery('simple', :prefixe)")
+        parametres['prefixe'] = f"{prefixe}:*"
+    return ' && '.join(parties), parametres
+
+
+def _filtres(client_id, tous_clients, entites, parametres):
+    conditions = []
+    if not tous_clients:
+        if client_id is None:
+            conditions.append('client_id IS NULL')
+        else:
+            conditions.append('client_id = :client_id')
+            parametres['client_id'] = client_id
+    if entites:
+        noms = []
+        for position, entite in enumerate(entites):
+            parametres[f'entite_{position}'] = entite
+            noms.append(f':entite_{position}')
+        conditions.append(f"entite IN ({', '.join(noms)})")
+    return conditions
+
+
+# ========================
+# RECHERCHE
+# ========================
+
+class RechercheIndisponible(RuntimeError):
+    """Index plein texte absent (base non prise en charge ou FTS5 manquant)"""
+
+
+def index_actif():
+    return _index_actif
+
+
+def rechercher(requete, client_id=None, tous_clients=False, entites=None, page=1, per_page=20):
+    """
+    Résultats classés par pertinence, filtrés par client (client_id, ou
+    tous_clients pour le super admin) et par type d'entité.
+
+    Retourne {'resultats': [...], 'total', 'page', 'per_page', 'pages'}.
+    """
+    if not _index_actif:
+        raise RechercheIndisponible("Index de recherche non disponible")
+    entites = [e for e in (entites or ENTITES) if e in ENTITES]
+    complets, prefixe = analyser_requete(requete)
+    vide = {'resultats': [], 'total': 0, 'page': page, 'per_page': per_page, 'pages': 0}
+    if not (complets or prefixe) or not entites:
+        return vide
+
+    connexion = db.session.connection()
+    parametres = {'limite': per_page, 'decalage': (page - 1) * per_page}
+    if _dialecte(connexion) == 'postgresql':
+        tsquery, parametres_requete = _requete_postgres(complets, prefixe)
+        parametres.update(parametres_requete)
+        conditions = [f"vecteur @@ ({tsquery})", 'NOT masque'] + \
+            _filtres(client_id, tous_clients, entites, parametres)
+        clause = ' AND '.join(conditions)
+        lignes = connexion.execute(text(f"""
+            SELECT entite, entite_id, libelle, resume, url, ts_rank_cd(vecteur, {tsquery}) AS score
+            FROM {TABLE_POSTGRES} WHERE {clause}
+            ORDER BY score DESC, entite_id DESC LIMIT :limite OFFSET :decalage
+        """), parametres).all()
+        total = connexion.execute(text(f"SELECT count(*) FROM {TABLE_POSTGRES} WHERE {clause}"), parametres).scalar()
+    else:
+        parametres['requete'] = _requete_sqlite(complets, prefixe)
+        conditions = [f"{TABLE_SQLITE} MATCH :requete", 'masque = 0'] + \
+            _filtres(client_id, tous_clients, entites, parametres)
+        clause = ' AND '.join(conditions)
+        lignes = connexion.execute(text(f"""
+            SELECT entite, entite_id, libelle, resume, url, -bm25({TABLE_SQLITE}, {POIDS_TITRE}, 1.0) AS score
+            FROM {TABLE_SQLITE} WHERE {clause}
+            ORDER BY score DESC, entite_id DESC LIMIT :limite OFFSET :decalage
+        """), parametres).all()
+        total = connexion.execute(text(f"SELECT count(*) FROM {TABLE_SQLITE} WHERE {clause}"), parametres).scalar()
+
+    return {
+        'resultats': [{
+            'type': ligne.entite,
+            'type_libelle': ENTITES[ligne.entite]['libelle_type'],
+            'id': int(ligne.entite_id),
+            'libelle': ligne.libelle,
+            'extrait': ligne.resume,
+            'url': ligne.url,
+            'score': round(float(ligne.score), 4),
+        } for ligne in lignes],
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': (total + per_page - 1) // per_page,
+    }
+
+
+def filtre_ids(entite, requete, client_id=None, tous_clients=False):
+    """
+    Condition SQL `id IN (ids trouvés dans l'index)` à combiner avec une
+    requête ORM existante ; None si l'index n'est pas disponible ou si la
+    requête ne contient aucun mot significatif.
+    """
+    complets, prefixe = analyser_requete(requete)
+    if not _index_actif or not (complets or prefixe):
+        return None
+    modele = ENTITES[entite]['modele']
+    parametres = {}
+    if db.engine.dialect.name == 'postgresql':
+        tsquery, parametres_requete = _requete_postgres(complets, prefixe)
+        parametres.update(parametres_requete)
+        conditions = [f"vecteur @@ ({tsquery})"] + _filtres(client_id, tous_clients, [entite], parametres)
+        table = TABLE_POSTGRES
+    else:
+        parametres['requete'] = _requete_sqlite(complets, prefixe)
+        conditions = [f"{TABLE_SQLITE} MATCH :requete"] + _filtres(client_id, tous_clients, [entite], parametres)
+        table = TABLE_SQLITE
+    sous_requete = text(f"SELECT entite_id FROM {table} WHERE {' AND '.join(conditions)}").bindparams(**parametres)
+    return modele.id.in_(sous_requete)
+
+
+# ========================
+# SYNCHRONISATION (ÉVÉNEMENTS DU MAPPER)
+# ========================
+
+def _colonnes_modifiees(objet, colonnes):
+    etat = inspect(objet)
+    return any(etat.attrs[colonne].history.has_changes() for colonne in colonnes + ('client_id',))
+
+
+def _apres_insertion(mapper, connexion, objet):
+    if _index_actif:
+        entite = _ENTITE_PAR_MODELE[mapper.class_]
+        _ecrire(connexion, [document(entite, objet)])
+
+
+def _apres_modification(mapper, connexion, objet):
+    if not _index_actif:
+        return
+    entite = _ENTITE_PAR_MODELE[mapper.class_]
+    if _colonnes_modifiees(objet, ENTITES[entite]['colonnes']):
+        _ecrire(connexion, [document(entite, objet)])
+
+
+def _apres_suppression(mapper, connexion, objet):
+    if _index_actif:
+        _supprimer(connexion, _ENTITE_PAR_MODELE[mapper.class_], [objet.id])
+
+
+def _avant_execution_orm(etat):
+    """query.update() / query.delete() sur une entité indexée : lignes touchées réindexées"""
+    if not _index_actif or not (etat.is_update or etat.is_delete) or not etat.is_orm_statement:
+        return None
+    mapper = etat.bind_arguments.get('mapper')
+    entite = _ENTITE_PAR_MODELE.get(mapper.class_) if mapper is not None else None
+    if entite is None:
+        return None
+
+    modele = ENTITES[entite]['modele']
+    selection = select(modele.id)
+    if etat.statement.whereclause is not None:
+        selection = selection.where(etat.statement.whereclause)
+    connexion = etat.session.connection()
+    ids = list(connexion.execute(selection).scalars())
+    resultat = etat.invoke_statement()
+    if etat.is_delete:
+        _supprimer(connexion, entite, ids)
+    else:
+        _reindexer_ids(connexion, entite, ids)
+    return resultat
+
+
+def _lignes(connexion, entite, ids=None):
+    definition = ENTITES[entite]
+    modele = definition['modele']
+    colonnes = [modele.id, modele.client_id] + [getattr(modele, c) for c in definition['colonnes']]
+    requete = select(*colonnes).order_by(modele.id)
+    if ids is not None:
+        requete = requete.where(modele.id.in_(ids))
+    return connexion.execute(requete.execution_options(yield_per=TAILLE_REINDEXATION))
+
+
+def _reindexer_ids(connexion, entite, ids):
+    for position in range(0, len(ids), TAILLE_REINDEXATION):
+        tranche = ids[position:position + TAILLE_REINDEXATION]
+        _ecrire(connexion, [document(entite, ligne) for ligne in _lignes(connexion, entite, tranche)])
+
+
+# ========================
+# CRÉATION ET RECONSTRUCTION DE L'INDEX
+# ========================
+
+def reindexer(entites=None):
+    """Reconstruit l'index (toutes les entités par défaut) ; retourne le nombre de documents"""
+    total = 0
+    with db.engine.begin() as connexion:
+        for entite in entites or ENTITES:
+            if _dialecte(connexion) == 'postgresql':
+                connexion.execute(text(f"DELETE FROM {TABLE_POSTGRES} WHERE entite = :entite"), {'entite': entite})
+            else:
+                connexion.execute(text(f"DELETE FROM {TABLE_SQLITE} WHERE entite = :entite"), {'entite': entite})
+            documents = []
+            for ligne in _lignes(connexion, entite):
+                documents.append(document(entite, ligne))
+                if len(documents) >= TAILLE_REINDEXATION:
+                    _ecrire(connexion, documents)
+                    total += len(documents)
+                    documents = []
+            _ecrire(connexion, documents)
+            total += len(documents)
+    logger.info("Index de recherche reconstruit: %d document(s)", total)
+    return total
+
+
+def assurer_index_recherche():
+    """Crée l'index s'il manque ; retourne True s'il vient d'être créé (à remplir)"""
+    inspecteur = inspect(db.engine)
+    dialecte = db.engine.dialect.name
+    with db.engine.begin() as connexion:
+        if dialecte == 'postgresql':
+            if inspecteur.has_table(TABLE_POSTGRES):
+                return False
+            connexion.execute(text(f"""
+                CREATE TABLE {TABLE_POSTGRES} (
+                    entite VARCHAR(30) NOT NULL,
+                    entite_id INTEGER NOT NULL,
+                    client_id INTEGER,
+                    masque BOOLEAN NOT NULL DEFAULT FALSE,
+                    libelle VARCHAR(300),
+                    resume TEXT,
+                    url VARCHAR(300),
+                    vecteur TSVECTOR NOT NULL,
+                    PRIMARY KEY (entite, entite_id)
+                )
+            """))
+            connexion.execute(text(f"CREATE INDEX ix_{TABLE_POSTGRES}_vecteur ON {TABLE_POSTGRES} USING GIN (vecteur)"))
+            connexion.execute(text(f"CREATE INDEX ix_{TABLE_POSTGRES}_client ON {TABLE_POSTGRES} (client_id, entite)"))
+            return True
+        if dialecte == 'sqlite':
+            if inspecteur.has_table(TABLE_SQLITE):
+                return False
+            connexion.execute(text(f"""
+                CREATE VIRTUAL TABLE {TABLE_SQLITE} USING fts5(
+                    titre, contenu,
+                    entite UNINDEXED, entite_id UNINDEXED, client_id UNINDEXED, masque UNINDEXED,
+                    libelle UNINDEXED, resume UNINDEXED, url UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            """))
+            return True
+    raise RechercheIndisponible(f"Recherche plein texte non prise en charge sur {dialecte}")
+
+
+def init_recherche(app):
+    """Création (et premier remplissage) de l'index, synchronisation par événements"""
+    global _index_actif
+
+    with app.app_context():
+        try:
+            cree = assurer_index_recherche()
+            _index_actif = True
+            if cree:
+                reindexer()
+        except (RechercheIndisponible, OperationalError) as e:
+            logger.warning("Recherche plein texte désactivée: %s", e)
+            _index_actif = False
+            return
+
+    for modele in _ENTITE_PAR_MODELE:
+        if not event.contains(modele, 'after_insert', _apres_insertion):
+            event.listen(modele, 'after_insert', _apres_insertion)
+            event.listen(modele, 'after_update', _apres_modification)
+            event.listen(modele, 'after_delete', _apres_suppression)
+    if not event.contains(Session, 'do_orm_execute', _avant_execution_orm):
+        event.listen(Session, 'do_orm_execute', _avant_execution_orm)
@@ -0,0 +1,544 @@
+# services/repartiteur_ia.py
+"""
+Répartiteur multi-fournisseurs pour les appels IA (OpenAI, Anthropic, Gemini).
+
+- Une session HTTP par fournisseur (connexions keep-alive réutilisées entre
+  les analyses) et des délais stricts : connexion, lecture, et une échéance
+  globale par appel que les nouvelles tentatives ne dépassent jamais.
+- 429 / 5xx / coupure réseau : nouvelle tentative avec recul exponentiel
+  (et gigue), en respectant l'en-tête Retry-After.
+- Deux modes de répartition (IA_MODE_REPARTITION) :
+    * 'secours' (défaut) : le fournisseur suivant n'est appelé qu'après
+      l'échec du précédent ;
+    * 'relance' : si le premier n'a pas répondu après IA_DELAI_RELANCE
+      secondes (ou sa latence p95 observée, si elle est plus longue), le
+      suivant est lancé en parallèle (requête couverte) ; la première
+      réponse valide l'emporte. Les appels perdants vont à leur terme et
+      sont facturés : relancer avant la latence habituelle doublerait la
+      dépense.
+- Une réponse n'est retenue que si elle est exploitable (contenu non vide,
+  JSON valide quand il est demandé).
+- Les réponses écartées (appel perdant, corps non exploitable) sont
+  transmises au rappel sur_reponse_ecartee pour être comptabilisées.
+- Latences, erreurs, 429 et « victoires » sont mesurées par fournisseur
+  (metriques_fournisseurs(), flask ia-fournisseurs).
+
+Le répartiteur expose chat.completions.create comme le client OpenAI :
+ServiceAnalyseIA l'utilise avec IA_FOURNISSEUR=multi. Pour les essais hors
+ligne, services/serveur_ia_local.py simule les trois API
+(OPENAI_BASE_URL, ANTHROPIC_BASE_URL, GEMINI_BASE_URL).
+"""
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_CONNEXION = 5       # secondes
+TIMEOUT_APPEL = 60          # échéance globale d'un appel (tentatives comprises)
+MAX_TENTATIVES = 3
+RECUL_INITIAL = 1.0         # secondes, doublé à chaque tentative
+RECUL_MAX = 20.0
+DELAI_RELANCE = 8.0
+STATUTS_REESSAYABLES = {429, 500, 502, 503, 504, 529}
+
+
+class ErreurFournisseurIA(Exception):
+    """Échec d'un fournisseur (ou de tous) ; reessayable indique une erreur transitoire"""
+
+    def __init__(self, message, fournisseur=None, statut=None, reessayable=False, attente=None, reponse=None):
+        self.fournisseur, self.statut = fournisseur, statut
+        self.reessayable, self.attente = reessayable, attente
+        self.reponse = reponse  # réponse reçue mais inexploitable (jetons consommés)
+        super().__init__(f"{fournisseur}: {message}" if fournisseur else message)
+
+
+class _Objet:
+    """Objet simple à attributs (mime les réponses du SDK OpenAI)"""
+
+    def __init__(self, **attributs):
+        self.__dict__.update(attributs)
+
+
+def reponse_ia(contenu, modele, fournisseur, jetons_prompt=0, jetons_reponse=0, latence_ms=None):
+    """Réponse normalisée, compatible avec response.choices[0].message.content / response.usage"""
+    return _Objet(
+        model=modele,
+        fournisseur=fournisseur,
+        latence_ms=latence_ms,
+        choices=[_Objet(message=_Objet(content=contenu), finish_reason='stop')],
+        usage=_Objet(prompt_tokens=jetons_prompt or 0, completion_tokens=jetons_reponse or 0,
+                     total_tokens=(jetons_prompt or 0) + (jetons_reponse or 0)),
+    )
+
+
+def extraire_json(texte):
+    """Premier objet JSON contenu dans le texte (réponses entourées de prose ou de ```json)"""
+    if not texte:
+        return None
+    try:
+        return json.loads(texte)
+    except ValueError:
+        pass
+    correspondance = re.search(r'\{.*\}', texte, re.DOTALL)
+    if correspondance:
+        try:
+            return json.loads(correspondance.group())
+        except ValueError:
+            return None
+    return None
+
+
+# ========================
+# MÉTRIQUES
+# ========================
+
+class MetriquesFournisseurs:
+    """Compteurs et latences récentes par fournisseur (thread-safe, en mémoire)"""
+
+    def __init__(self, taille=200):
+        self._verrou = threading.Lock()
+        self._taille = taille
+        self._donnees = {}
+
+    def _entree(self, fournisseur):
+        return self._donnees.setdefault(fournisseur, {
+            'appels': 0, 'succes': 0, 'echecs': 0, 'quotas': 0, 'victoires': 0,
+            'latences': deque(maxlen=self._taille),
+        })
+
+    def enregistrer(self, fournisseur, latence_ms, succes, statut=None):
+        with self._verrou:
+            entree = self._entree(fournisseur)
+            entree['appels'] += 1
+            entree['succes' if succes else 'echecs'] += 1
+            if statut == 429:
+                entree['quotas'] += 1
+            if succes:
+                entree['latences'].append(latence_ms)
+
+    def victoire(self, fournisseur):
+        with self._verrou:
+            self._entree(fournisseur)['victoires'] += 1
+
+    def instantane(self):
+        with self._verrou:
+            resultat = {}
+            for fournisseur, entree in self._donnees.items():
+                latences = sorted(entree['latences'])
+                resultat[fournisseur] = {
+                    **{cle: valeur for cle, valeur in entree.items() if cle != 'latences'},
+                    'latence_p50_ms': _centile(latences, 50),
+                    'latence_p95_ms': _centile(latences, 95),
+                    'latence_max_ms': latences[-1] if latences else None,
+                }
+            return resultat
+
+    def reinitialiser(self):
+        with self._verrou:
+            self._donnees.clear()
+
+
+def _centile(valeurs_triees, centile):
+    if not valeurs_triees:
+        return None
+    rang = min(len(valeurs_triees) - 1, int(round(centile / 100 * (len(valeurs_triees) - 1))))
+    return valeurs_triees[rang]
+
+
+METRIQUES = MetriquesFournisseurs()
+
+
+def metriques_fournisseurs():
+    return METRIQUES.instantane()
+
+
+# ========================
+# FOURNISSEURS
+# ========================
+
+class FournisseurIA:
+    """Appel HTTP d'un fournisseur : session réutilisée, délais, recul sur 429"""
+
+    nom = None
+    url_defaut = None
+    modele_defaut = None
+
+    def __init__(self, api_key, modele=None, base_url=None, timeout_connexion=TIMEOUT_CONNEXION,
+                 max_tentatives=MAX_TENTATIVES, taille_pool=4):
+        self.api_key = api_key
+        self.modele = modele or self.modele_defaut
+        self.base_url = (base_url or self.url_defaut).rstrip('/')
+        self.timeout_connexion = timeout_connexion
+        self.max_tentatives = max_tentatives
+        self.session = requests.Session()
+        adaptateur = HTTPAdapter(pool_connections=1, pool_maxsize=taille_pool, max_retries=0)
+        self.session.mount('http://', adaptateur)
+        self.session.mount('https://', adaptateur)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.modele} {self.base_url}>"
+
+    # À définir par fournisseur
+    def _requete(self, messages, temperature, max_tokens, format_json):
+        """(url, en-têtes, corps JSON)"""
+        raise NotImplementedError
+
+    def _lire(self, donnees):
+        """(contenu, modèle, jetons prompt, jetons réponse)"""
+        raise NotImplementedError
+
+    def completer(self, messages, temperature=0.7, max_tokens=1500, format_json=False, timeout=TIMEOUT_APPEL):
+        """Un appel avec nouvelles tentatives, borné par `timeout` secondes au total"""
+        echeance = time.monotonic() + timeout
+        tentative = 0
+        while True:
+            tentative += 1
+            restant = echeance - time.monotonic()
+            if restant <= 0:
+                raise ErreurFournisseurIA(f"délai de {timeout} s dépassé", self.nom, reessayable=True)
+            debut = time.perf_counter()
+            try:
+                reponse = self._envoyer(messages, temperature, max_tokens, format_json, restant)
+            except ErreurFournisseurIA as e:
+                latence_ms = round((time.perf_counter() - debut) * 1000, 1)
+                METRIQUES.enregistrer(self.nom, latence_ms, succes=False, statut=e.statut)
+                attente = self._recul(tentative, e.attente)
+                if not e.reessayable or tentative >= self.max_tentatives \
+                        or time.monotonic() + attente >= echeance:
+                    raise
+                logger.warning("Fournisseur %s : %s, nouvelle tentative dans %.1f s", self.nom, e, attente)
+                time.sleep(attente)
+                continue
+            latence_ms = round((time.perf_counter() - debut) * 1000, 1)
+            METRIQUES.enregistrer(self.nom, latence_ms, succes=True)
+            reponse.latence_ms = latence_ms
+            logger.debug("Fournisseur %s : réponse en %s ms", self.nom, latence_ms)
+            return reponse
+
+    @staticmethod
+    def _recul(tentative, retry_after=None):
+        if retry_after is not None:
+            return min(RECUL_MAX, retry_after)
+        return min(RECUL_MAX, RECUL_INITIAL * 2 ** (tentative - 1)) * random.uniform(0.8, 1.2)
+
+    def _envoyer(self, messages, temperature, max_tokens, format_json, restant):
+        url, en_tetes, corps = self._requete(messages, temperature, max_tokens, format_json)
+        try:
+            reponse = self.session.post(url, headers=en_tetes, json=corps,
+                                        timeout=(min(self.timeout_connexion, restant), restant))
+        except requests.Timeout:
+            raise ErreurFournisseurIA("délai dépassé", self.nom, reessayable=True)
+        except requests.ConnectionError as e:
+            raise ErreurFournisseurIA(f"connexion impossible ({e.__class__.__name__})", self.nom,
+                                      reessayable=True)
+
+        if reponse.status_code >= 400:
+            raise ErreurFournisseurIA(
+                f"HTTP {reponse.status_code} {reponse.text[:200]}", self.nom, statut=reponse.status_code,
+                reessayable=reponse.status_code in STATUTS_REESSAYABLES,
+                attente=_retry_after(reponse.headers.get('Retry-After')),
+            )
+        try:
+            contenu, modele, jetons_prompt, jetons_reponse = self._lire(reponse.json())
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise ErreurFournisseurIA(f"réponse illisible ({e})", self.nom)
+        return reponse_ia(contenu, modele or self.modele, self.nom, jetons_prompt, jetons_reponse)
+
+
+def _retry_after(valeur):
+    try:
+        return max(0.0, float(valeur)) if valeur else None
+    except ValueError:
+        return None
+
+
+def _systeme_et_dialogue(messages):
+    systeme = '\n'.join(m['content'] for m in messages if m.get('role') == 'system')
+    return systeme, [m for m in messages if m.get('role') != 'system']
+
+
+class FournisseurOpenAI(FournisseurIA):
+    nom = 'openai'
+    url_defaut = 'https://api.openai.com/v1'
+    modele_defaut = 'gpt-3.5-turbo'
+
+    def _requete(self, messages, temperature, max_tokens, format_json):
+        corps = {'model': self.modele, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens}
+        if format_json:
+            corps['response_format'] = {'type': 'json_object'}
+        return f"{self.base_url}/chat/completions", {'Authorization': f"Bearer {self.api_key}"}, corps
+
+    def _lire(self, donnees):
+        usage = donnees.get('usage') or {}
+        return (donnees['choices'][0]['message']['content'], donnees.get('model'),
+                usage.get('prompt_tokens'), usage.get('completion_tokens'))
+
+
+class FournisseurAnthropic(FournisseurIA):
+    nom = 'anthropic'
+    url_defaut = 'https://api.anthropic.com'
+    modele_defaut = 'claude-3-sonnet-20240229'
+
+    def _requete(self, messages, temperature, max_tokens, format_json):
+        systeme, dialogue = _systeme_et_dialogue(messages)
+        corps = {'model': self.modele, 'messages': dialogue, 'temperature': temperature, 'max_tokens': max_tokens}
+        if systeme:
+            corps['system'] = systeme
+        en_tetes = {'x-api-key': self.api_key, 'anthropic-version': '2023-06-01'}
+        return f"{self.base_url}/v1/messages", en_tetes, corps
+
+    def _lire(self, donnees):
+        usage = donnees.get('usage') or {}
+        contenu = ''.join(bloc.get('text', '') for bloc in donnees['content'] if bloc.get('type') == 'text')
+        return contenu, donnees.get('model'), usage.get('input_tokens'), usage.get('output_tokens')
+
+
+class FournisseurGemini(FournisseurIA):
+    nom = 'gemini'
+    url_defaut = 'https://generativelanguage.googleapis.com'
+    modele_defaut = 'gemini-pro'
+
+    def _requete(self, messages, temperature, max_tokens, format_json):
+        systeme, dialogue = _systeme_et_dialogue(messages)
+        corps = {
+            'contents': [{'role': 'model' if m['role'] == 'assistant' else 'user', 'parts': [{'text': m['content']}]}
+                         for m in dialogue],
+            'generationConfig': {'temperature': temperature, 'maxOutputTokens': max_tokens},
+        }
+        if systeme:
+            corps['systemInstruction'] = {'parts': [{'text': systeme}]}
+        if format_json:
+            corps['generationConfig']['responseMimeType'] = 'application/json'
+        url = f"{self.base_url}/v1beta/models/{self.modele}:generateContent"
+        return url, {'x-goog-api-key': self.api_key}, corps
+
+    def _lire(self, donnees):
+        usage = donnees.get('usageMetadata') or {}
+        parties = donnees['candidates'][0]['content']['parts']
+        return (''.join(p.get('text', '') for p in parties), self.modele,
+                usage.get('promptTokenCount'), usage.get('candidatesTokenCount'))
+
+
+FOURNISSEURS = {f.nom: f for f in (FournisseurOpenAI, FournisseurAnthropic, FournisseurGemini)}
+VARIABLES_ENV = {
+    'openai': ('OPENAI_API_KEY', 'OPENAI_BASE_URL', 'IA_MODELE_OPENAI'),
+    'anthropic': ('ANTHROPIC_API_KEY', 'ANTHROPIC_BASE_URL', 'IA_MODELE_ANTHROPIC'),
+    'gemini': ('GEMINI_API_KEY', 'GEMINI_BASE_URL', 'IA_MODELE_GEMINI'),
+}
+
+
+# ========================
+# RÉPARTITEUR
+# ========================
+
+class RepartiteurIA:
+    """
+    Appelle les fournisseurs dans l'ordre (secours) ou en requêtes couvertes
+    (relance) et renvoie la première réponse valide.
+    """
+
+    def __init__(self, fournisseurs, mode='secours', delai_relance=DELAI_RELANCE, timeout=TIMEOUT_APPEL):
+        if not fournisseurs:
+            raise ValueError("Aucun fournisseur IA configuré")
+        if mode not in ('relance', 'secours'):
+            raise ValueError(f"Mode de répartition inconnu: {mode}")
+        self.fournisseurs = list(fournisseurs)
+        self.mode = mode
+        self.delai_relance = delai_relance
+        self.timeout = timeout
+        self._executeur = ThreadPoolExecutor(max_workers=4 * len(self.fournisseurs),
+                                             thread_name_prefix='repartiteur-ia')
+        # Interface du client OpenAI (ServiceAnalyseIA, ClientIASimule)
+        self.chat = _Objet(completions=_Objet(create=self._create))
+        self.models = _Objet(list=lambda **kwargs: _Objet(data=[_Objet(id=f.modele) for f in self.fournisseurs]))
+
+    @property
+    def modele(self):
+        """Identifiant stable de la chaîne de fournisseurs (empreinte du cache IA)"""
+        return '+'.join(f"{f.nom}:{f.modele}" for f in self.fournisseurs)
+
+    def _create(self, model=None, messages=None, temperature=0.7, max_tokens=1500, timeout=None,
+                response_format=None, sur_reponse_ecartee=None, **kwargs):
+        """chat.completions.create : `model` est ignoré, chaque fournisseur a le sien"""
+        format_json = bool(response_format and response_format.get('type') == 'json_object')
+        return self.completer(messages, temperature=temperature, max_tokens=max_tokens,
+                              format_json=format_json, timeout=timeout, sur_reponse_ecartee=sur_reponse_ecartee)
+
+    @staticmethod
+    def valide(reponse, format_json=False):
+        contenu = reponse.choices[0].message.content
+        if not contenu or not contenu.strip():
+            return False
+        return not format_json or extraire_json(contenu) is not None
+
+    def _appeler(self, fournisseur, messages, temperature, max_tokens, format_json, echeance):
+        reponse = fournisseur.completer(messages, temperature, max_tokens, format_json,
+                                        timeout=max(0.0, echeance - time.monotonic()))
+        if not self.valide(reponse, format_json):
+            raise ErreurFournisseurIA("réponse vide ou non structurée", fournisseur.nom, reponse=reponse)
+        return reponse
+
+    def _delai_relance(self, en_cours):
+        """Attente avant relance : IA_DELAI_RELANCE, ou la latence p95 des fournisseurs en cours si plus longue"""
+        metriques = METRIQUES.instantane()
+        p95_ms = max((metriques.get(f.nom, {}).get('latence_p95_ms') or 0) for f in en_cours.values())
+        return max(self.delai_relance, p95_ms / 1000)
+
+    def _ecarter(self, en_cours, rappel):
+        """Appels encore en cours et non retenus : comptabilisés quand ils se terminent"""
+        for futur in en_cours:
+            futur.add_done_callback(lambda f: self._signaler_ecartee(f, rappel))
+
+    @staticmethod
+    def _signaler_ecartee(futur, rappel):
+        """Transmet au rappel la réponse d'un appel terminé mais non retenu"""
+        if rappel is None or futur.cancelled():
+            return
+        erreur = futur.exception()
+        reponse = getattr(erreur, 'reponse', None) if erreur is not None else futur.result()
+        if reponse is None:
+            return
+        try:
+            rappel(reponse)
+        except Exception as e:
+            logger.warning("IA : comptabilisation d'une réponse écartée impossible: %s", e)
+
+    def completer(self, messages, temperature=0.7, max_tokens=1500, format_json=False, timeout=None,
+                  sur_reponse_ecartee=None):
+        """
+        Première réponse valide de la chaîne. sur_reponse_ecartee(reponse) reçoit
+        les réponses facturées mais non retenues (appels perdants en mode
+        relance, à leur terme ; corps non exploitables).
+        """
+        echeance = time.monotonic() + (timeout or self.timeout)
+        restants = list(self.fournisseurs)
+        en_cours = {}
+        erreurs = []
+
+        def lancer():
+            fournisseur = restants.pop(0)
+            futur = self._executeur.submit(self._appeler, fournisseur, messages, temperature, max_tokens,
+                                           format_json, echeance)
+            en_cours[futur] = fournisseur
+
+        lancer()
+        while en_cours:
+            restant = echeance - time.monotonic()
+            if restant <= 0:
+                break
+            attente = min(restant, self._delai_relance(en_cours)) if self.mode == 'relance' and restants \
+                else restant
+            termines, _ = wait(en_cours, timeout=attente, return_when=FIRST_COMPLETED)
+
+            if not termines:
+                if not (self.mode == 'relance' and restants):
+                    continue  # échéance globale atteinte : vérifiée en tête de boucle
+                # Pas de réponse dans le délai : requête couverte sur le fournisseur suivant
+                logger.info("IA : %s sans réponse après %.1f s, relance sur %s",
+                            '/'.join(f.nom for f in en_cours.values()), attente, restants[0].nom)
+                lancer()
+                continue
+
+            for futur in termines:
+                fournisseur = en_cours.pop(futur)
+                try:
+                    reponse = futur.result()
+                except Exception as e:
+                    logger.warning("IA : échec du fournisseur %s: %s", fournisseur.nom, e)
+                    erreurs.append(e)
+                    self._signaler_ecartee(futur, sur_reponse_ecartee)
+                    continue
+                METRIQUES.victoire(fournisseur.nom)
+                if en_cours:
+                    logger.info("IA : %s a répondu en premier (%s ms), %s ignoré(s)", fournisseur.nom,
+                                reponse.latence_ms, '/'.join(f.nom for f in en_cours.values()))
+                    self._ecarter(en_cours, sur_reponse_ecartee)
+                return reponse
+
+            if not en_cours and restants:
+                lancer()
+
+        if en_cours:
+            self._ecarter(en_cours, sur_reponse_ecartee)
+            erreurs.append(ErreurFournisseurIA("délai dépassé", '/'.join(f.nom for f in en_cours.values()),
+                                               reessayable=True))
+        raise ErreurFournisseurIA(
+            "aucun fournisseur n'a répondu : " + '; '.join(str(e) for e in erreurs),
+            reessayable=any(getattr(e, 'reessayable', False) for e in erreurs),
+        )
+
+
+def fournisseurs_depuis_environnement(noms=None):
+    """Fournisseurs configurés (clé API présente), dans l'ordre de IA_FOURNISSEURS"""
+    noms = noms or os.environ.get('IA_FOURNISSEURS', 'openai,anthropic,gemini')
+    if isinstance(noms, str):
+        noms = [n.strip().lower() for n in noms.split(',') if n.strip()]
+    fournisseurs = []
+    for nom in noms:
+        if nom not in FOURNISSEURS:
+            logger.warning("Fournisseur IA inconnu ignoré: %s", nom)
+            continue
+        variable_cle, variable_url, variable_modele = VARIABLES_ENV[nom]
+        cle = os.environ.get(variable_cle)
+        if not cle:
+            continue
+        fournisseurs.append(FOURNISSEURS[nom](
+            cle, modele=os.environ.get(variable_modele), base_url=os.environ.get(variable_url),
+            max_tentatives=int(os.environ.get('IA_MAX_TENTATIVES', MAX_TENTATIVES)),
+        ))
+    return fournisseurs
+
+
+_repartiteur = {'instance': None}
+_verrou_repartiteur = threading.Lock()
+
+
+def repartiteur_depuis_environnement():
+    """Répartiteur partagé du processus (sessions HTTP réutilisées), None sans fournisseur configuré"""
+    with _verrou_repartiteur:
+        if _repartiteur['instance'] is None:
+            fournisseurs = fournisseurs_depuis_environnement()
+            if not fournisseurs:
+                return None
+            _repartiteur['instance'] = RepartiteurIA(
+                fournisseurs,
+                mode=os.environ.get('IA_MODE_REPARTITION', 'secours'),
+                delai_relance=float(os.environ.get('IA_DELAI_RELANCE', DELAI_RELANCE)),
+                timeout=float(os.environ.get('IA_TIMEOUT', TIMEOUT_APPEL)),
+            )
+            logger.info("Répartiteur IA : %s (mode %s)", _repartiteur['instance'].modele,
+                        _repartiteur['instance'].mode)
+        return _repartiteur['instance']
+
+
+def init_repartiteur_ia(app):
+    """Enregistre la commande CLI `flask ia-fournisseurs`"""
+    import click
+
+    @app.cli.command('ia-fournisseurs')
+    @click.option('--tester', is_flag=True, help='Envoie une requête courte à la chaîne de fournisseurs')
+    def ia_fournisseurs_command(tester):
+        """Fournisseurs IA configurés et métriques de latence."""
+        repartiteur = repartiteur_depuis_environnement()
+        if repartiteur is None:
+            click.echo("Aucun fournisseur IA configuré (OPENAI_API_KEY, ANTHROPIC_API_KEY, GEMINI_API_KEY)")
+            return
+        click.echo(f"Chaîne : {repartiteur.modele} (mode {repartiteur.mode}, relance {repartiteur.delai_relance} s)")
+        if tester:
+            try:
+                reponse = repartiteur.completer(
+                    [{'role': 'user', 'content': 'Réponds {"ok": true} en JSON.'}], max_tokens=20, format_json=True)
+                click.echo(f"Réponse de {reponse.fournisseur} en {reponse.latence_ms} ms")
+            except ErreurFournisseurIA as e:
+                click.echo(f"Échec : {e}")
+        click.echo(json.dumps(metriques_fournisseurs(), indent=2, ensure_ascii=False))
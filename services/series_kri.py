@@ -0,0 +1,415 @@
+# services/series_kri.py
+"""
+Séries temporelles des indicateurs (KRI/KPI).
+
+Les mesures brutes (mesure_kri) ne sont plus parcourues pour les
+statistiques et les graphiques : chaque écriture tient à jour des agrégats
+par jour, semaine (lundi) et mois (table kri_agregats : nombre, somme,
+somme des carrés, min, max, dernière valeur).
+
+- Insertion (unitaire ou groupée) : agrégats incrémentés par UPSERT, dans la
+  transaction de l'insertion.
+- Modification, suppression : min/max ne se décrémentent pas, les périodes
+  touchées sont recalculées depuis les mesures (une fois par période et par
+  flush, grâce à l'index (kri_id, date_mesure)).
+
+Lecture :
+    statistiques(kri_id)           -> dict (agrégats mensuels, ou journaliers sur un intervalle)
+    serie(kri_id, points_max=200)  -> points du graphique, sous-échantillonnés
+                                      (brut, jour, semaine ou mois selon le nombre de points)
+    valeurs_brutes(kri_id, ...)    -> tableaux NumPy (dates, valeurs), à la demande
+"""
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import case, delete, event, func, inspect, select
+from sqlalchemy.dialects.postgresql import insert as insert_postgres
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+from sqlalchemy.orm import Session
+
+from models import db, AgregatKRI, KRI, MesureKRI
+
+logger = logging.getLogger(__name__)
+
+GRANULARITES = (AgregatKRI.GRANULARITE_JOUR, AgregatKRI.GRANULARITE_SEMAINE, AgregatKRI.GRANULARITE_MOIS)
+POINTS_MAX = 200
+TAILLE_LOT = 5000
+
+_CLE_PERIODES = 'series_kri_periodes'
+_CLE_KRI_SUPPRIMES = 'series_kri_supprimes'
+
+
+# ========================
+# PÉRIODES ET AGRÉGATION
+# ========================
+
+def debut_periode(granularite, moment):
+    jour = moment.date() if isinstance(moment, datetime) else moment
+    if granularite == AgregatKRI.GRANULARITE_SEMAINE:
+        return jour - timedelta(days=jour.weekday())
+    if granularite == AgregatKRI.GRANULARITE_MOIS:
+        return jour.replace(day=1)
+    return jour
+
+
+def periodes(moment):
+    return [(granularite, debut_periode(granularite, moment)) for granularite in GRANULARITES]
+
+
+def _fin_periode(granularite, debut):
+    """Premier jour après la période"""
+    if granularite == AgregatKRI.GRANULARITE_SEMAINE:
+        return debut + timedelta(days=7)
+    if granularite == AgregatKRI.GRANULARITE_MOIS:
+        return (debut.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return debut + timedelta(days=1)
+
+
+def agreger(lignes):
+    """
+    Agrégats par (kri_id, granularité, début de période) d'un itérable de
+    (kri_id, valeur, date_mesure, client_id)
+    """
+    groupes = {}
+    for kri_id, valeur, date_mesure, client_id in lignes:
+        if kri_id is None or valeur is None or date_mesure is None:
+            continue
+        valeur = float(valeur)
+        for granularite, debut in periodes(date_mesure):
+            groupe = groupes.get((kri_id, granularite, debut))
+            if groupe is None:
+                groupes[(kri_id, granularite, debut)] = {
+                    'nb': 1, 'somme': valeur, 'somme_carres': valeur * valeur,
+                    'minimum': valeur, 'maximum': valeur,
+                    'derniere_valeur': valeur, 'derniere_date': date_mesure, 'client_id': client_id,
+                }
+                continue
+            groupe['nb'] += 1
+            groupe['somme'] += valeur
+            groupe['somme_carres'] += valeur * valeur
+            groupe['minimum'] = min(groupe['minimum'], valeur)
+            groupe['maximum'] = max(groupe['maximum'], valeur)
+            if date_mesure >= groupe['derniere_date']:
+                groupe['derniere_valeur'], groupe['derniere_date'] = valeur, date_mesure
+    return groupes
+
+
+def _lignes_agregats(groupes):
+    return [dict(valeurs, kri_id=kri_id, granularite=granularite, debut_periode=debut)
+            for (kri_id, granularite, debut), valeurs in groupes.items()]
+
+
+def _incrementer(connexion, groupes):
+    """Ajoute des groupes de nouvelles mesures aux agrégats existants (UPSERT)"""
+    if not groupes:
+        return
+    dialecte = connexion.dialect.name
+    if dialecte not in ('sqlite', 'postgresql'):
+        # Pas d'UPSERT portable : recalcul des périodes touchées
+        _recalculer(connexion, set(groupes))
+        return
+
+    table = AgregatKRI.__table__
+    instruction = (insert_postgres if dialecte == 'postgresql' else insert_sqlite)(table)
+    nouveau = instruction.excluded
+    instruction = instruction.on_conflict_do_update(
+        index_elements=['kri_id', 'granularite', 'debut_periode'],
+        set_={
+            'nb': table.c.nb + nouveau.nb,
+            'somme': table.c.somme + nouveau.somme,
+            'somme_carres': table.c.somme_carres + nouveau.somme_carres,
+            'minimum': case((nouveau.minimum < table.c.minimum, nouveau.minimum), else_=table.c.minimum),
+            'maximum': case((nouveau.maximum > table.c.maximum, nouveau.maximum), else_=table.c.maximum),
+            'derniere_valeur': case((nouveau.derniere_date >= table.c.derniere_date, nouveau.derniere_valeur),
+                                    else_=table.c.derniere_valeur),
+            'derniere_date': case((nouveau.derniere_date >= table.c.derniere_date, nouveau.derniere_date),
+                                  else_=table.c.derniere_date),
+        }
+    )
+    connexion.execute(instruction, _lignes_agregats(groupes))
+
+
+def _recalculer(connexion, cles):
+    """Recalcule des périodes (kri_id, granularité, début) depuis les mesures"""
+    table = AgregatKRI.__table__
+    for kri_id, granularite, debut in cles:
+        mesures = connexion.execute(
+            select(MesureKRI.kri_id, MesureKRI.valeur, MesureKRI.date_mesure, MesureKRI.client_id).where(
+                MesureKRI.kri_id == kri_id,
+                MesureKRI.date_mesure >= datetime.combine(debut, datetime.min.time()),
+                MesureKRI.date_mesure < datetime.combine(_fin_periode(granularite, debut), datetime.min.time()),
+            )
+        ).all()
+        groupe = agreger(mesures).get((kri_id, granularite, debut))
+        connexion.execute(delete(table).where(
+            table.c.kri_id == kri_id, table.c.granularite == granularite, table.c.debut_periode == debut
+        ))
+        if groupe:
+            connexion.execute(table.insert(), _lignes_agregats({(kri_id, granularite, debut): groupe}))
+
+
+def reconstruire(kri_ids=None, connexion=None):
+    """Recalcule tous les agrégats (ou ceux de quelques indicateurs) ; retourne le nombre de mesures lues"""
+    if connexion is None:
+        with db.engine.begin() as connexion:
+            return reconstruire(kri_ids, connexion)
+
+    table = AgregatKRI.__table__
+    suppression = delete(table)
+    requete = select(MesureKRI.kri_id, MesureKRI.valeur, MesureKRI.date_mesure, MesureKRI.client_id) \
+        .order_by(MesureKRI.kri_id, MesureKRI.date_mesure)
+    if kri_ids is not None:
+        kri_ids = list(kri_ids)
+        suppression = suppression.where(table.c.kri_id.in_(kri_ids))
+        requete = requete.where(MesureKRI.kri_id.in_(kri_ids))
+    connexion.execute(suppression)
+
+    total, lot, kri_courant = 0, [], None
+    for ligne in connexion.execute(requete.execution_options(yield_per=TAILLE_LOT)):
+        # Les mesures arrivent triées par indicateur : agrégats écrits indicateur par indicateur
+        if ligne.kri_id != kri_courant and len(lot) >= TAILLE_LOT:
+            connexion.execute(table.insert(), _lignes_agregats(agreger(lot)))
+            lot = []
+        kri_courant = ligne.kri_id
+        lot.append(tuple(ligne))
+        total += 1
+    if lot:
+        connexion.execute(table.insert(), _lignes_agregats(agreger(lot)))
+    return total
+
+
+# ========================
+# SYNCHRONISATION (ÉVÉNEMENTS)
+# ========================
+
+def _periodes_a_recalculer(session):
+    return session.info.setdefault(_CLE_PERIODES, set())
+
+
+def _apres_insertion(mapper, connexion, mesure):
+    _incrementer(connexion, agreger([(mesure.kri_id, mesure.valeur, mesure.date_mesure, mesure.client_id)]))
+
+
+def _apres_modification(mapper, connexion, mesure):
+    etat = inspect(mesure)
+    if not any(etat.attrs[nom].history.has_changes() for nom in ('kri_id', 'valeur', 'date_mesure')):
+        return
+    # Périodes de l'ancienne et de la nouvelle position de la mesure
+    a_recalculer = _periodes_a_recalculer(etat.session)
+    kri_ids = set(etat.attrs['kri_id'].history.deleted) | {mesure.kri_id}
+    moments = set(etat.attrs['date_mesure'].history.deleted) | {mesure.date_mesure}
+    for kri_id in kri_ids:
+        for moment in moments:
+            if kri_id is not None and moment is not None:
+                a_recalculer.update((kri_id, granularite, debut) for granularite, debut in periodes(moment))
+
+
+def _apres_suppression(mapper, connexion, mesure):
+    if mesure.kri_id is not None and mesure.date_mesure is not None:
+        _periodes_a_recalculer(inspect(mesure).session).update(
+            (mesure.kri_id, granularite, debut) for granularite, debut in periodes(mesure.date_mesure)
+        )
+
+
+def _apres_suppression_kri(mapper, connexion, kri):
+    inspect(kri).session.info.setdefault(_CLE_KRI_SUPPRIMES, set()).add(kri.id)
+
+
+def _apres_flush(session, contexte_flush):
+    periodes_touchees = session.info.pop(_CLE_PERIODES, None)
+    supprimes = session.info.pop(_CLE_KRI_SUPPRIMES, None)
+    if not (periodes_touchees or supprimes):
+        return
+    connexion = session.connection()
+    if supprimes:
+        connexion.execute(delete(AgregatKRI.__table__).where(AgregatKRI.__table__.c.kri_id.in_(supprimes)))
+    if periodes_touchees:
+        _recalculer(connexion, {cle for cle in periodes_touchees if cle[0] not in (supprimes or ())})
+
+
+def _apres_rollback(session, transaction_precedente):
+    session.info.pop(_CLE_PERIODES, None)
+    session.info.pop(_CLE_KRI_SUPPRIMES, None)
+
+
+def _avant_execution_orm(etat):
+    """Instructions groupées sur MesureKRI (insert(MesureKRI) avec une liste, query.update/delete)"""
+    if not (etat.is_insert or etat.is_update or etat.is_delete) or not etat.is_orm_statement:
+        return None
+    mapper = etat.bind_arguments.get('mapper')
+    if mapper is None or mapper.class_ is not MesureKRI:
+        return None
+    connexion = etat.session.connection()
+
+    if etat.is_insert:
+        lignes = etat.parameters if isinstance(etat.parameters, list) else [etat.parameters or {}]
+        _incrementer(connexion, agreger(
+            (ligne.get('kri_id'), ligne.get('valeur'), ligne.get('date_mesure'), ligne.get('client_id'))
+            for ligne in lignes
+        ))
+        return None
+
+    selection = select(MesureKRI.kri_id).distinct()
+    if isinstance(etat.parameters, list):
+        # update(MesureKRI) avec une liste de dicts : mise à jour groupée par clé primaire
+        selection = selection.where(MesureKRI.id.in_([ligne.get('id') for ligne in etat.parameters]))
+    elif etat.statement.whereclause is not None:
+        selection = selection.where(etat.statement.whereclause)
+    kri_ids = [kri_id for kri_id in connexion.execute(selection).scalars() if kri_id is not None]
+    resultat = etat.invoke_statement()
+    if kri_ids:
+        reconstruire(kri_ids, connexion)
+    return resultat
+
+
+# ========================
+# LECTURE
+# ========================
+
+def _conditions(kri_id, granularite, depuis=None, jusqu=None):
+    conditions = [AgregatKRI.kri_id == kri_id, AgregatKRI.granularite == granularite]
+    if depuis is not None:
+        conditions.append(AgregatKRI.debut_periode >= debut_periode(granularite, depuis))
+    if jusqu is not None:
+        conditions.append(AgregatKRI.debut_periode <= debut_periode(granularite, jusqu))
+    return conditions
+
+
+def statistiques(kri_id, depuis=None, jusqu=None):
+    """
+    Statistiques d'un indicateur depuis les agrégats (mensuels, ou journaliers
+    si un intervalle est donné) ; None sans mesure.
+    """
+    granularite = AgregatKRI.GRANULARITE_JOUR if (depuis or jusqu) else AgregatKRI.GRANULARITE_MOIS
+    conditions = _conditions(kri_id, granularite, depuis, jusqu)
+    nb, somme, somme_carres, minimum, maximum = db.session.query(
+        func.sum(AgregatKRI.nb), func.sum(AgregatKRI.somme), func.sum(AgregatKRI.somme_carres),
+        func.min(AgregatKRI.minimum), func.max(AgregatKRI.maximum),
+    ).filter(*conditions).one()
+    if not nb:
+        return None
+
+    derniere = db.session.query(AgregatKRI.derniere_valeur, AgregatKRI.derniere_date) \
+        .filter(*conditions).order_by(AgregatKRI.derniere_date.desc()).first()
+    premier_jour = db.session.query(func.min(AgregatKRI.debut_periode)) \
+        .filter(*_conditions(kri_id, AgregatKRI.GRANULARITE_JOUR, depuis, jusqu)).scalar()
+    moyenne = somme / nb
+    return {
+        'nb_mesures': int(nb),
+        'moyenne': moyenne,
+        'min': minimum,
+        'max': maximum,
+        'ecart_type': float(np.sqrt(max(somme_carres / nb - moyenne * moyenne, 0.0))) if nb > 1 else 0.0,
+        'derniere_valeur': derniere.derniere_valeur,
+        'derniere_date': derniere.derniere_date,
+        'premiere_date': premier_jour,
+        'periode_couverte': (derniere.derniere_date.date() - premier_jour).days if premier_jour else 0,
+    }
+
+
+def derniere_mesure(kri_id):
+    """Dernière mesure par date (index (kri_id, date_mesure))"""
+    return MesureKRI.query.filter_by(kri_id=kri_id) \
+        .order_by(MesureKRI.date_mesure.desc(), MesureKRI.id.desc()).first()
+
+
+def valeurs_brutes(kri_id, depuis=None, jusqu=None):
+    """(dates datetime64, valeurs float64) des mesures brutes, triées par date"""
+    requete = select(MesureKRI.date_mesure, MesureKRI.valeur).where(MesureKRI.kri_id == kri_id)
+    if depuis is not None:
+        requete = requete.where(MesureKRI.date_mesure >= depuis)
+    if jusqu is not None:
+        requete = requete.where(MesureKRI.date_mesure <= jusqu)
+    lignes = db.session.execute(requete.order_by(MesureKRI.date_mesure)).all()
+    dates = np.array([ligne[0] for ligne in lignes], dtype='datetime64[s]')
+    valeurs = np.fromiter((ligne[1] for ligne in lignes), dtype=np.float64, count=len(lignes))
+    return dates, valeurs
+
+
+def serie(kri_id, depuis=None, jusqu=None, points_max=POINTS_MAX):
+    """
+    Points d'un graphique : mesures brutes si elles tiennent dans points_max,
+    sinon la granularité la plus fine qui y tient (jour, semaine, mois).
+
+    Retourne {'granularite', 'dates', 'valeurs', 'minimums', 'maximums', 'nb'}
+    (tableaux NumPy ; valeurs = moyennes par période pour les agrégats).
+    """
+    nb_mesures = db.session.query(func.coalesce(func.sum(AgregatKRI.nb), 0)) \
+        .filter(*_conditions(kri_id, AgregatKRI.GRANULARITE_MOIS if not (depuis or jusqu)
+                             else AgregatKRI.GRANULARITE_JOUR, depuis, jusqu)).scalar()
+    if nb_mesures <= points_max:
+        dates, valeurs = valeurs_brutes(kri_id, depuis, jusqu)
+        return {'granularite': 'brut', 'dates': dates, 'valeurs': valeurs,
+                'minimums': valeurs, 'maximums': valeurs, 'nb': np.ones(len(valeurs), dtype=np.int64)}
+
+    for granularite in GRANULARITES:
+        conditions = _conditions(kri_id, granularite, depuis, jusqu)
+        nb_points = db.session.query(func.count(AgregatKRI.id)).filter(*conditions).scalar()
+        if nb_points <= points_max or granularite == AgregatKRI.GRANULARITE_MOIS:
+            break
+    lignes = db.session.query(
+        AgregatKRI.debut_periode, AgregatKRI.somme, AgregatKRI.nb, AgregatKRI.minimum, AgregatKRI.maximum
+    ).filter(*conditions).order_by(AgregatKRI.debut_periode).all()
+    nb = np.fromiter((l.nb for l in lignes), dtype=np.int64, count=len(lignes))
+    return {
+        'granularite': granularite,
+        'dates': np.array([l.debut_periode for l in lignes], dtype='datetime64[D]'),
+        'valeurs': np.fromiter((l.somme for l in lignes), dtype=np.float64, count=len(lignes)) / np.maximum(nb, 1),
+        'minimums': np.fromiter((l.minimum for l in lignes), dtype=np.float64, count=len(lignes)),
+        'maximums': np.fromiter((l.maximum for l in lignes), dtype=np.float64, count=len(lignes)),
+        'nb': nb,
+    }
+
+
+def serie_json(points):
+    """Série sérialisable (dates ISO, listes de flottants)"""
+    return {
+        'granularite': points['granularite'],
+        'dates': [str(d) for d in np.datetime_as_string(points['dates'], unit='D' if points['granularite'] != 'brut' else 's')],
+        'valeurs': [round(float(v), 6) for v in points['valeurs']],
+        'minimums': [round(float(v), 6) for v in points['minimums']],
+        'maximums': [round(float(v), 6) for v in points['maximums']],
+        'nb': points['nb'].tolist(),
+    }
+
+
+def tendance(kri_id, periode_jours=30):
+    """Tendance ('hausse', 'baisse', 'stable') des mesures des derniers jours (même règle que utils.calculer_tendance_kri)"""
+    _, valeurs = valeurs_brutes(kri_id, depuis=datetime.now() - timedelta(days=periode_jours))
+    if len(valeurs) < 2:
+        return 'stable'
+    pente = np.polyfit(np.arange(len(valeurs)), valeurs, 1)[0]
+    if pente > 0.1:
+        return 'hausse'
+    if pente < -0.1:
+        return 'baisse'
+    return 'stable'
+
+
+# ========================
+# INITIALISATION
+# ========================
+
+def assurer_series_kri():
+    """Index (kri_id, date_mesure) d'une table mesure_kri existante, premier remplissage des agrégats"""
+    index = next(i for i in MesureKRI.__table__.indexes if i.name == 'ix_mesure_kri_kri_date')
+    index.create(db.engine, checkfirst=True)
+    if db.session.query(AgregatKRI.id).first() is None and db.session.query(MesureKRI.id).first() is not None:
+        nb = reconstruire()
+        logger.info("Agrégats KRI calculés depuis %d mesure(s)", nb)
+    db.session.remove()
+
+
+def init_series_kri(app):
+    with app.app_context():
+        assurer_series_kri()
+
+    if not event.contains(MesureKRI, 'after_insert', _apres_insertion):
+        event.listen(MesureKRI, 'after_insert', _apres_insertion)
+        event.listen(MesureKRI, 'after_update', _apres_modification)
+        event.listen(MesureKRI, 'after_delete', _apres_suppression)
+        event.listen(KRI, 'after_delete', _apres_suppression_kri)
+        event.listen(Session, 'after_flush', _apres_flush)
+        event.listen(Session, 'after_soft_rollback', _apres_rollback)
+        event.listen(Session, 'do_orm_execute', _avant_execution_orm)
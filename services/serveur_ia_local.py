@@ -0,0 +1,202 @@
+# services/serveur_ia_local.py
+"""
+Serveur HTTP local qui imite les API OpenAI, Anthropic et Gemini, pour
+essayer le répartiteur (services/repartiteur_ia.py) sans clé ni réseau.
+
+Chaque fournisseur a son comportement réglable : latence, nombre de 429 à
+renvoyer avant de répondre, taux d'erreurs 500, réponse non structurée.
+
+    python -m services.serveur_ia_local --port 8765 --latence openai=12 --quotas anthropic=1
+
+    OPENAI_BASE_URL=http://127.0.0.1:8765/openai/v1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765/anthropic
+    GEMINI_BASE_URL=http://127.0.0.1:8765/gemini
+    (+ une clé quelconque : OPENAI_API_KEY=local ...)
+
+Depuis un script d'essai :
+
+    serveur = ServeurIALocal().demarrer()
+    serveur.regler('openai', latence=3)
+    ... fournisseurs(base_url=serveur.url('openai')) ...
+    serveur.arreter()
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.analyse_ia import ClientIASimule
+
+CHEMINS = {
+    'openai': '/openai/v1/chat/completions',
+    'anthropic': '/anthropic/v1/messages',
+    'gemini': '/gemini/v1beta/models/',
+}
+PREFIXES_URL = {'openai': '/openai/v1', 'anthropic': '/anthropic', 'gemini': '/gemini'}
+
+
+class _Gestionnaire(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive : vérifie la réutilisation des connexions
+
+    def log_message(self, format, *args):
+        pass
+
+    def _repondre(self, statut, donnees, en_tetes=None):
+        corps = json.dumps(donnees, ensure_ascii=False).encode('utf-8')
+        self.send_response(statut)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corps)))
+        for cle, valeur in (en_tetes or {}).items():
+            self.send_header(cle, valeur)
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def do_POST(self):
+        longueur = int(self.headers.get('Content-Length') or 0)
+        try:
+            requete = json.loads(self.rfile.read(longueur) or b'{}')
+        except ValueError:
+            return self._repondre(400, {'error': 'JSON invalide'})
+
+        fournisseur = next((nom for nom, chemin in CHEMINS.items() if self.path.startswith(chemin)), None)
+        if fournisseur is None:
+            return self._repondre(404, {'error': f"chemin inconnu {self.path}"})
+
+        serveur = self.server.serveur_ia
+        reglage = serveur.reglage(fournisseur)
+        serveur.compter(fournisseur, self.client_address)
+
+        if reglage['quotas'] > 0:
+            serveur.consommer_quota(fournisseur)
+            return self._repondre(429, {'error': {'message': 'Rate limit', 'type': 'rate_limit'}},
+                                  {'Retry-After': str(reglage['retry_after'])})
+        time.sleep(reglage['latence'])
+        if reglage['taux_erreur'] and random.random() < reglage['taux_erreur']:
+            return self._repondre(500, {'error': 'Erreur simulée'})
+
+        messages = requete.get('messages') or [
+            {'role': c.get('role', 'user'), 'content': ''.join(p.get('text', '') for p in c.get('parts', []))}
+            for c in requete.get('contents', [])
+        ]
+        if requete.get('system'):
+            messages = [{'role': 'system', 'content': requete['system']}] + messages
+        simulation = serveur.client_simule._completion(model=f"{fournisseur}-local", messages=messages)
+        contenu = 'Réponse non structurée.' if reglage['texte'] else simulation.choices[0].message.content
+        usage = simulation.usage
+
+        if fournisseur == 'openai':
+            return self._repondre(200, {
+                'model': requete.get('model') or 'openai-local',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': contenu},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens,
+                          'total_tokens': usage.total_tokens},
+            })
+        if fournisseur == 'anthropic':
+            return self._repondre(200, {
+                'model': requete.get('model') or 'anthropic-local',
+                'content': [{'type': 'text', 'text': contenu}],
+                'usage': {'input_tokens': usage.prompt_tokens, 'output_tokens': usage.completion_tokens},
+            })
+        return self._repondre(200, {
+            'candidates': [{'content': {'role': 'model', 'parts': [{'text': contenu}]}}],
+            'usageMetadata': {'promptTokenCount': usage.prompt_tokens,
+                              'candidatesTokenCount': usage.completion_tokens},
+        })
+
+
+class ServeurIALocal:
+    """Serveur factice dans un thread ; reglage()/regler() modifiables à chaud"""
+
+    def __init__(self, hote='127.0.0.1', port=0):
+        self._verrou = threading.Lock()
+        self._reglages = {nom: self._reglage_defaut() for nom in CHEMINS}
+        self.requetes = {nom: 0 for nom in CHEMINS}
+        self.connexions = {nom: set() for nom in CHEMINS}
+        self.client_simule = ClientIASimule(latence=0, taux_echec=0)
+        self.httpd = ThreadingHTTPServer((hote, port), _Gestionnaire)
+        self.httpd.daemon_threads = True
+        self.httpd.serveur_ia = self
+        self._thread = None
+
+    @staticmethod
+    def _reglage_defaut():
+        return {'latence': 0.0, 'quotas': 0, 'retry_after': 0, 'taux_erreur': 0.0, 'texte': False}
+
+    @property
+    def adresse(self):
+        hote, port = self.httpd.server_address[:2]
+        return f"http://{hote}:{port}"
+
+    def url(self, fournisseur):
+        """Valeur de XXX_BASE_URL pour ce fournisseur"""
+        return self.adresse + PREFIXES_URL[fournisseur]
+
+    def regler(self, fournisseur, **valeurs):
+        with self._verrou:
+            inconnus = set(valeurs) - set(self._reglages[fournisseur])
+            if inconnus:
+                raise ValueError(f"Réglages inconnus: {', '.join(sorted(inconnus))}")
+            self._reglages[fournisseur].update(valeurs)
+        return self
+
+    def reglage(self, fournisseur):
+        with self._verrou:
+            return dict(self._reglages[fournisseur])
+
+    def consommer_quota(self, fournisseur):
+        with self._verrou:
+            self._reglages[fournisseur]['quotas'] -= 1
+
+    def compter(self, fournisseur, adresse_client):
+        with self._verrou:
+            self.requetes[fournisseur] += 1
+            self.connexions[fournisseur].add(adresse_client)
+
+    def demarrer(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='serveur-ia-local', daemon=True)
+        self._thread.start()
+        return self
+
+    def arreter(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _valeurs_par_fournisseur(valeurs, convertir):
+    resultat = {}
+    for element in valeurs or []:
+        fournisseur, valeur = element.split('=', 1)
+        resultat[fournisseur.strip()] = convertir(valeur)
+    return resultat
+
+
+def main():
+    parseur = argparse.ArgumentParser(description="Serveur IA factice (OpenAI, Anthropic, Gemini)")
+    parseur.add_argument('--hote', default='127.0.0.1')
+    parseur.add_argument('--port', type=int, default=8765)
+    parseur.add_argument('--latence', action='append', help='fournisseur=secondes')
+    parseur.add_argument('--quotas', action='append', help='fournisseur=nombre de 429 avant de répondre')
+    parseur.add_argument('--taux-erreur', action='append', help='fournisseur=0..1 (HTTP 500)')
+    arguments = parseur.parse_args()
+
+    serveur = ServeurIALocal(arguments.hote, arguments.port)
+    for cle, valeurs, convertir in (('latence', arguments.latence, float), ('quotas', arguments.quotas, int),
+                                    ('taux_erreur', arguments.taux_erreur, float)):
+        for fournisseur, valeur in _valeurs_par_fournisseur(valeurs, convertir).items():
+            serveur.regler(fournisseur, **{cle: valeur})
+
+    for fournisseur in CHEMINS:
+        print(f"{fournisseur.upper()}_BASE_URL={serveur.url(fournisseur)}")
+    try:
+        serveur.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        serveur.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
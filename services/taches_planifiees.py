@@ -0,0 +1,378 @@
+# services/taches_planifiees.py
+"""
+Exécution des tâches planifiées hors des workers web.
+
+Les workers gunicorn ne démarrent plus de BackgroundScheduler : les tâches
+sont exécutées par un processus dédié (worker.py). Plusieurs instances de
+worker.py peuvent tourner (redéploiement, plusieurs machines) : une seule
+est « leader » et exécute les tâches, les autres attendent en veille.
+
+- Verrou de leader :
+    PostgreSQL -> pg_try_advisory_lock sur une connexion dédiée (libéré
+                  automatiquement si le processus meurt)
+    autres     -> bail dans la table verrous_taches (VerrouTache), renouvelé
+                  régulièrement et repris par un autre processus à expiration
+- État des tâches : APScheduler SQLAlchemyJobStore (table apscheduler_jobs),
+  les prochaines exécutions survivent aux redémarrages.
+- Historique : une ligne ExecutionTache par exécution (statut, durée, erreur).
+"""
+import importlib
+import os
+import signal
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+NOM_VERROU = 'planificateur'
+DUREE_BAIL = 90           # secondes
+INTERVALLE_VEILLE = 30    # secondes entre deux tentatives d'acquisition
+
+# Tâches planifiées : identifiant -> fonction (module:nom), libellé, déclencheur APScheduler
+TACHES = {
+    'verif_statuts': {
+        'fonction': 'app:automatiser_statuts_audits',
+        'nom': "Vérification automatique des statuts d'audit",
+        'declencheur': {'trigger': 'interval', 'hours': 1},
+    },
+    'verif_echeances': {
+        'fonction': 'app:verifier_echeances_et_alertes',
+        'nom': 'Vérification des échéances et alertes',
+        'declencheur': {'trigger': 'cron', 'hour': 8, 'minute': 0},
+    },
+    'synchro_kri': {
+        'fonction': 'utils:synchroniser_kri_automatique',
+        'nom': 'Synchronisation des états et alertes KRI',
+        'declencheur': {'trigger': 'interval', 'hours': 1},
+    },
+    'previsions_kri': {
+        'fonction': 'services.prevision_kri:actualiser',
+        'nom': 'Prévisions KRI et alertes précoces',
+        'declencheur': {'trigger': 'interval', 'hours': 1},
+    },
+    'resume_emails': {
+        'fonction': 'services.emails_sortants:preparer_resumes',
+        'nom': 'Résumés email des notifications',
+        'declencheur': {'trigger': 'cron', 'hour': 7, 'minute': 0},
+    },
+}
+
+_verrou_actif = None
+
+
+def identifiant_processus():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# ========================
+# VERROU DE LEADER
+# ========================
+
+class VerrouLeader:
+    """Verrou exclusif entre les processus worker.py"""
+
+    def __init__(self, app, nom=NOM_VERROU, duree=DUREE_BAIL):
+        self.app = app
+        self.nom = nom
+        self.duree = duree
+        self.detenteur = identifiant_processus()
+        self.detenu = False
+        self._connexion = None
+
+    @property
+    def _db(self):
+        from models import db
+        return db
+
+    def _consultatif(self):
+        return self._db.engine.dialect.name == 'postgresql'
+
+    def acquerir(self):
+        """Tente de devenir leader (ou renouvelle le bail). Retourne True si détenu."""
+        with self.app.app_context():
+            if self._consultatif():
+                self.detenu = self._acquerir_consultatif()
+            else:
+                self.detenu = self._acquerir_bail()
+        return self.detenu
+
+    def renouveler(self):
+        """Vérifie/prolonge la détention ; False si le verrou a été perdu"""
+        if not self.detenu:
+            return False
+        try:
+            with self.app.app_context():
+                if self._consultatif():
+                    self._connexion.execute(text('SELECT 1'))
+                    return True
+                self.detenu = self._acquerir_bail()
+        except Exception as e:
+            print(f"⚠️ Renouvellement du verrou {self.nom} impossible: {e}")
+            self._fermer_connexion()
+            self.detenu = False
+        return self.detenu
+
+    def liberer(self):
+        if not self.detenu:
+            return
+        try:
+            with self.app.app_context():
+                if self._consultatif():
+                    self._connexion.execute(text('SELECT pg_advisory_unlock(:cle)'), {'cle': self._cle()})
+                    self._connexion.close()
+                    self._connexion = None
+                else:
+                    from models import VerrouTache
+                    VerrouTache.query.filter_by(nom=self.nom, detenteur=self.detenteur).delete()
+                    self._db.session.commit()
+        except Exception as e:
+            print(f"⚠️ Libération du verrou {self.nom} impossible: {e}")
+        self.detenu = False
+
+    # --- PostgreSQL ---
+
+    def _cle(self):
+        return zlib.crc32(f'fkci:{self.nom}'.encode('utf-8'))
+
+    def _acquerir_consultatif(self):
+        if self._connexion is not None and self.detenu:
+            return True
+        try:
+            if self._connexion is None:
+                # Connexion hors pool de session : le verrou vit aussi longtemps qu'elle
+                self._connexion = self._db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            return bool(self._connexion.execute(
+                text('SELECT pg_try_advisory_lock(:cle)'), {'cle': self._cle()}
+            ).scalar())
+        except Exception as e:
+            print(f"⚠️ Acquisition du verrou {self.nom} impossible: {e}")
+            self._fermer_connexion()
+            return False
+
+    def _fermer_connexion(self):
+        """Abandonne la connexion du verrou consultatif (le verrou tombe avec elle)"""
+        if self._connexion is None:
+            return
+        try:
+            self._connexion.close()
+        except Exception:
+            pass
+        self._connexion = None
+
+    # --- Bail (SQLite et autres) ---
+
+    def _acquerir_bail(self):
+        from models import VerrouTache
+
+        session = self._db.session
+        maintenant = datetime.utcnow()
+        expiration = maintenant + timedelta(seconds=self.duree)
+        try:
+            # Prolongation (ou reprise d'un bail expiré) en une seule requête conditionnelle
+            pris = VerrouTache.query.filter(
+                VerrouTache.nom == self.nom,
+                (VerrouTache.detenteur == self.detenteur) | (VerrouTache.expire_le < maintenant)
+            ).update({'detenteur': self.detenteur, 'expire_le': expiration}, synchronize_session=False)
+            if not pris:
+                session.add(VerrouTache(nom=self.nom, detenteur=self.detenteur,
+                                        acquis_le=maintenant, expire_le=expiration))
+            session.commit()
+            return True
+        except IntegrityError:
+            # Un autre processus détient un bail valide
+            session.rollback()
+            return False
+
+
+# ========================
+# EXÉCUTION DES TÂCHES
+# ========================
+
+def _resoudre_fonction(reference):
+    module, nom = reference.split(':')
+    return getattr(importlib.import_module(module), nom)
+
+
+def _application():
+    from app import app
+    return app
+
+
+def executer_tache(tache_id, forcer=False):
+    """
+    Exécute une tâche et l'enregistre dans l'historique.
+
+    Sans `forcer`, la tâche n'est exécutée que si ce processus est leader :
+    - dans le planificateur, il doit détenir le verrou du worker (protection si
+      un job est déclenché juste après la perte du verrou) ;
+    - hors planificateur (script cron, worker.py --executer), le verrou est
+      pris le temps de l'exécution : la tâche est ignorée si un worker leader
+      tourne déjà, elle ne peut pas s'exécuter en même temps que lui.
+    `forcer` (demande manuelle explicite : option --forcer) passe outre le verrou.
+    """
+    if forcer or _verrou_actif is not None:
+        return _executer_tache(tache_id, None if forcer else _verrou_actif)
+
+    verrou = VerrouLeader(_application())
+    verrou.acquerir()
+    try:
+        return _executer_tache(tache_id, verrou)
+    finally:
+        verrou.liberer()
+
+
+def _executer_tache(tache_id, verrou):
+    """verrou None : exécution forcée ; sinon la tâche est ignorée si le verrou n'est pas détenu"""
+    from models import db, ExecutionTache
+
+    app = _application()
+    definition = TACHES[tache_id]
+
+    with app.app_context():
+        execution = ExecutionTache(tache=tache_id, detenteur=identifiant_processus(),
+                                   debut=datetime.utcnow())
+
+        if verrou is not None and not verrou.detenu:
+            execution.statut = 'ignoree'
+            execution.fin = execution.debut
+            execution.erreur = 'Processus non leader'
+            db.session.add(execution)
+            db.session.commit()
+            print(f"⏭️ Tâche {tache_id} ignorée : processus non leader")
+            return None
+
+        db.session.add(execution)
+        db.session.commit()
+        execution_id = execution.id
+
+        print(f"▶️ Tâche {tache_id} : {definition['nom']}")
+        depart = time.monotonic()
+        statut, resultat, erreur = 'succes', None, None
+        try:
+            resultat = _resoudre_fonction(definition['fonction'])()
+        except Exception as e:
+            db.session.rollback()
+            statut, erreur = 'echec', str(e)
+            import traceback
+            traceback.print_exc()
+
+        execution = db.session.get(ExecutionTache, execution_id)
+        execution.statut = statut
+        execution.fin = datetime.utcnow()
+        execution.duree_ms = int((time.monotonic() - depart) * 1000)
+        execution.resultat = resultat if isinstance(resultat, (dict, list)) else None
+        execution.erreur = erreur
+        db.session.commit()
+
+        icone = '✅' if statut == 'succes' else '❌'
+        print(f"{icone} Tâche {tache_id} terminée ({statut}, {execution.duree_ms} ms)")
+        return resultat
+
+
+def historique_taches(tache_id=None, limite=20):
+    """Dernières exécutions (la plus récente en premier)"""
+    from models import ExecutionTache
+
+    requete = ExecutionTache.query
+    if tache_id:
+        requete = requete.filter_by(tache=tache_id)
+    return requete.order_by(ExecutionTache.debut.desc(), ExecutionTache.id.desc()).limit(limite).all()
+
+
+# ========================
+# PLANIFICATEUR
+# ========================
+
+def _creer_planificateur(app):
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from models import db
+
+    with app.app_context():
+        moteur = db.engine
+
+    return BackgroundScheduler(
+        jobstores={'default': SQLAlchemyJobStore(engine=moteur, tablename='apscheduler_jobs')},
+        job_defaults={
+            'coalesce': True,             # une seule exécution de rattrapage après un arrêt
+            'max_instances': 1,
+            'misfire_grace_time': 3600,
+        },
+    )
+
+
+def _synchroniser_taches(planificateur):
+    """Enregistre les tâches de TACHES en conservant l'état persistant des tâches inchangées"""
+    for tache_id, definition in TACHES.items():
+        existante = planificateur.get_job(tache_id)
+        parametres = dict(definition['declencheur'])
+        declencheur = parametres.pop('trigger')
+
+        if existante is not None:
+            nouvelle = planificateur._create_trigger(declencheur, parametres)
+            if str(nouvelle) == str(existante.trigger) and existante.args == (tache_id,):
+                continue
+
+        planificateur.add_job(
+            'services.taches_planifiees:executer_tache',
+            trigger=declencheur,
+            args=[tache_id],
+            id=tache_id,
+            name=definition['nom'],
+            replace_existing=True,
+            **parametres
+        )
+
+    for job in planificateur.get_jobs():
+        if job.id not in TACHES:
+            planificateur.remove_job(job.id)
+
+
+def executer_planificateur(app, duree_bail=DUREE_BAIL, intervalle_veille=INTERVALLE_VEILLE):
+    """
+    Boucle principale du worker : attend le verrou, planifie les tâches,
+    renouvelle le bail et s'arrête proprement sur SIGTERM/SIGINT.
+    """
+    global _verrou_actif
+
+    verrou = VerrouLeader(app, duree=duree_bail)
+    arret = threading.Event()
+
+    def arreter(signum, frame):
+        print(f"🛑 Signal {signum} reçu, arrêt du worker...")
+        arret.set()
+
+    signal.signal(signal.SIGTERM, arreter)
+    signal.signal(signal.SIGINT, arreter)
+
+    print(f"🤖 Worker {verrou.detenteur} démarré")
+    while not arret.is_set():
+        if not verrou.acquerir():
+            print(f"⏳ Verrou '{verrou.nom}' détenu par un autre worker, mise en veille")
+            arret.wait(intervalle_veille)
+            continue
+
+        print(f"👑 Worker {verrou.detenteur} leader des tâches planifiées")
+        _verrou_actif = verrou
+        planificateur = _creer_planificateur(app)
+        planificateur.start(paused=True)
+        _synchroniser_taches(planificateur)
+        planificateur.resume()
+        for job in planificateur.get_jobs():
+            print(f"   📅 {job.id}: prochaine exécution {job.next_run_time}")
+
+        # Renouvellement du bail jusqu'à l'arrêt ou la perte du verrou
+        while not arret.wait(duree_bail / 3):
+            if not verrou.renouveler():
+                print("⚠️ Verrou perdu, arrêt des tâches planifiées")
+                break
+
+        planificateur.shutdown(wait=True)
+        _verrou_actif = None
+
+    verrou.liberer()
+    print("👋 Worker arrêté")
@@ -0,0 +1,106 @@
+# test_cache_tableau_bord.py
+"""
+Isolation multi-tenant du cache et des exports des tableaux de bord.
+
+Base SQLite temporaire (DATABASE_URL) : lancer avec `python -m pytest test_cache_tableau_bord.py`
+ou directement `python test_cache_tableau_bord.py`.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+_BASE = os.path.join(tempfile.mkdtemp(prefix='fkci-test-'), 'test.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_BASE}'
+
+from app import app  # noqa: E402
+from models import db, Client, User, Risque  # noqa: E402
+from services.cache_tableau_bord import cache_tableau_bord  # noqa: E402
+
+
+_DONNEES = {}
+
+
+def _creer_donnees():
+    """Client A (2 risques), client B (3 risques), un super admin et un utilisateur de A"""
+    if _DONNEES:
+        return _DONNEES['ids']
+    with app.app_context():
+        client_a = Client(nom='Client A', reference='TEST-A')
+        client_b = Client(nom='Client B', reference='TEST-B')
+        db.session.add_all([client_a, client_b])
+        db.session.flush()
+
+        for client, nombre in ((client_a, 2), (client_b, 3)):
+            for i in range(nombre):
+                db.session.add(Risque(reference=f'{client.reference}-R{i}', intitule=f'Risque {i}',
+                                      client_id=client.id, is_archived=False))
+
+        super_admin = User(username='test_super_admin', email='sa@test.local', role='super_admin')
+        utilisateur = User(username='test_utilisateur_a', email='a@test.local', role='utilisateur',
+                           client_id=client_a.id)
+        for user in (super_admin, utilisateur):
+            user.set_password('motdepasse')
+            user.is_active = True
+        db.session.add_all([super_admin, utilisateur])
+        db.session.commit()
+        _DONNEES['ids'] = (client_a.id, super_admin.id, utilisateur.id)
+        return _DONNEES['ids']
+
+
+def _connecter(client_http, user_id, viewing_client_id=None):
+    with client_http.session_transaction() as sess:
+        sess.clear()
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+        if viewing_client_id is not None:
+            sess['viewing_client_id'] = viewing_client_id
+
+
+def test_super_admin_visualisant_un_client_ne_pollue_pas_son_cache():
+    client_a_id, super_admin_id, utilisateur_id = _creer_donnees()
+    cache_tableau_bord.vider()
+
+    with app.test_client() as client_http:
+        # Le super admin visualise le client A : ses compteurs (non filtrés) ne
+        # doivent pas être rangés sous la portée du client A
+        _connecter(client_http, super_admin_id, viewing_client_id=client_a_id)
+        assert client_http.get('/').status_code == 200
+
+        _connecter(client_http, utilisateur_id)
+        assert client_http.get('/').status_code == 200
+
+    with app.app_context():
+        compteurs = cache_tableau_bord.obtenir('dashboard_compteurs', client_a_id, lambda: None)
+        assert compteurs is not None
+        assert compteurs['total_risques'] == 2
+
+
+def _risques_actifs(reponse):
+    for ligne in reponse.get_data(as_text=True).splitlines():
+        if ligne.startswith('"Risques Actifs"'):
+            return int(ligne.split(';')[1].strip('"'))
+    raise AssertionError("Ligne 'Risques Actifs' absente de l'export")
+
+
+def test_export_tableau_de_bord_restreint_au_client():
+    client_a_id, super_admin_id, utilisateur_id = _creer_donnees()
+
+    with app.test_client() as client_http:
+        # Rendu en arrière-plan du rapport 'dashboard_pdf' : client passé en paramètre
+        _connecter(client_http, super_admin_id)
+        assert _risques_actifs(client_http.get(f'/export/dashboard/csv?client_id={client_a_id}')) == 2
+        assert _risques_actifs(client_http.get('/export/dashboard/csv')) == 5
+
+        # Un utilisateur ne peut pas élargir son périmètre ni demander la vue globale
+        _connecter(client_http, utilisateur_id)
+        assert _risques_actifs(client_http.get('/export/dashboard/csv?client_id=0')) == 2
+        reponse = client_http.get('/rapports/dashboard_pdf/0', headers={'Accept': 'application/json'})
+        assert reponse.status_code == 403
+
+
+if __name__ == '__main__':
+    test_super_admin_visualisant_un_client_ne_pollue_pas_son_cache()
+    test_export_tableau_de_bord_restreint_au_client()
+    print("✅ Cache et exports des tableaux de bord isolés par client")
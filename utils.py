@@ -1,12 +1,22 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+import logging
 import numpy as np
 from io import BytesIO
 import base64
 from datetime import datetime, timedelta
 
+logger = logging.getLogger(__name__)
+
+def _pyplot():
+    """Import paresseux de matplotlib : réservé aux exports hors ligne (PDF/PNG).
+
+    L'affichage web utilise services/matrice_risques.py (SVG/JSON en cache).
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+    return plt, patches
+
 def calculer_niveau_risque(impact, probabilite):
     """Calculer le niveau de risque basé sur la matrice des risques - VERSION SYNCHRONISÉE"""
     score = impact * probabilite
@@ -35,6 +45,7 @@ def get_couleur_risque(score):
 
 def generer_matrice_risques(evaluations, matrice_type='classique'):
     """Générer différentes matrices de risques avec positionnement CORRECT - VERSION CORRIGÉE"""
+    plt, patches = _pyplot()
     fig, ax = plt.subplots(figsize=(14, 12))
     
     # Configuration de la matrice 5x5
@@ -62,8 +73,6 @@ def generer_matrice_risques(evaluations, matrice_type='classique'):
     evaluations_valides = []
     risques_non_evalues = []
     
-    print(f"🎯 Traitement de {len(evaluations)} évaluations pour la matrice {matrice_type}")
-    
     for idx, evaluation in enumerate(evaluations):
         # Utiliser les valeurs finales selon la priorité
         impact = (evaluation.impact_conf or 
@@ -108,13 +117,10 @@ def generer_matrice_risques(evaluations, matrice_type='classique'):
             
             risques_par_position[position_key].append(risque_data)
             evaluations_valides.append(evaluation)
-            
-            print(f"📍 Risque positionné CORRECT: {evaluation.risque.reference} à P{probabilite}/I{impact} -> Case [{x}, {y}] -> Score: {score_calcule}")
         else:
-            print(f"⚠️ Évaluation ignorée: {evaluation.risque.reference}")
             risques_non_evalues.append(evaluation.risque)
     
-    print(f"🔍 Matrice {matrice_type}: {len(evaluations_valides)} évaluations valides")
+    logger.debug("Matrice %s: %d évaluations valides", matrice_type, len(evaluations_valides))
     
     # Couleurs pour les différents risques
     colors = ['blue', 'purple', 'darkred', 'darkgreen', 'darkorange', 'darkcyan', 'brown', 'pink', 'navy', 'teal']
@@ -141,8 +147,6 @@ def generer_matrice_risques(evaluations, matrice_type='classique'):
             
         else:
             # Cas multiple : plusieurs risques à la même position
-            print(f"🔄 {len(risques_list)} risques à position {position_key}")
-            
             # Position centrale de la case
             x_centre = float(position_key.split('_')[0]) + 0.5
             y_centre = float(position_key.split('_')[1]) + 0.5
@@ -277,6 +281,7 @@ def diagnostiquer_evaluations_manquantes(cartographie_id):
 
 def generer_matrice_risque_specifique(evaluations, risque_surbrillance=None):
     """Générer une matrice avec un risque spécifique en surbrillance - VERSION LÉGENDES CORRIGÉE"""
+    plt, patches = _pyplot()
     fig, ax = plt.subplots(figsize=(14, 12))
     
     # Configuration de la matrice 5x5
@@ -797,8 +802,9 @@ def generer_organigramme_svg(processus):
 
 def mettre_a_jour_statistiques_cartographie(cartographie_id):
     """Mettre à jour les statistiques d'une cartographie - Version complète corrigée"""
-    from models import Cartographie, Risque, EvaluationRisque, db
-    from sqlalchemy import func, and_
+    from models import Cartographie, Risque, RisqueEvaluationCourante, db
+    from services.evaluation_courante import requete_evaluations_courantes
+    from sqlalchemy import func
     from datetime import datetime
     
     cartographie = Cartographie.query.get(cartographie_id)
@@ -815,49 +821,20 @@ def mettre_a_jour_statistiques_cartographie(cartographie_id):
             is_archived=False
         ).count()
         
-        # 2. Compter les risques évalués
-        risques_evalues = db.session.query(Risque)\
-            .join(EvaluationRisque)\
-            .filter(
-                Risque.cartographie_id == cartographie_id,
-                Risque.is_archived == False
-            )\
-            .distinct()\
-            .count()
-        
-        # 3. Calculer le score moyen
-        # Sous-requête pour les dernières évaluations
-        derniere_eval_subquery = db.session.query(
-            EvaluationRisque.risque_id,
-            func.max(EvaluationRisque.created_at).label('max_date')
-        ).group_by(EvaluationRisque.risque_id).subquery()
-        
-        score_moyen = db.session.query(func.avg(EvaluationRisque.score_risque))\
-            .join(derniere_eval_subquery, and_(
-                EvaluationRisque.risque_id == derniere_eval_subquery.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subquery.c.max_date
-            ))\
-            .join(Risque, EvaluationRisque.risque_id == Risque.id)\
-            .filter(
-                Risque.cartographie_id == cartographie_id,
-                Risque.is_archived == False
-            )\
-            .scalar()
-        
-        # 4. Compter les risques par niveau
-        niveaux_risques = db.session.query(
-            EvaluationRisque.niveau_risque,
-            func.count(EvaluationRisque.id)
-        ).join(derniere_eval_subquery, and_(
-            EvaluationRisque.risque_id == derniere_eval_subquery.c.risque_id,
-            EvaluationRisque.created_at == derniere_eval_subquery.c.max_date
-        ))\
-         .join(Risque, EvaluationRisque.risque_id == Risque.id)\
-         .filter(
-             Risque.cartographie_id == cartographie_id,
-             Risque.is_archived == False
-         )\
-         .group_by(EvaluationRisque.niveau_risque).all()
+        # 2-4. Risques évalués, score moyen et niveaux depuis la projection
+        # des évaluations courantes (une ligne par risque évalué)
+        courantes = requete_evaluations_courantes(
+            func.count(RisqueEvaluationCourante.risque_id),
+            func.avg(RisqueEvaluationCourante.score_risque)
+        ).filter(Risque.cartographie_id == cartographie_id)
+        risques_evalues, score_moyen = courantes.one()
+        
+        niveaux_risques = requete_evaluations_courantes(
+            RisqueEvaluationCourante.niveau_risque,
+            func.count(RisqueEvaluationCourante.risque_id)
+        ).filter(
+            Risque.cartographie_id == cartographie_id
+        ).group_by(RisqueEvaluationCourante.niveau_risque).all()
         
         # 5. Préparer les statistiques complètes
         statistiques = {
@@ -906,13 +883,14 @@ def mettre_a_jour_statistiques_cartographie(cartographie_id):
     
 def exporter_matrice_risques(evaluations, format='png'):
     """Exporter la matrice des risques dans différents formats"""
+    if format == 'svg':
+        from services.matrice_risques import construire_matrice, rendre_svg, svg_data_uri
+        return svg_data_uri(rendre_svg(construire_matrice(evaluations)))
+    
     matrice_image = generer_matrice_risques(evaluations)
     
     if format == 'png':
         return f"data:image/png;base64,{matrice_image}"
-    elif format == 'svg':
-        # Implémentation simplifiée pour SVG
-        return matrice_image  # Retourner l'image base64 pour l'instant
     else:
         return matrice_image
 
@@ -986,6 +964,7 @@ def analyser_tendances_risques(risques, periode_jours=90):
 
 def generer_heatmap_risques(cartographie):
     """Générer une heatmap des risques pour une cartographie"""
+    plt, _ = _pyplot()
     fig, ax = plt.subplots(figsize=(10, 8))
     
     # Préparer les données pour la heatmap
@@ -1057,6 +1036,7 @@ def calculer_indice_severite(risques):
 
 def generer_radar_chart_risques(cartographie):
     """Générer un radar chart des risques par catégorie"""
+    plt, _ = _pyplot()
     # Compter les risques par catégorie
     categories = {}
     for risque in cartographie.risques:
@@ -1555,11 +1535,17 @@ def recalculer_indicateurs_cartographie(cartographie_id):
     print(f"📊 Indicateurs recalculés pour {cartographie.nom}")
 
 def invalider_cache_cartographie(cartographie_id):
-    """Invalide le cache pour forcer le recalcul des vues"""
-    # Implémentation simple - vous pouvez utiliser Redis ou un cache mémoire
-    cache_key = f"cartographie_{cartographie_id}_stats"
-    # Supprimer le cache si existant
-    print(f"🗑️ Cache invalidé pour cartographie {cartographie_id}")
+    """Invalide le cache (agrégats et matrices) d'une cartographie et de son client"""
+    from models import Cartographie, db
+    from services.cache_tableau_bord import cache_tableau_bord
+    
+    try:
+        client_id = db.session.query(Cartographie.client_id).filter_by(id=cartographie_id).scalar()
+        cache_tableau_bord.invalider_cartographie(cartographie_id, client_id=client_id)
+        print(f"🗑️ Cache invalidé pour cartographie {cartographie_id}")
+        
+    except Exception as e:
+        print(f"⚠️ Erreur invalidation cache: {str(e)}")
 
 def generer_alerte_creation_risque(risque, user_id):
     """Générer une alerte lors de la création d'un risque"""
@@ -1653,8 +1639,17 @@ def nettoyer_donnees_orphelines():
     print("🧹 Nettoyage données orphelines")
 
 def invalider_cache_cartographie(cartographie_id):
-    """Invalider le cache d'une cartographie"""
-    print(f"🗑️ Cache invalidé pour cartographie {cartographie_id}")
+    """Invalide le cache (agrégats et matrices) d'une cartographie et de son client"""
+    from models import Cartographie, db
+    from services.cache_tableau_bord import cache_tableau_bord
+    
+    try:
+        client_id = db.session.query(Cartographie.client_id).filter_by(id=cartographie_id).scalar()
+        cache_tableau_bord.invalider_cartographie(cartographie_id, client_id=client_id)
+        print(f"🗑️ Cache invalidé pour cartographie {cartographie_id}")
+        
+    except Exception as e:
+        print(f"⚠️ Erreur invalidation cache: {str(e)}")
 
 def synchroniser_cartographie_complete(cartographie_id):
     """Synchronise complètement une cartographie après modification"""
@@ -1946,12 +1941,13 @@ def recalculer_indicateurs_cartographie(cartographie_id):
 
 
 def invalider_cache_cartographie(cartographie_id):
-    """Invalide le cache pour une cartographie spécifique"""
+    """Invalide le cache (agrégats et matrices) d'une cartographie et de son client"""
+    from models import Cartographie, db
+    from services.cache_tableau_bord import cache_tableau_bord
+    
     try:
-        # Vous pouvez implémenter ici votre logique de cache
-        # Par exemple, supprimer des fichiers ou vider des clés Redis
-        
-        # Pour l'instant, juste un log
+        client_id = db.session.query(Cartographie.client_id).filter_by(id=cartographie_id).scalar()
+        cache_tableau_bord.invalider_cartographie(cartographie_id, client_id=client_id)
         print(f"🗑️ Cache invalidé pour cartographie {cartographie_id}")
         
     except Exception as e:
@@ -2353,8 +2349,11 @@ def get_niveau_risque_matrice(score):
         return {'nom': 'Critique', 'couleur': 'critique', 'classe': 'matrice-connectee-critique'}
 
 def calculer_statistiques_kri(kri):
-    """Calcule les statistiques détaillées d'un KRI"""
-    if not kri.mesures:
+    """Calcule les statistiques détaillées d'un KRI (agrégats, sans relire les mesures)"""
+    from services.series_kri import serie, statistiques
+
+    stats = statistiques(kri.id)
+    if not stats:
         return {
             'moyenne': 0,
             'min': 0,
@@ -2364,25 +2363,19 @@ def calculer_statistiques_kri(kri):
             'ecart_type': 0
         }
     
-    valeurs = [m.valeur for m in kri.mesures]
-    dates = [m.date_mesure for m in kri.mesures]
+    # Tendance sur la série sous-échantillonnée (mesures brutes si peu nombreuses)
+    points = serie(kri.id)
     
-    # Trier par date
-    mesures_triees = sorted(zip(dates, valeurs), key=lambda x: x[0])
-    valeurs_triees = [v for d, v in mesures_triees]
-    
-    stats = {
-        'moyenne': round(np.mean(valeurs), 2),
-        'min': round(min(valeurs), 2),
-        'max': round(max(valeurs), 2),
-        'derniere_valeur': valeurs_triees[-1] if valeurs_triees else 0,
-        'ecart_type': round(np.std(valeurs), 2) if len(valeurs) > 1 else 0,
-        'tendance': calculer_tendance_kri_detaille(valeurs_triees),
-        'nb_mesures': len(valeurs),
-        'periode_couverte': (max(dates) - min(dates)).days if len(dates) > 1 else 0
+    return {
+        'moyenne': round(stats['moyenne'], 2),
+        'min': round(stats['min'], 2),
+        'max': round(stats['max'], 2),
+        'derniere_valeur': stats['derniere_valeur'],
+        'ecart_type': round(stats['ecart_type'], 2) if stats['nb_mesures'] > 1 else 0,
+        'tendance': calculer_tendance_kri_detaille(points['valeurs'].tolist()),
+        'nb_mesures': stats['nb_mesures'],
+        'periode_couverte': stats['periode_couverte']
     }
-    
-    return stats
 
 def calculer_tendance_kri_detaille(valeurs):
     """Calcule la tendance détaillée d'un KRI"""
@@ -2408,18 +2401,25 @@ def calculer_tendance_kri_detaille(valeurs):
         return 'stable'
 
 def generer_graphique_kri(kri):
-    """Génère un graphique d'évolution du KRI"""
-    if not kri.mesures:
+    """Génère un graphique d'évolution du KRI (série sous-échantillonnée sur les longues périodes)"""
+    from services.series_kri import serie
+
+    points = serie(kri.id)
+    if not len(points['valeurs']):
         return None
     
-    mesures_triees = sorted(kri.mesures, key=lambda x: x.date_mesure)
-    dates = [m.date_mesure.strftime('%d/%m/%Y') for m in mesures_triees]
-    valeurs = [m.valeur for m in mesures_triees]
+    plt, _ = _pyplot()
+    dates = [d.strftime('%d/%m/%Y') for d in points['dates'].astype('datetime64[s]').tolist()]
+    valeurs = points['valeurs']
     
     fig, ax = plt.subplots(figsize=(10, 6))
     
-    # Courbe principale
-    ax.plot(dates, valeurs, 'b-', linewidth=2, marker='o', markersize=4, label='Valeur KRI')
+    # Courbe principale (moyenne par période et plage min-max si agrégée)
+    if points['granularite'] == 'brut':
+        ax.plot(dates, valeurs, 'b-', linewidth=2, marker='o', markersize=4, label='Valeur KRI')
+    else:
+        ax.plot(dates, valeurs, 'b-', linewidth=2, label=f"Moyenne par {points['granularite']}")
+        ax.fill_between(dates, points['minimums'], points['maximums'], color='b', alpha=0.15, label='Min - max')
     
     # Seuils d'alerte
     if kri.seuil_alerte:
@@ -2452,34 +2452,21 @@ def generer_graphique_kri(kri):
     
     return graphic
 def synchroniser_kri_automatique():
-    """Synchronisation automatique des KRI"""
-    from models import KRI, MesureKRI, Risque, db
-    from datetime import datetime, timedelta
+    """Synchronisation automatique des KRI (états calculés par lots, voir services/analyse_kri.py)"""
+    from models import db
+    from services.analyse_kri import rafraichir, signaler_alertes
     
     print("🔄 SYNCHRONISATION AUTOMATIQUE DES KRI...")
     
     try:
-        kris = KRI.query.filter_by(est_actif=True).all()
-        kris_synchronises = 0
-        
-        for kri in kris:
-            # Vérifier si une synchronisation est nécessaire
-            besoin_sync = (
-                kri.derniere_sync is None or 
-                (datetime.utcnow() - kri.derniere_sync).total_seconds() > 3600  # 1 heure
-            )
-            
-            if besoin_sync:
-                # Mettre à jour la tendance
-                kri.tendance = calculer_tendance_kri(kri.mesures)
-                kri.derniere_sync = datetime.utcnow()
-                kris_synchronises += 1
-                
-                # Vérifier les alertes de seuil
-                verifier_alertes_kri(kri)
+        # Un seul calcul vectorisé pour tous les KRI actifs dont l'état est périmé (> 1 heure)
+        kris_synchronises = rafraichir()
+        
+        # Alertes des KRI entrés en alerte depuis le dernier signalement
+        nb_alertes = signaler_alertes()
         
         db.session.commit()
-        print(f"✅ {kris_synchronises}/{len(kris)} KRI synchronisés")
+        print(f"✅ {kris_synchronises} KRI synchronisés, {nb_alertes} alerte(s)")
         return True
         
     except Exception as e:
@@ -2488,47 +2475,16 @@ def synchroniser_kri_automatique():
         return False
 
 def verifier_alertes_kri(kri):
-    """Vérifier et créer des alertes pour les KRI dépassant les seuils"""
-    from models import Alerte, MesureKRI, db
-    
-    if not kri.mesures:
-        return
+    """Vérifier et créer des alertes pour un KRI dépassant ses seuils"""
+    from services.analyse_kri import rafraichir, signaler_alertes
     
-    derniere_mesure = MesureKRI.query.filter_by(kri_id=kri.id).order_by(MesureKRI.date_mesure.desc()).first()
-    if not derniere_mesure:
-        return
-    
-    valeur = derniere_mesure.valeur
-    
-    # Vérifier le seuil critique
-    if kri.seuil_critique and valeur >= kri.seuil_critique:
-        alerte = Alerte(
-            type='kri_critique',
-            gravite='haute',
-            titre=f"KRI {kri.nom} - Seuil critique dépassé",
-            description=f"Le KRI {kri.nom} a atteint la valeur {valeur}, dépassant le seuil critique de {kri.seuil_critique}",
-            entite_type='kri',
-            entite_id=kri.id,
-            created_by=1  # Système
-        )
-        db.session.add(alerte)
-    
-    # Vérifier le seuil d'alerte
-    elif kri.seuil_alerte and valeur >= kri.seuil_alerte:
-        alerte = Alerte(
-            type='kri_alerte', 
-            gravite='moyenne',
-            titre=f"KRI {kri.nom} - Seuil d'alerte dépassé",
-            description=f"Le KRI {kri.nom} a atteint la valeur {valeur}, dépassant le seuil d'alerte de {kri.seuil_alerte}",
-            entite_type='kri',
-            entite_id=kri.id,
-            created_by=1  # Système
-        )
-        db.session.add(alerte)
+    rafraichir([kri.id])
+    return signaler_alertes([kri.id])
 
 def synchroniser_kri_risque(risque_id):
     """Synchroniser les KRI d'un risque spécifique"""
     from models import KRI, Risque, db
+    from services.analyse_kri import recalculer
     
     risque = Risque.query.get(risque_id)
     if not risque:
@@ -2536,11 +2492,8 @@ def synchroniser_kri_risque(risque_id):
     
     kri = KRI.query.filter_by(risque_id=risque_id).first()
     if kri:
-        # Mettre à jour la tendance
-        kri.tendance = calculer_tendance_kri(kri.mesures)
-        kri.derniere_sync = datetime.utcnow()
-        
-        # Vérifier les alertes
+        # Recalculer l'état (tendance, seuils) puis vérifier les alertes
+        recalculer([kri.id])
         verifier_alertes_kri(kri)
         
         db.session.commit()
@@ -2581,30 +2534,15 @@ def invalider_cache_matrices(cartographie_id):
     
     print(f"🗑️ Invalidation du cache pour cartographie {cartographie_id}")
     
-    # Liste des clés de cache à invalider
-    cache_keys = [
-        f'matrice_classique_{cartographie_id}',
-        f'matrice_criticite_{cartographie_id}', 
-        f'matrice_priorisation_{cartographie_id}',
-        f'matrice_surbrillance_{cartographie_id}',
-        f'tableau_bordeaux_{cartographie_id}',
-        f'statistiques_{cartographie_id}',
-        f'indicateurs_{cartographie_id}'
-    ]
-    
-    # Implémentation de l'invalidation (adaptez selon votre système de cache)
-    for key in cache_keys:
-        # Si vous utilisez un cache Redis ou mémoire :
-        # cache.delete(key)
-        print(f"   🔸 Cache invalidé: {key}")
+    # Les matrices, statistiques et indicateurs sont indexés sur la génération
+    # de la cartographie : l'incrémenter rend toutes les entrées obsolètes
+    invalider_cache_cartographie(cartographie_id)
     
     # Forcer le recalcul au prochain affichage en mettant à jour le timestamp
     try:
         cartographie = Cartographie.query.get(cartographie_id)
         if cartographie:
             cartographie.derniere_sync_matrices = datetime.utcnow()
-            # Si vous avez un champ pour forcer le recalcul :
-            # cartographie.a_besoin_recalcul = True
             print(f"   🔸 Timestamp de synchronisation mis à jour")
     except Exception as e:
         print(f"   ⚠️ Erreur mise à jour timestamp: {e}")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Worker des tâches planifiées (automatisation des audits, échéances et alertes).
+
+Les workers web ne démarrent plus de scheduler : lancer ce processus à part
+(service « worker » de render.yaml). Plusieurs instances peuvent tourner,
+une seule exécute les tâches (verrou de leader, voir services/taches_planifiees.py).
+
+    python worker.py                        # boucle du planificateur
+    python worker.py --executer verif_statuts   # exécuter une tâche immédiatement (si aucun leader ne tourne)
+    python worker.py --executer verif_statuts --forcer   # même si un worker leader tourne
+    python worker.py --historique [--tache verif_echeances]
+    python worker.py --sans-analyses-ia     # sans les traiteurs de la file IA
+    python worker.py --sans-rapports        # sans le rendu des rapports en arrière-plan
+    python worker.py --sans-emails          # sans l'expédition de la boîte d'envoi
+    python worker.py --smtp-debug 1025      # serveur SMTP local qui affiche les emails reçus
+    python worker.py --reindexer-recherche  # reconstruire l'index de recherche plein texte
+    python worker.py --importer-mesures mesures.csv [--client 3]   # import groupé de mesures KRI
+
+Chaque instance fait aussi tourner IA_TRAITEURS traiteurs de la file des
+analyses IA (services/file_analyse_ia.py), RAPPORTS_PROCESSUS processus de
+rendu des rapports (services/rapports_generes.py) et EMAILS_TRAITEURS
+traiteurs de la boîte d'envoi (services/emails_sortants.py), leader ou non.
+"""
+
+import os
+import sys
+
+# Ajoutez le chemin du projet
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    """Point d'entrée principal"""
+    import argparse
+    from services.taches_planifiees import TACHES
+
+    parser = argparse.ArgumentParser(description='Worker des tâches planifiées')
+    parser.add_argument('--executer', choices=sorted(TACHES), help='Exécuter une tâche immédiatement')
+    parser.add_argument('--forcer', action='store_true',
+                        help="Avec --executer : ne pas prendre le verrou de leader (même si un worker tourne)")
+    parser.add_argument('--historique', action='store_true', help='Afficher les dernières exécutions')
+    parser.add_argument('--tache', choices=sorted(TACHES), help="Filtrer l'historique par tâche")
+    parser.add_argument('--limite', type=int, default=20, help="Nombre de lignes d'historique")
+    parser.add_argument('--sans-analyses-ia', action='store_true', help="Ne pas traiter la file des analyses IA")
+    parser.add_argument('--sans-rapports', action='store_true', help="Ne pas rendre les rapports en arrière-plan")
+    parser.add_argument('--sans-emails', action='store_true', help="Ne pas expédier la boîte d'envoi")
+    parser.add_argument('--reindexer-recherche', action='store_true',
+                        help="Reconstruire l'index de recherche plein texte puis quitter")
+    parser.add_argument('--importer-mesures', metavar='FICHIER',
+                        help="Importer des mesures KRI (CSV, XLSX ou JSON) puis quitter")
+    parser.add_argument('--client', type=int, help="Client des indicateurs importés (défaut : tous)")
+    parser.add_argument('--smtp-debug', type=int, metavar='PORT',
+                        help="Serveur SMTP de débogage : affiche les emails reçus sans les transmettre")
+    args = parser.parse_args()
+
+    if args.smtp_debug:
+        from services.emails_sortants import ServeurSMTPDebug
+        print(f"📧 Serveur SMTP de débogage sur localhost:{args.smtp_debug} (Ctrl+C pour arrêter)")
+        print(f"   MAIL_SERVER=localhost MAIL_PORT={args.smtp_debug} MAIL_USE_TLS=false MAIL_USERNAME=")
+        serveur = ServeurSMTPDebug(port=args.smtp_debug, afficher=True)
+        try:
+            serveur.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            serveur.server_close()
+        return
+
+    try:
+        from app import app
+    except ImportError as e:
+        print(f"❌ Impossible d'importer l'application Flask: {e}")
+        print("Assurez-vous d'être dans le bon répertoire")
+        sys.exit(1)
+
+    from services.taches_planifiees import executer_planificateur, executer_tache, historique_taches
+
+    if args.executer:
+        executer_tache(args.executer, forcer=args.forcer)
+    elif args.reindexer_recherche:
+        from services.recherche import reindexer
+        with app.app_context():
+            print(f"🔎 {reindexer()} document(s) indexé(s)")
+    elif args.importer_mesures:
+        from services.import_mesures_kri import ErreurImport, importer, lire_fichier
+        with app.app_context(), open(args.importer_mesures, 'rb') as flux:
+            try:
+                rapport = importer(lire_fichier(flux, args.importer_mesures), client_id=args.client,
+                                   tous_clients=args.client is None)
+            except ErreurImport as e:
+                print(f"❌ {e}")
+                sys.exit(1)
+        for erreur in rapport['erreurs']:
+            print(f"   ligne {erreur['ligne']}: {erreur['erreur']}")
+        print(f"📥 {rapport['total']} ligne(s) : {rapport['inserees']} insérée(s), {rapport['mises_a_jour']} mise(s) à jour, "
+              f"{rapport['inchangees']} inchangée(s), {rapport['nb_erreurs']} erreur(s), {rapport['alertes']} alerte(s)")
+        sys.exit(1 if rapport['nb_erreurs'] else 0)
+    elif args.historique:
+        with app.app_context():
+            for execution in historique_taches(args.tache, args.limite):
+                duree = f"{execution.duree_ms} ms" if execution.duree_ms is not None else '-'
+                print(f"{execution.debut:%Y-%m-%d %H:%M:%S}  {execution.tache:<16} {execution.statut:<9} "
+                      f"{duree:>10}  {execution.detenteur or ''}  {execution.erreur or ''}")
+    else:
+        traiteurs = []
+        if not args.sans_analyses_ia:
+            from services.file_analyse_ia import TraiteurAnalysesIA
+            traiteurs.append(TraiteurAnalysesIA(app).demarrer())
+        if not args.sans_rapports:
+            from services.rapports_generes import TraiteurRapports
+            traiteurs.append(TraiteurRapports(app).demarrer())
+        if not args.sans_emails:
+            from services.emails_sortants import TraiteurEmails
+            traiteurs.append(TraiteurEmails(app).demarrer())
+        try:
+            executer_planificateur(app)
+        finally:
+            for traiteur in traiteurs:
+                traiteur.arreter()
+
+
+if __name__ == "__main__":
+    main()